@@ -0,0 +1,214 @@
+"""Compares summarizer work of the halve-and-rewrite and the hierarchical history compactions.
+
+A long chat is replayed against DefaultMessageService with an in-memory stand-in of the db
+session; the history is shortened whenever it doesn't fit into the context, like the chat
+processor does. The summarizer only counts the tokens it's given.
+
+Run with: python benchmarks/history_summaries.py [--turns 1000] [--max-context-tokens 6000]
+"""
+
+import argparse
+import asyncio
+import random
+from unittest.mock import MagicMock
+
+from uuid_utils.compat import uuid7
+
+from aerith_cbot.config import LimitsConfig
+from aerith_cbot.database.models import Message, MessageLevel
+from aerith_cbot.services.abstractions import HistorySummarizer
+from aerith_cbot.services.implementations import (
+    DefaultMessageService,
+    HistoryValidator,
+    ImageDescriber,
+    TokenEstimator,
+)
+
+WORDS = [
+    "привет",
+    "как",
+    "дела",
+    "что",
+    "нового",
+    "вчера",
+    "смотрели",
+    "фильм",
+    "было",
+    "интересно",
+    "а",
+    "ты",
+]
+# a summary is about a quarter of what it summarizes, but not longer than that
+SUMMARY_RATIO = 0.25
+MAX_SUMMARY_TOKENS = 400
+
+
+class InMemorySession:
+    """Just enough of AsyncSession for DefaultMessageService"""
+
+    def __init__(self) -> None:
+        self.rows: dict = {}
+        self.written_rows = 0
+
+    def add(self, message: Message) -> None:
+        # what the db does on insert
+        message.id = uuid7()
+        if message.level is None:
+            message.level = MessageLevel.raw
+
+        self.rows[message.id] = message
+        self.written_rows += 1
+
+    def add_all(self, messages: list[Message]) -> None:
+        for message in messages:
+            self.add(message)
+
+    async def execute(self, stmt):
+        params = stmt.compile().params
+
+        if stmt.is_select:
+            # a single instance has no one to wait for on the history lock
+            if "pg_advisory_xact_lock_1" in params:
+                return _Result([])
+
+            rows = sorted(self.rows.values(), key=lambda row: (-row.level, row.id))
+            # the rows about to be rewritten, read again to check they haven't changed
+            if "id_1" in params:
+                rows = [row for row in rows if row.id in params["id_1"]]
+
+            return _Result(rows)
+
+        if stmt.is_update:
+            row = self.rows[params["id_1"]]
+            row.data = params["data"]
+            if "level" in params:
+                row.level = params["level"]
+            self.written_rows += 1
+        elif stmt.is_delete:
+            for message_id in params["id_1"]:
+                del self.rows[message_id]
+            self.written_rows += len(params["id_1"])
+
+    async def commit(self) -> None:
+        pass
+
+
+class _Result:
+    def __init__(self, rows: list[Message]) -> None:
+        self._rows = rows
+
+    def scalars(self) -> list[Message]:
+        return self._rows
+
+    def all(self) -> list[tuple]:
+        return [(row.id, row.level, row.data) for row in self._rows]
+
+
+class CountingSummarizer(HistorySummarizer):
+    def __init__(self, token_estimator: TokenEstimator) -> None:
+        self._token_estimator = token_estimator
+
+        self.calls = 0
+        self.input_tokens = 0
+        # how many times the oldest facts have been summarized, which is how much they drift
+        self._depths: dict[str, int] = {}
+        self.max_depth = 0
+
+    async def summarize(self, messages_to_summarize: list[dict]) -> str:
+        tokens = self._token_estimator.estimate(messages_to_summarize)
+
+        self.calls += 1
+        self.input_tokens += tokens
+
+        depth = 1 + max(self._depths.get(m["content"], 0) for m in messages_to_summarize)
+        self.max_depth = max(self.max_depth, depth)
+
+        summary_tokens = min(int(tokens * SUMMARY_RATIO), MAX_SUMMARY_TOKENS)
+        summary = " ".join(random.choices(WORDS, k=summary_tokens))
+        self._depths[summary] = depth
+
+        return summary
+
+
+def make_limits_config(compaction: str, max_context_tokens: int) -> LimitsConfig:
+    return LimitsConfig(
+        group_cooldown=0,
+        group_generic_tokens_limit=0,
+        group_per_user_tokens_limit=0,
+        group_per_support_user_tokens_limit=0,
+        group_per_user_max_other_usage_coeff=0,
+        private_cooldown=0,
+        private_tokens_limit=0,
+        private_support_tokens_limit=0,
+        group_max_context_tokens=max_context_tokens,
+        private_max_context_tokens=max_context_tokens,
+        private_support_max_context_tokens=max_context_tokens,
+        compaction=compaction,  # type: ignore
+    )
+
+
+async def replay(compaction: str, turns: int, max_context_tokens: int) -> dict:
+    random.seed(0)
+
+    token_estimator = TokenEstimator()
+    session = InMemorySession()
+    summarizer = CountingSummarizer(token_estimator)
+    limits_config = make_limits_config(compaction, max_context_tokens)
+    message_service = DefaultMessageService(
+        session,  # type: ignore
+        summarizer,
+        limits_config,
+        HistoryValidator(limits_config),
+        MagicMock(spec=ImageDescriber, **{"aged_images.return_value": {}}),
+    )
+
+    compactions = 0
+    for _ in range(turns):
+        await message_service.add_messages(
+            1,
+            [
+                {"role": "user", "content": " ".join(random.choices(WORDS, k=40))},
+                {"role": "assistant", "content": " ".join(random.choices(WORDS, k=60))},
+            ],
+        )
+
+        history = await message_service.fetch_messages(1)
+        if token_estimator.estimate(history) > max_context_tokens:
+            await message_service.shorten_history(1)
+            compactions += 1
+
+    history = await message_service.fetch_messages(1)
+
+    return {
+        "compactions": compactions,
+        "summarizer_calls": summarizer.calls,
+        "tokens_per_turn": summarizer.input_tokens / turns,
+        "rows_per_turn": session.written_rows / turns,
+        "max_depth": summarizer.max_depth,
+        "history_tokens": token_estimator.estimate(history),
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=1000)
+    parser.add_argument("--max-context-tokens", type=int, default=6000)
+    args = parser.parse_args()
+
+    print(
+        f"{'compaction':>12} {'compactions':>12} {'calls':>6} {'summarizer tokens/turn':>23} "
+        f"{'rows written/turn':>18} {'final history':>14} {'summary depth':>14}"
+    )
+
+    for compaction in ("halve", "hierarchical"):
+        result = await replay(compaction, args.turns, args.max_context_tokens)
+
+        print(
+            f"{compaction:>12} {result['compactions']:>12} {result['summarizer_calls']:>6} "
+            f"{result['tokens_per_turn']:>23.1f} {result['rows_per_turn']:>18.2f} "
+            f"{result['history_tokens']:>14} {result['max_depth']:>14}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,145 @@
+"""Measures how long a chat leased by a cut off bot instance stays orphaned.
+
+Two instances share the lease table; the first one leases a chat, runs a long turn and renews
+the lease by heartbeats until it's cut off at a random moment: its renewals hang from then on.
+The second one retries the chat the way the dispatcher does. Once the first instance reports
+the lease lost, its turn is cancelled like ChatDispatcher.on_lease_lost does, and the benchmark
+shows how long before the takeover that happened (a negative margin means both turns ran).
+
+Run with: python benchmarks/lease_failover.py [--db postgresql+asyncpg://...]
+(the db mode needs the chat_leases table, i.e. applied migrations)
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from aerith_cbot.config import LeasesConfig
+from aerith_cbot.services.implementations.chat_dispatcher import (
+    ChatLeases,
+    DbChatLeases,
+    InMemoryChatLeases,
+)
+
+CHAT_ID = 42
+TRIALS = 5
+
+
+async def measure_failover(
+    cut_off_instance: ChatLeases, alive_instance: ChatLeases, leases_config: LeasesConfig
+) -> tuple[float, float]:
+    """Seconds the chat was orphaned, and how long before the takeover its turn was cancelled"""
+
+    assert await cut_off_instance.acquire(CHAT_ID)
+
+    turn_task = asyncio.create_task(asyncio.sleep(3600))
+    cancelled_at = 0.0
+
+    def on_lost(chat_id: int) -> None:
+        nonlocal cancelled_at
+        cancelled_at = time.perf_counter()
+        turn_task.cancel()
+
+    # set while the renewals of the first instance get through
+    is_connected = asyncio.Event()
+    is_connected.set()
+    renew = cut_off_instance.renew
+
+    async def cut_off_renew() -> set[int]:
+        await is_connected.wait()
+        return await renew()
+
+    cut_off_instance.renew = cut_off_renew  # type: ignore
+
+    heartbeat_task = asyncio.create_task(cut_off_instance.run(on_lost))
+    # live through a few heartbeats, so the lease is renewed at least once
+    await asyncio.sleep(random.uniform(1, 3) * leases_config.heartbeat_interval)
+
+    is_connected.clear()
+    cut_off_at = time.perf_counter()
+
+    while not await alive_instance.acquire(CHAT_ID):
+        await asyncio.sleep(leases_config.retry_interval)
+
+    taken_over_at = time.perf_counter()
+
+    # back online, the first instance finds out its lease is gone if it hasn't yet
+    is_connected.set()
+    await asyncio.wait([turn_task])
+
+    heartbeat_task.cancel()
+    cut_off_instance.renew = renew  # type: ignore
+    await alive_instance.release(CHAT_ID)
+
+    return taken_over_at - cut_off_at, taken_over_at - cancelled_at
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", help="connection string of a db with the chat_leases table")
+    parser.add_argument("--ttl", type=float, default=3)
+    parser.add_argument("--heartbeat-interval", type=float, default=1)
+    parser.add_argument("--retry-interval", type=float, default=0.25)
+    args = parser.parse_args()
+
+    # the renewals of the cut off instance fail on purpose, their tracebacks aren't needed
+    logging.getLogger(ChatLeases.__module__).setLevel(logging.CRITICAL)
+
+    leases_config = LeasesConfig(
+        ttl=args.ttl,
+        heartbeat_interval=args.heartbeat_interval,
+        retry_interval=args.retry_interval,
+    )
+
+    if args.db:
+        engine = create_async_engine(args.db)
+        cut_off_instance: ChatLeases = DbChatLeases(engine, leases_config)
+        alive_instance: ChatLeases = DbChatLeases(engine, leases_config)
+    else:
+        engine = None
+        cut_off_instance = InMemoryChatLeases(leases_config)
+        alive_instance = InMemoryChatLeases(leases_config)
+
+        # both instances look at the same lease table
+        alive_instance._leases = cut_off_instance._leases  # type: ignore
+
+    print(
+        f"ttl {leases_config.ttl}s, heartbeat every {leases_config.heartbeat_interval}s, "
+        f"retry every {leases_config.retry_interval}s ({'db' if args.db else 'memory'})"
+    )
+
+    results = []
+    margins = []
+    for trial in range(TRIALS):
+        orphaned_time, margin = await measure_failover(
+            cut_off_instance, alive_instance, leases_config
+        )
+        results.append(orphaned_time)
+        margins.append(margin)
+
+        print(
+            f"trial {trial + 1}: picked up after {orphaned_time:.2f}s, "
+            f"turn cancelled {margin:.2f}s before"
+        )
+
+    print(
+        f"orphaned for min {min(results):.2f}s, avg {sum(results) / len(results):.2f}s, "
+        f"max {max(results):.2f}s; expected within "
+        f"[{leases_config.ttl - leases_config.heartbeat_interval:.2f}s, "
+        f"{leases_config.ttl + leases_config.retry_interval:.2f}s]"
+    )
+    print(
+        f"turn cancelled before the takeover by min {min(margins):.2f}s, "
+        f"avg {sum(margins) / len(margins):.2f}s"
+    )
+
+    if engine is not None:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
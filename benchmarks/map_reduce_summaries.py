@@ -0,0 +1,252 @@
+"""Measures summarization of long synthetic histories: in one request and by chunks.
+
+The OpenAI API is simulated behind the real client and the rate limiter: its latency grows with
+the prompt, prompts above the context window are rejected and some requests fail at random.
+A summarization fails if its summary doesn't cover the whole history.
+
+Run with: python benchmarks/map_reduce_summaries.py [--trials 3] [--failure-rate 0.05]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import re
+import time
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import httpx
+from openai import AsyncOpenAI
+
+from aerith_cbot.config import (
+    MediaConfig,
+    OpenAIConfig,
+    RateLimitsConfig,
+    load_llm_config,
+)
+from aerith_cbot.services.abstractions import SummarizationError
+from aerith_cbot.services.implementations import (
+    MediaCache,
+    MediaResolver,
+    OpenAIHistorySummarizer,
+    OpenAIRateLimiter,
+    RateLimitedTransport,
+    TokenEstimator,
+)
+
+LLM_CONFIG_PATH = str(Path(__file__).parent.parent / "llm")
+
+CONTEXT_WINDOW = 128_000
+# simulated seconds: a fixed part, reading the prompt and writing a summary of 300 tokens
+BASE_LATENCY = 0.5
+PROMPT_TOKENS_PER_SECOND = 20_000
+OUTPUT_LATENCY = 3
+WORDS = [
+    "привет",
+    "как",
+    "дела",
+    "что",
+    "нового",
+    "вчера",
+    "смотрели",
+    "фильм",
+    "было",
+    "интересно",
+    "а",
+    "ты",
+]
+
+
+class FakeOpenAI:
+    def __init__(self, failure_rate: float, time_scale: float) -> None:
+        self._failure_rate = failure_rate
+        self._time_scale = time_scale
+        self._token_estimator = TokenEstimator()
+
+        self.requests = 0
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+
+        body = json.loads(request.content)
+        tokens = self._token_estimator.estimate(body["messages"])
+
+        if tokens > CONTEXT_WINDOW:
+            return httpx.Response(
+                400,
+                json={
+                    "error": {
+                        "message": f"maximum context length is {CONTEXT_WINDOW} tokens",
+                        "type": "invalid_request_error",
+                        "code": "context_length_exceeded",
+                    }
+                },
+            )
+
+        latency = BASE_LATENCY + tokens / PROMPT_TOKENS_PER_SECOND + OUTPUT_LATENCY
+        await asyncio.sleep(latency * self._time_scale)
+
+        if random.random() < self._failure_rate:
+            return httpx.Response(500, json={"error": {"message": "server error"}})
+
+        # the summary tells which messages it covers, so lost chunks can be found
+        covered = set()
+        for message in body["messages"][1:]:
+            covered |= covered_ids(message["content"])
+
+        return httpx.Response(
+            200,
+            json={
+                "id": "chatcmpl-1",
+                "object": "chat.completion",
+                "created": 0,
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": format_covered(covered)},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {"prompt_tokens": tokens, "completion_tokens": 300, "total_tokens": 0},
+            },
+        )
+
+
+def covered_ids(content: str) -> set[int]:
+    if content.startswith("#"):
+        return {int(content[1 : content.index(" ")])}
+
+    ids = set()
+    for start, end in re.findall(r"(\d+)-(\d+)", content):
+        ids |= set(range(int(start), int(end) + 1))
+
+    return ids
+
+
+def format_covered(ids: set[int]) -> str:
+    ranges = []
+    for message_id in sorted(ids):
+        if ranges and ranges[-1][1] == message_id - 1:
+            ranges[-1][1] = message_id
+        else:
+            ranges.append([message_id, message_id])
+
+    return "covered " + " ".join(f"{start}-{end}" for start, end in ranges)
+
+
+def make_history(tokens: int) -> list[dict]:
+    history = []
+    token_estimator = TokenEstimator()
+
+    while tokens > 0:
+        role = "user" if len(history) % 2 == 0 else "assistant"
+        message = {
+            "role": role,
+            "content": f"#{len(history)} " + " ".join(random.choices(WORDS, k=60)),
+        }
+
+        history.append(message)
+        tokens -= token_estimator.estimate_message(message)
+
+    return history
+
+
+def make_summarizer(
+    fake_openai: FakeOpenAI, chunk_tokens: int, concurrency: int, tokens_per_minute: int
+) -> OpenAIHistorySummarizer:
+    token_estimator = TokenEstimator()
+    rate_limiter = OpenAIRateLimiter(
+        RateLimitsConfig(tokens_per_minute=tokens_per_minute), token_estimator
+    )
+
+    openai_client = AsyncOpenAI(
+        api_key="TOKEN",
+        base_url="http://openai.test/v1",
+        max_retries=1,
+        http_client=httpx.AsyncClient(
+            transport=RateLimitedTransport(rate_limiter, httpx.MockTransport(fake_openai.handle))
+        ),
+    )
+
+    openai_config = OpenAIConfig(
+        token="TOKEN",
+        group_model="gpt-5",
+        private_model="gpt-5",
+        private_support_model="gpt-5",
+        summarizer_model="gpt-5-nano",
+        memory_llm_model="gpt-5-nano",
+        memory_embedder_model="text-embedding-3-small",
+        summarizer_chunk_tokens=chunk_tokens,
+        summarizer_concurrency=concurrency,
+    )
+
+    return OpenAIHistorySummarizer(
+        openai_client,
+        openai_config,
+        load_llm_config(LLM_CONFIG_PATH),
+        token_estimator,
+        MediaResolver(MagicMock(), MediaCache(MediaConfig()), MediaConfig()),
+    )
+
+
+async def measure(args: argparse.Namespace, history_tokens: int, chunk_tokens: int) -> str:
+    wall_times = []
+    failures = 0
+    requests = 0
+
+    for _ in range(args.trials):
+        history = make_history(history_tokens)
+        fake_openai = FakeOpenAI(args.failure_rate, args.time_scale)
+        summarizer = make_summarizer(
+            fake_openai, chunk_tokens, args.concurrency, args.tokens_per_minute
+        )
+
+        start = time.perf_counter()
+        try:
+            summary = await summarizer.summarize(history)
+        except SummarizationError:
+            # e.g. the history doesn't fit into the context window of a single request
+            summary = ""
+        wall_times.append((time.perf_counter() - start) / args.time_scale)
+
+        if covered_ids(summary) != set(range(len(history))):
+            failures += 1
+        requests += fake_openai.requests
+
+    return (
+        f"{sum(wall_times) / len(wall_times):>10.1f} {max(wall_times):>8.1f} "
+        f"{requests / args.trials:>9.1f} {failures / args.trials:>9.0%}"
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trials", type=int, default=3)
+    parser.add_argument("--failure-rate", type=float, default=0.05)
+    parser.add_argument("--chunk-tokens", type=int, default=30_000)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--tokens-per-minute", type=int, default=2_000_000)
+    # simulated seconds are slept that many times faster
+    parser.add_argument("--time-scale", type=float, default=1)
+    args = parser.parse_args()
+
+    random.seed(0)
+
+    # failed summarizations are counted in the table, their tracebacks would only clutter it
+    logging.getLogger(OpenAIHistorySummarizer.__module__).setLevel(logging.CRITICAL)
+
+    print(
+        f"{'history':>8} {'mode':>10} {'avg, s':>10} {'max, s':>8} {'requests':>9} {'failures':>9}"
+    )
+
+    for history_tokens in (20_000, 100_000, 300_000):
+        for mode, chunk_tokens in (("single", 10**9), ("chunked", args.chunk_tokens)):
+            result = await measure(args, history_tokens, chunk_tokens)
+            print(f"{history_tokens:>8} {mode:>10} {result}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
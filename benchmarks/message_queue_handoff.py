@@ -0,0 +1,96 @@
+"""Compares the old deepcopy-and-clear batch handoff with the swap-out one on large bursts.
+
+Run with: python benchmarks/message_queue_handoff.py
+"""
+
+import copy
+import json
+import time
+from unittest.mock import patch
+
+from aerith_cbot.services.abstractions.models import ChatType
+from aerith_cbot.services.implementations.chat_dispatcher import MessageQueue
+
+CHATS_COUNT = 200
+ROUNDS = 5
+
+
+def make_message(chat_id: int, message_id: int) -> dict:
+    model_input = {
+        "message_id": message_id,
+        "sender": {"user_id": 1000 + message_id % 7, "name": f"user {message_id % 7}"},
+        "text": "сообщение из загруженной группы " * 10,
+        "date": "2025-01-01 12:00:00+00:00",
+    }
+
+    return {
+        "role": "user",
+        "content": [
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"https://api.telegram.org/file/botTOKEN/photos/{chat_id}_{message_id}.jpg",
+                    "detail": "low",
+                },
+            },
+            {"type": "text", "text": json.dumps(model_input, ensure_ascii=False)},
+        ],
+    }
+
+
+def fill_queue(queue: MessageQueue, burst_size: int) -> None:
+    for chat_id in range(CHATS_COUNT):
+        for message_id in range(burst_size):
+            queue.add(chat_id, ChatType.group, [make_message(chat_id, message_id)])
+
+
+def deepcopy_handoff(queue: MessageQueue) -> int:
+    # the way the dispatcher used to take ready entries: copy everything, then clear
+    handed_off = 0
+    for chat_id, entry in queue._local_entries.items():
+        ready_entry = copy.deepcopy(entry)
+        queue.clear(chat_id)
+        handed_off += len(ready_entry.messages)
+
+    return handed_off
+
+
+def swap_handoff(queue: MessageQueue) -> int:
+    return sum(len(entry.messages) for entry in queue.fetch_ready_entries())
+
+
+def measure(handoff, burst_size: int) -> float:
+    best = float("inf")
+
+    for _ in range(ROUNDS):
+        queue = MessageQueue()
+        fill_queue(queue, burst_size)
+
+        # every burst is ready once the longest window of its chat type is over
+        ready_time = time.time() + MessageQueue.BATCHING_POLICIES[ChatType.group].max_window + 1
+        with patch("time.time", return_value=ready_time):
+            start = time.perf_counter()
+            handed_off = handoff(queue)
+            best = min(best, time.perf_counter() - start)
+
+        assert handed_off == CHATS_COUNT * burst_size
+
+    return best
+
+
+def main() -> None:
+    print(f"{'burst':>8} {'deepcopy, ms':>14} {'swap, ms':>10} {'speedup':>9}")
+
+    # bursts stay within MessageQueue.MAX_ENTRY_MESSAGES, so nothing is dropped
+    for burst_size in (5, 20, MessageQueue.MAX_ENTRY_MESSAGES):
+        deepcopy_time = measure(deepcopy_handoff, burst_size)
+        swap_time = measure(swap_handoff, burst_size)
+
+        print(
+            f"{burst_size:>8} {deepcopy_time * 1000:>14.2f} {swap_time * 1000:>10.2f} "
+            f"{deepcopy_time / swap_time:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
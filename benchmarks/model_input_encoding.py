@@ -0,0 +1,189 @@
+"""Compares prompt tokens of user messages in the full and the compact encodings.
+
+The messages are the stored rows of a history (a jsonl file of Message.data, e.g. exported
+with `\\copy (select data from messages where chat_id = ...) to 'history.jsonl'`) or, without
+one, a generated group chat. Every user message in the full encoding is encoded both ways
+(the rows already compact are counted as they are), the compact history is then shortened as
+the chat processor does before a request. Tokens are counted with tiktoken
+when it's installed, otherwise with TokenEstimator.
+
+Run with: python benchmarks/model_input_encoding.py [--history history.jsonl] [--messages 2000]
+"""
+
+import argparse
+import json
+import random
+from collections.abc import Callable
+from datetime import UTC, datetime, timedelta
+
+from aerith_cbot.services.abstractions.models import ModelInputMessage, ModelInputUser
+from aerith_cbot.services.abstractions.utils.encoding import compact_batch, encode_model_input
+from aerith_cbot.services.implementations import TokenEstimator
+
+WORDS = [
+    "привет",
+    "как",
+    "дела",
+    "что",
+    "нового",
+    "вчера",
+    "смотрели",
+    "фильм",
+    "было",
+    "интересно",
+    "а",
+    "ты",
+]
+NAMES = ["Петька", "Вован", "Sona", "heeeqwww", "anto", "заец"]
+
+
+def generated_history(count: int) -> list[dict]:
+    random.seed(0)
+
+    users = [
+        ModelInputUser(user_id=random.randint(10**6, 10**10), name=name, is_aerith=False)
+        for name in NAMES
+    ]
+    aerith = ModelInputUser(user_id=7, name="Айрис", is_aerith=True)
+
+    date = datetime(2025, 4, 26, 15, 8, tzinfo=UTC)
+    sent: list[ModelInputMessage] = []
+    history = []
+    sender = users[0]
+
+    for i in range(count):
+        # people usually write several messages in a row
+        if random.random() < 0.4:
+            sender = random.choice(users)
+        date += timedelta(seconds=random.randint(5, 120))
+
+        reply_message = None
+        if sent and random.random() < 0.3:
+            reply_message = random.choice(sent[-20:])
+
+        message = ModelInputMessage(
+            message_id=i,
+            sender=sender,
+            reply_message=reply_message,
+            text=" ".join(random.choices(WORDS, k=random.randint(2, 30))),
+            date=str(date),
+            meta=None,
+        )
+        sent.append(message)
+        history.append(
+            {
+                "role": "user",
+                "content": [{"type": "text", "text": encode_model_input(message, version=1)}],
+            }
+        )
+
+        if random.random() < 0.15:
+            answer = " ".join(random.choices(WORDS, k=15))
+            sent.append(
+                ModelInputMessage(
+                    message_id=i + count, sender=aerith, text=answer, date=str(date), meta=None
+                )
+            )
+            history.append({"role": "assistant", "content": answer})
+
+    return history
+
+
+def stored_history(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def full_message(text: str) -> ModelInputMessage | None:
+    """The message of a user prompt in the full encoding, None if it's not one"""
+
+    try:
+        fields = json.loads(text)
+    except ValueError:
+        return None
+
+    if not isinstance(fields, dict) or "message_id" not in fields:
+        return None
+
+    return ModelInputMessage.model_validate(with_meta(fields))
+
+
+def with_meta(fields: dict) -> dict:
+    # the full encoding leaves out empty fields, though meta has no default
+    fields = {"meta": None, **fields}
+    if isinstance(fields.get("reply_message"), dict):
+        fields["reply_message"] = with_meta(fields["reply_message"])
+
+    return fields
+
+
+def reencoded(history: list[dict], version: int) -> list[dict]:
+    result = []
+
+    for message in history:
+        content = message.get("content")
+        if message.get("role") != "user" or not isinstance(content, list):
+            result.append(message)
+            continue
+
+        parts = []
+        for part in content:
+            decoded = full_message(part.get("text", "")) if part.get("type") == "text" else None
+            if decoded is not None:
+                part = {**part, "text": encode_model_input(decoded, version=version)}
+            parts.append(part)
+
+        result.append({**message, "content": parts})
+
+    return result
+
+
+def token_counter() -> tuple[str, Callable[[list[dict]], int]]:
+    try:
+        import tiktoken
+    except ImportError:
+        token_estimator = TokenEstimator()
+        return "TokenEstimator", lambda messages: token_estimator.estimate(messages)
+
+    encoding = tiktoken.get_encoding("o200k_base")
+
+    def count(messages: list[dict]) -> int:
+        return sum(
+            len(encoding.encode(json.dumps(message.get("content"), ensure_ascii=False)))
+            for message in messages
+        )
+
+    return "tiktoken o200k_base", count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history")
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.history is not None:
+        history = stored_history(args.history)
+    else:
+        history = generated_history(args.messages)
+
+    counter_name, count = token_counter()
+    variants = {
+        "full": reencoded(history, version=1),
+        "compact": reencoded(history, version=2),
+        "compact+batch": compact_batch(reencoded(history, version=2)),
+    }
+
+    print(f"{len(history)} messages, tokens counted with {counter_name}")
+    print(f"{'encoding':>14} {'tokens':>9} {'bytes':>10} {'vs full':>8}")
+
+    full_tokens = count(variants["full"])
+    for name, messages in variants.items():
+        tokens = count(messages)
+        size = len(json.dumps(messages, ensure_ascii=False).encode())
+
+        print(f"{name:>14} {tokens:>9} {size:>10} {tokens / full_tokens:>8.1%}")
+
+
+if __name__ == "__main__":
+    main()
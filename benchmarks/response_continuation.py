@@ -0,0 +1,259 @@
+"""Measures bytes sent to OpenAI per turn: replaying the history vs continuing stored responses.
+
+Turns run through DefaultChatProcessor with the real client, the rate-limited transport and the
+repository's instructions and tools; OpenAI is replaced by a stub of both APIs which answers
+with a number of tool calls and then a text. Tokens aren't simulated, only bytes on the wire.
+
+Run with: python benchmarks/response_continuation.py [--history 50 200] [--tool-calls 0 1 2 4]
+"""
+
+import argparse
+import asyncio
+import json
+import random
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock
+
+import httpx
+from openai import AsyncOpenAI
+
+from aerith_cbot.config import (
+    LimitsConfig,
+    LoadSheddingConfig,
+    MediaConfig,
+    OpenAIConfig,
+    RateLimitsConfig,
+    load_llm_config,
+)
+from aerith_cbot.services.abstractions.models import ChatType
+from aerith_cbot.services.abstractions.processors import ChatTurn
+from aerith_cbot.services.implementations import (
+    HistoryValidator,
+    MediaCache,
+    MediaResolver,
+    OpenAIRateLimiter,
+    RateLimitedTransport,
+    RequestTemplates,
+    TokenEstimator,
+)
+from aerith_cbot.services.implementations.processors import DefaultChatProcessor
+from aerith_cbot.services.implementations.processors.tools import ToolExecutionResult
+
+LLM_CONFIG_PATH = str(Path(__file__).parent.parent / "llm")
+
+WORDS = [
+    "привет",
+    "как",
+    "дела",
+    "что",
+    "нового",
+    "вчера",
+    "смотрели",
+    "фильм",
+    "было",
+    "интересно",
+    "а",
+    "ты",
+]
+ANSWER = '{"text": ["готово"], "reply_to_message_id": null, "sticker": null}'
+USAGE = {"prompt_tokens": 1000, "completion_tokens": 50, "total_tokens": 1050}
+
+
+class StubOpenAI:
+    """Answers with `tool_calls` calls of a tool, then with a text; keeps stored responses"""
+
+    def __init__(self, tool_calls: int) -> None:
+        self._tool_calls = tool_calls
+        self._calls = 0
+        self._response_ids: set[str] = set()
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        self._calls += 1
+        is_call = self._calls <= self._tool_calls
+        call_id = f"call_{self._calls}"
+
+        if request.url.path.endswith("/chat/completions"):
+            message: dict = {"role": "assistant", "content": ANSWER}
+            if is_call:
+                function = {"name": "get_chat_info", "arguments": "{}"}
+                message = {
+                    "role": "assistant",
+                    "content": None,
+                    "tool_calls": [{"id": call_id, "type": "function", "function": function}],
+                }
+
+            return httpx.Response(
+                200,
+                json={
+                    "id": f"chatcmpl-{self._calls}",
+                    "object": "chat.completion",
+                    "created": 0,
+                    "model": body["model"],
+                    "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                    "usage": USAGE,
+                },
+            )
+
+        previous_response_id = body.get("previous_response_id")
+        if previous_response_id is not None and previous_response_id not in self._response_ids:
+            return httpx.Response(404, json={"error": {"message": "not found"}})
+
+        output: dict = {
+            "type": "message",
+            "id": f"msg_{self._calls}",
+            "role": "assistant",
+            "status": "completed",
+            "content": [{"type": "output_text", "text": ANSWER, "annotations": []}],
+        }
+        if is_call:
+            output = {
+                "type": "function_call",
+                "call_id": call_id,
+                "name": "get_chat_info",
+                "arguments": "{}",
+            }
+
+        response_id = f"resp_{self._calls}"
+        self._response_ids.add(response_id)
+
+        return httpx.Response(
+            200,
+            json={
+                "id": response_id,
+                "object": "response",
+                "created_at": 0,
+                "model": body["model"],
+                "output": [output],
+                "parallel_tool_calls": True,
+                "tool_choice": "auto",
+                "tools": [],
+                "usage": {
+                    "input_tokens": USAGE["prompt_tokens"],
+                    "input_tokens_details": {"cached_tokens": 0},
+                    "output_tokens": USAGE["completion_tokens"],
+                    "output_tokens_details": {"reasoning_tokens": 0},
+                    "total_tokens": USAGE["total_tokens"],
+                },
+            },
+        )
+
+
+def make_history(length: int) -> list[dict]:
+    return [
+        {
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": " ".join(random.choices(WORDS, k=60)),
+        }
+        for i in range(length)
+    ]
+
+
+def make_limits_config() -> LimitsConfig:
+    return LimitsConfig(
+        group_cooldown=0,
+        group_generic_tokens_limit=0,
+        group_per_user_tokens_limit=0,
+        group_per_support_user_tokens_limit=0,
+        group_per_user_max_other_usage_coeff=0,
+        private_cooldown=0,
+        private_tokens_limit=0,
+        private_support_tokens_limit=0,
+        group_max_context_tokens=10**9,
+        private_max_context_tokens=10**9,
+        private_support_max_context_tokens=10**9,
+    )
+
+
+async def run_turn(history: list[dict], tool_calls: int, continue_responses: bool) -> int:
+    token_estimator = TokenEstimator()
+    llm_config = load_llm_config(LLM_CONFIG_PATH)
+
+    openai_client = AsyncOpenAI(
+        api_key="TOKEN",
+        base_url="http://openai.test/v1",
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            transport=RateLimitedTransport(
+                OpenAIRateLimiter(RateLimitsConfig(), token_estimator),
+                httpx.MockTransport(StubOpenAI(tool_calls).handle),
+            )
+        ),
+    )
+
+    openai_config = OpenAIConfig(
+        token="TOKEN",
+        group_model="gpt-5",
+        private_model="gpt-5",
+        private_support_model="gpt-5",
+        summarizer_model="gpt-5-nano",
+        memory_llm_model="gpt-5-nano",
+        memory_embedder_model="text-embedding-3-small",
+        continue_responses=continue_responses,
+    )
+
+    tool_dispatcher = MagicMock()
+    tool_dispatcher.execute_tool = AsyncMock(
+        return_value=ToolExecutionResult(" ".join(random.choices(WORDS, k=40)))
+    )
+    tool_dispatcher.is_parallel_safe = MagicMock(return_value=True)
+
+    message_service = MagicMock()
+    message_service.fetch_messages = AsyncMock(return_value=history)
+    message_service.add_messages = AsyncMock()
+
+    history_compactor = MagicMock()
+    history_compactor.wait = AsyncMock()
+
+    limits_config = make_limits_config()
+
+    processor = DefaultChatProcessor(
+        openai_client,
+        llm_config,
+        openai_config,
+        tool_dispatcher,
+        message_service,
+        limits_config,
+        MagicMock(),
+        MagicMock(subtract_group_tokens=AsyncMock()),
+        MagicMock(process=AsyncMock()),
+        MagicMock(),
+        token_estimator,
+        RequestTemplates(llm_config, token_estimator),
+        LoadSheddingConfig(),
+        history_compactor,
+        HistoryValidator(limits_config),
+        MediaResolver(MagicMock(), MediaCache(MediaConfig()), MediaConfig()),
+    )
+
+    turn = ChatTurn()
+    await processor.process(1, ChatType.group, turn)
+
+    return turn.sent_bytes
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history", type=int, nargs="+", default=[50, 200])
+    parser.add_argument("--tool-calls", type=int, nargs="+", default=[0, 1, 2, 4])
+    args = parser.parse_args()
+
+    random.seed(0)
+
+    print(f"{'history':>8} {'tool calls':>11} {'replay, KB':>11} {'continue, KB':>13} {'saved':>6}")
+
+    for history_length in args.history:
+        history = make_history(history_length)
+
+        for tool_calls in args.tool_calls:
+            replay_bytes = await run_turn(history, tool_calls, False)
+            continue_bytes = await run_turn(history, tool_calls, True)
+
+            print(
+                f"{history_length:>8} {tool_calls:>11} {replay_bytes / 1024:>11.1f} "
+                f"{continue_bytes / 1024:>13.1f} {1 - continue_bytes / replay_bytes:>6.0%}"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,6 +1,7 @@
 import logging
 import time
 
+import httpx
 import openai
 
 from aerimory.llm.base_llm import (
@@ -12,9 +13,9 @@ from aerimory.types import MemoriesStatus, Memory, OpenAILLMConfig
 
 
 class OpenAILLM(BaseLLM):
-    def __init__(self, config: OpenAILLMConfig):
+    def __init__(self, config: OpenAILLMConfig, http_client: httpx.AsyncClient | None = None):
         self._config = config
-        self._openai_client = openai.AsyncOpenAI(api_key=config.api_key)
+        self._openai_client = openai.AsyncOpenAI(api_key=config.api_key, http_client=http_client)
         self._logger = logging.getLogger(__name__)
 
     async def resolve_contradictions(
@@ -3,6 +3,7 @@ import time
 import uuid
 
 import chromadb
+import httpx
 import openai
 from chromadb.api import AsyncClientAPI
 
@@ -13,12 +14,14 @@ from aerimory.vector_stores import BaseVectorStore
 class ChromaVectorStore(BaseVectorStore):
     MAX_CACHE_SIZE = 80
 
-    def __init__(self, config: ChromaConfig) -> None:
+    def __init__(self, config: ChromaConfig, http_client: httpx.AsyncClient | None = None) -> None:
         super().__init__()
 
         self._config = config
         self._chroma_client: None | AsyncClientAPI = None
-        self._openai_client = openai.AsyncOpenAI(api_key=config.openai_embeddings.api_key)
+        self._openai_client = openai.AsyncOpenAI(
+            api_key=config.openai_embeddings.api_key, http_client=http_client
+        )
         self._embeddings_cache: dict[str, tuple[list[float], int]] = {}
         self._logger = logging.getLogger(__name__)
 
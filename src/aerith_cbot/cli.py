@@ -4,12 +4,16 @@ import os
 
 from aiogram import Bot, Dispatcher
 from aiogram.methods import DeleteWebhook
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from dishka.integrations.aiogram import setup_dishka
 
 from .commands import setup_commands
-from .config import load_config
+from .config import WebhookConfig, load_config
 from .container import init_dishka_container
 from .handlers import handlers_router
+from .services.implementations.chat_dispatcher import ChatDispatcher, ProcessWorkerTransport
+from .worker import start_workers, stop_workers
 
 
 async def main():
@@ -27,15 +31,62 @@ async def main():
 
     await setup_commands(bot)
 
-    container = await init_dishka_container(config, bot)
+    transport = None
+    if config.workers.count > 0:
+        transport = ProcessWorkerTransport(config.workers.count)
+        worker_processes = start_workers(config.workers.count, transport)
+
+    container = await init_dishka_container(config, bot, transport)
     setup_dishka(container=container, router=dp, auto_inject=True)
 
     dp.include_router(handlers_router)
 
+    # polling is already stopped when shutdown handlers run, but the bot can still send messages
+    chat_dispatcher = await container.get(ChatDispatcher)
+    dp.shutdown.register(chat_dispatcher.shutdown)
+
+    if transport is not None:
+
+        async def stop_worker_processes():
+            await stop_workers(transport, worker_processes)
+
+        dp.shutdown.register(stop_worker_processes)
+
+    if config.webhook.enabled:
+        await run_webhook(bot, dp, config.webhook)
+        return
+
+    if config.leases.backend == "db":
+        logging.getLogger(__name__).warning(
+            "Instances sharing chats should get updates by webhook, not by polling"
+        )
+
     await bot(DeleteWebhook(drop_pending_updates=True))
     await dp.start_polling(bot)
 
 
+async def run_webhook(bot: Bot, dp: Dispatcher, webhook_config: WebhookConfig):
+    """Serves the updates Telegram posts, every instance behind the url gets a share of them"""
+
+    app = web.Application()
+    handler = SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=webhook_config.secret_token)
+    handler.register(app, path=webhook_config.path)
+    setup_application(app, dp, bot=bot)
+
+    # pending updates aren't dropped: the other instances keep serving while this one restarts
+    await bot.set_webhook(webhook_config.url, secret_token=webhook_config.secret_token)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+
+    try:
+        await web.TCPSite(runner, webhook_config.host, webhook_config.port).start()
+        await asyncio.Event().wait()
+    finally:
+        # runs the shutdown handlers of the dispatcher, like the end of polling does
+        await runner.cleanup()
+
+
 def cli():
     """Wrapper for command line"""
     try:
@@ -1,5 +1,6 @@
 import json
 import tomllib
+from typing import Literal
 
 from pydantic import BaseModel
 
@@ -22,6 +23,15 @@ class OpenAIConfig(BaseModel):
     summarizer_model: str
     memory_llm_model: str
     memory_embedder_model: str
+    # show the text while it's being generated, editing the message at most once in the interval
+    stream_responses: bool = False
+    stream_edit_interval: float = 1.0
+    # longer histories are summarized by chunks of that many tokens, that many at a time
+    summarizer_chunk_tokens: int = 30_000
+    summarizer_concurrency: int = 4
+    # requests after the first one of a turn continue the response stored by OpenAI (the
+    # Responses API) and send only the new messages instead of the whole history
+    continue_responses: bool = False
 
 
 class LimitsConfig(BaseModel):
@@ -40,6 +50,19 @@ class LimitsConfig(BaseModel):
     group_max_context_tokens: int
     private_max_context_tokens: int
     private_support_max_context_tokens: int
+    # "hierarchical": старые сообщения сжимаются в краткие содержания частей, а те - в общее;
+    # "halve": первая половина истории каждый раз сжимается в одно сообщение
+    compaction: Literal["halve", "hierarchical"] = "hierarchical"
+    # (для "halve") сжимать историю так, чтобы начало промпта дольше оставалось в кэше OpenAI
+    cache_friendly_compaction: bool = False
+    # доля лимита контекста, после которой история сжимается в фоне, не задерживая ответы
+    soft_compaction_ratio: float = 0.75
+    # ссылки Telegram на файлы живут около часа: картинки старше этого (в секундах)
+    # заменяются заметкой, а не ломают запросы
+    media_ttl: int = 3300
+    # более длинные сообщения обрезаются, а в запрос попадают только последние картинки
+    max_message_chars: int = 20_000
+    max_images: int = 20
 
 
 class SupportConfig(BaseModel):
@@ -51,6 +74,105 @@ class SupportConfig(BaseModel):
     provider_token: str
 
 
+class DispatcherConfig(BaseModel):
+    max_concurrent_turns: int = 16
+    # cancel a turn that hasn't answered yet when new input comes and restart it with that input
+    latest_wins: bool = False
+    # seconds given to running turns to finish on shutdown before they're cancelled
+    shutdown_timeout: float = 20
+    # a turn running longer than that is cancelled and counted as a failure
+    turn_timeout: float = 300
+    # after a failed turn the chat waits failure_cooldown * 2^(failures - 1) seconds, capped
+    failure_cooldown: float = 30
+    max_failure_cooldown: float = 3600
+    # after that many failures in a row the chat is quarantined: its input waits for the cool-off
+    quarantine_after: int = 5
+
+
+class WorkersConfig(BaseModel):
+    # number of processes running chat turns; 0 runs them in the bot process
+    count: int = 0
+
+
+class RateLimitsConfig(BaseModel):
+    # budgets of a model until the rate-limit headers of its responses tell the real ones
+    requests_per_minute: float = 500
+    tokens_per_minute: float = 200_000
+    # seconds of the exponential backoff after a 429 without retry-after
+    base_backoff: float = 1
+    max_backoff: float = 60
+
+
+class LoadSheddingConfig(BaseModel):
+    enabled: bool = False
+    # turns are degraded once there are that many waiting for a slot or replies get that slow
+    # (p95, seconds), and back to normal when both are at most the low marks
+    high_pending_turns: int = 32
+    low_pending_turns: int = 8
+    high_latency: float = 30
+    low_latency: float = 10
+    # a degraded turn: a faster model (the usual one if not set), no images, no expensive tools
+    # and fewer tool calls
+    fallback_model: str | None = None
+    dropped_tools: list[str] = ["remember_user_info", "get_chat_info"]
+    max_tool_calls: int = 2
+
+
+class IdleCompactionConfig(BaseModel):
+    enabled: bool = False
+    # seconds between runs
+    interval: float = 60
+    # a chat is compacted after that many seconds without turns, if its last request has used
+    # at least that share of its context limit
+    idle_time: float = 600
+    min_usage_ratio: float = 0.5
+    max_concurrent: int = 2
+    # tokens of the histories compacted in one run
+    tokens_per_run: int = 200_000
+
+
+class LeasesConfig(BaseModel):
+    # "memory" for a single bot instance, "db" to share chats between several ones
+    backend: Literal["memory", "db"] = "memory"
+    # a lease not renewed for `ttl` seconds is free, so chats of a dead instance are taken over;
+    # a turn is cancelled once its lease has less than `heartbeat_interval` left unrenewed
+    ttl: float = 30
+    heartbeat_interval: float = 10
+    # how long a chat leased by another instance waits before the next attempt
+    retry_interval: float = 1
+
+
+class WebhookConfig(BaseModel):
+    # Telegram gives the updates of a bot to one getUpdates caller at a time, so several
+    # instances have to get them through a webhook, e.g. behind a load balancer at `url`
+    enabled: bool = False
+    url: str = ""
+    secret_token: str | None = None
+    host: str = "0.0.0.0"
+    port: int = 8080
+    path: str = "/webhook"
+
+
+class MediaConfig(BaseModel):
+    # images of the histories downloaded from Telegram, by their file_unique_id; the least
+    # recently used ones are removed above `cache_max_bytes`; with workers, each of them has its
+    # own subdirectory and an equal share of the size
+    cache_dir: str = "media_cache"
+    cache_max_bytes: int = 256 * 1024 * 1024
+    # "inline" sends images as data urls from the cache, "url" sends fresh Telegram links
+    # which OpenAI downloads itself
+    delivery: Literal["inline", "url"] = "inline"
+    # Telegram links live for about an hour, a resolved one is reused for that many seconds
+    url_ttl: float = 1800
+    # images are replaced with their short descriptions after that many turns of the chat or
+    # once they are that many seconds old; a description is made once per file by
+    # `summarizer_model`
+    describe_images: bool = True
+    describe_after_turns: int = 5
+    describe_after: float = 3600
+    describer_concurrency: int = 2
+
+
 class ChromaConfig(BaseModel):
     host: str
     port: int
@@ -81,6 +203,7 @@ class LLMConfig(BaseModel):
     group_instruction: str
     private_instruction: str
     summarize_instruction: str
+    describe_image_instruction: str
     additional_instructions: AdditionalInstructions
 
 
@@ -91,6 +214,14 @@ class Config(BaseModel):
     limits: LimitsConfig
     support: SupportConfig
     chroma: ChromaConfig
+    dispatcher: DispatcherConfig = DispatcherConfig()
+    workers: WorkersConfig = WorkersConfig()
+    leases: LeasesConfig = LeasesConfig()
+    webhook: WebhookConfig = WebhookConfig()
+    rate_limits: RateLimitsConfig = RateLimitsConfig()
+    load_shedding: LoadSheddingConfig = LoadSheddingConfig()
+    idle_compaction: IdleCompactionConfig = IdleCompactionConfig()
+    media: MediaConfig = MediaConfig()
     llm: LLMConfig
 
 
@@ -116,6 +247,9 @@ def load_llm_config(path: str) -> LLMConfig:
     with open(path + "/instructions/summarize_instruction.md", encoding="utf-8") as f:
         summarize_instruction = f.read()
 
+    with open(path + "/instructions/describe_image_instruction.md", encoding="utf-8") as f:
+        describe_image_instruction = f.read()
+
     with open(path + "/instructions/additional_instructions.json", encoding="utf-8") as f:
         additional_instructions = f.read()
 
@@ -132,5 +266,6 @@ def load_llm_config(path: str) -> LLMConfig:
         group_tools=group_tools,
         tools=tools,
         summarize_instruction=summarize_instruction,
+        describe_image_instruction=describe_image_instruction,
         additional_instructions=AdditionalInstructions.model_validate_json(additional_instructions),
     )
@@ -35,11 +35,30 @@ from aerith_cbot.services.implementations import (
     DefaultSupportService,
     DefaultUserContextProvider,
     GroupPermissionChecker,
+    HistoryCompactor,
+    HistoryValidator,
+    IdleCompactionScheduler,
+    ImageDescriber,
+    MediaCache,
+    MediaResolver,
     OpenAIHistorySummarizer,
+    OpenAIRateLimiter,
     OpenAIVoiceTranscriber,
+    RequestTemplates,
     SupportNotifier,
+    TokenEstimator,
+)
+from aerith_cbot.services.implementations.chat_dispatcher import (
+    ChatDispatcher,
+    ChatLeases,
+    DbChatLeases,
+    InMemoryChatLeases,
+    LocalTurnExecutor,
+    MessageQueue,
+    TurnExecutor,
+    WorkerPoolTurnExecutor,
+    WorkerTransport,
 )
-from aerith_cbot.services.implementations.chat_dispatcher import ChatDispatcher, MessageQueue
 from aerith_cbot.services.implementations.processors import (
     DefaultChatProcessor,
     DefaultGroupMessageProcessor,
@@ -53,12 +72,28 @@ from aerith_cbot.services.implementations.processors.tools import (
 from aerith_cbot.services.implementations.providers import ClientsProvider, ConfigProvider
 
 
-async def init_dishka_container(config: Config, bot: Bot) -> AsyncContainer:
+async def init_dishka_container(
+    config: Config,
+    bot: Bot,
+    transport: WorkerTransport | None = None,
+    run_bg_workers: bool = True,
+) -> AsyncContainer:
+    """Builds the container; with `transport` chat turns are sent to worker processes"""
+
     service_provider = Provider(scope=Scope.REQUEST)
 
     service_provider.provide(SupportNotifier, scope=Scope.APP)
     service_provider.provide(ChatDispatcher, scope=Scope.APP)
     service_provider.provide(MessageQueue, scope=Scope.APP)
+    service_provider.provide(TokenEstimator, scope=Scope.APP)
+    service_provider.provide(RequestTemplates, scope=Scope.APP)
+    service_provider.provide(OpenAIRateLimiter, scope=Scope.APP)
+    service_provider.provide(HistoryCompactor, scope=Scope.APP)
+    service_provider.provide(HistoryValidator, scope=Scope.APP)
+    service_provider.provide(MediaCache, scope=Scope.APP)
+    service_provider.provide(MediaResolver, scope=Scope.APP)
+    service_provider.provide(ImageDescriber, scope=Scope.APP)
+    service_provider.provide(IdleCompactionScheduler, scope=Scope.APP)
     service_provider.provide(OpenAIVoiceTranscriber, provides=VoiceTranscriber)
     service_provider.provide(DefaultSupportService, provides=SupportService)
     service_provider.provide(DefaultLimitsService, provides=LimitsService)
@@ -77,6 +112,17 @@ async def init_dishka_container(config: Config, bot: Bot) -> AsyncContainer:
     service_provider.provide(AerimoryMemoryService, provides=MemoryService)
     service_provider.provide(lambda: bot, scope=Scope.APP, provides=Bot)
 
+    if config.leases.backend == "db":
+        service_provider.provide(DbChatLeases, scope=Scope.APP, provides=ChatLeases)
+    else:
+        service_provider.provide(InMemoryChatLeases, scope=Scope.APP, provides=ChatLeases)
+
+    if transport is not None:
+        service_provider.provide(lambda: transport, scope=Scope.APP, provides=WorkerTransport)
+        service_provider.provide(WorkerPoolTurnExecutor, scope=Scope.APP, provides=TurnExecutor)
+    else:
+        service_provider.provide(LocalTurnExecutor, scope=Scope.APP, provides=TurnExecutor)
+
     container = make_async_container(
         service_provider,
         ConfigProvider(config),
@@ -85,14 +131,30 @@ async def init_dishka_container(config: Config, bot: Bot) -> AsyncContainer:
         AiogramProvider(),
     )
 
-    await _run_bg_workers(container)
+    if run_bg_workers:
+        await _run_bg_workers(container)
 
     return container
 
 
 async def _run_bg_workers(container: AsyncContainer) -> None:
     chat_dispatcher = await container.get(ChatDispatcher)
+
+    # a turn whose lease is lost is cancelled, so it can't run alongside another instance's one
+    chat_leases = await container.get(ChatLeases)
+    chat_leases.run_task = asyncio.create_task(chat_leases.run(chat_dispatcher.on_lease_lost))
+
+    await chat_dispatcher.restore()
     chat_dispatcher.run_task = asyncio.create_task(chat_dispatcher.run())
 
     support_notifier = await container.get(SupportNotifier)
     support_notifier.run_task = asyncio.create_task(support_notifier.run())
+
+    await run_idle_compaction(container)
+
+
+async def run_idle_compaction(container: AsyncContainer) -> None:
+    """Starts compacting idle chats in the process which runs their turns"""
+
+    idle_compaction_scheduler = await container.get(IdleCompactionScheduler)
+    idle_compaction_scheduler.run_task = asyncio.create_task(idle_compaction_scheduler.run())
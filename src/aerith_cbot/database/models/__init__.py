@@ -1,7 +1,10 @@
 from .base import Base
+from .chat_lease import ChatLease
 from .chat_state import ChatState
 from .group_limit_entry import GroupLimitEntry
-from .message import Message
+from .image_description import ImageDescription
+from .message import Message, MessageLevel
+from .spilled_queue_entry import SpilledQueueEntry
 from .sticker import Sticker
 from .user_group_last_contact import UserGroupLastContact
 from .user_group_limit_entry import UserGroupLimitEntry
@@ -13,6 +16,7 @@ __all__ = (
     "Base",
     "ChatState",
     "Message",
+    "MessageLevel",
     "Sticker",
     "UserGroupLastContact",
     "UserGroupLimitEntry",
@@ -20,4 +24,7 @@ __all__ = (
     "GroupLimitEntry",
     "UserSupport",
     "UserPersonalContext",
+    "SpilledQueueEntry",
+    "ChatLease",
+    "ImageDescription",
 )
@@ -0,0 +1,18 @@
+from sqlalchemy import BigInteger
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .base import Base
+
+
+class ChatLease(Base):
+    __tablename__ = "chat_leases"
+
+    chat_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    owner: Mapped[str] = mapped_column(nullable=False)
+    expires_at: Mapped[float] = mapped_column(nullable=False)
+
+    def __repr__(self) -> str:
+        return f"ChatLease(\
+        chat_id={self.chat_id}, \
+        owner={self.owner}, \
+        expires_at={self.expires_at})"
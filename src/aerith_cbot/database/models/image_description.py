@@ -0,0 +1,16 @@
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .base import Base
+
+
+class ImageDescription(Base):
+    __tablename__ = "image_descriptions"
+
+    # the same for every copy of a file: re-posted and forwarded images share descriptions
+    file_unique_id: Mapped[str] = mapped_column(primary_key=True)
+    description: Mapped[str] = mapped_column(nullable=False)
+
+    def __repr__(self) -> str:
+        return f"ImageDescription(\
+        file_unique_id={self.file_unique_id}, \
+        description={self.description})"
@@ -1,3 +1,5 @@
+import enum
+
 from sqlalchemy import JSON, UUID, BigInteger
 from sqlalchemy.orm import Mapped, mapped_column
 from uuid_utils.compat import uuid7
@@ -5,15 +7,26 @@ from uuid_utils.compat import uuid7
 from .base import Base
 
 
+class MessageLevel(enum.IntEnum):
+    # messages as they were sent
+    raw = 0
+    # a summary of a chunk of raw messages
+    chunk_summary = 1
+    # the long-term summary of everything before the chunk summaries
+    digest = 2
+
+
 class Message(Base):
     __tablename__ = "messages"
 
     id: Mapped[UUID] = mapped_column(UUID, primary_key=True, default=uuid7)
     chat_id: Mapped[int] = mapped_column(BigInteger, nullable=False, index=True)
     data: Mapped[dict] = mapped_column(JSON, nullable=False)
+    level: Mapped[int] = mapped_column(nullable=False, default=MessageLevel.raw, server_default="0")
 
     def __repr__(self) -> str:
         return f"Message(\
         id={self.id}, \
         chat_id={self.chat_id}, \
-        data={self.data})"
+        data={self.data}, \
+        level={self.level})"
@@ -0,0 +1,25 @@
+from sqlalchemy import JSON, UUID, BigInteger
+from sqlalchemy.orm import Mapped, mapped_column
+from uuid_utils.compat import uuid7
+
+from .base import Base
+
+
+class SpilledQueueEntry(Base):
+    __tablename__ = "spilled_queue_entries"
+
+    id: Mapped[UUID] = mapped_column(UUID, primary_key=True, default=uuid7)
+    chat_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    chat_type: Mapped[int] = mapped_column(nullable=False)
+    messages: Mapped[list] = mapped_column(JSON, nullable=False)
+    is_aerith_called: Mapped[bool] = mapped_column(nullable=False, default=False)
+    from_supporter: Mapped[bool] = mapped_column(nullable=False, default=False)
+
+    def __repr__(self) -> str:
+        return f"SpilledQueueEntry(\
+        id={self.id}, \
+        chat_id={self.chat_id}, \
+        chat_type={self.chat_type}, \
+        messages={self.messages}, \
+        is_aerith_called={self.is_aerith_called}, \
+        from_supporter={self.from_supporter})"
@@ -5,6 +5,7 @@ from aerith_cbot.filters import SenderFilter
 from .group import group_router
 from .migration import migrate_router
 from .private import private_router
+from .stats import stats_router
 from .stickers import stickers_router
 from .support import support_router
 from .utils import utils_router
@@ -13,7 +14,13 @@ handlers_router = Router()
 handlers_router.message.filter(SenderFilter("user"))
 
 handlers_router.include_routers(
-    migrate_router, support_router, stickers_router, utils_router, private_router, group_router
+    migrate_router,
+    support_router,
+    stickers_router,
+    stats_router,
+    utils_router,
+    private_router,
+    group_router,
 )  # order is important!
 
 __all__ = ("handlers_router",)
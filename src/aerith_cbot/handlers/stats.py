@@ -0,0 +1,192 @@
+import time
+
+from aiogram import Router, types
+from aiogram.filters import Command
+from dishka import FromDishka
+
+from aerith_cbot.config import BotConfig, WorkersConfig
+from aerith_cbot.services.implementations import (
+    HistoryCompactor,
+    HistoryValidator,
+    ImageDescriber,
+    MediaCache,
+    MediaResolver,
+    OpenAIRateLimiter,
+)
+from aerith_cbot.services.implementations.chat_dispatcher import (
+    ChatDispatcher,
+    MessageQueue,
+)
+
+stats_router = Router()
+
+WORKER_STATS_NOTE = "остальное считается в процессах-обработчиках, см. их логи"
+
+
+@stats_router.message(Command("queue"))
+async def queue_stats_handler(
+    message: types.Message,
+    bot_config: FromDishka[BotConfig],
+    message_queue: FromDishka[MessageQueue],
+    chat_dispatcher: FromDishka[ChatDispatcher],
+    rate_limiter: FromDishka[OpenAIRateLimiter],
+    history_compactor: FromDishka[HistoryCompactor],
+    history_validator: FromDishka[HistoryValidator],
+    media_resolver: FromDishka[MediaResolver],
+    media_cache: FromDishka[MediaCache],
+    workers_config: FromDishka[WorkersConfig],
+):
+    if message.from_user and message.from_user.id not in bot_config.admin_ids:
+        return
+
+    stats = message_queue.stats()
+    load_shedder = chat_dispatcher.load_shedder
+    windows = ", ".join(
+        f"{chat_type.name} {window:.1f} с" for chat_type, window in stats.average_windows.items()
+    )
+
+    dispatcher_stats = (
+        f"чатов в очереди: {stats.chats}\n"
+        f"ждут ответа: {stats.buffered_chats} ({stats.buffered_messages} сообщ., "
+        f"{stats.buffered_bytes / 1024:.1f} КБ)\n"
+        f"в работе: {chat_dispatcher.working_chats_count}, "
+        f"ждут слота: {chat_dispatcher.pending_turns_count}\n"
+        f"выброшено сообщений: {stats.dropped_messages}\n"
+        f"вытеснено чатов: {stats.evicted_entries}\n"
+        f"окно ожидания: {windows or 'нет данных'}\n"
+        f"LLM-вызовов на сообщение: {chat_dispatcher.llm_calls_per_message:.2f}, "
+        f"отправлено за ход: {chat_dispatcher.average_sent_bytes / 1024:.1f} КБ\n"
+        f"первый текст через {chat_dispatcher.average_first_byte_time:.1f} с, "
+        f"весь ответ через {chat_dispatcher.average_last_byte_time:.1f} с\n"
+        f"зависших ходов: {chat_dispatcher.turn_timeouts_count}, "
+        f"ошибок: {chat_dispatcher.turn_failures_count}\n"
+        f"отложено в карантин: {chat_dispatcher.quarantined_entries_count}\n"
+        f"прервано ходов с потерянной арендой: {chat_dispatcher.lost_leases_count}\n"
+        f"упрощённый режим: {'включён' if load_shedder.is_shedding else 'выключен'} "
+        f"(переключений: {load_shedder.switches_count}, "
+        f"упрощённых ходов: {load_shedder.degraded_turns_count}, "
+        f"p95 ответа: {load_shedder.p95_latency():.1f} с)\n"
+    )
+
+    # turns run in the workers, so do the requests, compactions and downloads they make
+    if workers_config.count:
+        await message.answer(dispatcher_stats + WORKER_STATS_NOTE)
+        return
+
+    turn_stats = (
+        f"запросов к OpenAI ждали лимита: {rate_limiter.throttled_count}, "
+        f"получили 429: {rate_limiter.rate_limited_count}\n"
+        f"сжатий истории: {history_compactor.compactions_count} "
+        f"(ошибок: {history_compactor.failures_count}), "
+        f"задержка {history_compactor.average_lag:.1f} с (макс. {history_compactor.max_lag:.1f} с)\n"
+        f"ходов ждали сжатия: {history_compactor.blocked_turns_count}, "
+        f"в среднем {history_compactor.average_blocked_time:.1f} с\n"
+        f"сжато в простое: {history_compactor.idle_compactions_count}, "
+        f"сэкономлено сжатий во время ответа: {history_compactor.avoided_compactions_count}\n"
+        f"исправлено историй: {history_validator.repaired_histories_count}, "
+        f"ошибок запроса обошлось без пересказа: {history_validator.avoided_summarizations_count}\n"
+        f"изображений подставлено: {media_resolver.resolved_count}, "
+        f"недоступно: {media_resolver.unavailable_count}, "
+        f"скачано: {media_resolver.downloads_count}\n"
+        f"кэш изображений: {media_cache.files_count} файлов, "
+        f"{media_cache.size_bytes / 1024 / 1024:.1f} МБ, "
+        f"попаданий {media_cache.hits_count}, промахов {media_cache.misses_count}, "
+        f"вытеснено {media_cache.evictions_count}"
+    )
+
+    await message.answer(dispatcher_stats + turn_stats)
+
+
+@stats_router.message(Command("breaker"))
+async def breaker_stats_handler(
+    message: types.Message,
+    bot_config: FromDishka[BotConfig],
+    chat_dispatcher: FromDishka[ChatDispatcher],
+):
+    if message.from_user and message.from_user.id not in bot_config.admin_ids:
+        return
+
+    cooling_down_chats = chat_dispatcher.cooling_down_chats()
+
+    if not cooling_down_chats:
+        await message.answer("все чаты работают нормально")
+        return
+
+    # the worst chats first; the rest wouldn't fit into one message anyway
+    worst_chats = sorted(cooling_down_chats.items(), key=lambda item: -item[1].count)[:30]
+
+    current_time = time.time()
+    lines = [
+        f"{chat_id}: ошибок подряд {failures.count}, "
+        f"пауза ещё {failures.cooldown_till - current_time:.0f} с"
+        for chat_id, failures in worst_chats
+    ]
+
+    await message.answer("\n".join(lines))
+
+
+@stats_router.message(Command("cache"))
+async def cache_stats_handler(
+    message: types.Message,
+    bot_config: FromDishka[BotConfig],
+    chat_dispatcher: FromDishka[ChatDispatcher],
+):
+    if message.from_user and message.from_user.id not in bot_config.admin_ids:
+        return
+
+    stats = chat_dispatcher.prompt_cache_stats
+
+    models = stats.models()
+    if not models:
+        await message.answer("запросов ещё не было")
+        return
+
+    lines = [
+        f"{model}: из кэша {usage.ratio:.0%} ({usage.cached_tokens}/{usage.prompt_tokens})"
+        for model, usage in models.items()
+    ]
+
+    worst_chats = stats.worst_chats(10)
+    if worst_chats:
+        lines.append("\nбольше всего токенов мимо кэша:")
+        lines += [
+            f"{chat_id}: из кэша {usage.ratio:.0%}, мимо {usage.prompt_tokens - usage.cached_tokens}"
+            for chat_id, usage in worst_chats
+        ]
+
+    await message.answer("\n".join(lines))
+
+
+@stats_router.message(Command("images"))
+async def images_stats_handler(
+    message: types.Message,
+    bot_config: FromDishka[BotConfig],
+    image_describer: FromDishka[ImageDescriber],
+    workers_config: FromDishka[WorkersConfig],
+):
+    if message.from_user and message.from_user.id not in bot_config.admin_ids:
+        return
+
+    # the histories are read, and their images described, in the workers
+    if workers_config.count:
+        await message.answer(WORKER_STATS_NOTE)
+        return
+
+    lines = [
+        (
+            f"описано изображений: {image_describer.descriptions_count} "
+            f"(не удалось: {image_describer.failures_count}), "
+            f"заменено в историях: {image_describer.replaced_images_count}"
+        )
+    ]
+
+    # the chats which save the most first; the rest wouldn't fit into one message anyway
+    savings = sorted(image_describer.savings().items(), key=lambda item: -item[1].saved_tokens)
+    if savings:
+        lines.append("\nсэкономлено токенов на каждом запросе:")
+        lines += [
+            f"{chat_id}: {chat_savings.saved_tokens} ({chat_savings.described_images} изобр.)"
+            for chat_id, chat_savings in savings[:30]
+        ]
+
+    await message.answer("\n".join(lines))
@@ -1,5 +1,5 @@
 from .chat_migration_service import ChatMigrationService
-from .history_summarizer import HistorySummarizer
+from .history_summarizer import HistorySummarizer, SummarizationError
 from .limits_service import LimitsService
 from .memory_service import MemoryService
 from .message_service import MessageService
@@ -16,6 +16,7 @@ __all__ = (
     "SenderService",
     "MessageService",
     "HistorySummarizer",
+    "SummarizationError",
     "PermissionChecker",
     "LimitsService",
     "SupportService",
@@ -1,7 +1,13 @@
 from abc import ABC, abstractmethod
 
 
+class SummarizationError(Exception):
+    """The history, or a part of it, hasn't been summarized"""
+
+
 class HistorySummarizer(ABC):
     @abstractmethod
     async def summarize(self, messages_to_summarize: list[dict]) -> str:
+        """The summary of the messages; raises SummarizationError if there is none"""
+
         raise NotImplementedError
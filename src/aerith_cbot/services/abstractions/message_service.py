@@ -10,6 +10,11 @@ class MessageService(ABC):
     async def add_messages(self, chat_id: int, messages: list[dict]) -> None:
         raise NotImplementedError
 
+    @abstractmethod
+    async def repair_history(self, chat_id: int, broken_urls: set[str]) -> bool:
+        """Fixes the messages which would fail a request; returns whether there were any"""
+        raise NotImplementedError
+
     @abstractmethod
     async def shorten_history(self, chat_id: int) -> None:
         raise NotImplementedError
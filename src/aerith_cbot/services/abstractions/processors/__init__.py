@@ -1,11 +1,13 @@
-from .chat import ChatProcessor
+from .chat import ChatProcessor, ChatTurn
 from .group_message import GroupMessageProcessor
-from .model_response import ModelResponseProcessor
+from .model_response import ModelResponseProcessor, ModelResponseStream
 from .private_message import PrivateMessageProcessor
 
 __all__ = (
     "GroupMessageProcessor",
     "ChatProcessor",
+    "ChatTurn",
     "PrivateMessageProcessor",
     "ModelResponseProcessor",
+    "ModelResponseStream",
 )
@@ -3,7 +3,36 @@ from abc import ABC, abstractmethod
 from aerith_cbot.services.abstractions.models import ChatType
 
 
+class ChatTurn:
+    """State of a running chat turn shared between the dispatcher and the chat processor"""
+
+    def __init__(self) -> None:
+        # the turn can be cancelled and started again with newer input
+        # until the processor starts acting on a model response
+        self.is_restartable = False
+
+        self.is_input_saved = False
+        self.llm_calls = 0
+
+        # the bot is overloaded: the turn should be cheaper and faster than usual
+        self.is_degraded = False
+
+        # seconds from the start of the turn until the user has seen the first and the last text
+        self.first_byte_time: float | None = None
+        self.last_byte_time: float | None = None
+
+        # prompt tokens of the turn's requests and how many of them hit the prompt cache
+        self.model: str | None = None
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+        # bytes of the turn's requests to the LLM
+        self.sent_bytes = 0
+
+
 class ChatProcessor(ABC):
     @abstractmethod
-    async def process(self, chat_id: int, chat_type: ChatType) -> None:
+    async def process(
+        self, chat_id: int, chat_type: ChatType, turn: ChatTurn | None = None
+    ) -> None:
         raise NotImplementedError
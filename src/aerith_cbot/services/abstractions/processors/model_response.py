@@ -1,11 +1,37 @@
 from abc import ABC, abstractmethod
 
 
+class ModelResponseStream(ABC):
+    """Shows the text of a model response to the user while it's being generated"""
+
+    def __init__(self) -> None:
+        self.message_id: int | None = None
+        # time.perf_counter() of the first part shown to the user
+        self.first_part_time: float | None = None
+
+    @abstractmethod
+    async def feed(self, content: str) -> None:
+        """Takes the next chunk of the raw response"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def restart(self) -> None:
+        """Starts a new response, e.g. when the request is retried; the shown message is reused"""
+        raise NotImplementedError
+
+
 class ModelResponseProcessor(ABC):
     @abstractmethod
-    async def process(self, chat_id: int, response_raw: str) -> None:
+    async def process(
+        self, chat_id: int, response_raw: str, stream: ModelResponseStream | None = None
+    ) -> bool:
+        """Sends the response to the chat; returns whether the user has got anything"""
         raise NotImplementedError
 
     @abstractmethod
     async def process_refusal(self, chat_id: int, refusal: str) -> None:
         raise NotImplementedError
+
+    @abstractmethod
+    def start_stream(self, chat_id: int) -> ModelResponseStream:
+        raise NotImplementedError
@@ -5,7 +5,21 @@ from .models import ModelResponse
 
 class SenderService(ABC):
     @abstractmethod
-    async def send_model_response(self, chat_id: int, response: ModelResponse) -> None:
+    async def send_model_response(
+        self, chat_id: int, response: ModelResponse, streamed_message_id: int | None = None
+    ) -> None:
+        """Sends the response; if its text was streamed, the streamed message gets the final text"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def send_model_response_part(
+        self,
+        chat_id: int,
+        text: str,
+        message_id: int | None = None,
+        reply_to_message_id: int | None = None,
+    ) -> int:
+        """Sends the beginning of a streamed text or edits the message with a longer one"""
         raise NotImplementedError
 
     @abstractmethod
@@ -0,0 +1,147 @@
+import functools
+import json
+from datetime import datetime
+
+from ..models import ModelInputMessage
+
+# 1 is the pydantic dump of ModelInputMessage, 2 is the compact one:
+#   {"v": 2, "id": 5, "u": [42, "Петя"], "at": "04-26 15:08", "re": {...}, "t": "привет"}
+# "m" is the meta, if there is one; "u" is "me" for messages of Aerith; replies have no "v"
+# and "at", and their text is cut. Stored rows keep the version they were written with; only
+# the compact ones are shortened further on the way to the model, the rest go as they are.
+ENCODING_VERSION = 2
+VERSION_KEY = "v"
+
+MAX_QUOTE_CHARS = 200
+QUOTE_ELLIPSIS = "…"
+AERITH = "me"
+
+
+def encode_model_input(message: ModelInputMessage, version: int = ENCODING_VERSION) -> str:
+    if version == 1:
+        return message.model_dump_json(exclude_none=True)
+
+    return _dumps({VERSION_KEY: version} | _compact_fields(message, is_quote=False))
+
+
+def compact_batch(messages: list[dict]) -> list[dict]:
+    """Drops the author and the time of user messages which repeat the previous message's
+
+    Only runs of compact messages not interrupted by others are shortened, so each message is
+    read along with the one right before it. The stored rows keep everything, this is done on
+    the way to the model.
+    """
+
+    result = []
+    previous: dict | None = None
+
+    for message in messages:
+        index, fields = _compact_part(message)
+        if fields is None:
+            previous = None
+            result.append(message)
+            continue
+
+        shortened = {
+            key: value
+            for key, value in fields.items()
+            if not (key in ("u", "at") and previous is not None and previous.get(key) == value)
+        }
+        previous = fields
+
+        if len(shortened) == len(fields):
+            result.append(message)
+        elif index is None:
+            result.append({**message, "content": _dumps(shortened)})
+        else:
+            content = list(message["content"])
+            content[index] = {**content[index], "text": _dumps(shortened)}
+            result.append({**message, "content": content})
+
+    return result
+
+
+def compact_date(date: str) -> str:
+    """ "2025-04-26 15:08:27+00:00" -> "04-26 15:08", other dates are left as they are"""
+
+    try:
+        return datetime.fromisoformat(date).strftime("%m-%d %H:%M")
+    except ValueError:
+        return date
+
+
+def _compact_fields(message: ModelInputMessage, is_quote: bool) -> dict:
+    fields: dict = {"id": message.message_id}
+
+    if message.sender.is_aerith:
+        fields["u"] = AERITH
+    else:
+        fields["u"] = [message.sender.user_id, message.sender.name]
+
+    if not is_quote:
+        fields["at"] = compact_date(message.date)
+
+    if message.reply_message is not None:
+        fields["re"] = _compact_fields(message.reply_message, is_quote=True)
+
+    if message.text is not None:
+        text = message.text
+        if is_quote and len(text) > MAX_QUOTE_CHARS:
+            text = text[:MAX_QUOTE_CHARS] + QUOTE_ELLIPSIS
+
+        fields["t"] = text
+
+    if message.meta is not None:
+        fields["m"] = message.meta
+
+    return fields
+
+
+def _compact_part(message: dict) -> tuple[int | None, dict | None]:
+    """The text of a user message in the compact encoding: its index in the content and fields"""
+
+    if message.get("role") != "user":
+        return None, None
+
+    content = message.get("content")
+    if isinstance(content, str):
+        fields = _loads(content)
+        return None, fields if _is_compact(fields) else None
+
+    if not isinstance(content, list):
+        return None, None
+
+    for i, part in enumerate(content):
+        if part.get("type") == "text":
+            fields = _loads(part.get("text", ""))
+            if _is_compact(fields):
+                return i, fields
+
+    return None, None
+
+
+def _is_compact(fields: dict | None) -> bool:
+    return fields is not None and fields.get(VERSION_KEY) == ENCODING_VERSION
+
+
+@functools.lru_cache(maxsize=4096)
+def _loads_cached(text: str) -> dict | None:
+    if not text.startswith("{"):
+        return None
+
+    try:
+        fields = json.loads(text)
+    except ValueError:
+        return None
+
+    return fields if isinstance(fields, dict) else None
+
+
+def _loads(text: str) -> dict | None:
+    # the cached dicts are shared, callers get their own copies
+    fields = _loads_cached(text)
+    return dict(fields) if fields is not None else None
+
+
+def _dumps(fields: dict) -> str:
+    return json.dumps(fields, ensure_ascii=False, separators=(",", ":"))
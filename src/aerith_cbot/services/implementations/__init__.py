@@ -6,9 +6,23 @@ from .default_sender_service import DefaultSenderService
 from .default_stickers_service import DefaultStickersService
 from .default_support_service import DefaultSupportService
 from .group_permission_checker import GroupPermissionChecker
+from .history_compactor import ChatUsage, HistoryCompactor
+from .history_validator import HistoryRepair, HistoryValidator
+from .idle_compaction_scheduler import IdleCompactionScheduler
+from .image_describer import ImageDescriber, ImageSavings
+from .media_cache import MediaCache
+from .media_resolver import MediaResolver
 from .openai_history_summarizer import OpenAIHistorySummarizer
+from .openai_rate_limiter import (
+    OpenAIRateLimiter,
+    RateLimitedTransport,
+    RequestPriority,
+    openai_priority,
+)
 from .openai_voice_transciber import OpenAIVoiceTranscriber
+from .prompt_cache import PromptCacheStats, RequestTemplate, RequestTemplates
 from .support_notifier import SupportNotifier
+from .token_estimator import TokenEstimator
 from .user_context_provider import DefaultUserContextProvider
 
 __all__ = (
@@ -24,4 +38,21 @@ __all__ = (
     "DefaultUserContextProvider",
     "OpenAIVoiceTranscriber",
     "DefaultChatMigrationService",
+    "TokenEstimator",
+    "RequestTemplate",
+    "RequestTemplates",
+    "PromptCacheStats",
+    "OpenAIRateLimiter",
+    "RateLimitedTransport",
+    "RequestPriority",
+    "openai_priority",
+    "HistoryCompactor",
+    "ChatUsage",
+    "IdleCompactionScheduler",
+    "HistoryValidator",
+    "HistoryRepair",
+    "MediaCache",
+    "MediaResolver",
+    "ImageDescriber",
+    "ImageSavings",
 )
@@ -1,4 +1,29 @@
 from .chat_dispatcher import ChatDispatcher
-from .message_queue import MessageQueue
+from .leases import ChatLeases, DbChatLeases, InMemoryChatLeases
+from .message_queue import MessageQueue, MessageQueueStats
+from .turn_executor import LocalTurnExecutor, TurnExecutor
+from .workers import (
+    ChatWorker,
+    LocalWorkerTransport,
+    ProcessWorkerTransport,
+    WorkerPoolTurnExecutor,
+    WorkerTransport,
+    WorkerTurnError,
+)
 
-__all__ = ("ChatDispatcher", "MessageQueue")
+__all__ = (
+    "ChatDispatcher",
+    "ChatLeases",
+    "ChatWorker",
+    "DbChatLeases",
+    "InMemoryChatLeases",
+    "LocalTurnExecutor",
+    "LocalWorkerTransport",
+    "MessageQueue",
+    "MessageQueueStats",
+    "ProcessWorkerTransport",
+    "TurnExecutor",
+    "WorkerPoolTurnExecutor",
+    "WorkerTransport",
+    "WorkerTurnError",
+)
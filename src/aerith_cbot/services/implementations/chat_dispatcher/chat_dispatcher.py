@@ -1,75 +1,521 @@
 import asyncio
+import collections
+import heapq
+import itertools
 import logging
+import time
 
-from dishka import AsyncContainer
-from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 
-from aerith_cbot.services.abstractions import MessageService
-from aerith_cbot.services.abstractions.processors import ChatProcessor
+from aerith_cbot.config import DispatcherConfig, LeasesConfig, LoadSheddingConfig
+from aerith_cbot.database.models import SpilledQueueEntry
+from aerith_cbot.services.abstractions.models import ChatType
+from aerith_cbot.services.abstractions.processors import ChatTurn
+from aerith_cbot.services.implementations.prompt_cache import PromptCacheStats
 
+from .leases import ChatLeases
+from .load_shedding import LoadShedder
 from .message_queue import (
     LocalQueueEntry,
     MessageQueue,
 )
+from .turn_executor import TurnExecutor
+
+
+class ChatFailures:
+    def __init__(self) -> None:
+        self.count = 0
+        self.cooldown_till = 0.0
+
+    def __repr__(self) -> str:
+        return f"ChatFailures(count={self.count}, cooldown_till={self.cooldown_till})"
 
 
 class ChatDispatcher:
+    # failures of the chats that failed lately; the oldest ones are forgotten above that
+    MAX_TRACKED_FAILURES = 10_000
+
     def __init__(
         self,
         db_engine: AsyncEngine,
         message_queue: MessageQueue,
-        container: AsyncContainer,
+        turn_executor: TurnExecutor,
+        chat_leases: ChatLeases,
+        dispatcher_config: DispatcherConfig,
+        leases_config: LeasesConfig,
+        load_shedding_config: LoadSheddingConfig,
     ) -> None:
         self._db_engine = db_engine
         self._message_queue = message_queue
-        self._container = container
+        self._turn_executor = turn_executor
+        self._chat_leases = chat_leases
+        self._dispatcher_config = dispatcher_config
+        self._leases_config = leases_config
 
         self._logger = logging.getLogger(__name__)
-        self._working_chats: dict[int, bool] = {}
-        self._bg_tasks: list[asyncio.Task] = []
+
+        # chats that were handed off by the queue: waiting in _pending_turns or running
+        self._working_chats: set[int] = set()
+        self._running_turns: dict[int, tuple[asyncio.Task, ChatTurn]] = {}
+
+        # min-heap of (priority, sequence number, entry); the sequence number makes chats
+        # of the same priority take turns in the order they became ready
+        self._pending_turns: list[tuple[tuple[int, int, int], int, LocalQueueEntry]] = []
+        self._turns_counter = itertools.count()
+
+        self._handled_messages = 0
+        self._llm_calls = 0
+
+        # response delays of the turns that have sent something
+        self._answered_turns = 0
+        self._first_byte_time_sum = 0.0
+        self._last_byte_time_sum = 0.0
+
+        # bytes sent to the LLM by the turns that have called it
+        self._requesting_turns = 0
+        self._sent_bytes = 0
+
+        # set on shutdown; turns cancelled before saving their input are kept to be spilled
+        self._is_closing = False
+        self._interrupted_entries: list[LocalQueueEntry] = []
+
+        # circuit breaker: chats that failed lately, in the order of their last failure
+        self._chat_failures: collections.OrderedDict[int, ChatFailures] = collections.OrderedDict()
+
+        self._turn_timeouts = 0
+        self._turn_failures = 0
+        self._quarantined_count = 0
+
+        # chats whose running turns are cancelled because their leases have been lost
+        self._lost_lease_chats: set[int] = set()
+        self._lost_leases = 0
+
+        self.prompt_cache_stats = PromptCacheStats()
+        self.load_shedder = LoadShedder(load_shedding_config)
 
         self.run_task: asyncio.Task | None = None
 
+    @property
+    def working_chats_count(self) -> int:
+        return len(self._running_turns)
+
+    @property
+    def pending_turns_count(self) -> int:
+        return len(self._pending_turns)
+
+    @property
+    def llm_calls_per_message(self) -> float:
+        return self._llm_calls / self._handled_messages if self._handled_messages else 0.0
+
+    @property
+    def average_first_byte_time(self) -> float:
+        return self._first_byte_time_sum / self._answered_turns if self._answered_turns else 0.0
+
+    @property
+    def average_last_byte_time(self) -> float:
+        return self._last_byte_time_sum / self._answered_turns if self._answered_turns else 0.0
+
+    @property
+    def average_sent_bytes(self) -> float:
+        return self._sent_bytes / self._requesting_turns if self._requesting_turns else 0.0
+
+    @property
+    def turn_timeouts_count(self) -> int:
+        return self._turn_timeouts
+
+    @property
+    def turn_failures_count(self) -> int:
+        return self._turn_failures
+
+    @property
+    def quarantined_entries_count(self) -> int:
+        return self._quarantined_count
+
+    @property
+    def lost_leases_count(self) -> int:
+        return self._lost_leases
+
+    def cooling_down_chats(self) -> dict[int, ChatFailures]:
+        current_time = time.time()
+
+        return {
+            chat_id: failures
+            for chat_id, failures in self._chat_failures.items()
+            if failures.cooldown_till > current_time
+        }
+
     async def run(self) -> None:
         while True:
             try:
-                entries_to_handle = self._message_queue.fetch_ready_entries()
+                await self._message_queue.wait()
+
+                entries_to_handle = self._message_queue.fetch_ready_entries(
+                    exclude=self._working_chats
+                )
 
                 self._logger.debug("Handling %s ready entries", len(entries_to_handle))
 
                 for entry in entries_to_handle:
-                    if (
-                        entry.chat_id not in self._working_chats
-                        or not self._working_chats[entry.chat_id]
-                    ):
-                        self._message_queue.clear(entry.chat_id)
+                    self._schedule(entry)
 
-                        coro = self.handle_entry(entry.chat_id, entry)
-                        task = asyncio.create_task(coro)
+                if self._dispatcher_config.latest_wins:
+                    self._restart_outdated_turns()
 
-                        task.add_done_callback(self._bg_tasks.remove)
-                        self._bg_tasks.append(task)
+                self._start_pending_turns()
             except Exception as err:
                 self._logger.error("Cannot handle entries cause of %s", err, exc_info=err)
-            finally:
                 await asyncio.sleep(1)
 
-    async def handle_entry(self, chat_id: int, entry: LocalQueueEntry) -> None:
-        self._logger.debug("Running chat processing for %s: %s", chat_id, entry)
+    async def restore(self) -> None:
+        """Puts the entries spilled on the last shutdown back into the queue"""
 
-        self._working_chats[chat_id] = True
+        start_time = time.perf_counter()
 
         try:
-            async with self._container() as container:
-                # TODO: перед добавлением этих сообщений проверять, сфокусирован ли чат или уже нет
-                message_service = await container.get(MessageService)
-                await message_service.add_messages(chat_id, entry.messages)
+            entries = await self._load_spilled_entries()
+        except Exception as err:
+            self._logger.error("Cannot restore spilled entries cause of %s", err, exc_info=err)
+            return
+
+        for entry in entries:
+            self._message_queue.add(
+                entry.chat_id,
+                entry.chat_type,
+                entry.messages,
+                is_aerith_called=entry.is_aerith_called,
+                from_supporter=entry.from_supporter,
+            )
 
-                processor = await container.get(ChatProcessor)
-                await processor.process(chat_id, entry.chat_type)
+        self._log_timing("Restored", len(entries), start_time)
+
+    async def shutdown(self) -> None:
+        """Stops dispatching, gives running turns time to finish and spills the rest to the db"""
+
+        self._is_closing = True
+
+        if self.run_task is not None:
+            self.run_task.cancel()
+
+        running_tasks = [task for task, _ in self._running_turns.values()]
+
+        if running_tasks:
+            _, unfinished_tasks = await asyncio.wait(
+                running_tasks, timeout=self._dispatcher_config.shutdown_timeout
+            )
+
+            if unfinished_tasks:
+                self._logger.warning(
+                    "Cancelling %s turns that haven't finished in time", len(unfinished_tasks)
+                )
+
+                for task in unfinished_tasks:
+                    task.cancel()
+
+                await asyncio.wait(unfinished_tasks)
+
+        # in the order messages came: interrupted turns, turns waiting for a slot, the buffer
+        entries = self._interrupted_entries + [entry for _, _, entry in self._pending_turns]
+        entries.extend(self._message_queue.drain())
+
+        self._interrupted_entries = []
+        self._pending_turns = []
+
+        if not entries:
+            return
+
+        start_time = time.perf_counter()
+
+        try:
+            await self._spill_entries(entries)
         except Exception as err:
             self._logger.error(
-                "Cannot handle messages for %s cause of %s", chat_id, err, exc_info=err
+                "Cannot spill %s entries cause of %s", len(entries), err, exc_info=err
             )
+            return
+
+        self._log_timing("Spilled", len(entries), start_time)
+
+    async def handle_entry(self, chat_id: int, entry: LocalQueueEntry, turn: ChatTurn) -> bool:
+        """Runs a turn of the chat; False if it was postponed instead of being run"""
+
+        self._logger.debug("Running chat processing for %s: %s", chat_id, entry)
+
+        is_leased = False
+        turn_deadline: asyncio.Timeout | None = None
+
+        started_at = time.monotonic()
+        queued_for = started_at - entry.scheduled_at if entry.scheduled_at is not None else 0.0
+
+        try:
+            if self._hold_if_cooling_down(entry):
+                return False
+
+            is_leased = await self._acquire_lease(chat_id)
+
+            if not is_leased:
+                # another instance is busy with the chat, so try again a bit later
+                self._message_queue.put_back(entry, self._leases_config.retry_interval)
+                return False
+
+            async with asyncio.timeout(self._dispatcher_config.turn_timeout) as turn_deadline:
+                await self._turn_executor.execute(chat_id, entry, turn)
+
+            self._chat_failures.pop(chat_id, None)
+        except asyncio.CancelledError:
+            is_lease_lost = chat_id in self._lost_lease_chats
+            self._lost_lease_chats.discard(chat_id)
+
+            if self._is_closing and not turn.is_input_saved:
+                self._interrupted_entries.append(entry)
+            elif is_lease_lost and not turn.is_input_saved:
+                # the input goes to the turn of whichever instance holds the chat next
+                self._message_queue.put_back(entry, self._leases_config.retry_interval)
+
+            raise
+        except Exception as err:
+            if turn_deadline is not None and turn_deadline.expired():
+                self._turn_timeouts += 1
+                self._logger.warning(
+                    "Turn in %s hasn't finished in %ss and has been cancelled",
+                    chat_id,
+                    self._dispatcher_config.turn_timeout,
+                )
+            else:
+                self._logger.error(
+                    "Cannot handle messages for %s cause of %s", chat_id, err, exc_info=err
+                )
+
+            self._register_failure(chat_id)
         finally:
-            self._working_chats[chat_id] = False
+            if is_leased:
+                self._llm_calls += turn.llm_calls
+
+                if turn.llm_calls:
+                    self._requesting_turns += 1
+                    self._sent_bytes += turn.sent_bytes
+                self._handled_messages += sum(
+                    1 for message in entry.messages if message["role"] == "user"
+                )
+
+                if turn.first_byte_time is not None and turn.last_byte_time is not None:
+                    self._answered_turns += 1
+                    self._first_byte_time_sum += turn.first_byte_time
+                    self._last_byte_time_sum += turn.last_byte_time
+
+                    self.load_shedder.observe_latency(queued_for + turn.last_byte_time)
+
+                if turn.model is not None:
+                    self.prompt_cache_stats.observe(
+                        chat_id, turn.model, turn.prompt_tokens, turn.cached_tokens
+                    )
+
+                await self._release_lease(chat_id)
+
+        return True
+
+    def on_lease_lost(self, chat_id: int) -> None:
+        """Cancels the turn of a chat which may be taken over by another instance any moment"""
+
+        running_turn = self._running_turns.get(chat_id)
+        if running_turn is None:
+            return
+
+        self._lost_leases += 1
+        self._logger.warning("Lease of chat %s has been lost; cancelling its turn", chat_id)
+
+        self._lost_lease_chats.add(chat_id)
+        running_turn[0].cancel()
+
+    def _schedule(self, entry: LocalQueueEntry) -> None:
+        # mark the chat as busy right away, so it's excluded until the turn is over
+        self._working_chats.add(entry.chat_id)
+        entry.scheduled_at = time.monotonic()
+
+        priority = (
+            0 if entry.from_supporter else 1,
+            0 if entry.chat_type == ChatType.private else 1,
+            0 if entry.is_aerith_called else 1,
+        )
+        heapq.heappush(self._pending_turns, (priority, next(self._turns_counter), entry))
+
+    def _start_pending_turns(self) -> None:
+        if self._is_closing:
+            return
+
+        while (
+            self._pending_turns
+            and len(self._running_turns) < self._dispatcher_config.max_concurrent_turns
+        ):
+            _, _, entry = heapq.heappop(self._pending_turns)
+
+            turn = ChatTurn()
+            turn.is_degraded = self.load_shedder.update(len(self._pending_turns))
+
+            task = asyncio.create_task(self.handle_entry(entry.chat_id, entry, turn))
+
+            task.add_done_callback(
+                lambda task, chat_id=entry.chat_id: self._on_turn_done(chat_id, task)
+            )
+            self._running_turns[entry.chat_id] = (task, turn)
+
+        if self._pending_turns:
+            self._logger.debug(
+                "All %s turn slots are busy; %s chats are waiting",
+                self._dispatcher_config.max_concurrent_turns,
+                len(self._pending_turns),
+            )
+
+    def _restart_outdated_turns(self) -> None:
+        for chat_id, (task, turn) in self._running_turns.items():
+            if turn.is_restartable and self._message_queue.is_ready(chat_id):
+                self._logger.info("New input in %s; restarting the turn with it", chat_id)
+
+                # the turn won't be restarted twice: it's not restartable until the next one
+                turn.is_restartable = False
+                task.cancel()
+
+    def _on_turn_done(self, chat_id: int, task: asyncio.Task) -> None:
+        # the chat stays busy until here, so it can't have another turn running meanwhile
+        running_turn = self._running_turns.get(chat_id)
+        if running_turn is not None and running_turn[0] is task:
+            del self._running_turns[chat_id]
+
+        self._working_chats.discard(chat_id)
+
+        # a restarted turn has run too, a postponed one waits for its retry instead
+        has_run = task.cancelled() or (task.exception() is None and task.result())
+
+        if has_run and not self._is_closing:
+            # messages that came while the chat was busy go to the next turn without waiting
+            next_entry = self._message_queue.take(chat_id)
+            if next_entry is not None:
+                self._schedule(next_entry)
+
+        self._start_pending_turns()
+
+    def _hold_if_cooling_down(self, entry: LocalQueueEntry) -> bool:
+        failures = self._chat_failures.get(entry.chat_id)
+        if failures is None:
+            return False
+
+        # once the cool-off is over, the next turn is a probe: a success closes the breaker
+        cooldown_left = failures.cooldown_till - time.time()
+        if cooldown_left <= 0:
+            return False
+
+        if failures.count >= self._dispatcher_config.quarantine_after:
+            self._quarantined_count += 1
+
+            self._logger.warning(
+                "Chat %s keeps failing; holding %s messages for %.0fs",
+                entry.chat_id,
+                len(entry.messages),
+                cooldown_left,
+            )
+
+        # the input waits in the queue and goes to the probe turn once the cool-off is over
+        self._message_queue.put_back(entry, cooldown_left)
+
+        return True
+
+    def _register_failure(self, chat_id: int) -> None:
+        self._turn_failures += 1
+
+        current_time = time.time()
+
+        failures = self._chat_failures.pop(chat_id, None) or ChatFailures()
+        failures.count += 1
+
+        cooldown = min(
+            self._dispatcher_config.failure_cooldown * 2 ** (failures.count - 1),
+            self._dispatcher_config.max_failure_cooldown,
+        )
+        failures.cooldown_till = current_time + cooldown
+
+        self._chat_failures[chat_id] = failures
+        self._forget_failures(current_time)
+
+        self._logger.warning(
+            "Chat %s has failed %s times in a row; cooling off for %ss",
+            chat_id,
+            failures.count,
+            cooldown,
+        )
+
+    def _forget_failures(self, current_time: float) -> None:
+        """Drops the failures of the chats which have been quiet for a while after them"""
+
+        while self._chat_failures:
+            chat_id, failures = next(iter(self._chat_failures.items()))
+
+            is_stale = (
+                failures.cooldown_till + self._dispatcher_config.max_failure_cooldown < current_time
+            )
+            if not is_stale and len(self._chat_failures) <= ChatDispatcher.MAX_TRACKED_FAILURES:
+                break
+
+            del self._chat_failures[chat_id]
+
+    async def _acquire_lease(self, chat_id: int) -> bool:
+        try:
+            return await self._chat_leases.acquire(chat_id)
+        except Exception as err:
+            self._logger.error("Cannot lease chat %s cause of %s", chat_id, err, exc_info=err)
+            return False
+
+    async def _release_lease(self, chat_id: int) -> None:
+        try:
+            await self._chat_leases.release(chat_id)
+        except Exception as err:
+            # the lease will expire by itself
+            self._logger.error("Cannot release chat %s cause of %s", chat_id, err, exc_info=err)
+
+    async def _spill_entries(self, entries: list[LocalQueueEntry]) -> None:
+        async with AsyncSession(self._db_engine) as session:
+            session.add_all(
+                SpilledQueueEntry(
+                    chat_id=entry.chat_id,
+                    chat_type=entry.chat_type.value,
+                    messages=entry.messages,
+                    is_aerith_called=entry.is_aerith_called,
+                    from_supporter=entry.from_supporter,
+                )
+                for entry in entries
+            )
+            await session.commit()
+
+    async def _load_spilled_entries(self) -> list[LocalQueueEntry]:
+        async with AsyncSession(self._db_engine) as session:
+            # taken and deleted in one statement, so instances starting together don't restore
+            # the same entries and the ones spilled meanwhile are left for the next restore
+            spilled_entries = list(
+                await session.scalars(delete(SpilledQueueEntry).returning(SpilledQueueEntry))
+            )
+            await session.commit()
+
+        # ids are uuid7, so they keep the order entries were spilled in
+        spilled_entries.sort(key=lambda spilled_entry: spilled_entry.id)
+
+        entries = []
+        for spilled_entry in spilled_entries:
+            entry = LocalQueueEntry(
+                spilled_entry.chat_id, ChatType(spilled_entry.chat_type), spilled_entry.messages
+            )
+            entry.is_aerith_called = spilled_entry.is_aerith_called
+            entry.from_supporter = spilled_entry.from_supporter
+
+            entries.append(entry)
+
+        return entries
+
+    def _log_timing(self, action: str, entries_count: int, start_time: float) -> None:
+        elapsed_time = time.perf_counter() - start_time
+
+        self._logger.info(
+            "%s %s queue entries in %.3fs (%.2fms per entry)",
+            action,
+            entries_count,
+            elapsed_time,
+            elapsed_time * 1000 / entries_count if entries_count else 0,
+        )
@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections.abc import Callable
+
+from sqlalchemy import ColumnElement, delete, func, or_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from aerith_cbot.config import LeasesConfig
+from aerith_cbot.database.models import ChatLease
+
+
+class ChatLeases(ABC):
+    """Makes sure a chat is processed by one bot instance at a time
+
+    A lease is held for the duration of a turn and renewed by heartbeats (`run`); if its owner
+    dies, the lease expires and another instance takes the chat over. An instance that couldn't
+    renew a lease in time reports it lost, so its turn is stopped before the chat is taken over.
+    """
+
+    def __init__(self, leases_config: LeasesConfig) -> None:
+        self._leases_config = leases_config
+        self.owner = make_owner_id()
+
+        self._logger = logging.getLogger(__name__)
+
+        self._held_chats: set[int] = set()
+        # chat_id -> monotonic time of the last extension, taken before it was asked for
+        self._renewed_at: dict[int, float] = {}
+
+        self.run_task: asyncio.Task | None = None
+
+    @abstractmethod
+    async def acquire(self, chat_id: int) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def release(self, chat_id: int) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def renew(self) -> set[int]:
+        """Extends the held leases; returns the chats which are still held"""
+        raise NotImplementedError
+
+    async def run(self, on_lost: Callable[[int], None]) -> None:
+        """Renews the leases by heartbeats, calls `on_lost` with the chats no longer held"""
+
+        while True:
+            try:
+                await asyncio.sleep(self._leases_config.heartbeat_interval)
+
+                held_chats = set(self._held_chats)
+                started_at = time.monotonic()
+
+                try:
+                    # a hung connection counts as a failed renewal, so expiring leases are noticed
+                    async with asyncio.timeout(self._leases_config.heartbeat_interval):
+                        renewed_chats = await self.renew()
+                except Exception as err:
+                    self._logger.error("Cannot renew chat leases cause of %s", err, exc_info=err)
+
+                    # the leases may expire before the next heartbeat gets through
+                    renewed_chats = {
+                        chat_id for chat_id in held_chats if not self._is_expiring(chat_id)
+                    }
+                else:
+                    for chat_id in renewed_chats & self._held_chats:
+                        self._renewed_at[chat_id] = started_at
+
+                # the chats released meanwhile aren't lost
+                for chat_id in (held_chats - renewed_chats) & self._held_chats:
+                    self._forget(chat_id)
+                    on_lost(chat_id)
+            except Exception as err:
+                self._logger.error("Cannot check chat leases cause of %s", err, exc_info=err)
+
+    def _hold(self, chat_id: int, renewed_at: float) -> None:
+        self._held_chats.add(chat_id)
+        self._renewed_at[chat_id] = renewed_at
+
+    def _forget(self, chat_id: int) -> None:
+        self._held_chats.discard(chat_id)
+        self._renewed_at.pop(chat_id, None)
+
+    def _is_expiring(self, chat_id: int) -> bool:
+        renewed_at = self._renewed_at.get(chat_id)
+        if renewed_at is None:
+            return True
+
+        # the lease is taken for `ttl` from a clock read after `renewed_at`
+        time_left = renewed_at + self._leases_config.ttl - time.monotonic()
+        return time_left <= self._leases_config.heartbeat_interval
+
+
+def make_owner_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+class InMemoryChatLeases(ChatLeases):
+    """Leases of a single bot instance"""
+
+    def __init__(self, leases_config: LeasesConfig) -> None:
+        super().__init__(leases_config)
+
+        # chat_id -> (owner, expires_at)
+        self._leases: dict[int, tuple[str, float]] = {}
+
+    async def acquire(self, chat_id: int) -> bool:
+        started_at = time.monotonic()
+        current_time = time.time()
+
+        lease = self._leases.get(chat_id)
+        if lease is not None and lease[0] != self.owner and lease[1] > current_time:
+            return False
+
+        self._leases[chat_id] = (self.owner, current_time + self._leases_config.ttl)
+        self._hold(chat_id, started_at)
+        return True
+
+    async def release(self, chat_id: int) -> None:
+        self._forget(chat_id)
+
+        lease = self._leases.get(chat_id)
+        if lease is not None and lease[0] == self.owner:
+            del self._leases[chat_id]
+
+    async def renew(self) -> set[int]:
+        expires_at = time.time() + self._leases_config.ttl
+
+        renewed_chats = set()
+        for chat_id in self._held_chats:
+            lease = self._leases.get(chat_id)
+            if lease is not None and lease[0] == self.owner:
+                self._leases[chat_id] = (self.owner, expires_at)
+                renewed_chats.add(chat_id)
+
+        return renewed_chats
+
+
+class DbChatLeases(ChatLeases):
+    """Leases shared by bot instances through the chat_leases table"""
+
+    def __init__(self, db_engine: AsyncEngine, leases_config: LeasesConfig) -> None:
+        super().__init__(leases_config)
+
+        self._db_engine = db_engine
+
+    async def acquire(self, chat_id: int) -> bool:
+        started_at = time.monotonic()
+
+        # take the lease if it's free, expired or already ours in one statement
+        statement = insert(ChatLease).values(
+            chat_id=chat_id, owner=self.owner, expires_at=_db_time() + self._leases_config.ttl
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[ChatLease.chat_id],
+            set_={"owner": statement.excluded.owner, "expires_at": statement.excluded.expires_at},
+            where=or_(ChatLease.expires_at < _db_time(), ChatLease.owner == self.owner),
+        ).returning(ChatLease.chat_id)
+
+        async with AsyncSession(self._db_engine) as session:
+            leased_chat_id = (await session.execute(statement)).scalar_one_or_none()
+            await session.commit()
+
+        if leased_chat_id is None:
+            return False
+
+        self._hold(chat_id, started_at)
+        return True
+
+    async def release(self, chat_id: int) -> None:
+        self._forget(chat_id)
+
+        async with AsyncSession(self._db_engine) as session:
+            await session.execute(
+                delete(ChatLease).where(ChatLease.chat_id == chat_id, ChatLease.owner == self.owner)
+            )
+            await session.commit()
+
+    async def renew(self) -> set[int]:
+        if not self._held_chats:
+            return set()
+
+        async with AsyncSession(self._db_engine) as session:
+            result = await session.execute(
+                update(ChatLease)
+                .where(ChatLease.chat_id.in_(self._held_chats), ChatLease.owner == self.owner)
+                .values(expires_at=_db_time() + self._leases_config.ttl)
+                .returning(ChatLease.chat_id)
+            )
+            renewed_chats = set(result.scalars())
+            await session.commit()
+
+        return renewed_chats
+
+
+def _db_time() -> ColumnElement[float]:
+    # the clock of the db, so the instances don't depend on their own clocks being in sync
+    return func.extract("epoch", func.now())
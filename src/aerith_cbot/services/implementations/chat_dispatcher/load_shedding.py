@@ -0,0 +1,78 @@
+import collections
+import logging
+import time
+
+from aerith_cbot.config import LoadSheddingConfig
+
+
+class LoadShedder:
+    """Decides when turns are degraded to keep replies fast under load
+
+    The switch has hysteresis: it turns on at the high marks and off only when both the backlog
+    and the latency are down to the low ones, so it doesn't flap around a single threshold.
+    """
+
+    # replies the latency percentile is taken over; older ones say little about the load now
+    LATENCY_WINDOW = 100
+    LATENCY_MAX_AGE = 300
+
+    def __init__(self, load_shedding_config: LoadSheddingConfig) -> None:
+        self._load_shedding_config = load_shedding_config
+        self._logger = logging.getLogger(__name__)
+
+        # (time of the reply, seconds from handoff to the last text)
+        self._latencies: collections.deque[tuple[float, float]] = collections.deque(
+            maxlen=LoadShedder.LATENCY_WINDOW
+        )
+
+        self.is_shedding = False
+        self.switches_count = 0
+        self.degraded_turns_count = 0
+
+    def observe_latency(self, latency: float) -> None:
+        self._latencies.append((time.monotonic(), latency))
+
+    def p95_latency(self) -> float:
+        oldest_time = time.monotonic() - LoadShedder.LATENCY_MAX_AGE
+        latencies = sorted(latency for at, latency in self._latencies if at >= oldest_time)
+
+        if not latencies:
+            return 0.0
+
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def update(self, pending_turns: int) -> bool:
+        """Re-evaluates the load; returns whether the next turn should be degraded"""
+
+        if not self._load_shedding_config.enabled:
+            return False
+
+        config = self._load_shedding_config
+        p95_latency = self.p95_latency()
+
+        if not self.is_shedding and (
+            pending_turns >= config.high_pending_turns or p95_latency >= config.high_latency
+        ):
+            self._switch(True, pending_turns, p95_latency)
+        elif (
+            self.is_shedding
+            and pending_turns <= config.low_pending_turns
+            and p95_latency <= config.low_latency
+        ):
+            self._switch(False, pending_turns, p95_latency)
+
+        if self.is_shedding:
+            self.degraded_turns_count += 1
+
+        return self.is_shedding
+
+    def _switch(self, is_shedding: bool, pending_turns: int, p95_latency: float) -> None:
+        self.is_shedding = is_shedding
+        self.switches_count += 1
+
+        self._logger.warning(
+            "Load shedding is %s: %s turns waiting, p95 reply latency %.1fs",
+            "on" if is_shedding else "off",
+            pending_turns,
+            p95_latency,
+        )
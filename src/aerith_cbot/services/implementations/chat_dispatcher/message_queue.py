@@ -1,58 +1,406 @@
-import copy
+import asyncio
+import heapq
 import logging
-import random
 import time
+from collections import OrderedDict
+from collections.abc import Container
+from typing import ClassVar
 
 from aerith_cbot.services.abstractions.models import ChatType
 
 
 class LocalQueueEntry:
-    def __init__(self, chat_id: int, chat_type: ChatType, messages: list[dict]) -> None:
+    def __init__(
+        self, chat_id: int, chat_type: ChatType, messages: list[dict], size: int | None = None
+    ) -> None:
         self.chat_id = chat_id
         self.chat_type = chat_type
         self.messages = messages
         self.last_updated = time.time()
+        self.deadline: float | None = None
+        # when the dispatcher has taken it from the queue (monotonic), to measure reply latency
+        self.scheduled_at: float | None = None
+        self.size = sum(_message_size(message) for message in messages) if size is None else size
+
+        # moving average of the time between adds, None until the second one
+        self.arrival_interval: float | None = None
+
+        # scheduling hints for the dispatcher
+        self.is_aerith_called = False
+        self.from_supporter = False
 
     def __repr__(self) -> str:
         return f"{self.chat_id}/{self.chat_type}/{self.last_updated}: {self.messages}"
 
 
+class BatchingPolicy:
+    """Debounce limits of one chat type
+
+    The window follows the observed interval between messages: if the next message is likely
+    to come within `max_window`, the queue waits a bit longer than the usual interval for it,
+    otherwise waiting is useless and `min_window` is used. The count limit grows with the rate
+    up to `max_count`, so fast chats are answered once per burst instead of every few messages.
+    """
+
+    def __init__(
+        self, min_window: float, max_window: float, min_count: int, max_count: int
+    ) -> None:
+        self.min_window = min_window
+        self.max_window = max_window
+        self.min_count = min_count
+        self.max_count = max_count
+
+
+class MessageQueueStats:
+    def __init__(
+        self,
+        chats: int,
+        buffered_chats: int,
+        buffered_messages: int,
+        buffered_bytes: int,
+        dropped_messages: int,
+        evicted_entries: int,
+        average_windows: dict[ChatType, float],
+    ) -> None:
+        self.chats = chats
+        self.buffered_chats = buffered_chats
+        self.buffered_messages = buffered_messages
+        self.buffered_bytes = buffered_bytes
+        self.dropped_messages = dropped_messages
+        self.evicted_entries = evicted_entries
+        self.average_windows = average_windows
+
+    def __repr__(self) -> str:
+        return f"MessageQueueStats(\
+        chats={self.chats}, \
+        buffered_chats={self.buffered_chats}, \
+        buffered_messages={self.buffered_messages}, \
+        buffered_bytes={self.buffered_bytes}, \
+        dropped_messages={self.dropped_messages}, \
+        evicted_entries={self.evicted_entries}, \
+        average_windows={self.average_windows})"
+
+
 class MessageQueue:
-    TIME_LIMIT_LOWER_BOUND = 2
-    TIME_LIMIT_UPPER_BOUND = 3
-    COUNT_LIMIT = 4
+    MAX_ENTRY_MESSAGES = 50
+    IDLE_ENTRY_TTL = 3600
+
+    # weight of the newest interval in the moving average and the longest interval it counts;
+    # a pause longer than that is just a quiet chat, not a reason to wait
+    ARRIVAL_SMOOTHING = 0.3
+    MAX_ARRIVAL_INTERVAL = 30
+    WINDOW_TO_INTERVAL = 1.5
+
+    BATCHING_POLICIES: ClassVar[dict[ChatType, BatchingPolicy]] = {
+        ChatType.private: BatchingPolicy(min_window=0.5, max_window=3, min_count=4, max_count=4),
+        ChatType.group: BatchingPolicy(min_window=1, max_window=5, min_count=4, max_count=20),
+    }
 
     def __init__(self) -> None:
         self._logger = logging.getLogger(__name__)
-        self._local_entries: dict[int, LocalQueueEntry] = {}
 
-    def add(self, chat_id: int, chat_type: ChatType, messages: list[dict]) -> None:
+        # ordered by the last update, so idle entries are always at the beginning
+        self._local_entries: OrderedDict[int, LocalQueueEntry] = OrderedDict()
+
+        self._dropped_messages = 0
+        self._evicted_entries = 0
+
+        # min-heap of (deadline, chat_id); an item is stale if it doesn't match entry.deadline
+        self._deadlines: list[tuple[float, int]] = []
+        self._wakeup = asyncio.Event()
+
+        # chat type -> (sum of chosen windows, their count)
+        self._windows: dict[ChatType, tuple[float, int]] = {}
+
+    def add(
+        self,
+        chat_id: int,
+        chat_type: ChatType,
+        messages: list[dict],
+        is_aerith_called: bool = False,
+        from_supporter: bool = False,
+    ) -> None:
         self._logger.debug("Addding new messages in %s/%s chat: %s", chat_id, chat_type, messages)
 
         if chat_id not in self._local_entries:
-            self._local_entries[chat_id] = LocalQueueEntry(chat_id, chat_type, messages)
+            entry = LocalQueueEntry(chat_id, chat_type, messages)
+            self._local_entries[chat_id] = entry
+        else:
+            entry = self._local_entries[chat_id]
+
+            current_time = time.time()
+            self._track_arrival(entry, current_time - entry.last_updated)
+
+            entry.last_updated = current_time
+            entry.messages.extend(messages)
+            entry.size += sum(_message_size(message) for message in messages)
+
+            self._local_entries.move_to_end(chat_id)
+
+        entry.is_aerith_called = entry.is_aerith_called or is_aerith_called
+        entry.from_supporter = entry.from_supporter or from_supporter
+
+        if len(entry.messages) > MessageQueue.MAX_ENTRY_MESSAGES:
+            self._drop_oldest(entry)
+
+        if len(entry.messages) > self._count_limit(entry):
+            self._arm(entry, entry.last_updated)
         else:
-            self._local_entries[chat_id].last_updated = time.time()
-            self._local_entries[chat_id].messages.extend(messages)
+            window = self._window(entry)
+            self._track_window(entry.chat_type, window)
+
+            self._logger.debug("Debounce window for %s: %.2fs", chat_id, window)
+
+            self._arm(entry, entry.last_updated + window)
+
+    def take(self, chat_id: int) -> LocalQueueEntry | None:
+        """Hands off the pending messages of the chat right away, ignoring its deadline"""
+
+        entry = self._local_entries.get(chat_id)
+        if entry is None or not entry.messages:
+            return None
+
+        return self._take(entry)
+
+    def put_back(self, entry: LocalQueueEntry, delay: float) -> None:
+        """Returns handed off messages in front of the chat's buffer, ready again after `delay`"""
+
+        buffered_entry = self._local_entries.get(entry.chat_id)
+
+        if buffered_entry is None:
+            buffered_entry = LocalQueueEntry(entry.chat_id, entry.chat_type, [], size=0)
+            self._local_entries[entry.chat_id] = buffered_entry
+
+        buffered_entry.messages = entry.messages + buffered_entry.messages
+        buffered_entry.size += entry.size
+        buffered_entry.is_aerith_called = buffered_entry.is_aerith_called or entry.is_aerith_called
+        buffered_entry.from_supporter = buffered_entry.from_supporter or entry.from_supporter
+
+        if len(buffered_entry.messages) > MessageQueue.MAX_ENTRY_MESSAGES:
+            self._drop_oldest(buffered_entry)
+
+        self._arm(buffered_entry, time.time() + delay)
+
+    def drain(self) -> list[LocalQueueEntry]:
+        """Hands off the pending messages of every chat, ready or not"""
+
+        return [self._take(entry) for entry in self._local_entries.values() if entry.messages]
+
+    def is_ready(self, chat_id: int) -> bool:
+        entry = self._local_entries.get(chat_id)
+
+        return (
+            entry is not None
+            and bool(entry.messages)
+            and entry.deadline is not None
+            and entry.deadline <= time.time()
+        )
+
+    def fetch_ready_entries(self, exclude: Container[int] = ()) -> list[LocalQueueEntry]:
+        """Hands off the pending messages of every ready chat to the caller
+
+        The returned entries own their message lists: the queue starts a fresh buffer for the chat
+        instead of copying. Ready chats from `exclude` keep their messages until `take` is called.
+        """
 
-    def fetch_ready_entries(self) -> list[LocalQueueEntry]:
         ready_entries = []
         current_time = time.time()
 
-        for chat_id, entry in self._local_entries.items():
-            if entry.messages and (
-                current_time - entry.last_updated
-                > random.randint(
-                    MessageQueue.TIME_LIMIT_LOWER_BOUND, MessageQueue.TIME_LIMIT_UPPER_BOUND
-                )
-                or len(entry.messages) > MessageQueue.COUNT_LIMIT
-            ):
-                ready_entries.append(copy.deepcopy(entry))
+        self._evict_idle(current_time)
+
+        while self._deadlines and self._deadlines[0][0] <= current_time:
+            deadline, chat_id = heapq.heappop(self._deadlines)
+
+            entry = self._local_entries.get(chat_id)
+            if entry is None or entry.deadline != deadline:
+                continue
+
+            if entry.messages and chat_id not in exclude:
+                ready_entries.append(self._take(entry))
 
         return ready_entries
 
+    def next_deadline(self) -> float | None:
+        while self._deadlines:
+            deadline, chat_id = self._deadlines[0]
+
+            entry = self._local_entries.get(chat_id)
+            if entry is not None and entry.deadline == deadline:
+                return deadline
+
+            heapq.heappop(self._deadlines)
+
+        return None
+
+    async def wait(self) -> None:
+        """Sleeps until the nearest deadline passes or a new one is armed"""
+
+        self._wakeup.clear()
+
+        deadline = self.next_deadline()
+        timeout = None if deadline is None else max(deadline - time.time(), 0)
+
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except TimeoutError:
+            pass
+
+    async def wait_ready_entries(self, exclude: Container[int] = ()) -> list[LocalQueueEntry]:
+        """Sleeps until there are ready entries and hands them off"""
+
+        while True:
+            ready_entries = self.fetch_ready_entries(exclude)
+            if ready_entries:
+                return ready_entries
+
+            await self.wait()
+
     def clear(self, chat_id: int) -> None:
         self._logger.debug("Clearing message_queue for chat %s", chat_id)
 
         if chat_id in self._local_entries:
-            self._local_entries[chat_id].messages.clear()
+            self._local_entries[chat_id].messages = []
+            self._local_entries[chat_id].size = 0
+            self._local_entries[chat_id].deadline = None
+            self._local_entries[chat_id].is_aerith_called = False
+            self._local_entries[chat_id].from_supporter = False
+
+    def stats(self) -> MessageQueueStats:
+        buffered_chats = 0
+        buffered_messages = 0
+        buffered_bytes = 0
+
+        for entry in self._local_entries.values():
+            if entry.messages:
+                buffered_chats += 1
+                buffered_messages += len(entry.messages)
+                buffered_bytes += entry.size
+
+        return MessageQueueStats(
+            chats=len(self._local_entries),
+            buffered_chats=buffered_chats,
+            buffered_messages=buffered_messages,
+            buffered_bytes=buffered_bytes,
+            dropped_messages=self._dropped_messages,
+            evicted_entries=self._evicted_entries,
+            average_windows={
+                chat_type: total / count for chat_type, (total, count) in self._windows.items()
+            },
+        )
+
+    def _window(self, entry: LocalQueueEntry) -> float:
+        policy = MessageQueue.BATCHING_POLICIES[entry.chat_type]
+
+        # nothing is known about the chat yet, and a second message would make it wait longer
+        if entry.arrival_interval is None:
+            return policy.min_window
+
+        window = entry.arrival_interval * MessageQueue.WINDOW_TO_INTERVAL
+
+        if window > policy.max_window:
+            return policy.min_window
+
+        return max(window, policy.min_window)
+
+    def _count_limit(self, entry: LocalQueueEntry) -> int:
+        policy = MessageQueue.BATCHING_POLICIES[entry.chat_type]
+
+        if not entry.arrival_interval:
+            return policy.min_count
+
+        # about as many messages as come during the longest window
+        count_limit = round(policy.max_window / entry.arrival_interval)
+        return min(max(count_limit, policy.min_count), policy.max_count)
+
+    def _track_arrival(self, entry: LocalQueueEntry, interval: float) -> None:
+        interval = min(interval, MessageQueue.MAX_ARRIVAL_INTERVAL)
+
+        if entry.arrival_interval is None:
+            entry.arrival_interval = interval
+        else:
+            entry.arrival_interval = (
+                MessageQueue.ARRIVAL_SMOOTHING * interval
+                + (1 - MessageQueue.ARRIVAL_SMOOTHING) * entry.arrival_interval
+            )
+
+    def _track_window(self, chat_type: ChatType, window: float) -> None:
+        total, count = self._windows.get(chat_type, (0.0, 0))
+        self._windows[chat_type] = (total + window, count + 1)
+
+    def _arm(self, entry: LocalQueueEntry, deadline: float) -> None:
+        entry.deadline = deadline
+        heapq.heappush(self._deadlines, (deadline, entry.chat_id))
+
+        self._wakeup.set()
+
+    def _take(self, entry: LocalQueueEntry) -> LocalQueueEntry:
+        # the size is already known, so the messages aren't serialized again
+        ready_entry = LocalQueueEntry(entry.chat_id, entry.chat_type, entry.messages, entry.size)
+        ready_entry.last_updated = entry.last_updated
+        ready_entry.is_aerith_called = entry.is_aerith_called
+        ready_entry.from_supporter = entry.from_supporter
+
+        entry.deadline = None
+        entry.messages = []
+        entry.size = 0
+        entry.is_aerith_called = False
+        entry.from_supporter = False
+
+        return ready_entry
+
+    def _drop_oldest(self, entry: LocalQueueEntry) -> None:
+        """Drops the oldest user messages of a flooding chat, system instructions are kept"""
+
+        overflow = len(entry.messages) - MessageQueue.MAX_ENTRY_MESSAGES
+        kept_messages = []
+
+        for message in entry.messages:
+            if overflow > 0 and message["role"] != "system":
+                overflow -= 1
+                entry.size -= _message_size(message)
+            else:
+                kept_messages.append(message)
+
+        dropped_count = len(entry.messages) - len(kept_messages)
+        self._dropped_messages += dropped_count
+
+        self._logger.warning(
+            "Chat %s floods the queue; dropped %s oldest messages", entry.chat_id, dropped_count
+        )
+
+        entry.messages = kept_messages
+
+    def _evict_idle(self, current_time: float) -> None:
+        stale_chat_ids = []
+        for chat_id, entry in self._local_entries.items():
+            if current_time - entry.last_updated <= MessageQueue.IDLE_ENTRY_TTL:
+                break
+
+            stale_chat_ids.append(chat_id)
+
+        for chat_id in stale_chat_ids:
+            if self._local_entries[chat_id].messages:
+                # still waiting for its turn (e.g. the chat is busy), so it's not idle
+                self._local_entries.move_to_end(chat_id)
+                continue
+
+            del self._local_entries[chat_id]
+            self._evicted_entries += 1
+
+            self._logger.debug("Evicted idle queue entry of chat %s", chat_id)
+
+
+def _message_size(message: dict) -> int:
+    # the length of its texts and links: the rest is small, and it's counted on every add
+    content = message.get("content")
+    if isinstance(content, str):
+        return len(content)
+
+    size = 0
+    for part in content or ():
+        if part.get("type") == "text":
+            size += len(part.get("text", ""))
+        elif part.get("type") == "image_url":
+            size += len(part.get("image_url", {}).get("url", ""))
+
+    return size
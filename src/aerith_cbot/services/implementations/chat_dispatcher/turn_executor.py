@@ -0,0 +1,34 @@
+from abc import ABC, abstractmethod
+
+from dishka import AsyncContainer
+
+from aerith_cbot.services.abstractions import MessageService
+from aerith_cbot.services.abstractions.processors import ChatProcessor, ChatTurn
+
+from .message_queue import LocalQueueEntry
+
+
+class TurnExecutor(ABC):
+    @abstractmethod
+    async def execute(self, chat_id: int, entry: LocalQueueEntry, turn: ChatTurn) -> None:
+        raise NotImplementedError
+
+
+class LocalTurnExecutor(TurnExecutor):
+    """Runs chat turns in the current process"""
+
+    def __init__(self, container: AsyncContainer) -> None:
+        self._container = container
+
+    async def execute(self, chat_id: int, entry: LocalQueueEntry, turn: ChatTurn) -> None:
+        async with self._container() as container:
+            # TODO: перед добавлением этих сообщений проверять, сфокусирован ли чат или уже нет
+            message_service = await container.get(MessageService)
+            await message_service.add_messages(chat_id, entry.messages)
+
+            # the input is saved, so a restarted turn will see it along with the newer one
+            turn.is_input_saved = True
+            turn.is_restartable = True
+
+            processor = await container.get(ChatProcessor)
+            await processor.process(chat_id, entry.chat_type, turn)
@@ -0,0 +1,324 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import queue
+from abc import ABC, abstractmethod
+
+from aerith_cbot.config import WorkersConfig
+from aerith_cbot.services.abstractions.processors import ChatTurn
+
+from .message_queue import LocalQueueEntry
+from .turn_executor import TurnExecutor
+
+
+class TurnCommand:
+    """Starts a turn in a worker, or cancels it if there is no entry"""
+
+    def __init__(
+        self, turn_id: int, entry: LocalQueueEntry | None, is_degraded: bool = False
+    ) -> None:
+        self.turn_id = turn_id
+        self.entry = entry
+        self.is_degraded = is_degraded
+
+    def __repr__(self) -> str:
+        return f"TurnCommand(\
+        turn_id={self.turn_id}, \
+        entry={self.entry}, \
+        is_degraded={self.is_degraded})"
+
+
+class TurnReport:
+    def __init__(
+        self,
+        turn_id: int,
+        is_input_saved: bool,
+        llm_calls: int,
+        error: str | None = None,
+        first_byte_time: float | None = None,
+        last_byte_time: float | None = None,
+        model: str | None = None,
+        prompt_tokens: int = 0,
+        cached_tokens: int = 0,
+        sent_bytes: int = 0,
+    ) -> None:
+        self.turn_id = turn_id
+        self.is_input_saved = is_input_saved
+        self.llm_calls = llm_calls
+        self.error = error
+        self.first_byte_time = first_byte_time
+        self.last_byte_time = last_byte_time
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.cached_tokens = cached_tokens
+        self.sent_bytes = sent_bytes
+
+    def __repr__(self) -> str:
+        return f"TurnReport(\
+        turn_id={self.turn_id}, \
+        is_input_saved={self.is_input_saved}, \
+        llm_calls={self.llm_calls}, \
+        error={self.error}, \
+        first_byte_time={self.first_byte_time}, \
+        last_byte_time={self.last_byte_time}, \
+        model={self.model}, \
+        prompt_tokens={self.prompt_tokens}, \
+        cached_tokens={self.cached_tokens}, \
+        sent_bytes={self.sent_bytes})"
+
+
+class WorkerTurnError(Exception):
+    """A turn has failed in a worker process"""
+
+
+class WorkerTransport(ABC):
+    """Carries commands from the bot process to workers and reports back
+
+    A `None` command stops the worker.
+    """
+
+    @abstractmethod
+    async def send_command(self, worker_id: int, command: TurnCommand | None) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def receive_command(self, worker_id: int) -> TurnCommand | None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def send_report(self, report: TurnReport) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def receive_report(self) -> TurnReport:
+        raise NotImplementedError
+
+
+class LocalWorkerTransport(WorkerTransport):
+    """Workers in the same event loop; a stand-in for tests and local runs"""
+
+    def __init__(self, workers_count: int) -> None:
+        self._commands: list[asyncio.Queue[TurnCommand | None]] = [
+            asyncio.Queue() for _ in range(workers_count)
+        ]
+        self._reports: asyncio.Queue[TurnReport] = asyncio.Queue()
+
+    async def send_command(self, worker_id: int, command: TurnCommand | None) -> None:
+        await self._commands[worker_id].put(command)
+
+    async def receive_command(self, worker_id: int) -> TurnCommand | None:
+        return await self._commands[worker_id].get()
+
+    async def send_report(self, report: TurnReport) -> None:
+        await self._reports.put(report)
+
+    async def receive_report(self) -> TurnReport:
+        return await self._reports.get()
+
+
+class ProcessWorkerTransport(WorkerTransport):
+    """Workers in separate processes, connected with multiprocessing queues"""
+
+    # blocking gets run in threads; the timeout lets those threads exit with the event loop
+    POLL_INTERVAL = 1
+
+    def __init__(self, workers_count: int) -> None:
+        context = multiprocessing.get_context("spawn")
+
+        self._commands = [context.Queue() for _ in range(workers_count)]
+        self._reports = context.Queue()
+
+    async def send_command(self, worker_id: int, command: TurnCommand | None) -> None:
+        self._commands[worker_id].put(command)
+
+    async def receive_command(self, worker_id: int) -> TurnCommand | None:
+        return await self._get(self._commands[worker_id])
+
+    async def send_report(self, report: TurnReport) -> None:
+        self._reports.put(report)
+
+    async def receive_report(self) -> TurnReport:
+        return await self._get(self._reports)
+
+    async def _get(self, source: multiprocessing.Queue):
+        while True:
+            try:
+                return await asyncio.to_thread(
+                    source.get, timeout=ProcessWorkerTransport.POLL_INTERVAL
+                )
+            except queue.Empty:
+                continue
+
+
+class WorkerPoolTurnExecutor(TurnExecutor):
+    """Runs chat turns in worker processes
+
+    A chat always goes to the same worker (by the hash of its id), so its turns stay ordered.
+    Workers report only when a turn is over, so `latest_wins` can't restart their turns. A
+    cancelled turn which the worker hasn't reported yet may still be running there, so the
+    next turn of its chat isn't sent until it is.
+    """
+
+    # how long a cancelled turn is waited for to learn whether its input was saved
+    CANCEL_TIMEOUT = 5
+
+    def __init__(self, transport: WorkerTransport, workers_config: WorkersConfig) -> None:
+        self._transport = transport
+        self._workers_config = workers_config
+
+        self._logger = logging.getLogger(__name__)
+
+        self._turn_ids = itertools.count()
+        self._reports: dict[int, asyncio.Future[TurnReport]] = {}
+        # chat_id -> the report of its cancelled turn the worker hasn't confirmed yet
+        self._unconfirmed_cancels: dict[int, asyncio.Future[TurnReport]] = {}
+
+        self._read_task: asyncio.Task | None = None
+
+    def worker_for(self, chat_id: int) -> int:
+        return hash(chat_id) % self._workers_config.count
+
+    async def execute(self, chat_id: int, entry: LocalQueueEntry, turn: ChatTurn) -> None:
+        if self._read_task is None:
+            self._read_task = asyncio.create_task(self._read_reports())
+
+        unconfirmed_cancel = self._unconfirmed_cancels.get(chat_id)
+        if unconfirmed_cancel is not None:
+            self._logger.info("Turn in %s waits until the previous one is cancelled", chat_id)
+            await asyncio.shield(unconfirmed_cancel)
+
+        turn_id = next(self._turn_ids)
+        worker_id = self.worker_for(chat_id)
+
+        report_future = asyncio.get_running_loop().create_future()
+        self._reports[turn_id] = report_future
+
+        try:
+            await self._transport.send_command(
+                worker_id, TurnCommand(turn_id, entry, turn.is_degraded)
+            )
+
+            try:
+                report = await asyncio.shield(report_future)
+            except asyncio.CancelledError:
+                await self._transport.send_command(worker_id, TurnCommand(turn_id, None))
+
+                try:
+                    report = await asyncio.wait_for(
+                        asyncio.shield(report_future), WorkerPoolTurnExecutor.CANCEL_TIMEOUT
+                    )
+                    self._apply_report(turn, report)
+                except TimeoutError:
+                    self._logger.warning("Worker %s hasn't cancelled turn %s", worker_id, turn_id)
+
+                    # it may still be running there, the chat isn't free until it's reported
+                    self._unconfirmed_cancels[chat_id] = report_future
+                    report_future.add_done_callback(
+                        lambda _: self._on_cancel_confirmed(chat_id, turn_id, report_future)
+                    )
+
+                raise
+
+            self._apply_report(turn, report)
+
+            if report.error is not None:
+                raise WorkerTurnError(f"worker {worker_id}: {report.error}")
+        finally:
+            if self._unconfirmed_cancels.get(chat_id) is not report_future:
+                self._reports.pop(turn_id, None)
+
+    def _on_cancel_confirmed(
+        self, chat_id: int, turn_id: int, report_future: asyncio.Future[TurnReport]
+    ) -> None:
+        self._reports.pop(turn_id, None)
+
+        if self._unconfirmed_cancels.get(chat_id) is report_future:
+            del self._unconfirmed_cancels[chat_id]
+
+        self._logger.info("Turn %s in %s has been cancelled at last", turn_id, chat_id)
+
+    async def _read_reports(self) -> None:
+        while True:
+            report = await self._transport.receive_report()
+
+            report_future = self._reports.get(report.turn_id)
+            if report_future is not None and not report_future.done():
+                report_future.set_result(report)
+
+    def _apply_report(self, turn: ChatTurn, report: TurnReport) -> None:
+        turn.is_input_saved = report.is_input_saved
+        turn.llm_calls = report.llm_calls
+        turn.first_byte_time = report.first_byte_time
+        turn.last_byte_time = report.last_byte_time
+        turn.model = report.model
+        turn.prompt_tokens = report.prompt_tokens
+        turn.cached_tokens = report.cached_tokens
+        turn.sent_bytes = report.sent_bytes
+
+
+class ChatWorker:
+    """Runs the turns sent to one worker and reports them back"""
+
+    def __init__(
+        self, worker_id: int, transport: WorkerTransport, turn_executor: TurnExecutor
+    ) -> None:
+        self._worker_id = worker_id
+        self._transport = transport
+        self._turn_executor = turn_executor
+
+        self._logger = logging.getLogger(__name__)
+
+        self._turns: dict[int, asyncio.Task] = {}
+
+    async def run(self) -> None:
+        while True:
+            command = await self._transport.receive_command(self._worker_id)
+
+            if command is None:
+                break
+
+            if command.entry is None:
+                task = self._turns.get(command.turn_id)
+                if task is not None:
+                    task.cancel()
+            else:
+                self._turns[command.turn_id] = asyncio.create_task(
+                    self._run_turn(command.turn_id, command.entry, command.is_degraded)
+                )
+
+        # the bot process stops the workers after draining them, so nothing should be left
+        for task in self._turns.values():
+            task.cancel()
+
+    async def _run_turn(self, turn_id: int, entry: LocalQueueEntry, is_degraded: bool) -> None:
+        turn = ChatTurn()
+        turn.is_degraded = is_degraded
+        error = None
+
+        try:
+            await self._turn_executor.execute(entry.chat_id, entry, turn)
+        except asyncio.CancelledError:
+            self._logger.info("Turn %s in %s has been cancelled", turn_id, entry.chat_id)
+        except Exception as err:
+            error = repr(err)
+            self._logger.error(
+                "Cannot handle messages for %s cause of %s", entry.chat_id, err, exc_info=err
+            )
+        finally:
+            del self._turns[turn_id]
+
+            await self._transport.send_report(
+                TurnReport(
+                    turn_id,
+                    is_input_saved=turn.is_input_saved,
+                    llm_calls=turn.llm_calls,
+                    error=error,
+                    first_byte_time=turn.first_byte_time,
+                    last_byte_time=turn.last_byte_time,
+                    model=turn.model,
+                    prompt_tokens=turn.prompt_tokens,
+                    cached_tokens=turn.cached_tokens,
+                    sent_bytes=turn.sent_bytes,
+                )
+            )
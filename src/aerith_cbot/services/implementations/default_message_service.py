@@ -1,42 +1,323 @@
 import logging
+import time
 
-from sqlalchemy import delete, select, update
+from sqlalchemy import delete, func, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from aerith_cbot.database.models import Message
+from aerith_cbot.config import LimitsConfig
+from aerith_cbot.database.models import Message, MessageLevel
 from aerith_cbot.services.abstractions import HistorySummarizer, MessageService
 
+from .history_validator import HistoryRepair, HistoryValidator, message_age
+from .image_describer import ImageDescriber
+
+
+def with_tool_messages(messages: list[Message], start: int, end: int) -> list[Message]:
+    """`messages[start:end]` and the tool calls and responses right after them
+
+    Messages with the 'tool' role must follow their calls, so they can't be split.
+    """
+
+    result = messages[start:end]
+    for message in messages[end:]:
+        if message.data["role"] == "tool" or "tool_calls" in message.data:
+            result.append(message)
+        else:
+            break
+
+    return result
+
+
+class HierarchicalCompaction:
+    """Which messages a compaction of the summary levels takes
+
+    The history is a digest, then chunk summaries, then raw messages. A compaction summarizes
+    the older raw messages into a new chunk summary, so it reads only what hasn't been
+    summarized yet. Once there are too many chunk summaries, the older ones are folded into
+    the digest, so summaries are rarely summarized again.
+    """
+
+    # share of the raw messages summarized at once
+    SUMMARIZED_SHARE = 0.75
+    MAX_CHUNK_SUMMARIES = 3
+    # chunk summaries left after folding, the recent past stays more detailed
+    KEPT_CHUNK_SUMMARIES = 1
+
+    def __init__(self, messages: list[Message]) -> None:
+        raw_messages = [m for m in messages if m.level == MessageLevel.raw]
+        chunk_summaries = [m for m in messages if m.level == MessageLevel.chunk_summary]
+        digests = [m for m in messages if m.level == MessageLevel.digest]
+
+        self.digest = digests[0] if digests else None
+
+        self.raw_messages_to_summarize: list[Message] = []
+        if len(raw_messages) >= 2:
+            self.raw_messages_to_summarize = with_tool_messages(
+                raw_messages,
+                0,
+                max(int(len(raw_messages) * HierarchicalCompaction.SUMMARIZED_SHARE), 1),
+            )
+
+        chunk_summaries_count = len(chunk_summaries) + (1 if self.raw_messages_to_summarize else 0)
+
+        self.chunk_summaries_to_fold: list[Message] = []
+        if chunk_summaries_count > HierarchicalCompaction.MAX_CHUNK_SUMMARIES:
+            self.chunk_summaries_to_fold = chunk_summaries[
+                : chunk_summaries_count - HierarchicalCompaction.KEPT_CHUNK_SUMMARIES
+            ]
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.raw_messages_to_summarize and not self.chunk_summaries_to_fold
+
+    def __repr__(self) -> str:
+        return f"HierarchicalCompaction(\
+        raw_messages_to_summarize={len(self.raw_messages_to_summarize)}, \
+        chunk_summaries_to_fold={len(self.chunk_summaries_to_fold)}, \
+        has_digest={self.digest is not None})"
+
 
 class DefaultMessageService(MessageService):
-    def __init__(self, db_session: AsyncSession, history_summarizer: HistorySummarizer) -> None:
+    def __init__(
+        self,
+        db_session: AsyncSession,
+        history_summarizer: HistorySummarizer,
+        limits_config: LimitsConfig,
+        history_validator: HistoryValidator,
+        image_describer: ImageDescriber,
+    ) -> None:
         super().__init__()
 
         self._db_session = db_session
         self._history_summarizer = history_summarizer
+        self._limits_config = limits_config
+        self._history_validator = history_validator
+        self._image_describer = image_describer
         self._logger = logging.getLogger(__name__)
 
     async def fetch_messages(self, chat_id: int) -> list[dict]:
-        stmt = select(Message).where(Message.chat_id == chat_id).order_by(Message.id)
-        old_messages_raw = await self._db_session.execute(stmt)
+        messages = await self._select_history(chat_id)
+
+        # expired media and broken tool calls are fixed before anything sees them
+        repair = self._repair(chat_id, messages)
+        data = await self._describe_old_images(chat_id, messages, repair.messages)
+
+        # the fixes and descriptions are stored in one transaction, so later turns don't repeat
+        # the work and the prompt changes once and not on every turn
+        rewritten_messages = [
+            msg for msg, new_data in zip(messages, data) if new_data is not msg.data
+        ]
+        if rewritten_messages and await self._lock_unchanged(chat_id, rewritten_messages):
+            await self._write_history(messages, data)
+            await self._db_session.commit()
+
+        return [message for message in data if message is not None]
 
-        return [om.data for om in old_messages_raw.scalars()]
+    async def repair_history(self, chat_id: int, broken_urls: set[str]) -> bool:
+        # nothing slow happens between the read and the write, so the lock is held for both
+        await self._lock_history(chat_id)
+        messages = await self._select_history(chat_id)
+
+        repair = self._repair(chat_id, messages, broken_urls)
+        if not repair.is_empty:
+            await self._write_history(messages, repair.messages)
+
+        await self._db_session.commit()
+
+        return not repair.is_empty
+
+    def _repair(
+        self,
+        chat_id: int,
+        messages: list[Message],
+        broken_urls: set[str] | frozenset[str] = frozenset(),
+    ) -> HistoryRepair:
+        current_time = time.time()
+        # only the faults are stored, the size limits of a request are applied to each request
+        repair = self._history_validator.repair(
+            [msg.data for msg in messages],
+            [message_age(msg.id, current_time) for msg in messages],
+            broken_urls,
+            apply_limits=False,
+        )
+
+        if not repair.is_empty:
+            self._logger.warning("History of %s has been repaired: %s", chat_id, repair)
+
+        return repair
+
+    async def _write_history(self, messages: list[Message], data: list[dict | None]) -> None:
+        """Rewrites the messages whose data has been replaced and deletes the dropped ones"""
+
+        for message, new_data in zip(messages, data):
+            if new_data is not None and new_data is not message.data:
+                stmt = update(Message).where(Message.id == message.id).values(data=new_data)
+                await self._db_session.execute(stmt)
+
+        dropped_messages = [msg for msg, new_data in zip(messages, data) if new_data is None]
+        if dropped_messages:
+            await self._delete_messages(dropped_messages)
+
+    async def _describe_old_images(
+        self, chat_id: int, messages: list[Message], data: list[dict | None]
+    ) -> list[dict | None]:
+        current_time = time.time()
+        ages = [message_age(msg.id, current_time) for msg in messages]
+
+        images = self._image_describer.aged_images(data, ages)
+        if not images:
+            return data
+
+        descriptions = await self._image_describer.descriptions(self._db_session, images)
+        if not descriptions:
+            return data
+
+        return self._image_describer.replace(chat_id, data, ages, descriptions)
 
     async def add_messages(self, chat_id: int, messages: list[dict]) -> None:
         self._db_session.add_all([Message(chat_id=chat_id, data=md) for md in messages])
         await self._db_session.commit()
 
     async def shorten_history(self, chat_id: int) -> None:
-        stmt = select(Message).where(Message.chat_id == chat_id).order_by(Message.id)
-        messages_raw = await self._db_session.execute(stmt)
-        messages: list[Message] = list(messages_raw.scalars())
+        messages = await self._read_history(chat_id)
+
+        if self._limits_config.compaction == "hierarchical":
+            await self._shorten_hierarchically(chat_id, messages)
+        else:
+            await self._shorten_by_half(chat_id, messages)
+
+    async def _shorten_hierarchically(self, chat_id: int, messages: list[Message]) -> None:
+        compaction = HierarchicalCompaction(messages)
+        self._logger.info("Compaction in %s: %s", chat_id, compaction)
+
+        if compaction.is_empty:
+            return
+
+        chunk_summary = None
+        if compaction.raw_messages_to_summarize:
+            chunk_summary = await self._history_summarizer.summarize(
+                [msg.data for msg in compaction.raw_messages_to_summarize]
+            )
+            self._logger.info("Chunk summary in %s is:\n%s", chat_id, chunk_summary)
 
-        # the problem is messages with 'tool' role must be a response to messages
-        messages_to_summarize: list[Message] = messages[: len(messages) // 2]
-        for ci in range(len(messages) // 2, len(messages)):
-            if messages[ci].data["role"] == "tool" or ("tool_calls" in messages[ci].data):
-                messages_to_summarize.append(messages[ci])
+        digest = None
+        if compaction.chunk_summaries_to_fold:
+            messages_to_fold = [msg.data for msg in compaction.chunk_summaries_to_fold]
+            if compaction.digest is not None:
+                messages_to_fold.insert(0, compaction.digest.data)
+
+            digest = await self._history_summarizer.summarize(messages_to_fold)
+            self._logger.info("Digest in %s is:\n%s", chat_id, digest)
+
+        compacted_messages = (
+            compaction.raw_messages_to_summarize + compaction.chunk_summaries_to_fold
+        )
+        if digest is not None and compaction.digest is not None:
+            compacted_messages.append(compaction.digest)
+
+        if not await self._lock_unchanged(chat_id, compacted_messages):
+            return
+
+        if chunk_summary is not None:
+            # the newest chunk summary, ids are ordered by time
+            self._db_session.add(
+                Message(
+                    chat_id=chat_id,
+                    data={"role": "assistant", "content": chunk_summary},
+                    level=MessageLevel.chunk_summary,
+                )
+            )
+            await self._delete_messages(compaction.raw_messages_to_summarize)
+
+        if digest is not None:
+            if compaction.digest is not None:
+                stmt = (
+                    update(Message)
+                    .where(Message.id == compaction.digest.id)
+                    .values(data={"role": "assistant", "content": digest})
+                )
+                await self._db_session.execute(stmt)
             else:
-                break
+                self._db_session.add(
+                    Message(
+                        chat_id=chat_id,
+                        data={"role": "assistant", "content": digest},
+                        level=MessageLevel.digest,
+                    )
+                )
+
+            await self._delete_messages(compaction.chunk_summaries_to_fold)
+
+        await self._db_session.commit()
+
+    async def _select_history(self, chat_id: int) -> list[Message]:
+        stmt = (
+            select(Message)
+            .where(Message.chat_id == chat_id)
+            .order_by(Message.level.desc(), Message.id)
+        )
+        messages_raw = await self._db_session.execute(stmt)
+
+        return list(messages_raw.scalars())
+
+    async def _read_history(self, chat_id: int) -> list[Message]:
+        """The history as it is between the writes of other instances
+
+        The transaction ends right after the read, so no connection idles in it and no other
+        instance waits for the lock while the summarizer works.
+        """
+
+        await self._lock_history(chat_id)
+        messages = await self._select_history(chat_id)
+        await self._db_session.commit()
+
+        return messages
+
+    async def _lock_unchanged(self, chat_id: int, messages: list[Message]) -> bool:
+        """Locks the history for a write of `messages`; false if they've changed since the read
+
+        Another instance may have compacted or repaired the history meanwhile, then the write
+        is skipped and the lock is released.
+        """
+
+        await self._lock_history(chat_id)
+
+        stmt = select(Message.id, Message.level, Message.data).where(
+            Message.id.in_([msg.id for msg in messages])
+        )
+        rows = (await self._db_session.execute(stmt)).all()
+
+        stored = {message_id: (level, data) for message_id, level, data in rows}
+        if stored == {msg.id: (msg.level, msg.data) for msg in messages}:
+            return True
+
+        self._logger.info(
+            "History of %s has changed since it was read, skipping the write", chat_id
+        )
+        await self._db_session.commit()
+
+        return False
+
+    async def _lock_history(self, chat_id: int) -> None:
+        # other bot instances write the history too; the lock is held until the commit
+        await self._db_session.execute(select(func.pg_advisory_xact_lock(chat_id)))
+
+    async def _delete_messages(self, messages: list[Message]) -> None:
+        stmt = delete(Message).where(Message.id.in_([msg.id for msg in messages]))
+        await self._db_session.execute(stmt)
+
+    async def _shorten_by_half(self, chat_id: int, messages: list[Message]) -> None:
+        start = 0
+        end = len(messages) // 2
+
+        if self._limits_config.cache_friendly_compaction:
+            # the oldest message (usually the summary of a previous compaction) stays as it is,
+            # so the cached prompt prefix survives; and more is taken, so compactions are rarer
+            if len(messages) > 2 and "tool_calls" not in messages[0].data:
+                start = 1
+            end = max(len(messages) * 3 // 4, start + 1)
+
+        messages_to_summarize = with_tool_messages(messages, start, end)
 
         summarize_result = await self._history_summarizer.summarize(
             [msg.data for msg in messages_to_summarize]
@@ -44,6 +325,9 @@ class DefaultMessageService(MessageService):
 
         self._logger.info("Summarize result in %s is:\n%s", chat_id, summarize_result)
 
+        if not await self._lock_unchanged(chat_id, messages_to_summarize):
+            return
+
         # edit first message
         message_to_edit_id = messages_to_summarize[0].id
         stmt = (
@@ -61,9 +345,7 @@ class DefaultMessageService(MessageService):
         await self._db_session.commit()
 
     async def shorten_full_history_without_media(self, chat_id: int) -> None:
-        stmt = select(Message).where(Message.chat_id == chat_id).order_by(Message.id)
-        messages_raw = await self._db_session.execute(stmt)
-        messages_to_summarize: list[Message] = list(messages_raw.scalars())
+        messages_to_summarize = await self._read_history(chat_id)
 
         messages_data_to_summarize = []
         for message in messages_to_summarize:
@@ -80,12 +362,19 @@ class DefaultMessageService(MessageService):
 
         self._logger.info("Summarize result in %s is:\n%s", chat_id, summarize_result)
 
+        if not await self._lock_unchanged(chat_id, messages_to_summarize):
+            return
+
         # edit first message
         message_to_edit_id = messages_to_summarize[0].id
         stmt = (
             update(Message)
             .where(Message.id == message_to_edit_id)
-            .values(data={"role": "assistant", "content": summarize_result})
+            # everything is summarized, so it's the digest now
+            .values(
+                data={"role": "assistant", "content": summarize_result},
+                level=MessageLevel.digest,
+            )
         )
         await self._db_session.execute(stmt)
 
@@ -4,6 +4,7 @@ import random
 
 from aiogram import Bot, types
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from chatgpt_md_converter import telegram_format
 from sqlalchemy import update
@@ -27,13 +28,18 @@ class DefaultSenderService(SenderService):
         self._db_session = db_session
         self._logger = logging.getLogger(__name__)
 
-    async def send_model_response(self, chat_id: int, response: ModelResponse) -> None:
+    async def send_model_response(
+        self, chat_id: int, response: ModelResponse, streamed_message_id: int | None = None
+    ) -> None:
         if response.text or response.sticker:
-            await self._bot.send_chat_action(chat_id=chat_id, action="typing")
+            if streamed_message_id is None:
+                await self._bot.send_chat_action(chat_id=chat_id, action="typing")
 
             if response.text:
                 formatted_text = telegram_format(response.text)
-                if formatted_text:
+                if formatted_text and streamed_message_id is not None:
+                    await self._edit_message(chat_id, streamed_message_id, formatted_text)
+                elif formatted_text:
                     await self._bot.send_message(
                         chat_id,
                         formatted_text,
@@ -69,6 +75,35 @@ class DefaultSenderService(SenderService):
             )
             await self._db_session.commit()
 
+    async def send_model_response_part(
+        self,
+        chat_id: int,
+        text: str,
+        message_id: int | None = None,
+        reply_to_message_id: int | None = None,
+    ) -> int:
+        # parts are sent as plain text: unfinished markdown can't be formatted yet
+        if message_id is None:
+            message = await self._bot.send_message(
+                chat_id, text, reply_to_message_id=reply_to_message_id
+            )
+            return message.message_id
+
+        await self._edit_message(chat_id, message_id, text, parse_mode=None)
+        return message_id
+
+    async def _edit_message(
+        self, chat_id: int, message_id: int, text: str, parse_mode: str | None = ParseMode.HTML
+    ) -> None:
+        try:
+            await self._bot.edit_message_text(
+                text, chat_id=chat_id, message_id=message_id, parse_mode=parse_mode
+            )
+        except TelegramBadRequest as err:
+            # the last part may be the whole text already
+            if "message is not modified" not in err.message:
+                raise
+
     async def send_model_refusal(self, chat_id: int, refusal: str) -> None:
         await self._bot.send_message(chat_id, refusal)
 
@@ -0,0 +1,256 @@
+import asyncio
+import collections
+import logging
+import time
+
+from dishka import AsyncContainer
+
+from aerith_cbot.config import LimitsConfig
+from aerith_cbot.services.abstractions import MessageService
+
+from .token_estimator import TokenEstimator
+
+
+class _Compaction:
+    def __init__(self, task: asyncio.Task, requested_at: float, without_media: bool) -> None:
+        self.task = task
+        self.requested_at = requested_at
+        self.without_media = without_media
+
+
+class ChatUsage:
+    """Tokens of the last request of a chat and when it was made"""
+
+    def __init__(self, tokens: int, max_context_tokens: int, active_at: float) -> None:
+        self.tokens = tokens
+        self.max_context_tokens = max_context_tokens
+        self.active_at = active_at
+
+    @property
+    def ratio(self) -> float:
+        return self.tokens / self.max_context_tokens if self.max_context_tokens else 0.0
+
+    def __repr__(self) -> str:
+        return f"ChatUsage(\
+        tokens={self.tokens}, \
+        max_context_tokens={self.max_context_tokens}, \
+        active_at={self.active_at})"
+
+
+class HistoryCompactor:
+    """Summarizes chat histories off the turns' path, one summarization per chat at a time
+
+    Turns request a compaction once a chat's history gets close to its context limit, and the
+    next turns find it already shortened. A turn only has to wait when the history doesn't fit
+    at all, or when it comes while a compaction of its chat is still running. The compactions
+    of other bot instances are waited for by the message service, under a lock in the db.
+
+    It also remembers how big the recent chats are, so the idle ones can be compacted before
+    they're needed (see `IdleCompactionScheduler`).
+    """
+
+    # only the recently active chats are kept
+    MAX_TRACKED_CHATS = 10_000
+
+    def __init__(
+        self,
+        container: AsyncContainer,
+        limits_config: LimitsConfig,
+        token_estimator: TokenEstimator,
+    ) -> None:
+        self._container = container
+        self._limits_config = limits_config
+        self._token_estimator = token_estimator
+
+        self._logger = logging.getLogger(__name__)
+
+        self._compactions: dict[int, _Compaction] = {}
+
+        self._usages: collections.OrderedDict[int, ChatUsage] = collections.OrderedDict()
+        # chats compacted while idle: the tokens it has removed from their history
+        self._precompacted: dict[int, int] = {}
+
+        self.idle_compactions_count = 0
+        # turns which would have crossed the soft limit without an idle compaction before them
+        self.avoided_compactions_count = 0
+
+        self.compactions_count = 0
+        self.failures_count = 0
+        # time from the request of a compaction to its end
+        self._lag_sum = 0.0
+        self.max_lag = 0.0
+
+        self.blocked_turns_count = 0
+        self._blocked_time_sum = 0.0
+
+    @property
+    def average_lag(self) -> float:
+        return self._lag_sum / self.compactions_count if self.compactions_count else 0.0
+
+    @property
+    def average_blocked_time(self) -> float:
+        if not self.blocked_turns_count:
+            return 0.0
+
+        return self._blocked_time_sum / self.blocked_turns_count
+
+    def is_compacting(self, chat_id: int) -> bool:
+        return chat_id in self._compactions
+
+    def track_usage(self, chat_id: int, tokens: int, max_context_tokens: int) -> None:
+        """Remembers the tokens of the last request of a chat, at the end of its turn"""
+
+        removed_tokens = self._precompacted.pop(chat_id, None)
+        soft_limit = max_context_tokens * self._limits_config.soft_compaction_ratio
+
+        if removed_tokens is not None and tokens + removed_tokens > soft_limit:
+            self.avoided_compactions_count += 1
+
+        self._usages.pop(chat_id, None)
+        self._usages[chat_id] = ChatUsage(tokens, max_context_tokens, time.monotonic())
+
+        if len(self._usages) > HistoryCompactor.MAX_TRACKED_CHATS:
+            evicted_chat_id, _ = self._usages.popitem(last=False)
+            self._precompacted.pop(evicted_chat_id, None)
+
+    def idle_chats(self, idle_time: float, min_ratio: float) -> list[tuple[int, ChatUsage]]:
+        """Chats inactive for `idle_time` seconds using `min_ratio` of their context, fullest first"""
+
+        oldest_active_at = time.monotonic() - idle_time
+
+        chats = [
+            (chat_id, usage)
+            for chat_id, usage in self._usages.items()
+            if usage.active_at <= oldest_active_at
+            and usage.ratio >= min_ratio
+            and chat_id not in self._compactions
+        ]
+
+        return sorted(chats, key=lambda item: item[1].ratio, reverse=True)
+
+    async def compact_idle(self, chat_id: int) -> None:
+        """Compacts the history of an idle chat; does nothing if it's being compacted"""
+
+        if chat_id in self._compactions:
+            return
+
+        compaction = self._start(chat_id, without_media=False, is_idle=True)
+        await asyncio.shield(compaction.task)
+
+    def request(self, chat_id: int) -> None:
+        """Starts a compaction in the background unless one is running already"""
+
+        # the idle compaction hasn't been enough
+        self._precompacted.pop(chat_id, None)
+
+        if chat_id not in self._compactions:
+            self._start(chat_id, without_media=False)
+
+    async def wait(self, chat_id: int) -> None:
+        """Waits for the running compaction of the chat, if there is one"""
+
+        compaction = self._compactions.get(chat_id)
+        if compaction is None:
+            return
+
+        started_at = time.monotonic()
+        await asyncio.shield(compaction.task)
+        self._track_blocking(chat_id, started_at)
+
+    async def compact(self, chat_id: int, without_media: bool = False) -> None:
+        """Compacts the history now; joins the running compaction if it's of the same kind"""
+
+        started_at = time.monotonic()
+        self._precompacted.pop(chat_id, None)
+
+        compaction = self._compactions.get(chat_id)
+        while compaction is not None and compaction.without_media != without_media:
+            await asyncio.shield(compaction.task)
+            compaction = self._compactions.get(chat_id)
+
+        if compaction is None:
+            compaction = self._start(chat_id, without_media)
+
+        # the turn may be cancelled, the compaction goes on anyway
+        await asyncio.shield(compaction.task)
+        self._track_blocking(chat_id, started_at)
+
+    def _start(self, chat_id: int, without_media: bool, is_idle: bool = False) -> _Compaction:
+        compaction = _Compaction(
+            asyncio.create_task(self._run(chat_id, without_media, is_idle)),
+            time.monotonic(),
+            without_media,
+        )
+        self._compactions[chat_id] = compaction
+
+        compaction.task.add_done_callback(lambda _: self._on_done(chat_id, compaction))
+
+        return compaction
+
+    async def _run(self, chat_id: int, without_media: bool, is_idle: bool) -> bool:
+        try:
+            async with self._container() as container:
+                message_service = await container.get(MessageService)
+
+                tokens_before = 0
+                if is_idle:
+                    tokens_before = self._token_estimator.estimate(
+                        await message_service.fetch_messages(chat_id)
+                    )
+
+                if without_media:
+                    await message_service.shorten_full_history_without_media(chat_id)
+                else:
+                    await message_service.shorten_history(chat_id)
+
+                if is_idle:
+                    tokens_after = self._token_estimator.estimate(
+                        await message_service.fetch_messages(chat_id)
+                    )
+
+                    self.idle_compactions_count += 1
+                    self._precompacted[chat_id] = max(tokens_before - tokens_after, 0)
+        except Exception as err:
+            self.failures_count += 1
+            self._logger.error(
+                "Cannot compact history of %s cause of %s", chat_id, err, exc_info=err
+            )
+            return False
+
+        return True
+
+    def _on_done(self, chat_id: int, compaction: _Compaction) -> None:
+        if self._compactions.get(chat_id) is compaction:
+            del self._compactions[chat_id]
+
+        # the history is another one now, its size is known after the next turn
+        self._usages.pop(chat_id, None)
+
+        # the failures are counted on their own, the lag is of the compactions done
+        if compaction.task.cancelled() or not compaction.task.result():
+            return
+
+        lag = time.monotonic() - compaction.requested_at
+
+        self.compactions_count += 1
+        self._lag_sum += lag
+        self.max_lag = max(self.max_lag, lag)
+
+        self._logger.info("History of %s has been compacted in %.2fs", chat_id, lag)
+
+    def _track_blocking(self, chat_id: int, started_at: float) -> None:
+        blocked_time = time.monotonic() - started_at
+
+        self.blocked_turns_count += 1
+        self._blocked_time_sum += blocked_time
+
+        self._logger.info("Turn in %s has waited %.2fs for a compaction", chat_id, blocked_time)
+
+    def __repr__(self) -> str:
+        return f"HistoryCompactor(\
+        running={len(self._compactions)}, \
+        compactions_count={self.compactions_count}, \
+        failures_count={self.failures_count}, \
+        blocked_turns_count={self.blocked_turns_count}, \
+        idle_compactions_count={self.idle_compactions_count}, \
+        avoided_compactions_count={self.avoided_compactions_count})"
@@ -0,0 +1,259 @@
+import re
+import uuid
+
+from aerith_cbot.config import LimitsConfig
+from aerith_cbot.utils.media import parse_media_reference
+
+# shown instead of images which can't be sent anymore
+IMAGE_UNAVAILABLE = {"type": "text", "text": "(изображение больше недоступно)"}
+TRUNCATION_NOTE = "… (сообщение обрезано)"
+
+_URL_PATTERN = re.compile(r"https?://[^\s'\"<>]+")
+
+
+def message_age(message_id: object, current_time: float) -> float | None:
+    """Seconds since a message was stored, from the time in its uuid7 id"""
+
+    if not isinstance(message_id, uuid.UUID) or message_id.version != 7:
+        return None
+
+    return current_time - (message_id.int >> 80) / 1000
+
+
+def broken_media_urls(error_message: str) -> set[str]:
+    """Links a request error complains about, like "Error while downloading https://..." """
+
+    return {url.rstrip(".,;:)") for url in _URL_PATTERN.findall(error_message)}
+
+
+class HistoryRepair:
+    """A repaired history: `messages` follow the original ones, with None for dropped ones
+
+    Repaired messages are new dicts, the untouched ones are the original objects.
+    """
+
+    def __init__(self, messages: list[dict | None]) -> None:
+        self.messages = messages
+
+        self.dropped_tool_messages = 0
+        self.dropped_tool_calls = 0
+        self.replaced_images = 0
+        self.truncated_messages = 0
+
+    @property
+    def is_empty(self) -> bool:
+        return not (
+            self.dropped_tool_messages
+            or self.dropped_tool_calls
+            or self.replaced_images
+            or self.truncated_messages
+        )
+
+    def repaired(self) -> list[dict]:
+        return [message for message in self.messages if message is not None]
+
+    def __repr__(self) -> str:
+        return f"HistoryRepair(\
+        dropped_tool_messages={self.dropped_tool_messages}, \
+        dropped_tool_calls={self.dropped_tool_calls}, \
+        replaced_images={self.replaced_images}, \
+        truncated_messages={self.truncated_messages})"
+
+
+class HistoryValidator:
+    """Finds what would make OpenAI reject a history and fixes just the messages at fault
+
+    Tool responses without their call are dropped and calls without responses are removed;
+    images that have expired, were reported broken or aren't images at all are replaced
+    with a note. Those are faults and can be fixed in the stored history for good. The size
+    limits of a request only apply with `apply_limits`: too long texts are cut and only the
+    newest images are kept. Summarizing the whole history without media is left for the
+    errors this doesn't explain.
+    """
+
+    # Telegram file links work for about an hour, the other links are ours to keep
+    EXPIRING_URL_PREFIX = "https://api.telegram.org/file/"
+    # OpenAI takes images up to 20 MB, which is that many characters in base64
+    MAX_DATA_URL_CHARS = 20 * 1024 * 1024 * 4 // 3
+
+    def __init__(self, limits_config: LimitsConfig) -> None:
+        self._limits_config = limits_config
+
+        self.repaired_histories_count = 0
+        # requests rejected by OpenAI which went through after a repair, without summarization
+        self.avoided_summarizations_count = 0
+
+    def track_avoided_summarization(self) -> None:
+        self.avoided_summarizations_count += 1
+
+    def repair(
+        self,
+        messages: list[dict],
+        ages: list[float | None] | None = None,
+        broken_urls: set[str] | frozenset[str] = frozenset(),
+        apply_limits: bool = True,
+    ) -> HistoryRepair:
+        """Fixes the messages; `ages` are seconds since they were sent, if known"""
+
+        repair = HistoryRepair(list(messages))
+
+        self._pair_tool_calls(repair)
+
+        for i, message in enumerate(repair.messages):
+            if message is not None:
+                age = ages[i] if ages is not None else None
+                repair.messages[i] = self._repair_content(
+                    repair, message, age, broken_urls, apply_limits
+                )
+
+        if apply_limits:
+            self._limit_images(repair)
+
+        if not repair.is_empty:
+            self.repaired_histories_count += 1
+
+        return repair
+
+    def _pair_tool_calls(self, repair: HistoryRepair) -> None:
+        # nothing has been dropped yet
+        messages: list[dict] = repair.messages  # type: ignore
+        i = 0
+
+        while i < len(messages):
+            call_index = i
+            message = messages[call_index]
+
+            # responses which don't follow a call
+            if message["role"] == "tool":
+                repair.messages[i] = None
+                repair.dropped_tool_messages += 1
+                i += 1
+                continue
+
+            tool_calls = message.get("tool_calls") or []
+            call_ids = {tool_call["id"] for tool_call in tool_calls}
+
+            # responses must come right after their call
+            answered_ids = set()
+            i += 1
+            while i < len(messages) and messages[i]["role"] == "tool":
+                call_id = messages[i]["tool_call_id"]
+
+                if call_id in call_ids and call_id not in answered_ids:
+                    answered_ids.add(call_id)
+                else:
+                    repair.messages[i] = None
+                    repair.dropped_tool_messages += 1
+
+                i += 1
+
+            if answered_ids == call_ids:
+                continue
+
+            kept_calls = [tool_call for tool_call in tool_calls if tool_call["id"] in answered_ids]
+            repair.dropped_tool_calls += len(tool_calls) - len(kept_calls)
+
+            if kept_calls:
+                repair.messages[call_index] = {**message, "tool_calls": kept_calls}
+            elif message.get("content") is not None or message.get("refusal") is not None:
+                repair.messages[call_index] = {
+                    key: value for key, value in message.items() if key != "tool_calls"
+                }
+            else:
+                repair.messages[call_index] = None
+
+    def _repair_content(
+        self,
+        repair: HistoryRepair,
+        message: dict,
+        age: float | None,
+        broken_urls: set[str] | frozenset[str],
+        apply_limits: bool,
+    ) -> dict:
+        content = message.get("content")
+        max_chars = self._limits_config.max_message_chars if apply_limits else None
+
+        if isinstance(content, str):
+            if max_chars is None or len(content) <= max_chars:
+                return message
+
+            repair.truncated_messages += 1
+            return {**message, "content": self._truncate(content)}
+
+        if not isinstance(content, list):
+            return message
+
+        parts = []
+        is_changed = False
+
+        for part in content:
+            if (
+                part.get("type") == "text"
+                and max_chars is not None
+                and len(part.get("text", "")) > max_chars
+            ):
+                part = {**part, "text": self._truncate(part["text"])}
+                repair.truncated_messages += 1
+                is_changed = True
+            elif part.get("type") == "image_url" and not self._is_image_valid(
+                part, age, broken_urls
+            ):
+                part = IMAGE_UNAVAILABLE
+                repair.replaced_images += 1
+                is_changed = True
+
+            parts.append(part)
+
+        return {**message, "content": parts} if is_changed else message
+
+    def _is_image_valid(
+        self, part: dict, age: float | None, broken_urls: set[str] | frozenset[str]
+    ) -> bool:
+        image_url = part.get("image_url")
+        url = image_url.get("url") if isinstance(image_url, dict) else None
+
+        if not isinstance(url, str) or url in broken_urls:
+            return False
+
+        # references to Telegram files don't expire, they are resolved right before a request
+        if parse_media_reference(url) is not None:
+            return True
+
+        if url.startswith("data:image/"):
+            return len(url) <= HistoryValidator.MAX_DATA_URL_CHARS
+
+        if not url.startswith(("https://", "http://")):
+            return False
+
+        return not (
+            url.startswith(HistoryValidator.EXPIRING_URL_PREFIX)
+            and age is not None
+            and age > self._limits_config.media_ttl
+        )
+
+    def _limit_images(self, repair: HistoryRepair) -> None:
+        images_left = self._limits_config.max_images
+
+        # the newest images are kept
+        for i in range(len(repair.messages) - 1, -1, -1):
+            message = repair.messages[i]
+            if message is None or not isinstance(message.get("content"), list):
+                continue
+
+            parts = []
+            for part in reversed(message["content"]):
+                if part.get("type") == "image_url":
+                    if images_left > 0:
+                        images_left -= 1
+                    else:
+                        part = IMAGE_UNAVAILABLE
+                        repair.replaced_images += 1
+
+                parts.append(part)
+
+            parts.reverse()
+            if parts != message["content"]:
+                repair.messages[i] = {**message, "content": parts}
+
+    def _truncate(self, text: str) -> str:
+        return text[: self._limits_config.max_message_chars] + TRUNCATION_NOTE
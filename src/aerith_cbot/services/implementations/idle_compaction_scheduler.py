@@ -0,0 +1,74 @@
+import asyncio
+import logging
+
+from aerith_cbot.config import IdleCompactionConfig
+
+from .history_compactor import HistoryCompactor
+
+
+class IdleCompactionScheduler:
+    """Compacts histories of idle chats close to their context limit during quiet periods
+
+    So their next turn doesn't have to summarize them. Every run takes the fullest idle chats
+    until their tokens reach the run's budget, and compacts a few of them at a time.
+    """
+
+    def __init__(
+        self, history_compactor: HistoryCompactor, idle_compaction_config: IdleCompactionConfig
+    ) -> None:
+        self._history_compactor = history_compactor
+        self._idle_compaction_config = idle_compaction_config
+
+        self._logger = logging.getLogger(__name__)
+
+        self.run_task: asyncio.Task | None = None
+
+    async def run(self) -> None:
+        if not self._idle_compaction_config.enabled:
+            return
+
+        while True:
+            try:
+                await self.run_once()
+            except Exception as err:
+                self._logger.error("Cannot compact idle chats cause of %s", err, exc_info=err)
+            finally:
+                await asyncio.sleep(self._idle_compaction_config.interval)
+
+    async def run_once(self) -> int:
+        """Compacts the idle chats fitting into the budget; returns how many"""
+
+        config = self._idle_compaction_config
+
+        chat_ids = []
+        tokens_left = config.tokens_per_run
+
+        for chat_id, usage in self._history_compactor.idle_chats(
+            config.idle_time, config.min_usage_ratio
+        ):
+            # the whole history goes to the summarizer at worst
+            if usage.tokens > tokens_left:
+                continue
+
+            tokens_left -= usage.tokens
+            chat_ids.append(chat_id)
+
+        if not chat_ids:
+            return 0
+
+        semaphore = asyncio.Semaphore(config.max_concurrent)
+
+        async def compact(chat_id: int) -> None:
+            async with semaphore:
+                await self._history_compactor.compact_idle(chat_id)
+
+        await asyncio.gather(*(compact(chat_id) for chat_id in chat_ids))
+
+        self._logger.info(
+            "Compacted %s idle chats (%s tokens); turns saved from compactions so far: %s",
+            len(chat_ids),
+            config.tokens_per_run - tokens_left,
+            self._history_compactor.avoided_compactions_count,
+        )
+
+        return len(chat_ids)
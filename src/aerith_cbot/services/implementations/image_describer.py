@@ -0,0 +1,290 @@
+import asyncio
+import collections
+import logging
+from collections.abc import Iterator
+
+from dishka import AsyncContainer
+from openai import AsyncOpenAI, OpenAIError
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from aerith_cbot.config import LLMConfig, MediaConfig, OpenAIConfig
+from aerith_cbot.database.models import ImageDescription
+from aerith_cbot.utils.media import parse_media_reference
+
+from .history_validator import IMAGE_UNAVAILABLE
+from .media_resolver import MediaResolver
+from .openai_rate_limiter import RequestPriority, openai_priority
+from .token_estimator import TokenEstimator
+
+
+def description_part(description: str) -> dict:
+    return {"type": "text", "text": f"(изображение: {description})"}
+
+
+class ImageSavings:
+    """Images of a chat replaced with descriptions and the prompt tokens it saves per request"""
+
+    def __init__(self) -> None:
+        self.described_images = 0
+        self.saved_tokens = 0
+
+    def __repr__(self) -> str:
+        return f"ImageSavings(\
+        described_images={self.described_images}, \
+        saved_tokens={self.saved_tokens})"
+
+
+class ImageDescriber:
+    """Replaces old images of histories with their short text descriptions
+
+    An image is described after `describe_after_turns` turns of its chat or once it's
+    `describe_after` seconds old. Descriptions are made in the background, once per
+    file_unique_id, and stored, so a re-posted or forwarded image gets the same one for free;
+    until its description is ready an image stays as it is.
+    """
+
+    MAX_CACHED_DESCRIPTIONS = 10_000
+    MAX_DESCRIPTION_CHARS = 300
+    # only the recently active chats are kept
+    MAX_TRACKED_CHATS = 10_000
+
+    def __init__(
+        self,
+        container: AsyncContainer,
+        openai_client: AsyncOpenAI,
+        openai_config: OpenAIConfig,
+        llm_config: LLMConfig,
+        media_config: MediaConfig,
+        media_resolver: MediaResolver,
+        token_estimator: TokenEstimator,
+    ) -> None:
+        self._container = container
+        self._openai_client = openai_client
+        self._openai_config = openai_config
+        self._llm_config = llm_config
+        self._media_config = media_config
+        self._media_resolver = media_resolver
+        self._token_estimator = token_estimator
+        self._logger = logging.getLogger(__name__)
+
+        self._semaphore = asyncio.Semaphore(media_config.describer_concurrency)
+        self._descriptions: collections.OrderedDict[str, str] = collections.OrderedDict()
+        # descriptions being made and the images which couldn't be described, by file_unique_id
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._failed: set[str] = set()
+
+        self._savings: collections.OrderedDict[int, ImageSavings] = collections.OrderedDict()
+
+        self.descriptions_count = 0
+        self.failures_count = 0
+        self.replaced_images_count = 0
+
+    def savings(self) -> dict[int, ImageSavings]:
+        return dict(self._savings)
+
+    def aged_images(self, messages: list[dict | None], ages: list[float | None]) -> dict[str, str]:
+        """References of the images old enough to be described, by their file_unique_id"""
+
+        return {
+            file_unique_id: reference
+            for _, _, file_unique_id, reference in self._aged_parts(messages, ages)
+        }
+
+    async def descriptions(
+        self, db_session: AsyncSession, images: dict[str, str]
+    ) -> dict[str, str]:
+        """Descriptions of the images which have them, the others are described meanwhile"""
+
+        descriptions = {}
+        missing = []
+
+        for file_unique_id in images:
+            description = self._descriptions.get(file_unique_id)
+            if description is not None:
+                self._descriptions.move_to_end(file_unique_id)
+                descriptions[file_unique_id] = description
+            elif file_unique_id not in self._tasks and file_unique_id not in self._failed:
+                missing.append(file_unique_id)
+
+        if missing:
+            stmt = select(ImageDescription).where(ImageDescription.file_unique_id.in_(missing))
+            result = await db_session.execute(stmt)
+
+            for image_description in result.scalars():
+                self._remember(image_description.file_unique_id, image_description.description)
+                descriptions[image_description.file_unique_id] = image_description.description
+
+            for file_unique_id in missing:
+                if file_unique_id not in descriptions:
+                    self._start(file_unique_id, images[file_unique_id])
+
+        return descriptions
+
+    def replace(
+        self,
+        chat_id: int,
+        messages: list[dict | None],
+        ages: list[float | None],
+        descriptions: dict[str, str],
+    ) -> list[dict | None]:
+        """The messages with their aged images replaced if described, the others are left as is"""
+
+        result = list(messages)
+        described_images = 0
+        saved_tokens = 0
+
+        for i, j, file_unique_id, _ in self._aged_parts(messages, ages):
+            description = descriptions.get(file_unique_id)
+            message = result[i]
+            if description is None or message is None:
+                continue
+
+            # a message is copied once, on its first replaced image
+            if message is messages[i]:
+                message = {**message, "content": list(message["content"])}
+                result[i] = message
+
+            image_tokens = self._token_estimator.estimate_message(
+                {"content": [message["content"][j]]}
+            )
+            message["content"][j] = description_part(description)
+            text_tokens = self._token_estimator.estimate_message(
+                {"content": [message["content"][j]]}
+            )
+
+            described_images += 1
+            saved_tokens += image_tokens - text_tokens
+
+        if described_images:
+            self._track_savings(chat_id, described_images, saved_tokens)
+
+        return result
+
+    def _aged_parts(
+        self, messages: list[dict | None], ages: list[float | None]
+    ) -> Iterator[tuple[int, int, str, str]]:
+        """Indexes of the messages and parts of the aged images, their file ids and references"""
+
+        if not self._media_config.describe_images:
+            return
+
+        turns = 0
+
+        for i in range(len(messages) - 1, -1, -1):
+            message, age = messages[i], ages[i]
+            if message is None:
+                continue
+
+            is_aged = turns >= self._media_config.describe_after_turns or (
+                age is not None and age >= self._media_config.describe_after
+            )
+
+            if is_aged and isinstance(message.get("content"), list):
+                for j, part in enumerate(message["content"]):
+                    parsed = _parsed_reference(part)
+                    if parsed is not None:
+                        yield i, j, parsed[1], part["image_url"]["url"]
+
+            # a turn ends with the final answer of the assistant
+            if message["role"] == "assistant" and not message.get("tool_calls"):
+                turns += 1
+
+    def _track_savings(self, chat_id: int, described_images: int, saved_tokens: int) -> None:
+        savings = self._savings.pop(chat_id, None) or ImageSavings()
+        savings.described_images += described_images
+        savings.saved_tokens += saved_tokens
+        self._savings[chat_id] = savings
+
+        while len(self._savings) > ImageDescriber.MAX_TRACKED_CHATS:
+            self._savings.popitem(last=False)
+
+        self.replaced_images_count += described_images
+
+    def _start(self, file_unique_id: str, reference: str) -> None:
+        task = asyncio.create_task(self._describe(file_unique_id, reference))
+        self._tasks[file_unique_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(file_unique_id, None))
+
+    async def _describe(self, file_unique_id: str, reference: str) -> None:
+        async with self._semaphore:
+            try:
+                description = await self._generate(reference)
+            except OpenAIError as err:
+                self._logger.warning("Cannot describe image %s: %s", file_unique_id, err)
+                description = None
+
+            if not description:
+                self.failures_count += 1
+                self._failed.add(file_unique_id)
+                if len(self._failed) > ImageDescriber.MAX_CACHED_DESCRIPTIONS:
+                    # the images are retried some time, but not on every turn
+                    self._failed.clear()
+                return
+
+            try:
+                async with self._container() as container:
+                    db_session = await container.get(AsyncSession)
+                    await db_session.merge(
+                        ImageDescription(file_unique_id=file_unique_id, description=description)
+                    )
+                    await db_session.commit()
+            except Exception as err:
+                self._logger.error(
+                    "Cannot save description of %s cause of %s", file_unique_id, err, exc_info=err
+                )
+
+            self.descriptions_count += 1
+            self._remember(file_unique_id, description)
+
+    async def _generate(self, reference: str) -> str | None:
+        messages = await self._media_resolver.resolve(
+            [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "image_url", "image_url": {"url": reference, "detail": "low"}}
+                    ],
+                }
+            ]
+        )
+
+        if messages[0]["content"][0] == IMAGE_UNAVAILABLE:
+            return None
+
+        # live turns go first
+        with openai_priority(RequestPriority.background):
+            result = await self._openai_client.chat.completions.create(
+                model=self._openai_config.summarizer_model,
+                messages=[
+                    {"role": "developer", "content": self._llm_config.describe_image_instruction}
+                ]
+                + messages,  # type: ignore
+            )
+
+        content = result.choices[0].message.content
+        if content is None:
+            return None
+
+        return content.strip()[: ImageDescriber.MAX_DESCRIPTION_CHARS]
+
+    def _remember(self, file_unique_id: str, description: str) -> None:
+        self._descriptions[file_unique_id] = description
+        self._descriptions.move_to_end(file_unique_id)
+
+        while len(self._descriptions) > ImageDescriber.MAX_CACHED_DESCRIPTIONS:
+            self._descriptions.popitem(last=False)
+
+    def __repr__(self) -> str:
+        return f"ImageDescriber(\
+        descriptions_count={self.descriptions_count}, \
+        failures_count={self.failures_count}, \
+        replaced_images_count={self.replaced_images_count})"
+
+
+def _parsed_reference(part: dict) -> tuple[str, str] | None:
+    image_url = part.get("image_url") if part.get("type") == "image_url" else None
+    if not isinstance(image_url, dict) or not isinstance(image_url.get("url"), str):
+        return None
+
+    return parse_media_reference(image_url["url"])
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import os
+import re
+from collections import OrderedDict
+from pathlib import Path
+
+from aerith_cbot.config import MediaConfig
+
+
+class MediaCache:
+    """Files downloaded from Telegram on disk, by their file_unique_id
+
+    The least recently used files are removed once the cache is above `cache_max_bytes`. The
+    order lives in memory and is restored from modification times on start, a hit touches its
+    file for that.
+    """
+
+    # file_unique_id is short and url-safe, anything else in the directory isn't ours
+    KEY_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+    TEMP_SUFFIX = ".tmp"
+
+    def __init__(self, media_config: MediaConfig) -> None:
+        self._dir = Path(media_config.cache_dir)
+        self._max_bytes = media_config.cache_max_bytes
+        self._logger = logging.getLogger(__name__)
+
+        # sizes of the files from the least recently used one
+        self._sizes: OrderedDict[str, int] = OrderedDict()
+
+        self.size_bytes = 0
+        self.hits_count = 0
+        self.misses_count = 0
+        self.evictions_count = 0
+
+        self._restore()
+
+    @property
+    def files_count(self) -> int:
+        return len(self._sizes)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._sizes
+
+    async def get(self, key: str) -> bytes | None:
+        if key not in self._sizes:
+            self.misses_count += 1
+            return None
+
+        try:
+            data = await asyncio.to_thread(self._read, self._dir / key)
+        except OSError as err:
+            self._logger.warning("Cannot read %s from the media cache: %s", key, err)
+            self._forget(key)
+            self.misses_count += 1
+            return None
+
+        # it could have been evicted while being read
+        if key in self._sizes:
+            self._sizes.move_to_end(key)
+
+        self.hits_count += 1
+        return data
+
+    async def put(self, key: str, data: bytes) -> None:
+        if MediaCache.KEY_PATTERN.fullmatch(key) is None or len(data) > self._max_bytes:
+            return
+
+        try:
+            await asyncio.to_thread(self._write, self._dir / key, data)
+        except OSError as err:
+            self._logger.warning("Cannot write %s to the media cache: %s", key, err)
+            return
+
+        self._forget(key)
+        self._sizes[key] = len(data)
+        self.size_bytes += len(data)
+
+        self._evict()
+
+    def _restore(self) -> None:
+        if not self._dir.is_dir():
+            return
+
+        files = []
+        for path in self._dir.iterdir():
+            if path.suffix == MediaCache.TEMP_SUFFIX:
+                # left by an interrupted write
+                path.unlink(missing_ok=True)
+            elif path.is_file() and MediaCache.KEY_PATTERN.fullmatch(path.name) is not None:
+                stat = path.stat()
+                files.append((stat.st_mtime, path.name, stat.st_size))
+
+        for _, key, size in sorted(files):
+            self._sizes[key] = size
+            self.size_bytes += size
+
+        # the limit could have been lowered since the last start
+        self._evict()
+
+        self._logger.info(
+            "Media cache restored: %s files, %s bytes", self.files_count, self.size_bytes
+        )
+
+    def _evict(self) -> None:
+        while self.size_bytes > self._max_bytes and self._sizes:
+            key, size = self._sizes.popitem(last=False)
+            self.size_bytes -= size
+            self.evictions_count += 1
+
+            (self._dir / key).unlink(missing_ok=True)
+
+    def _forget(self, key: str) -> None:
+        size = self._sizes.pop(key, None)
+        if size is not None:
+            self.size_bytes -= size
+
+    @staticmethod
+    def _read(path: Path) -> bytes:
+        data = path.read_bytes()
+        os.utime(path)
+        return data
+
+    @staticmethod
+    def _write(path: Path, data: bytes) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # readers never see a half-written file
+        temp_path = path.with_name(path.name + MediaCache.TEMP_SUFFIX)
+        temp_path.write_bytes(data)
+        os.replace(temp_path, path)
+
+    def __repr__(self) -> str:
+        return f"MediaCache(\
+        files_count={self.files_count}, \
+        size_bytes={self.size_bytes}, \
+        hits_count={self.hits_count}, \
+        misses_count={self.misses_count}, \
+        evictions_count={self.evictions_count})"
@@ -0,0 +1,222 @@
+import asyncio
+import base64
+import logging
+import time
+
+import aiohttp
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+
+from aerith_cbot.config import MediaConfig
+from aerith_cbot.utils.media import parse_media_reference
+
+from .history_validator import IMAGE_UNAVAILABLE
+from .media_cache import MediaCache
+
+# Telegram converts photos to jpeg, the rest is for images sent some other way
+_IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+)
+
+
+def image_mime_type(data: bytes) -> str:
+    for signature, mime_type in _IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+
+    return "image/jpeg"
+
+
+class MediaResolver:
+    """Resolves the media references of a history right before they are sent to OpenAI
+
+    With "inline" delivery an image is sent as a data url, downloaded once and then served
+    from the media cache; with "url" delivery it's a Telegram link resolved from the file_id
+    and reused while it's fresh. Images which can't be resolved are replaced with a note, so
+    an expired link never gets into a request.
+    """
+
+    DOWNLOAD_TIMEOUT = 30
+
+    def __init__(self, bot: Bot, media_cache: MediaCache, media_config: MediaConfig) -> None:
+        self._bot = bot
+        self._media_cache = media_cache
+        self._media_config = media_config
+        self._logger = logging.getLogger(__name__)
+
+        # fresh Telegram links by references, with the time they were resolved at
+        self._urls: dict[str, tuple[str, float]] = {}
+        # downloads in progress by file_unique_id, so the same image isn't fetched twice
+        self._downloads: dict[str, asyncio.Task[bytes | None]] = {}
+
+        self.resolved_count = 0
+        self.unavailable_count = 0
+        self.downloads_count = 0
+
+    async def resolve(self, messages: list[dict]) -> list[dict]:
+        """The messages with their references replaced, the others are left as is"""
+
+        references = list(
+            {url for message in messages for url in _image_urls(message) if _is_reference(url)}
+        )
+        if not references:
+            return messages
+
+        resolved = dict(
+            zip(references, await asyncio.gather(*map(self._resolve, references)), strict=True)
+        )
+
+        for url in resolved.values():
+            if url is None:
+                self.unavailable_count += 1
+            else:
+                self.resolved_count += 1
+
+        return [_replace_images(message, resolved) for message in messages]
+
+    def references_of(self, urls: set[str]) -> set[str]:
+        """The urls and the references they were resolved from, which are resolved again later"""
+
+        references = set(urls)
+
+        for reference, (url, _) in list(self._urls.items()):
+            if url in urls:
+                references.add(reference)
+                del self._urls[reference]
+
+        return references
+
+    async def _resolve(self, reference: str) -> str | None:
+        parsed = parse_media_reference(reference)
+        if parsed is None:
+            return None
+
+        file_id, file_unique_id = parsed
+
+        if self._media_config.delivery == "url":
+            return await self._fresh_url(reference, file_id)
+
+        data = await self._media_cache.get(file_unique_id)
+        if data is None:
+            download = self._downloads.get(file_unique_id)
+            if download is None:
+                download = asyncio.create_task(self._download(file_id, file_unique_id))
+                self._downloads[file_unique_id] = download
+                download.add_done_callback(lambda _: self._downloads.pop(file_unique_id, None))
+
+            data = await asyncio.shield(download)
+
+        if data is None:
+            return None
+
+        return f"data:{image_mime_type(data)};base64,{base64.b64encode(data).decode()}"
+
+    async def _fresh_url(self, reference: str, file_id: str) -> str | None:
+        current_time = time.monotonic()
+
+        cached = self._urls.get(reference)
+        if cached is not None and current_time - cached[1] < self._media_config.url_ttl:
+            return cached[0]
+
+        file_path = await self._file_path(file_id)
+        if file_path is None:
+            return None
+
+        # the expired links go along the way
+        self._urls = {
+            key: value
+            for key, value in self._urls.items()
+            if current_time - value[1] < self._media_config.url_ttl
+        }
+
+        url = self._bot.session.api.file_url(self._bot.token, file_path)
+        self._urls[reference] = (url, current_time)
+
+        return url
+
+    async def _download(self, file_id: str, file_unique_id: str) -> bytes | None:
+        file_path = await self._file_path(file_id)
+        if file_path is None:
+            return None
+
+        try:
+            result = await self._bot.download_file(
+                file_path, timeout=MediaResolver.DOWNLOAD_TIMEOUT
+            )
+        except (TelegramAPIError, aiohttp.ClientError, TimeoutError) as err:
+            self._logger.warning("Cannot download %s: %s", file_unique_id, err)
+            return None
+
+        if result is None:
+            return None
+
+        data = result.read()
+        self.downloads_count += 1
+
+        await self._media_cache.put(file_unique_id, data)
+
+        return data
+
+    async def _file_path(self, file_id: str) -> str | None:
+        try:
+            file = await self._bot.get_file(file_id)
+        except TelegramAPIError as err:
+            self._logger.warning("Cannot resolve file %s: %s", file_id, err)
+            return None
+
+        return file.file_path
+
+    def __repr__(self) -> str:
+        return f"MediaResolver(\
+        resolved_count={self.resolved_count}, \
+        unavailable_count={self.unavailable_count}, \
+        downloads_count={self.downloads_count})"
+
+
+def _is_reference(url: str) -> bool:
+    return parse_media_reference(url) is not None
+
+
+def _image_urls(message: dict) -> list[str]:
+    content = message.get("content")
+    if not isinstance(content, list):
+        return []
+
+    urls = []
+    for part in content:
+        image_url = part.get("image_url") if part.get("type") == "image_url" else None
+        if isinstance(image_url, dict) and isinstance(image_url.get("url"), str):
+            urls.append(image_url["url"])
+
+    return urls
+
+
+def _replace_images(message: dict, resolved: dict[str, str | None]) -> dict:
+    content = message.get("content")
+    if not isinstance(content, list):
+        return message
+
+    parts = []
+    is_changed = False
+
+    for part in content:
+        if part.get("type") == "image_url" and isinstance(part.get("image_url"), dict):
+            url = part["image_url"].get("url")
+
+            if url in resolved:
+                resolved_url = resolved[url]
+                if resolved_url is None:
+                    part = IMAGE_UNAVAILABLE
+                else:
+                    part = {**part, "image_url": {**part["image_url"], "url": resolved_url}}
+
+                is_changed = True
+
+        parts.append(part)
+
+    return {**message, "content": parts} if is_changed else message
@@ -1,44 +1,131 @@
+import asyncio
 import logging
 
 from openai import AsyncClient
 
 from aerith_cbot.config import LLMConfig, OpenAIConfig
-from aerith_cbot.services.abstractions import HistorySummarizer
+from aerith_cbot.services.abstractions import HistorySummarizer, SummarizationError
+
+from .media_resolver import MediaResolver
+from .openai_rate_limiter import RequestPriority, openai_priority
+from .token_estimator import TokenEstimator
 
 
 class OpenAIHistorySummarizer(HistorySummarizer):
+    """Summarizes a history in one request, or a long one by parts
+
+    A history above `summarizer_chunk_tokens` is split into chunks which are summarized
+    concurrently (the rate limiter decides when they go), then their summaries are merged by
+    summarizing them together. If any chunk fails, the whole summary does: the history is
+    left as it is rather than losing the failed part.
+    """
+
+    # merges of merges; after that the summaries are merged in one request whatever their size
+    MAX_MERGE_DEPTH = 3
+
     def __init__(
         self,
         openai_client: AsyncClient,
         openai_config: OpenAIConfig,
         llm_config: LLMConfig,
+        token_estimator: TokenEstimator,
+        media_resolver: MediaResolver,
     ) -> None:
         self._openai_client = openai_client
         self._openai_config = openai_config
         self._llm_config = llm_config
+        self._token_estimator = token_estimator
+        self._media_resolver = media_resolver
 
         self._logger = logging.getLogger(__name__)
 
     async def summarize(self, messages_to_summarize: list[dict]) -> str:
-        messages = [
-            {"role": "developer", "content": self._llm_config.summarize_instruction}
-        ] + messages_to_summarize
+        return await self._summarize(messages_to_summarize, 0)
 
-        content = ""
+    async def _summarize(self, messages_to_summarize: list[dict], depth: int) -> str:
+        chunks = self.split(messages_to_summarize)
 
-        try:
-            result = await self._openai_client.chat.completions.create(
-                model=self._openai_config.summarizer_model,
-                messages=messages,  # type: ignore
+        if len(chunks) <= 1 or depth >= OpenAIHistorySummarizer.MAX_MERGE_DEPTH:
+            return await self._summarize_chunk(messages_to_summarize)
+
+        self._logger.info(
+            "Summarizing %s messages by %s chunks (depth %s)",
+            len(messages_to_summarize),
+            len(chunks),
+            depth,
+        )
+
+        semaphore = asyncio.Semaphore(self._openai_config.summarizer_concurrency)
+
+        async def summarize_chunk(chunk: list[dict]) -> str:
+            async with semaphore:
+                return await self._summarize_chunk(chunk)
+
+        results = await asyncio.gather(
+            *(summarize_chunk(chunk) for chunk in chunks), return_exceptions=True
+        )
+
+        summaries = [result for result in results if isinstance(result, str)]
+        if len(summaries) < len(results):
+            raise SummarizationError(
+                f"{len(results) - len(summaries)} of {len(chunks)} chunks haven't been summarized"
             )
 
-            if result.choices[0].message.refusal is not None:
-                self._logger.warning("Refusal in %s: %s", result.choices[0].message.refusal)
+        return await self._summarize(
+            [{"role": "assistant", "content": summary} for summary in summaries], depth + 1
+        )
+
+    def split(self, messages: list[dict]) -> list[list[dict]]:
+        """Splits the messages into chunks of at most `summarizer_chunk_tokens`
+
+        Tool responses stay in the chunk of their call, even if it gets bigger because of that.
+        """
 
-            elif result.choices[0].message.content is not None:
-                content = result.choices[0].message.content
+        chunks: list[list[dict]] = []
+        chunk_tokens = 0
+
+        for message in messages:
+            tokens = self._token_estimator.estimate_message(message)
+
+            if not chunks or (
+                chunk_tokens + tokens > self._openai_config.summarizer_chunk_tokens
+                and message["role"] != "tool"
+            ):
+                chunks.append([])
+                chunk_tokens = 0
+
+            chunks[-1].append(message)
+            chunk_tokens += tokens
+
+        return chunks
+
+    async def _summarize_chunk(self, messages_to_summarize: list[dict]) -> str:
+        try:
+            messages = [
+                {"role": "developer", "content": self._llm_config.summarize_instruction}
+            ] + await self._media_resolver.resolve(messages_to_summarize)
+
+            # live turns go first
+            with openai_priority(RequestPriority.background):
+                result = await self._openai_client.chat.completions.create(
+                    model=self._openai_config.summarizer_model,
+                    messages=messages,  # type: ignore
+                )
+
+            self._logger.info(
+                "Summarized %s messages, usage: %s", len(messages_to_summarize), result.usage
+            )
 
         except Exception as err:
             self._logger.error("Cannot shorten messages cause of %s", err, exc_info=err)
+            raise SummarizationError(str(err)) from err
+
+        message = result.choices[0].message
+        if message.refusal is not None:
+            self._logger.warning("Refusal in summarization: %s", message.refusal)
+            raise SummarizationError(f"refusal: {message.refusal}")
+
+        if not message.content:
+            raise SummarizationError("empty summary")
 
-        return content
+        return message.content
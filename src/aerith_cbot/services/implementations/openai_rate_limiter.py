@@ -0,0 +1,364 @@
+import asyncio
+import contextlib
+import contextvars
+import enum
+import heapq
+import itertools
+import json
+import logging
+import random
+import re
+import time
+
+import httpx
+from openai._constants import DEFAULT_CONNECTION_LIMITS
+
+from aerith_cbot.config import RateLimitsConfig
+
+from .token_estimator import TokenEstimator
+
+
+class RequestPriority(enum.IntEnum):
+    # the lower goes first
+    interactive = 0
+    background = 1
+
+
+_request_priority: contextvars.ContextVar[RequestPriority] = contextvars.ContextVar(
+    "request_priority", default=RequestPriority.interactive
+)
+
+
+@contextlib.contextmanager
+def openai_priority(priority: RequestPriority):
+    """Sets the priority of OpenAI requests made inside the block"""
+
+    token = _request_priority.set(priority)
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+
+class RequestMeter:
+    """Requests sent to OpenAI inside `measure_requests` and their bytes"""
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.sent_bytes = 0
+
+    def __repr__(self) -> str:
+        return f"RequestMeter(requests={self.requests}, sent_bytes={self.sent_bytes})"
+
+
+_request_meter: contextvars.ContextVar[RequestMeter | None] = contextvars.ContextVar(
+    "request_meter", default=None
+)
+
+
+@contextlib.contextmanager
+def measure_requests():
+    """Counts OpenAI requests made inside the block (sent through `RateLimitedTransport`)"""
+
+    meter = RequestMeter()
+    token = _request_meter.set(meter)
+    try:
+        yield meter
+    finally:
+        _request_meter.reset(token)
+
+
+def backoff_delay(failures: int, base: float = 1, limit: float = 60) -> float:
+    """Exponential backoff with full jitter, so waiting callers don't retry all at once"""
+
+    return random.uniform(0, min(limit, base * 2 ** max(failures - 1, 0)))
+
+
+def parse_reset_time(value: str) -> float:
+    """Parses durations of x-ratelimit-reset-* headers, like "1s", "6m0s" or "20ms" """
+
+    seconds = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|s|m|h)", value):
+        seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+
+    return seconds
+
+
+class _Waiter:
+    def __init__(self) -> None:
+        self.event = asyncio.Event()
+
+
+class ModelBudget:
+    """Requests and tokens per minute left for a model, refilled continuously"""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float) -> None:
+        self.requests_limit = requests_per_minute
+        self.tokens_limit = tokens_per_minute
+        self.requests_remaining = requests_per_minute
+        self.tokens_remaining = tokens_per_minute
+        self.updated_at = time.monotonic()
+
+        # set by 429 responses: nothing is sent until then
+        self.blocked_until = 0.0
+        self.failures = 0
+
+        # heap of (priority, sequence number, waiter)
+        self.waiters: list[tuple[int, int, _Waiter]] = []
+
+    def refill(self, current_time: float) -> None:
+        elapsed = current_time - self.updated_at
+        self.updated_at = current_time
+
+        self.requests_remaining = min(
+            self.requests_limit, self.requests_remaining + self.requests_limit * elapsed / 60
+        )
+        self.tokens_remaining = min(
+            self.tokens_limit, self.tokens_remaining + self.tokens_limit * elapsed / 60
+        )
+
+    def wait_time(self, tokens: int, current_time: float) -> float:
+        self.refill(current_time)
+
+        # a request bigger than the whole budget waits for a full one rather than forever
+        tokens = min(tokens, self.tokens_limit)
+
+        wait_time = max(self.blocked_until - current_time, 0.0)
+        if self.requests_remaining < 1:
+            wait_time = max(wait_time, (1 - self.requests_remaining) * 60 / self.requests_limit)
+        if self.tokens_remaining < tokens:
+            wait_time = max(wait_time, (tokens - self.tokens_remaining) * 60 / self.tokens_limit)
+
+        return wait_time
+
+    def take(self, tokens: int) -> None:
+        self.requests_remaining -= 1
+        self.tokens_remaining -= min(tokens, self.tokens_limit)
+
+    def __repr__(self) -> str:
+        return f"ModelBudget(\
+        requests_remaining={self.requests_remaining:.1f}/{self.requests_limit}, \
+        tokens_remaining={self.tokens_remaining:.0f}/{self.tokens_limit}, \
+        blocked_until={self.blocked_until}, \
+        waiters={len(self.waiters)})"
+
+
+class OpenAIRateLimiter:
+    """Process-wide scheduler of OpenAI requests
+
+    Every OpenAI client of the process sends requests through it (see `RateLimitedTransport`).
+    Requests wait for the requests and tokens per minute of their model, in the order of their
+    priority; budgets follow the rate-limit headers of responses, and a 429 stops the model's
+    requests for a backoff delay instead of letting every caller retry on its own.
+    """
+
+    def __init__(
+        self, rate_limits_config: RateLimitsConfig, token_estimator: TokenEstimator
+    ) -> None:
+        self._rate_limits_config = rate_limits_config
+        self._token_estimator = token_estimator
+
+        self._logger = logging.getLogger(__name__)
+
+        self._budgets: dict[str, ModelBudget] = {}
+        self._sequence = itertools.count()
+
+        self.throttled_count = 0
+        self.rate_limited_count = 0
+
+    def budget(self, model: str) -> ModelBudget:
+        budget = self._budgets.get(model)
+
+        if budget is None:
+            budget = ModelBudget(
+                self._rate_limits_config.requests_per_minute,
+                self._rate_limits_config.tokens_per_minute,
+            )
+            self._budgets[model] = budget
+
+        return budget
+
+    def estimate_tokens(self, body: dict) -> int:
+        """Tokens a request counts against the limit: the prompt and the completion limit"""
+
+        tokens = self._token_estimator.estimate(
+            body.get("messages") or [],
+            body.get("tools") or [],
+            body.get("response_format") or (body.get("text") or {}).get("format"),
+        )
+
+        if isinstance(body.get("input"), str):
+            tokens += self._token_estimator.estimate_text(body["input"])
+        elif isinstance(body.get("input"), list):
+            # a continued response counts its stored part too, the headers correct that later
+            tokens += self._token_estimator.estimate(body["input"])
+
+        return tokens + (body.get("max_completion_tokens") or body.get("max_tokens") or 0)
+
+    async def acquire(
+        self, model: str, tokens: int, priority: RequestPriority | None = None
+    ) -> None:
+        budget = self.budget(model)
+
+        if priority is None:
+            priority = _request_priority.get()
+
+        waiter = _Waiter()
+        entry = (int(priority), next(self._sequence), waiter)
+        heapq.heappush(budget.waiters, entry)
+
+        is_throttled = False
+
+        try:
+            while True:
+                if budget.waiters[0] is not entry:
+                    # woken up once it's the first one
+                    waiter.event.clear()
+                    await waiter.event.wait()
+                    continue
+
+                wait_time = budget.wait_time(tokens, time.monotonic())
+                if wait_time <= 0:
+                    budget.take(tokens)
+                    return
+
+                is_throttled = True
+
+                # a response with a newer budget wakes it up earlier
+                waiter.event.clear()
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(waiter.event.wait(), wait_time)
+        finally:
+            if is_throttled:
+                self.throttled_count += 1
+
+            budget.waiters.remove(entry)
+            heapq.heapify(budget.waiters)
+
+            # the next one checks the budget itself
+            self._wake_first(budget)
+
+    def on_response(self, model: str, response: httpx.Response) -> None:
+        budget = self.budget(model)
+        current_time = time.monotonic()
+        budget.refill(current_time)
+
+        headers = response.headers
+
+        # the server knows the real limits and what's left of them better than we do
+        try:
+            if "x-ratelimit-limit-requests" in headers:
+                budget.requests_limit = float(headers["x-ratelimit-limit-requests"])
+            if "x-ratelimit-limit-tokens" in headers:
+                budget.tokens_limit = float(headers["x-ratelimit-limit-tokens"])
+            if "x-ratelimit-remaining-requests" in headers:
+                budget.requests_remaining = min(
+                    budget.requests_remaining, float(headers["x-ratelimit-remaining-requests"])
+                )
+            if "x-ratelimit-remaining-tokens" in headers:
+                budget.tokens_remaining = min(
+                    budget.tokens_remaining, float(headers["x-ratelimit-remaining-tokens"])
+                )
+        except ValueError:
+            self._logger.warning("Cannot parse rate limit headers of %s: %s", model, headers)
+
+        if response.status_code == 429:
+            self.rate_limited_count += 1
+            budget.failures += 1
+
+            delay = self._retry_after(headers)
+            if delay is None:
+                delay = backoff_delay(
+                    budget.failures,
+                    self._rate_limits_config.base_backoff,
+                    self._rate_limits_config.max_backoff,
+                )
+
+            # the budget is spent: after the pause requests come back at the refill rate
+            budget.blocked_until = max(budget.blocked_until, current_time + delay)
+            budget.requests_remaining = min(budget.requests_remaining, 0)
+            budget.tokens_remaining = min(budget.tokens_remaining, 0)
+
+            self._logger.warning(
+                "Rate limited by OpenAI on %s (failures in a row: %s); pausing for %.2fs",
+                model,
+                budget.failures,
+                delay,
+            )
+        elif response.status_code < 400:
+            budget.failures = 0
+
+        self._wake_first(budget)
+
+    def _retry_after(self, headers: httpx.Headers) -> float | None:
+        try:
+            if "retry-after-ms" in headers:
+                return float(headers["retry-after-ms"]) / 1000
+            if "retry-after" in headers:
+                return float(headers["retry-after"])
+        except ValueError:
+            pass
+
+        for header in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+            if header in headers:
+                reset_time = parse_reset_time(headers[header])
+                if reset_time > 0:
+                    return reset_time
+
+        return None
+
+    def _wake_first(self, budget: ModelBudget) -> None:
+        if budget.waiters:
+            budget.waiters[0][2].event.set()
+
+
+class RateLimitedTransport(httpx.AsyncBaseTransport):
+    """Sends OpenAI requests through the rate limiter"""
+
+    def __init__(
+        self, rate_limiter: OpenAIRateLimiter, transport: httpx.AsyncBaseTransport | None = None
+    ) -> None:
+        self._rate_limiter = rate_limiter
+        # a transport passed to the client makes its `limits` unused, so openai's are kept here
+        self._transport = transport or httpx.AsyncHTTPTransport(limits=DEFAULT_CONNECTION_LIMITS)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        model, tokens = self._describe(request)
+
+        meter = _request_meter.get()
+        if meter is not None:
+            meter.requests += 1
+            meter.sent_bytes += _body_size(request)
+
+        await self._rate_limiter.acquire(model, tokens)
+        response = await self._transport.handle_async_request(request)
+        self._rate_limiter.on_response(model, response)
+
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+    def _describe(self, request: httpx.Request) -> tuple[str, int]:
+        # multipart uploads (transcriptions) only count as requests
+        if not _is_json(request):
+            return request.url.path, 0
+
+        try:
+            body = json.loads(request.content)
+        except ValueError:
+            return request.url.path, 0
+
+        return body.get("model") or request.url.path, self._rate_limiter.estimate_tokens(body)
+
+
+def _is_json(request: httpx.Request) -> bool:
+    return request.headers.get("content-type", "").startswith("application/json")
+
+
+def _body_size(request: httpx.Request) -> int:
+    # streamed bodies (multipart uploads) aren't read yet, so their declared size is taken
+    if _is_json(request):
+        return len(request.content)
+
+    return int(request.headers.get("content-length", 0))
@@ -1,10 +1,14 @@
 import asyncio
 import logging
+import time
 
-from openai import APIError, AsyncOpenAI, BadRequestError, RateLimitError
-from openai.types.chat import ChatCompletion
+from openai import APIError, AsyncOpenAI, BadRequestError, NotFoundError, RateLimitError
+from openai.lib.streaming.chat import ChatCompletionStreamState
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion, ChatCompletionMessageToolCall
+from openai.types.responses import Response
 
-from aerith_cbot.config import LimitsConfig, LLMConfig, OpenAIConfig
+from aerith_cbot.config import LimitsConfig, LLMConfig, LoadSheddingConfig, OpenAIConfig
 from aerith_cbot.services.abstractions import (
     LimitsService,
     MessageService,
@@ -14,14 +18,70 @@ from aerith_cbot.services.abstractions import (
 from aerith_cbot.services.abstractions.models import (
     ChatType,
 )
-from aerith_cbot.services.abstractions.processors import ChatProcessor, ModelResponseProcessor
-from aerith_cbot.services.implementations.processors.tools import ToolCommandDispatcher
+from aerith_cbot.services.abstractions.processors import (
+    ChatProcessor,
+    ChatTurn,
+    ModelResponseProcessor,
+    ModelResponseStream,
+)
+from aerith_cbot.services.abstractions.utils.encoding import compact_batch
+from aerith_cbot.services.implementations.history_compactor import HistoryCompactor
+from aerith_cbot.services.implementations.history_validator import (
+    HistoryValidator,
+    broken_media_urls,
+)
+from aerith_cbot.services.implementations.media_resolver import MediaResolver
+from aerith_cbot.services.implementations.openai_rate_limiter import (
+    backoff_delay,
+    measure_requests,
+)
+from aerith_cbot.services.implementations.processors.response_chain import (
+    ResponseChain,
+    to_chat_completion,
+    to_response_input,
+    to_response_text,
+    to_response_tools,
+)
+from aerith_cbot.services.implementations.processors.tools import (
+    ToolCommandDispatcher,
+    ToolExecutionResult,
+)
+from aerith_cbot.services.implementations.prompt_cache import (
+    RequestTemplate,
+    RequestTemplates,
+)
+from aerith_cbot.services.implementations.token_estimator import TokenEstimator
+
+# shown instead of images when they are dropped under load
+IMAGE_PLACEHOLDER = {"type": "text", "text": "(изображение скрыто из-за высокой нагрузки)"}
+
+
+def without_images(messages: list[dict]) -> list[dict]:
+    """Replaces image parts of the messages with a note, leaving the stored history intact"""
+
+    result = []
+
+    for message in messages:
+        content = message.get("content")
+
+        if isinstance(content, list) and any(part.get("type") == "image_url" for part in content):
+            content = [
+                part if part.get("type") != "image_url" else IMAGE_PLACEHOLDER for part in content
+            ]
+            message = {**message, "content": content}
+
+        result.append(message)
+
+    return result
 
 
 class DefaultChatProcessor(ChatProcessor):
     MAX_LLM_CALL_ATTEMPTS = 3
     MAX_LLM_CALL_ITERATIONS = 10
     MAX_TOOL_CALL_ITERATIONS = 5
+    MAX_PARALLEL_TOOL_CALLS = 4
+    MAX_PROACTIVE_SHORTENINGS = 2
+    RETRY_BACKOFF = 2
 
     def __init__(
         self,
@@ -35,6 +95,12 @@ class DefaultChatProcessor(ChatProcessor):
         limits_service: LimitsService,
         model_response_processor: ModelResponseProcessor,
         support_service: SupportService,
+        token_estimator: TokenEstimator,
+        request_templates: RequestTemplates,
+        load_shedding_config: LoadSheddingConfig,
+        history_compactor: HistoryCompactor,
+        history_validator: HistoryValidator,
+        media_resolver: MediaResolver,
     ) -> None:
         super().__init__()
 
@@ -48,26 +114,29 @@ class DefaultChatProcessor(ChatProcessor):
         self._context_provider = context_provider
         self._model_response_processor = model_response_processor
         self._support_service = support_service
+        self._token_estimator = token_estimator
+        self._request_templates = request_templates
+        self._load_shedding_config = load_shedding_config
+        self._history_compactor = history_compactor
+        self._history_validator = history_validator
+        self._media_resolver = media_resolver
         self._logger = logging.getLogger(__name__)
 
-    async def process(self, chat_id: int, chat_type: ChatType) -> None:
+    async def process(
+        self, chat_id: int, chat_type: ChatType, turn: ChatTurn | None = None
+    ) -> None:
+        started_at = time.perf_counter()
+
+        # a compaction started by the previous turn may still be rewriting the history
+        await self._history_compactor.wait(chat_id)
+
         old_messages: list[dict] = await self._message_service.fetch_messages(chat_id)
         new_messages: list[dict] = []
 
         if chat_type == ChatType.group:
-            tools = self._llm_config.tools + self._llm_config.group_tools
-            instruction_messages = [
-                {"role": "developer", "content": self._llm_config.group_instruction}
-            ]
-
             model_to_use = self._openai_config.group_model
             max_context_tokens = self._limits_config.group_max_context_tokens
         elif chat_type == ChatType.private:
-            tools = self._llm_config.tools
-            instruction_messages = [
-                {"role": "developer", "content": self._llm_config.private_instruction}
-            ]
-
             if await self._support_service.is_active_supporter(chat_id):
                 model_to_use = self._openai_config.private_support_model
                 max_context_tokens = self._limits_config.private_support_max_context_tokens
@@ -75,33 +144,62 @@ class DefaultChatProcessor(ChatProcessor):
                 model_to_use = self._openai_config.private_model
                 max_context_tokens = self._limits_config.private_max_context_tokens
 
+        max_tool_calls = DefaultChatProcessor.MAX_TOOL_CALL_ITERATIONS
+        dropped_tools: frozenset[str] = frozenset()
+
+        if turn is not None and turn.is_degraded:
+            model_to_use = self._load_shedding_config.fallback_model or model_to_use
+            max_tool_calls = min(max_tool_calls, self._load_shedding_config.max_tool_calls)
+            dropped_tools = frozenset(self._load_shedding_config.dropped_tools)
+
+            self._logger.info("The turn in %s is degraded because of the load", chat_id)
+
+        template = self._request_templates.get(chat_type, model_to_use, dropped_tools)
+
         self._logger.info("Used model for chat %s: %s", chat_id, model_to_use)
         self._logger.info("max_context_tokens for chat %s: %s", chat_id, max_context_tokens)
 
         tokens_to_subtract = 0
+        last_total_tokens = None
+
+        chain = ResponseChain() if self._openai_config.continue_responses else None
 
         current_iterations = 0
         current_tool_calls = 0
 
         while (
             current_iterations < DefaultChatProcessor.MAX_LLM_CALL_ITERATIONS
-            and current_tool_calls < DefaultChatProcessor.MAX_TOOL_CALL_ITERATIONS
+            and current_tool_calls < max_tool_calls
         ):
+            estimated_tokens = await self._fit_context(
+                chat_id, max_context_tokens, template, old_messages, new_messages
+            )
+
+            stream = None
+            if self._openai_config.stream_responses:
+                stream = self._model_response_processor.start_stream(chat_id)
+
             result = await self._get_llm_response(
-                chat_id,
-                model_to_use,
-                instruction_messages,
-                old_messages,
-                new_messages,
-                tools,
+                chat_id, template, old_messages, new_messages, stream, turn, chain
             )
 
             self._logger.debug("LLM response in %s: %s", chat_id, result)
 
+            # from now on the turn has effects (messages, tools), so it must not be restarted
+            if turn is not None:
+                turn.is_restartable = False
+                turn.llm_calls += 1
+
             tokens_to_subtract += await self._process_token_usage(
-                chat_id, max_context_tokens, result
+                chat_id, max_context_tokens, result, estimated_tokens
             )
 
+            if result.usage is not None:
+                last_total_tokens = result.usage.total_tokens
+
+            if turn is not None and result.usage is not None:
+                self._track_cache_usage(turn, model_to_use, result.usage)
+
             if not result.choices:
                 break
 
@@ -119,9 +217,12 @@ class DefaultChatProcessor(ChatProcessor):
                 # here we assume that the model will generate exactly one text response
                 # so we will continue to call tools even if text response was generated
                 if result.choices[0].message.content is not None:
-                    await self._model_response_processor.process(
-                        chat_id, result.choices[0].message.content
+                    is_sent = await self._model_response_processor.process(
+                        chat_id, result.choices[0].message.content, stream
                     )
+
+                    if is_sent and turn is not None and turn.first_byte_time is None:
+                        self._track_delivery(chat_id, turn, started_at, stream)
             except Exception as err:
                 self._logger.error("Error processing model response", exc_info=err)
 
@@ -136,12 +237,11 @@ class DefaultChatProcessor(ChatProcessor):
                 result.choices[0].message.tool_calls,
             )
 
-            # call all functions in one response
-            for tool_call in result.choices[0].message.tool_calls:
-                tool_response = await self._tool_command_dispatcher.execute_tool(
-                    tool_call.function.name, tool_call.function.arguments, chat_id
-                )
+            # the calls above the limit are dropped
+            tool_calls = result.choices[0].message.tool_calls[: max_tool_calls - current_tool_calls]
+            tool_responses = await self._execute_tools(chat_id, tool_calls)
 
+            for tool_call, tool_response in zip(tool_calls, tool_responses):
                 new_messages.append(
                     {
                         "role": "tool",
@@ -150,21 +250,19 @@ class DefaultChatProcessor(ChatProcessor):
                     },
                 )
 
-                current_tool_calls += 1
-
-                if current_tool_calls >= DefaultChatProcessor.MAX_TOOL_CALL_ITERATIONS:
-                    self._logger.warning(
-                        "Tool call limit in %s (last_call: %s)", chat_id, tool_call
-                    )
+            current_tool_calls += len(tool_calls)
 
-                    new_messages.append(
-                        {
-                            "role": "system",
-                            "content": self._llm_config.additional_instructions.you_call_too_many_tools,
-                        }
-                    )
+            if current_tool_calls >= max_tool_calls:
+                self._logger.warning(
+                    "Tool call limit in %s (last_call: %s)", chat_id, tool_calls[-1]
+                )
 
-                    break
+                new_messages.append(
+                    {
+                        "role": "system",
+                        "content": self._llm_config.additional_instructions.you_call_too_many_tools,
+                    }
+                )
 
             current_iterations += 1
 
@@ -175,6 +273,14 @@ class DefaultChatProcessor(ChatProcessor):
             tokens_to_subtract,
         )
 
+        if turn is not None:
+            self._logger.info(
+                "Chat %s has sent %s bytes to the LLM in %s calls",
+                chat_id,
+                turn.sent_bytes,
+                turn.llm_calls,
+            )
+
         if chat_type == ChatType.group:
             await self._limits_service.subtract_group_tokens(chat_id, tokens_to_subtract)
         elif chat_type == ChatType.private:
@@ -182,66 +288,364 @@ class DefaultChatProcessor(ChatProcessor):
 
         await self._message_service.add_messages(chat_id, new_messages)
 
+        if last_total_tokens is not None:
+            self._history_compactor.track_usage(chat_id, last_total_tokens, max_context_tokens)
+
+    async def _fit_context(
+        self,
+        chat_id: int,
+        max_context_tokens: int,
+        template: RequestTemplate,
+        old_messages: list[dict],
+        new_messages: list[dict],
+    ) -> int:
+        """Shortens the history before the request if it won't fit; returns the estimate"""
+
+        shortenings = 0
+
+        while True:
+            estimated_tokens = self._token_estimator.estimate(
+                old_messages + new_messages, prefix_tokens=template.prefix_tokens
+            )
+
+            if (
+                estimated_tokens <= max_context_tokens
+                or shortenings >= DefaultChatProcessor.MAX_PROACTIVE_SHORTENINGS
+                # there is nothing to summarize
+                or len(old_messages) < 2
+            ):
+                return estimated_tokens
+
+            self._logger.info(
+                "Estimated %s tokens in chat %s above limit (%s); shortening history in advance",
+                estimated_tokens,
+                chat_id,
+                max_context_tokens,
+            )
+
+            # update old_messages both here and in the caller
+            await self._history_compactor.compact(chat_id)
+            old_messages[:] = await self._message_service.fetch_messages(chat_id)
+
+            shortenings += 1
+
+    async def _execute_tools(
+        self, chat_id: int, tool_calls: list[ChatCompletionMessageToolCall]
+    ) -> list[ToolExecutionResult]:
+        semaphore = asyncio.Semaphore(DefaultChatProcessor.MAX_PARALLEL_TOOL_CALLS)
+
+        async def execute(tool_call: ChatCompletionMessageToolCall) -> ToolExecutionResult:
+            async with semaphore:
+                return await self._tool_command_dispatcher.execute_tool(
+                    tool_call.function.name, tool_call.function.arguments, chat_id
+                )
+
+        results: list[ToolExecutionResult] = []
+        parallel_calls: list[ChatCompletionMessageToolCall] = []
+
+        for tool_call in tool_calls:
+            if self._tool_command_dispatcher.is_parallel_safe(tool_call.function.name):
+                parallel_calls.append(tool_call)
+                continue
+
+            # a tool with effects waits for the calls before it and holds the ones after it
+            results += await asyncio.gather(*(execute(call) for call in parallel_calls))
+            parallel_calls = []
+
+            results.append(await execute(tool_call))
+
+        results += await asyncio.gather(*(execute(call) for call in parallel_calls))
+
+        return results
+
     async def _get_llm_response(
         self,
         chat_id: int,
-        model_to_use: str,
-        instruction_messages: list[dict],
+        template: RequestTemplate,
         old_messages: list[dict],
         new_messages: list[dict],
-        tools: list,
+        stream: ModelResponseStream | None = None,
+        turn: ChatTurn | None = None,
+        chain: ResponseChain | None = None,
     ) -> ChatCompletion:
         attempts = 0
         last_error = ValueError("Undefined error when sending request to a llm")
+        is_repaired = False
 
         while True:
             if attempts >= DefaultChatProcessor.MAX_LLM_CALL_ATTEMPTS:
                 raise last_error
 
+            messages = template.messages(old_messages, new_messages)
+            if turn is not None and turn.is_degraded:
+                messages = without_images(messages)
+
+            # repeated authors and times are dropped on the way, the stored rows keep them
+            messages = compact_batch(messages)
+
+            # the stored history is only cleared of faults, the size limits are applied here
+            messages = self._history_validator.repair(messages).repaired()
+            messages = await self._media_resolver.resolve(messages)
+
             try:
-                return await self._openai_client.chat.completions.create(
-                    model=model_to_use,
-                    tools=tools,
-                    messages=instruction_messages + old_messages + new_messages,  # type: ignore
-                    response_format=self._llm_config.response_schema,  # type: ignore
-                    store=True,
-                )
+                result = await self._request_llm(template, messages, stream, turn, chain)
+
+                if is_repaired:
+                    self._history_validator.track_avoided_summarization()
+
+                return result
             except RateLimitError as err:
                 last_error = err
+                delay = backoff_delay(attempts + 1, base=DefaultChatProcessor.RETRY_BACKOFF)
                 self._logger.error(
-                    "RateLimitError error when sending request to a llm %s; trying to shorten history",
+                    "RateLimitError error when sending request to a llm %s; shortening history in background and trying again in %.2fs",
                     err,
+                    delay,
                     exc_info=err,
                 )
 
-                # after shortening history, update old_messages both here and in the caller
-                await self._message_service.shorten_history(chat_id)
-                old_messages[:] = await self._message_service.fetch_messages(chat_id)
+                # a smaller request is more likely to fit into the tokens limit,
+                # but the turn doesn't wait for the summarizer
+                self._history_compactor.request(chat_id)
+                await asyncio.sleep(delay)
+
+                # if the history has been shortened meanwhile, update old_messages both
+                # here and in the caller
+                if not self._history_compactor.is_compacting(chat_id):
+                    old_messages[:] = await self._message_service.fetch_messages(chat_id)
             except BadRequestError as err:
                 last_error = err
-                self._logger.error(
-                    "BadRequestError error when sending request to a llm %s; trying to remove media",
-                    err,
-                    exc_info=err,
-                )
 
-                # after shortening history, update old_messages both here and in the caller
-                await self._message_service.shorten_full_history_without_media(chat_id)
+                # the messages at fault are fixed if they can be found, summarizing the whole
+                # history without media is the last resort
+                # the history keeps references to the images, not the links sent
+                broken_urls = self._media_resolver.references_of(broken_media_urls(err.message))
+                is_repaired = await self._message_service.repair_history(chat_id, broken_urls)
+
+                if is_repaired:
+                    self._logger.error(
+                        "BadRequestError error when sending request to a llm %s; the history has been repaired",
+                        err,
+                        exc_info=err,
+                    )
+                else:
+                    self._logger.error(
+                        "BadRequestError error when sending request to a llm %s; trying to remove media",
+                        err,
+                        exc_info=err,
+                    )
+
+                    await self._history_compactor.compact(chat_id, without_media=True)
+
+                # update old_messages both here and in the caller
                 old_messages[:] = await self._message_service.fetch_messages(chat_id)
             except APIError as err:
                 last_error = err
+                delay = backoff_delay(attempts + 1, base=DefaultChatProcessor.RETRY_BACKOFF)
                 self._logger.error(
-                    "APIError error when sending request to a llm %s; waiting for 2s and trying again",
+                    "APIError error when sending request to a llm %s; waiting for %.2fs and trying again",
                     err,
+                    delay,
                     exc_info=err,
                 )
 
-                await asyncio.sleep(2)
+                await asyncio.sleep(delay)
             finally:
                 attempts += 1
 
+    async def _request_llm(
+        self,
+        template: RequestTemplate,
+        messages: list[dict],
+        stream: ModelResponseStream | None,
+        turn: ChatTurn | None,
+        chain: ResponseChain | None,
+    ) -> ChatCompletion:
+        with measure_requests() as meter:
+            try:
+                if chain is not None:
+                    return await self._continue_response(template, messages, stream, turn, chain)
+
+                if stream is not None:
+                    return await self._stream_llm_response(template, messages, stream, turn)
+
+                return await self._openai_client.chat.completions.create(
+                    model=template.model,
+                    tools=template.tools,
+                    messages=messages,  # type: ignore
+                    response_format=template.response_format,  # type: ignore
+                    store=True,
+                )
+            finally:
+                if turn is not None:
+                    turn.sent_bytes += meter.sent_bytes
+
+    async def _continue_response(
+        self,
+        template: RequestTemplate,
+        messages: list[dict],
+        stream: ModelResponseStream | None,
+        turn: ChatTurn | None,
+        chain: ResponseChain,
+    ) -> ChatCompletion:
+        """Requests the Responses API, sending only what the previous response hasn't seen"""
+
+        previous_response_id, input_messages = chain.continuation(messages)
+
+        try:
+            response = await self._create_response(
+                template, input_messages, previous_response_id, stream, turn
+            )
+        except (BadRequestError, NotFoundError) as err:
+            if previous_response_id is None:
+                raise
+
+            # the stored response may have expired or been rejected, the whole history is
+            # sent instead; the errors of that request are handled as usual
+            self._logger.warning(
+                "Cannot continue response %s cause of %s; sending the whole history",
+                previous_response_id,
+                err,
+            )
+
+            chain.reset()
+            response = await self._create_response(template, messages, None, stream, turn)
+
+        chain.advance(response.id, messages)
+
+        return to_chat_completion(response)
+
+    async def _create_response(
+        self,
+        template: RequestTemplate,
+        messages: list[dict],
+        previous_response_id: str | None,
+        stream: ModelResponseStream | None,
+        turn: ChatTurn | None,
+    ) -> Response:
+        request = {
+            "model": template.model,
+            "input": to_response_input(messages),
+            "tools": to_response_tools(template.tools),
+            "text": to_response_text(template.response_format),
+            "store": True,
+        }
+
+        if previous_response_id is not None:
+            request["previous_response_id"] = previous_response_id
+
+        if stream is None:
+            return await self._openai_client.responses.create(**request)
+
+        # a failed attempt may have streamed a part of its response already
+        stream.restart()
+
+        events = await self._openai_client.responses.create(**request, stream=True)
+
+        response = None
+        async for event in events:
+            if event.type == "response.output_text.delta":
+                await stream.feed(event.delta)
+
+                # the user has seen a part of the response, so the turn can't be restarted
+                if turn is not None and stream.message_id is not None:
+                    turn.is_restartable = False
+            elif event.type == "response.completed":
+                response = event.response
+
+        if response is None:
+            raise ValueError("The response stream has ended without a response")
+
+        return response
+
+    async def _stream_llm_response(
+        self,
+        template: RequestTemplate,
+        messages: list[dict],
+        stream: ModelResponseStream,
+        turn: ChatTurn | None,
+    ) -> ChatCompletion:
+        # a failed attempt may have streamed a part of its response already
+        stream.restart()
+
+        chunks = await self._openai_client.chat.completions.create(
+            model=template.model,
+            tools=template.tools,
+            messages=messages,  # type: ignore
+            response_format=template.response_format,  # type: ignore
+            store=True,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+
+        state = ChatCompletionStreamState()
+        async for chunk in chunks:
+            state.handle_chunk(chunk)
+
+            if chunk.choices and chunk.choices[0].delta.content:
+                await stream.feed(chunk.choices[0].delta.content)
+
+                # the user has seen a part of the response, so the turn can't be restarted
+                if turn is not None and stream.message_id is not None:
+                    turn.is_restartable = False
+
+        # the accumulated completion has parsing-related fields which a plain one doesn't
+        completion = state.get_final_completion()
+        return ChatCompletion.model_validate(
+            completion.model_dump(
+                exclude={
+                    "choices": {
+                        "__all__": {
+                            "message": {
+                                "parsed": True,
+                                "tool_calls": {
+                                    "__all__": {
+                                        "index": True,
+                                        "function": {"parsed_arguments": True},
+                                    }
+                                },
+                            }
+                        }
+                    }
+                }
+            )
+        )
+
+    def _track_cache_usage(self, turn: ChatTurn, model: str, usage: CompletionUsage) -> None:
+        cached_tokens = 0
+        if usage.prompt_tokens_details is not None:
+            cached_tokens = usage.prompt_tokens_details.cached_tokens or 0
+
+        turn.model = model
+        turn.prompt_tokens += usage.prompt_tokens
+        turn.cached_tokens += cached_tokens
+
+    def _track_delivery(
+        self,
+        chat_id: int,
+        turn: ChatTurn,
+        started_at: float,
+        stream: ModelResponseStream | None,
+    ) -> None:
+        delivered_at = time.perf_counter()
+        first_part_time = stream.first_part_time if stream is not None else None
+
+        turn.first_byte_time = (first_part_time or delivered_at) - started_at
+        turn.last_byte_time = delivered_at - started_at
+
+        self._logger.info(
+            "Response in %s: first text after %.2fs, whole text after %.2fs",
+            chat_id,
+            turn.first_byte_time,
+            turn.last_byte_time,
+        )
+
     async def _process_token_usage(
-        self, chat_id: int, max_context_tokens: int, result: ChatCompletion
+        self,
+        chat_id: int,
+        max_context_tokens: int,
+        result: ChatCompletion,
+        estimated_tokens: int | None = None,
     ) -> int:
         # idk when this is possible
         if result.usage is None:
@@ -250,14 +654,19 @@ class DefaultChatProcessor(ChatProcessor):
 
         self._logger.info("Usage in chat %s : %s", chat_id, result.usage)
 
-        if result.usage.total_tokens > max_context_tokens:
+        if estimated_tokens is not None:
+            self._token_estimator.observe(estimated_tokens, result.usage.prompt_tokens)
+
+        soft_limit = max_context_tokens * self._limits_config.soft_compaction_ratio
+        if result.usage.total_tokens > soft_limit:
             self._logger.info(
-                "Usage in chat %s above limit (%s>%s); shortening history",
+                "Usage in chat %s close to limit (%s>%.0f); shortening history in background",
                 chat_id,
                 result.usage.total_tokens,
-                max_context_tokens,
+                soft_limit,
             )
-            await self._message_service.shorten_history(chat_id)
+            # the next turns will find the history shortened already
+            self._history_compactor.request(chat_id)
 
         # we will always get details in response, but in case of
         # some errors we will count tokens in the other way
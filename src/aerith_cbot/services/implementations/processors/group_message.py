@@ -6,9 +6,15 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from aerith_cbot.config import LimitsConfig, LLMConfig
 from aerith_cbot.database.models import ChatState, UserGroupLastContact
-from aerith_cbot.services.abstractions import LimitsService, SenderService, VoiceTranscriber
+from aerith_cbot.services.abstractions import (
+    LimitsService,
+    SenderService,
+    SupportService,
+    VoiceTranscriber,
+)
 from aerith_cbot.services.abstractions.models import ChatType, InputChat, InputMessage
 from aerith_cbot.services.abstractions.processors import GroupMessageProcessor
+from aerith_cbot.services.abstractions.utils.encoding import encode_model_input
 from aerith_cbot.services.abstractions.utils.mapping import input_msg_to_model_input
 from aerith_cbot.services.implementations.chat_dispatcher import MessageQueue
 
@@ -26,6 +32,7 @@ class DefaultGroupMessageProcessor(GroupMessageProcessor):
         llm_config: LLMConfig,
         sender_service: SenderService,
         voice_transcriber: VoiceTranscriber,
+        support_service: SupportService,
     ) -> None:
         super().__init__()
 
@@ -37,6 +44,7 @@ class DefaultGroupMessageProcessor(GroupMessageProcessor):
         self._llm_config = llm_config
         self._sender_service = sender_service
         self._voice_transcriber = voice_transcriber
+        self._support_service = support_service
 
     async def process(self, message: InputMessage) -> None:
         chat_state = await self._create_of_fetch_chat_state(message.chat)
@@ -140,7 +148,7 @@ class DefaultGroupMessageProcessor(GroupMessageProcessor):
         content.append(
             {
                 "type": "text",
-                "text": model_input_message.model_dump_json(exclude_none=True),
+                "text": encode_model_input(model_input_message),
             }
         )
 
@@ -150,7 +158,13 @@ class DefaultGroupMessageProcessor(GroupMessageProcessor):
                 "content": content,
             }
         )
-        self._message_queue.add(message.chat.id, ChatType.group, new_messages)
+        self._message_queue.add(
+            message.chat.id,
+            ChatType.group,
+            new_messages,
+            is_aerith_called=message.is_aerith_called,
+            from_supporter=await self._support_service.is_active_supporter(message.sender.id),
+        )
 
     async def _create_of_fetch_chat_state(self, chat: InputChat) -> ChatState:
         chat_state = await self._db_session.get(ChatState, chat.id)
@@ -1,26 +1,88 @@
 import logging
+import time
 
 from pydantic import ValidationError
 from sqlalchemy import update
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from aerith_cbot.config import OpenAIConfig
 from aerith_cbot.database.models import ChatState
 from aerith_cbot.services.abstractions import SenderService
 from aerith_cbot.services.abstractions.models import ModelResponse
-from aerith_cbot.services.abstractions.processors import ModelResponseProcessor
+from aerith_cbot.services.abstractions.processors import ModelResponseProcessor, ModelResponseStream
+from aerith_cbot.utils.streaming import ResponseTextParser
+
+
+class TelegramResponseStream(ModelResponseStream):
+    # a shorter beginning isn't worth a message: the rest comes in a moment anyway
+    MIN_FIRST_PART_LENGTH = 20
+
+    def __init__(self, chat_id: int, sender_service: SenderService, edit_interval: float) -> None:
+        super().__init__()
+
+        self._chat_id = chat_id
+        self._sender_service = sender_service
+        self._edit_interval = edit_interval
+        self._logger = logging.getLogger(__name__)
+
+        self._parser = ResponseTextParser()
+        self._shown_text = ""
+        self._shown_at = 0.0
+        self._is_broken = False
+
+    async def feed(self, content: str) -> None:
+        self._parser.feed(content)
+
+        text = self._parser.text.strip()
+        if self._is_broken or not text or text == self._shown_text:
+            return
+
+        current_time = time.perf_counter()
+
+        if self.message_id is None and len(text) < TelegramResponseStream.MIN_FIRST_PART_LENGTH:
+            return
+        if self.message_id is not None and current_time - self._shown_at < self._edit_interval:
+            return
+
+        try:
+            self.message_id = await self._sender_service.send_model_response_part(
+                self._chat_id,
+                text,
+                message_id=self.message_id,
+                reply_to_message_id=self._parser.values.get("reply_to_message_id"),
+            )
+        except Exception as err:
+            # the whole response is still sent (or the message is edited) once it's done
+            self._logger.error("Cannot stream response in %s", self._chat_id, exc_info=err)
+            self._is_broken = True
+            return
+
+        if self.first_part_time is None:
+            self.first_part_time = current_time
+
+        self._shown_text = text
+        self._shown_at = current_time
+
+    def restart(self) -> None:
+        self._parser = ResponseTextParser()
 
 
 class DefaultModelResponseProcessor(ModelResponseProcessor):
     IGNORING_STREAK_LIMIT = 10
 
-    def __init__(self, sender_service: SenderService, db_session: AsyncSession) -> None:
+    def __init__(
+        self, sender_service: SenderService, db_session: AsyncSession, openai_config: OpenAIConfig
+    ) -> None:
         super().__init__()
 
         self._sender_service = sender_service
         self._db_session = db_session
+        self._openai_config = openai_config
         self._logger = logging.getLogger(__name__)
 
-    async def process(self, chat_id: int, response_raw: str) -> None:
+    async def process(
+        self, chat_id: int, response_raw: str, stream: ModelResponseStream | None = None
+    ) -> bool:
         try:
             response = ModelResponse.model_validate_json(response_raw)
         except ValidationError as err:
@@ -29,23 +91,27 @@ class DefaultModelResponseProcessor(ModelResponseProcessor):
                 response_raw,
                 exc_info=err,
             )
-            return
+            return False
 
         if response.text or response.sticker:
             try:
-                await self._sender_service.send_model_response(chat_id, response)
+                await self._sender_service.send_model_response(
+                    chat_id, response, stream.message_id if stream is not None else None
+                )
             except Exception as err:
                 self._logger.error(
                     "Failed to send model response in chat %s",
                     chat_id,
                     exc_info=err,
                 )
-                return
+                return False
 
             await self._db_session.execute(
                 update(ChatState).where(ChatState.chat_id == chat_id).values(ignoring_streak=0)
             )
             await self._db_session.commit()
+
+            return True
         else:
             chat_state = await self._db_session.get_one(ChatState, chat_id)
 
@@ -65,6 +131,8 @@ class DefaultModelResponseProcessor(ModelResponseProcessor):
 
             await self._db_session.commit()
 
+            return False
+
     async def process_refusal(self, chat_id: int, refusal: str) -> None:
         self._logger.info("Processing refusal in chat %s: %s", chat_id, refusal)
 
@@ -82,3 +150,8 @@ class DefaultModelResponseProcessor(ModelResponseProcessor):
             update(ChatState).where(ChatState.chat_id == chat_id).values(ignoring_streak=0)
         )
         await self._db_session.commit()
+
+    def start_stream(self, chat_id: int) -> ModelResponseStream:
+        return TelegramResponseStream(
+            chat_id, self._sender_service, self._openai_config.stream_edit_interval
+        )
@@ -5,9 +5,15 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from aerith_cbot.config import LimitsConfig, LLMConfig
 from aerith_cbot.database.models import ChatState
-from aerith_cbot.services.abstractions import LimitsService, SenderService, VoiceTranscriber
+from aerith_cbot.services.abstractions import (
+    LimitsService,
+    SenderService,
+    SupportService,
+    VoiceTranscriber,
+)
 from aerith_cbot.services.abstractions.models import ChatType, InputChat, InputMessage
 from aerith_cbot.services.abstractions.processors import PrivateMessageProcessor
+from aerith_cbot.services.abstractions.utils.encoding import encode_model_input
 from aerith_cbot.services.abstractions.utils.mapping import input_msg_to_model_input
 from aerith_cbot.services.implementations.chat_dispatcher import MessageQueue
 
@@ -24,6 +30,7 @@ class DefaultPrivateMessageProcessor(PrivateMessageProcessor):
         llm_config: LLMConfig,
         sender_service: SenderService,
         voice_transcriber: VoiceTranscriber,
+        support_service: SupportService,
     ) -> None:
         super().__init__()
 
@@ -35,6 +42,7 @@ class DefaultPrivateMessageProcessor(PrivateMessageProcessor):
         self._llm_config = llm_config
         self._sender_service = sender_service
         self._voice_transcriber = voice_transcriber
+        self._support_service = support_service
 
     async def process(self, message: InputMessage) -> None:
         chat_state = await self._create_of_fetch_chat_state(message.chat)
@@ -95,7 +103,7 @@ class DefaultPrivateMessageProcessor(PrivateMessageProcessor):
         content.append(
             {
                 "type": "text",
-                "text": model_input_message.model_dump_json(exclude_none=True),
+                "text": encode_model_input(model_input_message),
             }
         )
 
@@ -106,7 +114,13 @@ class DefaultPrivateMessageProcessor(PrivateMessageProcessor):
             }
         )
 
-        self._message_queue.add(message.chat.id, ChatType.private, new_messages)
+        self._message_queue.add(
+            message.chat.id,
+            ChatType.private,
+            new_messages,
+            is_aerith_called=True,
+            from_supporter=await self._support_service.is_active_supporter(message.sender.id),
+        )
 
     async def _create_of_fetch_chat_state(self, chat: InputChat) -> ChatState:
         chat_state = await self._db_session.get(ChatState, chat.id)
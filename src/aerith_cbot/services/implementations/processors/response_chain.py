@@ -0,0 +1,172 @@
+from openai.types.chat import ChatCompletion
+from openai.types.responses import Response
+
+
+def to_response_input(messages: list[dict]) -> list[dict]:
+    """Converts chat completion messages to input items of the Responses API"""
+
+    items = []
+
+    for message in messages:
+        role = message["role"]
+
+        if role == "tool":
+            items.append(
+                {
+                    "type": "function_call_output",
+                    "call_id": message["tool_call_id"],
+                    "output": message["content"],
+                }
+            )
+            continue
+
+        content = message.get("content")
+        if isinstance(content, list):
+            content = [_to_response_part(part, role) for part in content]
+
+        # an assistant message with tool calls only has no content
+        if content is not None:
+            items.append({"role": role, "content": content})
+
+        for tool_call in message.get("tool_calls") or []:
+            items.append(
+                {
+                    "type": "function_call",
+                    "call_id": tool_call["id"],
+                    "name": tool_call["function"]["name"],
+                    "arguments": tool_call["function"]["arguments"],
+                }
+            )
+
+    return items
+
+
+def _to_response_part(part: dict, role: str) -> dict:
+    if part.get("type") == "text":
+        return {
+            "type": "output_text" if role == "assistant" else "input_text",
+            "text": part["text"],
+        }
+
+    if part.get("type") == "image_url":
+        return {
+            "type": "input_image",
+            "image_url": part["image_url"]["url"],
+            "detail": part["image_url"].get("detail", "auto"),
+        }
+
+    return part
+
+
+def to_response_tools(tools: list) -> list[dict]:
+    return [{"type": "function", **tool["function"]} for tool in tools]
+
+
+def to_response_text(response_format: dict) -> dict:
+    # {"type": "json_schema", "json_schema": {...}} -> {"format": {"type": "json_schema", ...}}
+    format_type = response_format["type"]
+    return {"format": {"type": format_type, **response_format.get(format_type, {})}}
+
+
+def to_chat_completion(response: Response) -> ChatCompletion:
+    """Converts a response to a chat completion, so the chat processor handles both the same"""
+
+    texts = []
+    refusal = None
+    tool_calls = []
+
+    for item in response.output:
+        if item.type == "message":
+            for part in item.content:
+                if part.type == "output_text":
+                    texts.append(part.text)
+                elif part.type == "refusal":
+                    refusal = part.refusal
+        elif item.type == "function_call":
+            tool_calls.append(
+                {
+                    "id": item.call_id,
+                    "type": "function",
+                    "function": {"name": item.name, "arguments": item.arguments},
+                }
+            )
+
+    usage = None
+    if response.usage is not None:
+        usage = {
+            "prompt_tokens": response.usage.input_tokens,
+            "completion_tokens": response.usage.output_tokens,
+            "total_tokens": response.usage.total_tokens,
+            "prompt_tokens_details": {
+                "cached_tokens": response.usage.input_tokens_details.cached_tokens
+            },
+        }
+
+    return ChatCompletion.model_validate(
+        {
+            "id": response.id,
+            "object": "chat.completion",
+            "created": int(response.created_at),
+            "model": response.model,
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "tool_calls" if tool_calls else "stop",
+                    "message": {
+                        "role": "assistant",
+                        "content": "".join(texts) if texts else None,
+                        "refusal": refusal,
+                        "tool_calls": tool_calls or None,
+                    },
+                }
+            ],
+            "usage": usage,
+        }
+    )
+
+
+class ResponseChain:
+    """The response stored by OpenAI which the next request of a turn continues
+
+    A continuation only sends the messages after the ones the response has seen and its own
+    output (the assistant message). If those messages have changed, e.g. the history has been
+    compacted, the next request sends everything again.
+    """
+
+    def __init__(self) -> None:
+        self._response_id: str | None = None
+        self._messages: list[dict] = []
+
+    @property
+    def response_id(self) -> str | None:
+        return self._response_id
+
+    def continuation(self, messages: list[dict]) -> tuple[str | None, list[dict]]:
+        """The response to continue and the messages to send for it"""
+
+        count = len(self._messages)
+
+        if (
+            self._response_id is None
+            or len(messages) <= count
+            or messages[count]["role"] != "assistant"
+            or messages[:count] != self._messages
+        ):
+            return None, messages
+
+        return self._response_id, messages[count + 1 :]
+
+    def advance(self, response_id: str, messages: list[dict]) -> None:
+        """Remembers the response to the given messages"""
+
+        self._response_id = response_id
+        self._messages = list(messages)
+
+    def reset(self) -> None:
+        self._response_id = None
+        self._messages = []
+
+    def __repr__(self) -> str:
+        return f"ResponseChain(\
+        response_id={self._response_id}, \
+        messages={len(self._messages)})"
@@ -2,6 +2,9 @@ from abc import ABC, abstractmethod
 
 
 class ToolCommand(ABC):
+    # read-only tools which can run alongside the other calls of the same model response
+    is_parallel_safe = False
+
     @abstractmethod
     async def execute(self, arguments: str, chat_id: int) -> str:
         pass
@@ -19,3 +22,7 @@ class ToolCommandDispatcher(ABC):
     @abstractmethod
     async def execute_tool(self, name: str, arguments: str, chat_id: int) -> ToolExecutionResult:
         pass
+
+    @abstractmethod
+    def is_parallel_safe(self, name: str) -> bool:
+        pass
@@ -76,3 +76,7 @@ class DefaultToolCommandDispatcher(ToolCommandDispatcher):
         self._logger.info("Result for tool %s in chat %s is: %s", name, chat_id, result)
 
         return ToolExecutionResult(result)
+
+    def is_parallel_safe(self, name: str) -> bool:
+        tool = self._tools.get(name)
+        return tool is not None and tool.is_parallel_safe
@@ -20,6 +20,8 @@ class FetchInfoParams(BaseModel):
 
 
 class FetchInfoToolCommand(ToolCommand):
+    is_parallel_safe = True
+
     def __init__(self, memory_service: MemoryService, llm_config: LLMConfig) -> None:
         super().__init__()
 
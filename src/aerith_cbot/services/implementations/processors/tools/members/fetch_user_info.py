@@ -14,6 +14,8 @@ class FetchUserInfoParams(BaseModel):
 
 
 class FetchUserInfoToolCommand(ToolCommand):
+    is_parallel_safe = True
+
     def __init__(self, memory_service: MemoryService, llm_config: LLMConfig) -> None:
         super().__init__()
 
@@ -12,6 +12,8 @@ from . import ToolCommand
 
 
 class GetChatInfoToolCommand(ToolCommand):
+    is_parallel_safe = True
+
     def __init__(
         self,
         bot: Bot,
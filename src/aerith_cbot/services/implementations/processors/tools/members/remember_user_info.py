@@ -5,6 +5,10 @@ from pydantic import BaseModel
 
 from aerith_cbot.config import LLMConfig
 from aerith_cbot.services.abstractions import MemoryService
+from aerith_cbot.services.implementations.openai_rate_limiter import (
+    RequestPriority,
+    openai_priority,
+)
 
 from . import ToolCommand
 
@@ -26,13 +30,14 @@ class RememberUserInfoToolCommand(ToolCommand):
         params = RememberUserInfoParams.model_validate_json(arguments)
 
         # dont wait for the task to complete for optimization purposes
-        asyncio.create_task(self._memory_service.remember(str(params.user_id), params.info))
+        asyncio.create_task(self._safe_remember(str(params.user_id), params.info))
 
         return self._llm_config.additional_instructions.info_saved
 
     async def _safe_remember(self, object_id: str, info: str):
         try:
-            await self._memory_service.remember(object_id, info)
+            with openai_priority(RequestPriority.background):
+                await self._memory_service.remember(object_id, info)
         except Exception as e:
             self._logger.exception(
                 "Cannot create memory for %s cause of %s", object_id, e, exc_info=e
@@ -8,6 +8,8 @@ class ThinkParams(BaseModel):
 
 
 class ThinkToolCommand(ToolCommand):
+    is_parallel_safe = True
+
     def __init__(self) -> None:
         super().__init__()
 
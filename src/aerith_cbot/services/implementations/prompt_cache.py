@@ -0,0 +1,157 @@
+import collections
+import copy
+
+from aerith_cbot.config import LLMConfig
+from aerith_cbot.services.abstractions.models import ChatType
+
+from .token_estimator import TokenEstimator
+
+
+class RequestTemplate:
+    """The fixed beginning of LLM requests: instructions, tools and the response schema
+
+    OpenAI caches prompts by their prefix, so it's built once and never changed: every request
+    of a chat type and model starts with the same bytes.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        instruction_messages: list[dict],
+        tools: list,
+        response_format: dict,
+        prefix_tokens: int,
+    ) -> None:
+        self._model = model
+        # copies, so changes of the config objects can't leak into the prefix
+        self._instruction_messages = tuple(copy.deepcopy(instruction_messages))
+        self._tools = tuple(copy.deepcopy(tools))
+        self._response_format = copy.deepcopy(response_format)
+        self._prefix_tokens = prefix_tokens
+
+    @property
+    def model(self) -> str:
+        return self._model
+
+    @property
+    def tools(self) -> list:
+        return list(self._tools)
+
+    @property
+    def response_format(self) -> dict:
+        return self._response_format
+
+    @property
+    def prefix_tokens(self) -> int:
+        """Estimated tokens of the instructions and the schemas"""
+        return self._prefix_tokens
+
+    def messages(self, *history: list[dict]) -> list[dict]:
+        """The instructions followed by the given history parts"""
+
+        messages = list(self._instruction_messages)
+        for part in history:
+            messages += part
+
+        return messages
+
+    def __repr__(self) -> str:
+        return f"RequestTemplate(\
+        model={self._model}, \
+        tools={len(self._tools)}, \
+        prefix_tokens={self._prefix_tokens})"
+
+
+class RequestTemplates:
+    """Builds request templates once per chat type, model and set of dropped tools"""
+
+    def __init__(self, llm_config: LLMConfig, token_estimator: TokenEstimator) -> None:
+        self._llm_config = llm_config
+        self._token_estimator = token_estimator
+
+        self._templates: dict[tuple[ChatType, str, frozenset[str]], RequestTemplate] = {}
+
+    def get(
+        self, chat_type: ChatType, model: str, dropped_tools: frozenset[str] = frozenset()
+    ) -> RequestTemplate:
+        key = (chat_type, model, dropped_tools)
+        template = self._templates.get(key)
+
+        if template is None:
+            template = self._build(chat_type, model, dropped_tools)
+            self._templates[key] = template
+
+        return template
+
+    def _build(
+        self, chat_type: ChatType, model: str, dropped_tools: frozenset[str]
+    ) -> RequestTemplate:
+        if chat_type == ChatType.group:
+            tools = self._llm_config.tools + self._llm_config.group_tools
+            instruction = self._llm_config.group_instruction
+        else:
+            tools = self._llm_config.tools
+            instruction = self._llm_config.private_instruction
+
+        tools = [tool for tool in tools if tool["function"]["name"] not in dropped_tools]
+
+        instruction_messages = [{"role": "developer", "content": instruction}]
+
+        prefix_tokens = sum(
+            self._token_estimator.estimate_message(message) for message in instruction_messages
+        ) + self._token_estimator.estimate_schemas(tools, self._llm_config.response_schema)
+
+        return RequestTemplate(
+            model, instruction_messages, tools, self._llm_config.response_schema, prefix_tokens
+        )
+
+
+class CacheUsage:
+    def __init__(self) -> None:
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    @property
+    def ratio(self) -> float:
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    def __repr__(self) -> str:
+        return f"CacheUsage(prompt_tokens={self.prompt_tokens}, cached_tokens={self.cached_tokens})"
+
+
+class PromptCacheStats:
+    """Share of prompt tokens served from the OpenAI prompt cache, per model and per chat"""
+
+    # only the recently active chats are kept
+    MAX_CHATS = 1000
+
+    def __init__(self) -> None:
+        self._models: dict[str, CacheUsage] = {}
+        self._chats: collections.OrderedDict[int, CacheUsage] = collections.OrderedDict()
+
+    def observe(self, chat_id: int, model: str, prompt_tokens: int, cached_tokens: int) -> None:
+        chat_usage = self._chats.pop(chat_id, None) or CacheUsage()
+        self._chats[chat_id] = chat_usage
+
+        if len(self._chats) > PromptCacheStats.MAX_CHATS:
+            self._chats.popitem(last=False)
+
+        model_usage = self._models.setdefault(model, CacheUsage())
+
+        for usage in (chat_usage, model_usage):
+            usage.prompt_tokens += prompt_tokens
+            usage.cached_tokens += cached_tokens
+
+    def models(self) -> dict[str, CacheUsage]:
+        return dict(self._models)
+
+    def chat(self, chat_id: int) -> CacheUsage | None:
+        return self._chats.get(chat_id)
+
+    def worst_chats(self, count: int) -> list[tuple[int, CacheUsage]]:
+        """Chats which have sent the most uncached tokens"""
+
+        return sorted(
+            self._chats.items(),
+            key=lambda item: item[1].cached_tokens - item[1].prompt_tokens,
+        )[:count]
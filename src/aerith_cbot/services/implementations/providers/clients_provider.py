@@ -2,7 +2,7 @@ from typing import AsyncIterable
 
 import aiohttp
 from dishka import Provider, Scope, provide
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 
 from aerimory import AerimoryClient
 from aerimory.llm import OpenAILLM
@@ -13,6 +13,14 @@ from aerith_cbot.config import (
     ChromaConfig,
     OpenAIConfig,
 )
+from aerith_cbot.services.implementations.openai_rate_limiter import (
+    OpenAIRateLimiter,
+    RateLimitedTransport,
+)
+
+
+def rate_limited_http_client(rate_limiter: OpenAIRateLimiter) -> DefaultAsyncHttpxClient:
+    return DefaultAsyncHttpxClient(transport=RateLimitedTransport(rate_limiter))
 
 
 class ClientsProvider(Provider):
@@ -23,8 +31,12 @@ class ClientsProvider(Provider):
         await client.close()
 
     @provide(scope=Scope.APP)
-    async def openai_client(self, openai_config: OpenAIConfig) -> AsyncIterable[AsyncOpenAI]:
-        client = AsyncOpenAI(api_key=openai_config.token)
+    async def openai_client(
+        self, openai_config: OpenAIConfig, rate_limiter: OpenAIRateLimiter
+    ) -> AsyncIterable[AsyncOpenAI]:
+        client = AsyncOpenAI(
+            api_key=openai_config.token, http_client=rate_limited_http_client(rate_limiter)
+        )
         yield client
         await client.close()
 
@@ -33,6 +45,7 @@ class ClientsProvider(Provider):
         self,
         chroma_config: ChromaConfig,
         openai_config: OpenAIConfig,
+        rate_limiter: OpenAIRateLimiter,
     ) -> AerimoryClient:
         open_ai_llm_config = OpenAILLMConfig(
             api_key=openai_config.token, model=openai_config.memory_llm_model
@@ -45,8 +58,12 @@ class ClientsProvider(Provider):
             ),
         )
 
+        # memory requests share the rate limits with the rest of the bot
         client = AerimoryClient(
-            vector_store=ChromaVectorStore(aeimory_chroma_config), llm=OpenAILLM(open_ai_llm_config)
+            vector_store=ChromaVectorStore(
+                aeimory_chroma_config, rate_limited_http_client(rate_limiter)
+            ),
+            llm=OpenAILLM(open_ai_llm_config, rate_limited_http_client(rate_limiter)),
         )
 
         return client
@@ -5,10 +5,17 @@ from aerith_cbot.config import (
     ChromaConfig,
     Config,
     DbConfig,
+    DispatcherConfig,
+    IdleCompactionConfig,
+    LeasesConfig,
     LimitsConfig,
     LLMConfig,
+    LoadSheddingConfig,
+    MediaConfig,
     OpenAIConfig,
+    RateLimitsConfig,
     SupportConfig,
+    WorkersConfig,
 )
 
 
@@ -44,3 +51,31 @@ class ConfigProvider(Provider):
     @provide(scope=Scope.APP)
     def support_config(self) -> SupportConfig:
         return self.config.support
+
+    @provide(scope=Scope.APP)
+    def dispatcher_config(self) -> DispatcherConfig:
+        return self.config.dispatcher
+
+    @provide(scope=Scope.APP)
+    def workers_config(self) -> WorkersConfig:
+        return self.config.workers
+
+    @provide(scope=Scope.APP)
+    def leases_config(self) -> LeasesConfig:
+        return self.config.leases
+
+    @provide(scope=Scope.APP)
+    def rate_limits_config(self) -> RateLimitsConfig:
+        return self.config.rate_limits
+
+    @provide(scope=Scope.APP)
+    def load_shedding_config(self) -> LoadSheddingConfig:
+        return self.config.load_shedding
+
+    @provide(scope=Scope.APP)
+    def idle_compaction_config(self) -> IdleCompactionConfig:
+        return self.config.idle_compaction
+
+    @provide(scope=Scope.APP)
+    def media_config(self) -> MediaConfig:
+        return self.config.media
@@ -0,0 +1,125 @@
+import json
+import logging
+import math
+
+
+class TokenEstimator:
+    """Estimates prompt tokens offline, without a tokenizer
+
+    The estimate is rough (about 4 latin or 3 other characters per token), so it is corrected
+    by the ratio between actual and estimated tokens of the previous requests.
+    """
+
+    # tokens which wrap each message and prime the reply
+    MESSAGE_OVERHEAD = 4
+    REPLY_OVERHEAD = 3
+    # a low-detail image costs the same whatever its size
+    LOW_DETAIL_IMAGE_TOKENS = 85
+    # high-detail images depend on their size which we don't know here, so take a 1024px one
+    HIGH_DETAIL_IMAGE_TOKENS = 765
+    TOOL_OVERHEAD = 8
+
+    ASCII_CHARS_PER_TOKEN = 4
+    OTHER_CHARS_PER_TOKEN = 3
+
+    CORRECTION_SMOOTHING = 0.2
+    # the estimator shouldn't go crazy because of a single weird request
+    MIN_CORRECTION = 0.5
+    MAX_CORRECTION = 2.0
+
+    def __init__(self) -> None:
+        self._logger = logging.getLogger(__name__)
+
+        self.correction = 1.0
+
+    def estimate_text(self, text: str) -> int:
+        ascii_chars = sum(1 for char in text if char.isascii())
+        other_chars = len(text) - ascii_chars
+
+        return math.ceil(
+            ascii_chars / TokenEstimator.ASCII_CHARS_PER_TOKEN
+            + other_chars / TokenEstimator.OTHER_CHARS_PER_TOKEN
+        )
+
+    def estimate_message(self, message: dict) -> int:
+        tokens = TokenEstimator.MESSAGE_OVERHEAD
+
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += self.estimate_text(content)
+        elif isinstance(content, list):
+            for part in content:
+                # chat completions parts and their Responses API counterparts
+                if part.get("type") in ("text", "input_text", "output_text"):
+                    tokens += self.estimate_text(part.get("text", ""))
+                elif part.get("type") in ("image_url", "input_image"):
+                    if part.get("type") == "image_url":
+                        detail = part.get("image_url", {}).get("detail")
+                    else:
+                        detail = part.get("detail")
+
+                    if detail == "low":
+                        tokens += TokenEstimator.LOW_DETAIL_IMAGE_TOKENS
+                    else:
+                        tokens += TokenEstimator.HIGH_DETAIL_IMAGE_TOKENS
+
+        # function calls and their outputs are separate items in the Responses API
+        for field in ("output", "arguments"):
+            if isinstance(message.get(field), str):
+                tokens += self.estimate_text(message[field])
+
+        for tool_call in message.get("tool_calls") or []:
+            function = tool_call.get("function", {})
+            tokens += TokenEstimator.TOOL_OVERHEAD
+            tokens += self.estimate_text(function.get("name", ""))
+            tokens += self.estimate_text(function.get("arguments", ""))
+
+        return tokens
+
+    def estimate_schemas(self, tools: list | tuple, response_format: dict | None = None) -> int:
+        # schemas are rendered into the prompt in a compact form close to their json
+        tokens = 0
+
+        for tool in tools:
+            tokens += TokenEstimator.TOOL_OVERHEAD
+            tokens += self.estimate_text(json.dumps(tool, ensure_ascii=False))
+
+        if response_format:
+            tokens += self.estimate_text(json.dumps(response_format, ensure_ascii=False))
+
+        return tokens
+
+    def estimate(
+        self,
+        messages: list[dict],
+        tools: list | tuple = (),
+        response_format: dict | None = None,
+        prefix_tokens: int = 0,
+    ) -> int:
+        """Estimates prompt tokens of a request; `prefix_tokens` is a precomputed raw estimate"""
+
+        tokens = TokenEstimator.REPLY_OVERHEAD + prefix_tokens
+        tokens += sum(self.estimate_message(message) for message in messages)
+        tokens += self.estimate_schemas(tools, response_format)
+
+        return math.ceil(tokens * self.correction)
+
+    def observe(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """Corrects next estimates by the actual prompt tokens of a request"""
+
+        if estimated_tokens <= 0 or actual_tokens <= 0:
+            return
+
+        error = (estimated_tokens - actual_tokens) / actual_tokens
+        self._logger.info(
+            "Estimated %s prompt tokens, actual %s (error %+.1f%%)",
+            estimated_tokens,
+            actual_tokens,
+            error * 100,
+        )
+
+        # the estimate already includes the correction, so the raw ratio is scaled back
+        ratio = self.correction * actual_tokens / estimated_tokens
+        ratio = min(max(ratio, TokenEstimator.MIN_CORRECTION), TokenEstimator.MAX_CORRECTION)
+
+        self.correction += TokenEstimator.CORRECTION_SMOOTHING * (ratio - self.correction)
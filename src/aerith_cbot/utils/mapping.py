@@ -3,6 +3,7 @@ from aiogram import Bot
 from aiogram.types import Chat, Message, User
 
 from aerith_cbot.services.abstractions.models import InputChat, InputMessage, InputUser
+from aerith_cbot.utils.media import low_detail_photo, media_reference
 
 
 def tg_chat_to_input_chat(chat: Chat) -> InputChat:
@@ -29,11 +30,11 @@ async def tg_msg_to_input_message(
 
     text = msg.text or msg.caption or (msg.sticker and msg.sticker.emoji)
 
+    # the photo is resolved when it's sent to the model, its links don't live long
     photo_url = None
-    if msg.photo is not None:
-        file_id = msg.photo[-1].file_id
-        file = await bot.get_file(file_id)
-        photo_url = f"https://api.telegram.org/file/bot{bot.token}/{file.file_path}"
+    if msg.photo:
+        photo = low_detail_photo(msg.photo)
+        photo_url = media_reference(photo.file_id, photo.file_unique_id)
 
     voice_url = None
     if msg.voice is not None and msg.voice.duration < 1200:
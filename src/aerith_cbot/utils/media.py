@@ -0,0 +1,35 @@
+from aiogram.types import PhotoSize
+
+# images are stored in the history as references to Telegram files instead of their links,
+# which expire in about an hour; they are resolved right before a request
+MEDIA_REFERENCE_PREFIX = "tg-file:"
+
+# images are sent with "low" detail, so OpenAI scales them down to 512px anyway
+LOW_DETAIL_SIZE = 512
+
+
+def media_reference(file_id: str, file_unique_id: str) -> str:
+    return f"{MEDIA_REFERENCE_PREFIX}{file_unique_id}/{file_id}"
+
+
+def parse_media_reference(url: str) -> tuple[str, str] | None:
+    """The file_id and file_unique_id of a reference, None for other urls"""
+
+    if not url.startswith(MEDIA_REFERENCE_PREFIX):
+        return None
+
+    file_unique_id, _, file_id = url.removeprefix(MEDIA_REFERENCE_PREFIX).partition("/")
+    if not file_unique_id or not file_id:
+        return None
+
+    return file_id, file_unique_id
+
+
+def low_detail_photo(sizes: list[PhotoSize]) -> PhotoSize:
+    """The smallest size of a photo which is still enough for a low-detail image"""
+
+    for size in sizes:
+        if max(size.width, size.height) >= LOW_DETAIL_SIZE:
+            return size
+
+    return sizes[-1]
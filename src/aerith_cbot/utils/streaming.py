@@ -0,0 +1,107 @@
+import json
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class ResponseTextParser:
+    """Incrementally extracts string fields of a flat JSON object streamed in chunks
+
+    It's made for `ModelResponse`: the text is known before the whole object is generated, so it
+    can be shown to the user early. Values of the other fields are available once they're done.
+    """
+
+    def __init__(self, streamed_field: str = "text") -> None:
+        self._streamed_field = streamed_field
+
+        self._state = "object"
+        self._key: list[str] = []
+        self._value: list[str] = []
+        self._escape: str | None = None
+        self._high_surrogate: int | None = None
+
+        self.values: dict = {}
+
+    @property
+    def text(self) -> str:
+        """The streamed field decoded so far"""
+
+        if self._streamed_field in self.values:
+            return self.values[self._streamed_field] or ""
+
+        if self._state == "string" and "".join(self._key) == self._streamed_field:
+            return "".join(self._value)
+
+        return ""
+
+    def feed(self, chunk: str) -> None:
+        for char in chunk:
+            self._feed_char(char)
+
+    def _feed_char(self, char: str) -> None:
+        if self._state == "object":
+            if char == '"':
+                self._key = []
+                self._state = "key"
+        elif self._state == "key":
+            if self._escape is not None:
+                self._key.append(_ESCAPES.get(char, char))
+                self._escape = None
+            elif char == "\\":
+                self._escape = ""
+            elif char == '"':
+                self._state = "colon"
+            else:
+                self._key.append(char)
+        elif self._state == "colon":
+            if char == ":":
+                self._state = "value"
+        elif self._state == "value":
+            if char == '"':
+                self._value = []
+                self._state = "string"
+            elif not char.isspace():
+                self._value = [char]
+                self._state = "literal"
+        elif self._state == "string":
+            self._feed_string_char(char)
+        elif self._state == "literal":
+            if char in ",}":
+                self.values["".join(self._key)] = json.loads("".join(self._value).strip())
+                self._state = "object"
+            else:
+                self._value.append(char)
+
+    def _feed_string_char(self, char: str) -> None:
+        if self._escape is None:
+            if char == "\\":
+                self._escape = ""
+            elif char == '"':
+                self.values["".join(self._key)] = "".join(self._value)
+                self._state = "object"
+            else:
+                self._value.append(char)
+            return
+
+        if self._escape == "" and char != "u":
+            self._value.append(_ESCAPES.get(char, char))
+            self._escape = None
+            return
+
+        # \uXXXX: collect 4 hex digits after "u"
+        self._escape += char
+        if len(self._escape) < 5:
+            return
+
+        code = int(self._escape[1:], 16)
+        self._escape = None
+
+        if 0xD800 <= code <= 0xDBFF:
+            # the first half of a surrogate pair, the second one is the next escape
+            self._high_surrogate = code
+        elif 0xDC00 <= code <= 0xDFFF and self._high_surrogate is not None:
+            self._value.append(
+                chr(0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00))
+            )
+            self._high_surrogate = None
+        else:
+            self._value.append(chr(code))
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+from multiprocessing.process import BaseProcess
+
+from aiogram import Bot
+
+from .config import load_config
+from .container import init_dishka_container, run_idle_compaction
+from .services.implementations.chat_dispatcher import ChatWorker, TurnExecutor, WorkerTransport
+
+
+def start_workers(workers_count: int, transport: WorkerTransport) -> list[BaseProcess]:
+    context = multiprocessing.get_context("spawn")
+
+    processes = []
+    for worker_id in range(workers_count):
+        process = context.Process(
+            target=run_worker, args=(worker_id, transport), name=f"aerith-worker-{worker_id}"
+        )
+        process.start()
+
+        processes.append(process)
+
+    return processes
+
+
+async def stop_workers(transport: WorkerTransport, processes: list[BaseProcess]) -> None:
+    for worker_id in range(len(processes)):
+        await transport.send_command(worker_id, None)
+
+    for process in processes:
+        await asyncio.to_thread(process.join)
+
+
+def run_worker(worker_id: int, transport: WorkerTransport) -> None:
+    """Entry point of a worker process"""
+
+    # Ctrl+C reaches the whole process group, but workers are stopped by the bot process
+    # only after it has drained them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    asyncio.run(_worker_main(worker_id, transport))
+
+
+async def _worker_main(worker_id: int, transport: WorkerTransport) -> None:
+    config = load_config(os.environ["CONFIG_PATH"], os.environ["LLM_CONFIG_PATH"])
+
+    # every worker evicts only its own files, the chats of a worker are always its own anyway
+    config.media.cache_dir = os.path.join(config.media.cache_dir, f"worker-{worker_id}")
+    config.media.cache_max_bytes //= config.workers.count
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"%(asctime)s - %(levelname)s - worker {worker_id} - %(name)s - %(message)s",
+        force=True,
+        encoding="utf-8",
+    )
+
+    bot = Bot(token=config.bot.token)
+    container = await init_dishka_container(config, bot, run_bg_workers=False)
+
+    # the turns of the worker's chats, and so the sizes of their histories, are known only here
+    await run_idle_compaction(container)
+
+    try:
+        turn_executor = await container.get(TurnExecutor)
+        await ChatWorker(worker_id, transport, turn_executor).run()
+    finally:
+        await container.close()
+        await bot.session.close()
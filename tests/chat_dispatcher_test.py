@@ -0,0 +1,645 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from aerith_cbot.config import DispatcherConfig, LeasesConfig, LoadSheddingConfig
+from aerith_cbot.services.abstractions import MessageService
+from aerith_cbot.services.abstractions.models import ChatType
+from aerith_cbot.services.abstractions.processors import ChatProcessor, ChatTurn
+from aerith_cbot.services.implementations.chat_dispatcher import (
+    ChatDispatcher,
+    InMemoryChatLeases,
+    LocalTurnExecutor,
+    MessageQueue,
+    TurnExecutor,
+)
+from aerith_cbot.services.implementations.chat_dispatcher.message_queue import (
+    LocalQueueEntry,
+)
+
+
+def make_entry(
+    chat_id: int, chat_type: ChatType, is_aerith_called=False, from_supporter=False
+) -> LocalQueueEntry:
+    entry = LocalQueueEntry(chat_id, chat_type, [{"role": "user", "content": "hi"}])
+    entry.is_aerith_called = is_aerith_called
+    entry.from_supporter = from_supporter
+
+    return entry
+
+
+def make_dispatcher(
+    max_concurrent_turns: int,
+    latest_wins=False,
+    load_shedding_config: LoadSheddingConfig | None = None,
+) -> ChatDispatcher:
+    return ChatDispatcher(
+        db_engine=MagicMock(),
+        message_queue=MessageQueue(),
+        turn_executor=MagicMock(spec=TurnExecutor),
+        chat_leases=InMemoryChatLeases(LeasesConfig()),
+        dispatcher_config=DispatcherConfig(
+            max_concurrent_turns=max_concurrent_turns, latest_wins=latest_wins
+        ),
+        leases_config=LeasesConfig(),
+        load_shedding_config=load_shedding_config or LoadSheddingConfig(),
+    )
+
+
+@pytest.mark.asyncio
+async def test_turns_are_started_by_priority():
+    dispatcher = make_dispatcher(max_concurrent_turns=1)
+    handled_chats = []
+
+    async def handle_entry(chat_id: int, entry: LocalQueueEntry, turn: ChatTurn) -> None:
+        handled_chats.append(chat_id)
+        dispatcher._working_chats.discard(chat_id)
+
+    dispatcher.handle_entry = handle_entry  # type: ignore
+
+    dispatcher._schedule(make_entry(1, ChatType.group))
+    dispatcher._schedule(make_entry(2, ChatType.group, is_aerith_called=True))
+    dispatcher._schedule(make_entry(3, ChatType.private, is_aerith_called=True))
+    dispatcher._schedule(make_entry(4, ChatType.group, from_supporter=True))
+    dispatcher._start_pending_turns()
+
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+    assert handled_chats == [4, 3, 2, 1]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_turns_limit():
+    dispatcher = make_dispatcher(max_concurrent_turns=2)
+    release_event = asyncio.Event()
+
+    async def handle_entry(chat_id: int, entry: LocalQueueEntry, turn: ChatTurn) -> None:
+        await release_event.wait()
+        dispatcher._working_chats.discard(chat_id)
+
+    dispatcher.handle_entry = handle_entry  # type: ignore
+
+    for chat_id in range(5):
+        dispatcher._schedule(make_entry(chat_id, ChatType.group))
+    dispatcher._start_pending_turns()
+
+    await asyncio.sleep(0)
+
+    assert dispatcher.working_chats_count == 2
+    assert dispatcher.pending_turns_count == 3
+
+    release_event.set()
+
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+    assert dispatcher.working_chats_count == 0
+    assert dispatcher.pending_turns_count == 0
+
+
+@pytest.mark.asyncio
+async def test_hot_chat_does_not_starve_others():
+    dispatcher = make_dispatcher(max_concurrent_turns=1)
+    handled_chats = []
+
+    async def handle_entry(chat_id: int, entry: LocalQueueEntry, turn: ChatTurn) -> None:
+        handled_chats.append(chat_id)
+        dispatcher._working_chats.discard(chat_id)
+
+        # the hot chat has new messages right after each turn
+        if chat_id == 1 and handled_chats.count(1) < 3:
+            dispatcher._schedule(make_entry(1, ChatType.group))
+
+    dispatcher.handle_entry = handle_entry  # type: ignore
+
+    dispatcher._schedule(make_entry(1, ChatType.group))
+    dispatcher._schedule(make_entry(2, ChatType.group))
+    dispatcher._schedule(make_entry(3, ChatType.group))
+    dispatcher._start_pending_turns()
+
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+    assert handled_chats == [1, 2, 3, 1, 1]
+
+
+def make_container(processor: ChatProcessor, message_service: MessageService) -> MagicMock:
+    async def get(dependency_type):
+        return processor if dependency_type is ChatProcessor else message_service
+
+    request_container = MagicMock()
+    request_container.get = get
+
+    container = MagicMock()
+    container.return_value.__aenter__ = AsyncMock(return_value=request_container)
+    container.return_value.__aexit__ = AsyncMock(return_value=None)
+
+    return container
+
+
+@pytest.mark.asyncio
+async def test_pending_messages_go_to_next_turn_right_away():
+    dispatcher = make_dispatcher(max_concurrent_turns=4)
+    release_event = asyncio.Event()
+
+    message_service = MagicMock(spec=MessageService)
+    message_service.add_messages = AsyncMock()
+
+    async def process(chat_id: int, chat_type: ChatType, turn: ChatTurn) -> None:
+        await release_event.wait()
+
+    processor = MagicMock(spec=ChatProcessor)
+    processor.process = AsyncMock(side_effect=process)
+
+    dispatcher._turn_executor = LocalTurnExecutor(make_container(processor, message_service))
+
+    dispatcher._schedule(make_entry(1, ChatType.private))
+    dispatcher._start_pending_turns()
+    await asyncio.sleep(0)
+
+    # new message comes while the first turn is running, its debounce window is far away
+    with patch.object(MessageQueue, "_window", return_value=100):
+        dispatcher._message_queue.add(1, ChatType.private, [{"role": "user", "content": "more"}])
+
+    release_event.set()
+
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+    assert processor.process.call_count == 2
+    assert message_service.add_messages.call_args_list[1].args == (
+        1,
+        [{"role": "user", "content": "more"}],
+    )
+
+
+@pytest.mark.asyncio
+async def test_next_turn_starts_after_previous_one_is_over():
+    dispatcher = make_dispatcher(max_concurrent_turns=4)
+    release_lease_event = asyncio.Event()
+    finish_event = asyncio.Event()
+    leased_chats = []
+
+    chat_leases = dispatcher._chat_leases
+    acquire, release = chat_leases.acquire, chat_leases.release
+
+    async def acquire_lease(chat_id: int) -> bool:
+        leased_chats.append(chat_id)
+        return await acquire(chat_id)
+
+    async def release_lease(chat_id: int) -> None:
+        # the first turn is slow to let its lease go
+        if len(leased_chats) == 1:
+            await release_lease_event.wait()
+        await release(chat_id)
+
+    chat_leases.acquire = acquire_lease  # type: ignore
+    chat_leases.release = release_lease  # type: ignore
+
+    message_service = MagicMock(spec=MessageService)
+    message_service.add_messages = AsyncMock()
+
+    async def process(chat_id: int, chat_type: ChatType, turn: ChatTurn) -> None:
+        if processor.process.call_count == 1:
+            # new messages come while the first turn is running
+            dispatcher._message_queue.add(chat_id, chat_type, [{"role": "user", "content": "more"}])
+        else:
+            await finish_event.wait()
+
+    processor = MagicMock(spec=ChatProcessor)
+    processor.process = AsyncMock(side_effect=process)
+
+    dispatcher._turn_executor = LocalTurnExecutor(make_container(processor, message_service))
+
+    dispatcher._schedule(make_entry(1, ChatType.private))
+    dispatcher._start_pending_turns()
+
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+    # the first turn is still letting its lease go, so the chat can't have another one yet
+    dispatcher._start_pending_turns()
+    await asyncio.sleep(0)
+
+    assert processor.process.call_count == 1
+
+    release_lease_event.set()
+
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+    # the second turn is running alone and holds the lease
+    assert processor.process.call_count == 2
+    assert dispatcher.working_chats_count == 1
+    assert chat_leases._leases[1][0] == chat_leases.owner  # type: ignore
+
+    finish_event.set()
+
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+    assert dispatcher.working_chats_count == 0
+    assert 1 not in chat_leases._leases  # type: ignore
+
+
+@pytest.mark.asyncio
+async def test_latest_wins_restarts_turn():
+    dispatcher = make_dispatcher(max_concurrent_turns=4, latest_wins=True)
+    release_event = asyncio.Event()
+    started_turns = []
+
+    message_service = MagicMock(spec=MessageService)
+    message_service.add_messages = AsyncMock()
+
+    async def process(chat_id: int, chat_type: ChatType, turn: ChatTurn) -> None:
+        started_turns.append(turn)
+        await release_event.wait()
+
+    processor = MagicMock(spec=ChatProcessor)
+    processor.process = process
+
+    dispatcher._turn_executor = LocalTurnExecutor(make_container(processor, message_service))
+
+    dispatcher._schedule(make_entry(1, ChatType.private))
+    dispatcher._start_pending_turns()
+    await asyncio.sleep(0)
+
+    assert started_turns[0].is_restartable
+
+    with patch.object(MessageQueue, "_window", return_value=0):
+        dispatcher._message_queue.add(1, ChatType.private, [{"role": "user", "content": "more"}])
+
+    dispatcher._restart_outdated_turns()
+
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+    # the first turn was cancelled and the second one has got the new message
+    assert len(started_turns) == 2
+    assert message_service.add_messages.call_args_list[1].args == (
+        1,
+        [{"role": "user", "content": "more"}],
+    )
+
+    release_event.set()
+
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+    assert dispatcher.working_chats_count == 0
+
+
+@pytest.mark.asyncio
+async def test_latest_wins_keeps_committed_turn():
+    dispatcher = make_dispatcher(max_concurrent_turns=4, latest_wins=True)
+    release_event = asyncio.Event()
+
+    message_service = MagicMock(spec=MessageService)
+    message_service.add_messages = AsyncMock()
+
+    async def process(chat_id: int, chat_type: ChatType, turn: ChatTurn) -> None:
+        # the model has answered, so the turn is not restartable anymore
+        turn.is_restartable = False
+        await release_event.wait()
+
+    processor = MagicMock(spec=ChatProcessor)
+    processor.process = AsyncMock(side_effect=process)
+
+    dispatcher._turn_executor = LocalTurnExecutor(make_container(processor, message_service))
+
+    dispatcher._schedule(make_entry(1, ChatType.private))
+    dispatcher._start_pending_turns()
+    await asyncio.sleep(0)
+
+    with patch.object(MessageQueue, "_window", return_value=0):
+        dispatcher._message_queue.add(1, ChatType.private, [{"role": "user", "content": "more"}])
+
+    dispatcher._restart_outdated_turns()
+    await asyncio.sleep(0)
+
+    assert processor.process.call_count == 1
+
+    release_event.set()
+
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+    assert processor.process.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_llm_calls_per_message():
+    dispatcher = make_dispatcher(max_concurrent_turns=4)
+
+    message_service = MagicMock(spec=MessageService)
+    message_service.add_messages = AsyncMock()
+
+    async def process(chat_id: int, chat_type: ChatType, turn: ChatTurn) -> None:
+        turn.llm_calls = 3
+
+    processor = MagicMock(spec=ChatProcessor)
+    processor.process = process
+
+    dispatcher._turn_executor = LocalTurnExecutor(make_container(processor, message_service))
+
+    entry = make_entry(1, ChatType.group)
+    entry.messages = [
+        {"role": "system", "content": "Aerith was mentioned"},
+        {"role": "user", "content": "Hello"},
+        {"role": "user", "content": "How are you?"},
+    ]
+
+    await dispatcher.handle_entry(1, entry, ChatTurn())
+
+    assert dispatcher.llm_calls_per_message == 1.5
+
+
+@pytest.mark.asyncio
+async def test_shutdown_spills_unprocessed_entries():
+    dispatcher = make_dispatcher(max_concurrent_turns=1)
+    dispatcher._dispatcher_config.shutdown_timeout = 0.05
+    dispatcher._spill_entries = AsyncMock()
+
+    async def add_messages(chat_id: int, messages: list[dict]) -> None:
+        await asyncio.Event().wait()
+
+    message_service = MagicMock(spec=MessageService)
+    # saving the input hangs, so the turn is cancelled before it's saved
+    message_service.add_messages = AsyncMock(side_effect=add_messages)
+
+    processor = MagicMock(spec=ChatProcessor)
+    dispatcher._turn_executor = LocalTurnExecutor(make_container(processor, message_service))
+
+    dispatcher._schedule(make_entry(1, ChatType.private))
+    dispatcher._schedule(make_entry(2, ChatType.private))
+    dispatcher._start_pending_turns()
+    await asyncio.sleep(0)
+
+    dispatcher._message_queue.add(3, ChatType.group, [{"role": "user", "content": "later"}])
+
+    await dispatcher.shutdown()
+
+    spilled_entries = dispatcher._spill_entries.call_args.args[0]
+
+    assert [entry.chat_id for entry in spilled_entries] == [1, 2, 3]
+    assert dispatcher.working_chats_count == 0
+    assert dispatcher._message_queue.stats().buffered_messages == 0
+
+
+@pytest.mark.asyncio
+async def test_shutdown_lets_turns_finish():
+    dispatcher = make_dispatcher(max_concurrent_turns=4)
+    dispatcher._spill_entries = AsyncMock()
+
+    message_service = MagicMock(spec=MessageService)
+    message_service.add_messages = AsyncMock()
+
+    async def process(chat_id: int, chat_type: ChatType, turn: ChatTurn) -> None:
+        await asyncio.sleep(0.05)
+
+    processor = MagicMock(spec=ChatProcessor)
+    processor.process = AsyncMock(side_effect=process)
+
+    dispatcher._turn_executor = LocalTurnExecutor(make_container(processor, message_service))
+
+    dispatcher._schedule(make_entry(1, ChatType.private))
+    dispatcher._start_pending_turns()
+    await asyncio.sleep(0)
+
+    await dispatcher.shutdown()
+
+    processor.process.assert_awaited_once()
+    dispatcher._spill_entries.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_restore_spilled_entries():
+    dispatcher = make_dispatcher(max_concurrent_turns=4)
+    dispatcher._load_spilled_entries = AsyncMock(
+        return_value=[make_entry(1, ChatType.private, from_supporter=True)]
+    )
+
+    await dispatcher.restore()
+
+    entry = dispatcher._message_queue.take(1)
+
+    assert entry is not None
+    assert entry.messages == [{"role": "user", "content": "hi"}]
+    assert entry.from_supporter
+
+
+@pytest.mark.asyncio
+async def test_chat_leased_by_another_instance_is_postponed():
+    dispatcher = make_dispatcher(max_concurrent_turns=4)
+
+    other_instance_leases = InMemoryChatLeases(LeasesConfig())
+    other_instance_leases._leases = dispatcher._chat_leases._leases  # type: ignore
+    await other_instance_leases.acquire(1)
+
+    message_service = MagicMock(spec=MessageService)
+    message_service.add_messages = AsyncMock()
+
+    processor = MagicMock(spec=ChatProcessor)
+    processor.process = AsyncMock()
+
+    dispatcher._turn_executor = LocalTurnExecutor(make_container(processor, message_service))
+
+    await dispatcher.handle_entry(1, make_entry(1, ChatType.private), ChatTurn())
+
+    # the messages are back in the queue, waiting for the next attempt
+    processor.process.assert_not_called()
+    assert dispatcher._message_queue.stats().buffered_messages == 1
+
+    await other_instance_leases.release(1)
+
+    entry = dispatcher._message_queue.take(1)
+    assert entry is not None
+
+    await dispatcher.handle_entry(1, entry, ChatTurn())
+
+    processor.process.assert_awaited_once()
+    assert await other_instance_leases.acquire(1)
+
+
+@pytest.mark.asyncio
+async def test_turn_with_lost_lease_is_cancelled():
+    dispatcher = make_dispatcher(max_concurrent_turns=4)
+
+    async def execute(chat_id: int, entry: LocalQueueEntry, turn: ChatTurn) -> None:
+        await asyncio.Event().wait()
+
+    dispatcher._turn_executor.execute = AsyncMock(side_effect=execute)  # type: ignore
+
+    dispatcher._schedule(make_entry(1, ChatType.private))
+    dispatcher._start_pending_turns()
+    await asyncio.sleep(0)
+
+    # the lease couldn't be renewed in time and another instance has taken the chat
+    other_instance_leases = InMemoryChatLeases(LeasesConfig())
+    other_instance_leases._leases = dispatcher._chat_leases._leases  # type: ignore
+    with patch("time.time", return_value=time.time() + 60):
+        assert await other_instance_leases.acquire(1)
+
+    dispatcher.on_lease_lost(1)
+
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+    # the input hasn't been saved, so it waits for the instance holding the chat
+    assert dispatcher.lost_leases_count == 1
+    assert dispatcher.working_chats_count == 0
+    assert dispatcher._turn_executor.execute.await_count == 1  # type: ignore
+    assert dispatcher._message_queue.stats().buffered_messages == 1
+
+
+def make_failing_dispatcher(side_effect) -> tuple[ChatDispatcher, AsyncMock]:
+    dispatcher = make_dispatcher(max_concurrent_turns=4)
+
+    message_service = MagicMock(spec=MessageService)
+    message_service.add_messages = AsyncMock()
+
+    processor = MagicMock(spec=ChatProcessor)
+    processor.process = AsyncMock(side_effect=side_effect)
+
+    dispatcher._turn_executor = LocalTurnExecutor(make_container(processor, message_service))
+
+    return dispatcher, processor.process
+
+
+@pytest.mark.asyncio
+async def test_stuck_turn_is_cancelled():
+    async def process(chat_id: int, chat_type: ChatType, turn: ChatTurn) -> None:
+        await asyncio.Event().wait()
+
+    dispatcher, _ = make_failing_dispatcher(process)
+    dispatcher._dispatcher_config.turn_timeout = 0.05
+
+    await asyncio.wait_for(
+        dispatcher.handle_entry(1, make_entry(1, ChatType.private), ChatTurn()), 1
+    )
+
+    assert dispatcher.turn_timeouts_count == 1
+    assert dispatcher.turn_failures_count == 1
+    assert 1 in dispatcher.cooling_down_chats()
+
+
+@pytest.mark.asyncio
+async def test_failing_chat_cools_off_exponentially():
+    dispatcher, process = make_failing_dispatcher(RuntimeError("broken history"))
+    config = dispatcher._dispatcher_config
+
+    with patch("time.time", return_value=1000.0):
+        await dispatcher.handle_entry(1, make_entry(1, ChatType.private), ChatTurn())
+
+        # the new input waits for the cool-off instead of failing again right away
+        await dispatcher.handle_entry(1, make_entry(1, ChatType.private), ChatTurn())
+
+    assert process.await_count == 1
+    assert dispatcher._chat_failures[1].cooldown_till == 1000.0 + config.failure_cooldown
+    assert dispatcher._message_queue.stats().buffered_messages == 1
+
+    with patch("time.time", return_value=1000.0 + config.failure_cooldown + 1):
+        entry = dispatcher._message_queue.take(1)
+        assert entry is not None
+
+        await dispatcher.handle_entry(1, entry, ChatTurn())
+
+    assert process.await_count == 2
+    assert dispatcher._chat_failures[1].cooldown_till == (
+        1000.0 + config.failure_cooldown + 1 + 2 * config.failure_cooldown
+    )
+
+
+@pytest.mark.asyncio
+async def test_chat_is_quarantined_and_recovers():
+    dispatcher, process = make_failing_dispatcher(RuntimeError("broken history"))
+    config = dispatcher._dispatcher_config
+
+    current_time = 1000.0
+    for _ in range(config.quarantine_after):
+        with patch("time.time", return_value=current_time):
+            await dispatcher.handle_entry(1, make_entry(1, ChatType.private), ChatTurn())
+
+        current_time += config.max_failure_cooldown + 1
+
+    # the breaker is open, so the input waits for the whole cool-off instead of being retried
+    with patch("time.time", return_value=current_time - config.max_failure_cooldown):
+        await dispatcher.handle_entry(1, make_entry(1, ChatType.private), ChatTurn())
+
+        assert not dispatcher._message_queue.is_ready(1)
+
+    assert process.await_count == config.quarantine_after
+    assert dispatcher.quarantined_entries_count == 1
+    assert dispatcher._message_queue.stats().buffered_messages == 1
+
+    # the cool-off is over: a successful probe gets the held input and closes the breaker
+    process.side_effect = None
+
+    with patch("time.time", return_value=current_time):
+        assert dispatcher._message_queue.is_ready(1)
+
+        entry = dispatcher._message_queue.take(1)
+        assert entry is not None
+
+        await dispatcher.handle_entry(1, entry, ChatTurn())
+
+    assert process.await_count == config.quarantine_after + 1
+    assert 1 not in dispatcher._chat_failures
+
+
+@pytest.mark.asyncio
+async def test_failures_of_quiet_chats_are_forgotten():
+    dispatcher, _ = make_failing_dispatcher(RuntimeError("broken history"))
+    config = dispatcher._dispatcher_config
+
+    with patch("time.time", return_value=1000.0):
+        await dispatcher.handle_entry(1, make_entry(1, ChatType.private), ChatTurn())
+
+    # chat 1 has been quiet for longer than the longest cool-off when chat 2 fails
+    later = 1000.0 + config.failure_cooldown + 2 * config.max_failure_cooldown
+    with patch("time.time", return_value=later):
+        await dispatcher.handle_entry(2, make_entry(2, ChatType.private), ChatTurn())
+
+    assert list(dispatcher._chat_failures) == [2]
+
+    with (
+        patch.object(ChatDispatcher, "MAX_TRACKED_FAILURES", 2),
+        patch("time.time", return_value=1.0e6),
+    ):
+        for chat_id in range(3, 6):
+            await dispatcher.handle_entry(
+                chat_id, make_entry(chat_id, ChatType.private), ChatTurn()
+            )
+
+    assert list(dispatcher._chat_failures) == [4, 5]
+
+
+@pytest.mark.asyncio
+async def test_turns_are_degraded_under_load():
+    dispatcher = make_dispatcher(
+        max_concurrent_turns=1,
+        load_shedding_config=LoadSheddingConfig(
+            enabled=True, high_pending_turns=3, low_pending_turns=1
+        ),
+    )
+    degraded_turns = []
+
+    async def handle_entry(chat_id: int, entry: LocalQueueEntry, turn: ChatTurn) -> None:
+        degraded_turns.append(turn.is_degraded)
+        dispatcher._working_chats.discard(chat_id)
+
+    dispatcher.handle_entry = handle_entry  # type: ignore
+
+    for chat_id in range(5):
+        dispatcher._schedule(make_entry(chat_id, ChatType.group))
+    dispatcher._start_pending_turns()
+
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+    assert degraded_turns == [True, True, True, False, False]
+    assert dispatcher.load_shedder.switches_count == 2
+    assert dispatcher.load_shedder.degraded_turns_count == 3
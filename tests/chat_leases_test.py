@@ -0,0 +1,188 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from aerith_cbot.config import LeasesConfig
+from aerith_cbot.services.implementations.chat_dispatcher import DbChatLeases, InMemoryChatLeases
+
+
+def make_instances() -> tuple[InMemoryChatLeases, InMemoryChatLeases]:
+    first_instance = InMemoryChatLeases(LeasesConfig(ttl=30))
+    second_instance = InMemoryChatLeases(LeasesConfig(ttl=30))
+
+    # both instances look at the same lease table
+    second_instance._leases = first_instance._leases
+
+    return first_instance, second_instance
+
+
+@pytest.mark.asyncio
+async def test_lease_is_exclusive():
+    first_instance, second_instance = make_instances()
+
+    assert await first_instance.acquire(1)
+    assert await first_instance.acquire(1)
+    assert not await second_instance.acquire(1)
+    assert await second_instance.acquire(2)
+
+    await first_instance.release(1)
+
+    assert await second_instance.acquire(1)
+
+
+@pytest.mark.asyncio
+async def test_expired_lease_is_taken_over():
+    first_instance, second_instance = make_instances()
+
+    with patch("time.time", return_value=1000.0):
+        assert await first_instance.acquire(1)
+
+    with patch("time.time", return_value=1020.0):
+        await first_instance.renew()
+
+    # the lease is renewed, so it's still held 30 seconds after it was taken
+    with patch("time.time", return_value=1040.0):
+        assert not await second_instance.acquire(1)
+
+    # the first instance has died and stopped renewing its lease
+    with patch("time.time", return_value=1051.0):
+        assert await second_instance.acquire(1)
+        assert not await first_instance.acquire(1)
+
+
+def make_db_session(leased_chat_id: int | None) -> MagicMock:
+    result = MagicMock()
+    result.scalar_one_or_none.return_value = leased_chat_id
+
+    db_session = MagicMock()
+    db_session.execute = AsyncMock(return_value=result)
+    db_session.commit = AsyncMock()
+
+    return db_session
+
+
+def compiled(statement) -> str:
+    return str(
+        statement.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
+    )
+
+
+@pytest.mark.asyncio
+async def test_db_leases():
+    chat_leases = DbChatLeases(MagicMock(), LeasesConfig(ttl=30))
+
+    with patch(f"{DbChatLeases.__module__}.AsyncSession") as session_class:
+        db_session = make_db_session(leased_chat_id=1)
+        session_class.return_value.__aenter__.return_value = db_session
+
+        assert await chat_leases.acquire(1)
+
+        acquire = compiled(db_session.execute.call_args.args[0])
+        # expiration is up to the clock of the db, not of the instances
+        assert "EXTRACT(epoch FROM now()) + 30.0" in acquire
+        assert "ON CONFLICT (chat_id) DO UPDATE" in acquire
+        assert "WHERE chat_leases.expires_at < EXTRACT(epoch FROM now()) OR chat_leases.owner" in (
+            acquire
+        )
+
+        # the chat is leased by another instance
+        db_session.execute.return_value.scalar_one_or_none.return_value = None
+        assert not await chat_leases.acquire(2)
+
+        db_session.execute.return_value.scalars.return_value = [1]
+        assert await chat_leases.renew() == {1}
+
+        renew = compiled(db_session.execute.call_args.args[0])
+        assert "SET expires_at=(EXTRACT(epoch FROM now()) + 30.0)" in renew
+        assert "chat_leases.chat_id IN (1)" in renew
+        assert "RETURNING chat_leases.chat_id" in renew
+
+        await chat_leases.release(1)
+
+        release = compiled(db_session.execute.call_args.args[0])
+        assert f"chat_leases.chat_id = 1 AND chat_leases.owner = '{chat_leases.owner}'" in release
+
+        # nothing is held, so there is nothing to renew
+        db_session.execute.reset_mock()
+        await chat_leases.renew()
+        db_session.execute.assert_not_called()
+
+
+async def run_heartbeats(chat_leases, count: int) -> list[int]:
+    """Runs `count` heartbeats of the leases, returns the chats reported lost"""
+
+    lost_chats = []
+    sleep = AsyncMock(side_effect=[None] * count + [asyncio.CancelledError()])
+
+    with patch("asyncio.sleep", sleep), pytest.raises(asyncio.CancelledError):
+        await chat_leases.run(lost_chats.append)
+
+    return lost_chats
+
+
+@pytest.mark.asyncio
+async def test_taken_over_lease_is_lost():
+    first_instance, second_instance = make_instances()
+
+    with patch("time.time", return_value=1000.0):
+        assert await first_instance.acquire(1)
+        assert await first_instance.acquire(2)
+        await first_instance.release(2)
+
+    # the first instance has been stuck for longer than the ttl
+    with patch("time.time", return_value=1031.0):
+        assert await second_instance.acquire(1)
+
+    assert await run_heartbeats(first_instance, 1) == [1]
+    # it's reported once
+    assert await run_heartbeats(first_instance, 1) == []
+
+
+@pytest.mark.asyncio
+async def test_lease_expiring_during_db_outage_is_lost():
+    chat_leases = DbChatLeases(MagicMock(), LeasesConfig(ttl=30, heartbeat_interval=10))
+
+    with patch(f"{DbChatLeases.__module__}.AsyncSession") as session_class:
+        db_session = make_db_session(leased_chat_id=1)
+        session_class.return_value.__aenter__.return_value = db_session
+
+        with patch("time.monotonic", return_value=1000.0):
+            assert await chat_leases.acquire(1)
+
+        # the db is down, so the lease can't be renewed
+        db_session.execute.side_effect = OSError("connection refused")
+
+        # the lease is still good for more than a heartbeat
+        with patch("time.monotonic", return_value=1010.0):
+            assert await run_heartbeats(chat_leases, 1) == []
+
+        # the next heartbeat may come after another instance has taken the chat
+        with patch("time.monotonic", return_value=1021.0):
+            assert await run_heartbeats(chat_leases, 1) == [1]
+
+
+@pytest.mark.asyncio
+async def test_hung_renewal_is_a_failed_one():
+    chat_leases = DbChatLeases(MagicMock(), LeasesConfig(ttl=0.3, heartbeat_interval=0.1))
+
+    with patch(f"{DbChatLeases.__module__}.AsyncSession") as session_class:
+        db_session = make_db_session(leased_chat_id=1)
+        session_class.return_value.__aenter__.return_value = db_session
+
+        assert await chat_leases.acquire(1)
+
+        async def hang(*args) -> None:
+            await asyncio.Event().wait()
+
+        # the connection hangs instead of failing
+        db_session.execute.side_effect = hang
+
+        lost_event = asyncio.Event()
+        run_task = asyncio.create_task(chat_leases.run(lambda chat_id: lost_event.set()))
+
+        try:
+            await asyncio.wait_for(lost_event.wait(), 2)
+        finally:
+            run_task.cancel()
@@ -1,22 +1,38 @@
+import asyncio
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 from httpx import Request, Response
-from openai import APIError, RateLimitError
+from openai import APIError, BadRequestError, RateLimitError
 from openai.types import CompletionUsage
-from openai.types.chat import ChatCompletion, ChatCompletionMessage, ChatCompletionMessageToolCall
+from openai.types.chat import (
+    ChatCompletion,
+    ChatCompletionChunk,
+    ChatCompletionMessage,
+    ChatCompletionMessageToolCall,
+)
 from openai.types.chat.chat_completion_message_tool_call_param import Function
 
-from aerith_cbot.config import LimitsConfig
+from aerith_cbot.config import LimitsConfig, LoadSheddingConfig, MediaConfig
 from aerith_cbot.services.abstractions import SupportService
 from aerith_cbot.services.abstractions.models import ChatType
-from aerith_cbot.services.implementations import DefaultLimitsService, DefaultUserContextProvider
+from aerith_cbot.services.abstractions.processors import ChatTurn, ModelResponseStream
+from aerith_cbot.services.implementations import (
+    DefaultLimitsService,
+    DefaultUserContextProvider,
+    HistoryCompactor,
+    HistoryValidator,
+    MediaCache,
+    MediaResolver,
+    RequestTemplates,
+    TokenEstimator,
+)
 from aerith_cbot.services.implementations.processors import DefaultChatProcessor
 from aerith_cbot.services.implementations.processors.tools import ToolExecutionResult
 
 
 @pytest.fixture
-def mock_dependencies(default_limits_config: LimitsConfig):
+def mock_dependencies(default_limits_config: LimitsConfig, tmp_path):
     mock_openai_client = MagicMock()
     mock_openai_client.chat.completions.create = AsyncMock()
 
@@ -28,9 +44,12 @@ def mock_dependencies(default_limits_config: LimitsConfig):
 
     mock_openai_config = MagicMock()
     mock_openai_config.model = "gpt-4"
+    mock_openai_config.stream_responses = False
+    mock_openai_config.continue_responses = False
 
     mock_tool_dispatcher = MagicMock()
     mock_tool_dispatcher.execute_tool = AsyncMock()
+    mock_tool_dispatcher.is_parallel_safe = MagicMock(return_value=False)
 
     mock_model_response_processor = MagicMock()
     mock_model_response_processor.process = AsyncMock()
@@ -51,6 +70,14 @@ def mock_dependencies(default_limits_config: LimitsConfig):
 
     mock_support_service = MagicMock(spec=SupportService)
 
+    mock_history_compactor = MagicMock(spec=HistoryCompactor)
+    mock_history_compactor.wait = AsyncMock()
+    mock_history_compactor.compact = AsyncMock()
+    mock_history_compactor.is_compacting.return_value = False
+
+    token_estimator = TokenEstimator()
+    media_config = MediaConfig(cache_dir=str(tmp_path))
+
     return {
         "openai_client": mock_openai_client,
         "llm_config": mock_llm_config,
@@ -62,6 +89,12 @@ def mock_dependencies(default_limits_config: LimitsConfig):
         "context_provider": mock_context_provider,
         "model_response_processor": mock_model_response_processor,
         "support_service": mock_support_service,
+        "token_estimator": token_estimator,
+        "request_templates": RequestTemplates(mock_llm_config, token_estimator),
+        "load_shedding_config": LoadSheddingConfig(),
+        "history_compactor": mock_history_compactor,
+        "history_validator": HistoryValidator(default_limits_config),
+        "media_resolver": MediaResolver(MagicMock(), MediaCache(media_config), media_config),
     }
 
 
@@ -107,6 +140,12 @@ async def test_basic_chat_processing(mock_dependencies, mock_chat_completion):
         deps["limits_serivce"],
         deps["model_response_processor"],
         deps["support_service"],
+        deps["token_estimator"],
+        deps["request_templates"],
+        deps["load_shedding_config"],
+        deps["history_compactor"],
+        deps["history_validator"],
+        deps["media_resolver"],
     )
 
     await processor.process(chat_id=123, chat_type=ChatType.private)
@@ -139,6 +178,12 @@ async def test_group_chat_uses_group_tools(mock_dependencies, mock_chat_completi
         deps["limits_serivce"],
         deps["model_response_processor"],
         deps["support_service"],
+        deps["token_estimator"],
+        deps["request_templates"],
+        deps["load_shedding_config"],
+        deps["history_compactor"],
+        deps["history_validator"],
+        deps["media_resolver"],
     )
 
     await processor.process(chat_id=123, chat_type=ChatType.group)
@@ -179,6 +224,12 @@ async def test_processing_with_refusal(mock_dependencies):
         deps["limits_serivce"],
         deps["model_response_processor"],
         deps["support_service"],
+        deps["token_estimator"],
+        deps["request_templates"],
+        deps["load_shedding_config"],
+        deps["history_compactor"],
+        deps["history_validator"],
+        deps["media_resolver"],
     )
 
     await processor.process(chat_id=123, chat_type=ChatType.private)
@@ -218,6 +269,12 @@ async def test_validation_error_handling(mock_dependencies):
         deps["limits_serivce"],
         deps["model_response_processor"],
         deps["support_service"],
+        deps["token_estimator"],
+        deps["request_templates"],
+        deps["load_shedding_config"],
+        deps["history_compactor"],
+        deps["history_validator"],
+        deps["media_resolver"],
     )
 
     await processor.process(chat_id=123, chat_type=ChatType.private)
@@ -250,15 +307,26 @@ async def test_rate_limit_retry(mock_dependencies, mock_chat_completion):
         deps["limits_serivce"],
         deps["model_response_processor"],
         deps["support_service"],
+        deps["token_estimator"],
+        deps["request_templates"],
+        deps["load_shedding_config"],
+        deps["history_compactor"],
+        deps["history_validator"],
+        deps["media_resolver"],
     )
 
-    await processor.process(chat_id=123, chat_type=ChatType.private)
+    with patch("asyncio.sleep", AsyncMock()) as sleep_mock:
+        await processor.process(chat_id=123, chat_type=ChatType.private)
+
+        sleep_mock.assert_called_once()
 
     assert deps["openai_client"].chat.completions.create.call_count == 2
 
-    # call in _get_llm_response and main loop
-    deps["message_service"].shorten_history.assert_called_with(123)
-    assert deps["message_service"].shorten_history.call_count == 2
+    # requested in _get_llm_response and main loop, the turn waits for neither
+    deps["history_compactor"].request.assert_called_with(123)
+    assert deps["history_compactor"].request.call_count == 2
+    deps["history_compactor"].compact.assert_not_called()
+    deps["message_service"].shorten_history.assert_not_called()
 
     deps["model_response_processor"].process.assert_called_once()
 
@@ -282,6 +350,12 @@ async def test_api_error_retry(mock_dependencies, mock_chat_completion):
         deps["limits_serivce"],
         deps["model_response_processor"],
         deps["support_service"],
+        deps["token_estimator"],
+        deps["request_templates"],
+        deps["load_shedding_config"],
+        deps["history_compactor"],
+        deps["history_validator"],
+        deps["media_resolver"],
     )
 
     with patch("asyncio.sleep", AsyncMock()) as sleep_mock:
@@ -310,11 +384,22 @@ async def test_max_token_usage_triggers_shortening(mock_dependencies, mock_chat_
         deps["limits_serivce"],
         deps["model_response_processor"],
         deps["support_service"],
+        deps["token_estimator"],
+        deps["request_templates"],
+        deps["load_shedding_config"],
+        deps["history_compactor"],
+        deps["history_validator"],
+        deps["media_resolver"],
     )
 
     await processor.process(chat_id=123, chat_type=ChatType.group)
 
-    deps["message_service"].shorten_history.assert_called_once_with(123)
+    deps["history_compactor"].request.assert_called_once_with(123)
+
+    # the size of the history is remembered for idle compactions
+    deps["history_compactor"].track_usage.assert_called_once_with(
+        123, 150, deps["limits_config"].group_max_context_tokens
+    )
 
 
 @pytest.mark.asyncio
@@ -372,12 +457,22 @@ async def test_max_iterations_limit(mock_dependencies):
             deps["limits_serivce"],
             deps["model_response_processor"],
             deps["support_service"],
+            deps["token_estimator"],
+            deps["request_templates"],
+            deps["load_shedding_config"],
+            deps["history_compactor"],
+            deps["history_validator"],
+            deps["media_resolver"],
         )
 
-        await processor.process(chat_id=123, chat_type=ChatType.private)
+        turn = ChatTurn()
+        await processor.process(chat_id=123, chat_type=ChatType.private, turn=turn)
 
         assert deps["openai_client"].chat.completions.create.call_count == 3
         assert deps["tool_dispatcher"].execute_tool.call_count == 3
+
+        assert turn.llm_calls == 3
+        assert not turn.is_restartable
     finally:
         DefaultChatProcessor.MAX_LLM_CALL_ITERATIONS = original_max_iterations
 
@@ -400,6 +495,12 @@ async def test_exception_in_response_processor_service(mock_dependencies, mock_c
         deps["limits_serivce"],
         deps["model_response_processor"],
         deps["support_service"],
+        deps["token_estimator"],
+        deps["request_templates"],
+        deps["load_shedding_config"],
+        deps["history_compactor"],
+        deps["history_validator"],
+        deps["media_resolver"],
     )
 
     await processor.process(chat_id=123, chat_type=ChatType.private)
@@ -427,12 +528,19 @@ async def test_retry_limit_exceeded(mock_dependencies):
         deps["limits_serivce"],
         deps["model_response_processor"],
         deps["support_service"],
+        deps["token_estimator"],
+        deps["request_templates"],
+        deps["load_shedding_config"],
+        deps["history_compactor"],
+        deps["history_validator"],
+        deps["media_resolver"],
     )
 
-    try:
-        await processor.process(chat_id=123, chat_type=ChatType.private)
-    except Exception:
-        pass
+    with patch("asyncio.sleep", AsyncMock()):
+        try:
+            await processor.process(chat_id=123, chat_type=ChatType.private)
+        except Exception:
+            pass
 
     assert (
         deps["openai_client"].chat.completions.create.call_count
@@ -440,8 +548,7 @@ async def test_retry_limit_exceeded(mock_dependencies):
     )
 
     assert (
-        deps["message_service"].shorten_history.call_count
-        == DefaultChatProcessor.MAX_LLM_CALL_ATTEMPTS
+        deps["history_compactor"].request.call_count == DefaultChatProcessor.MAX_LLM_CALL_ATTEMPTS
     )
 
     deps["message_service"].add_messages.assert_not_called()
@@ -468,6 +575,12 @@ async def test_no_choices_in_completion(mock_dependencies):
         deps["limits_serivce"],
         deps["model_response_processor"],
         deps["support_service"],
+        deps["token_estimator"],
+        deps["request_templates"],
+        deps["load_shedding_config"],
+        deps["history_compactor"],
+        deps["history_validator"],
+        deps["media_resolver"],
     )
 
     await processor.process(chat_id=123, chat_type=ChatType.private)
@@ -476,3 +589,460 @@ async def test_no_choices_in_completion(mock_dependencies):
 
     deps["model_response_processor"].process.assert_not_called()
     deps["model_response_processor"].process_refusal.assert_not_called()
+
+
+def make_chunk(
+    content: str | None, finish_reason: str | None = None, is_first: bool = False
+) -> ChatCompletionChunk:
+    delta = {"content": content}
+    # like the api, the role comes only with the first chunk
+    if is_first:
+        delta["role"] = "assistant"
+
+    return ChatCompletionChunk.model_validate(
+        {
+            "id": "chatcmpl-1",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "gpt-4",
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": delta,
+                    "finish_reason": finish_reason,
+                }
+            ],
+        }
+    )
+
+
+class FakeResponseStream(ModelResponseStream):
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.parts: list[str] = []
+        self.restarts = 0
+
+    async def feed(self, content: str) -> None:
+        self.parts.append(content)
+
+        if self.first_part_time is None:
+            self.message_id = 1
+            self.first_part_time = 0.0
+
+    def restart(self) -> None:
+        self.restarts += 1
+
+
+@pytest.mark.asyncio
+async def test_streamed_response(mock_dependencies):
+    deps = mock_dependencies
+    deps["openai_config"].stream_responses = True
+
+    content_parts = ['{"reply_to_message_id": null, "text": "Hel', 'lo!", "sticker": null}']
+    usage_chunk = ChatCompletionChunk.model_validate(
+        {
+            "id": "chatcmpl-1",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "gpt-4",
+            "choices": [],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120},
+        }
+    )
+
+    async def stream_chunks():
+        for i, part in enumerate(content_parts):
+            yield make_chunk(part, is_first=i == 0)
+        yield make_chunk(None, finish_reason="stop")
+        yield usage_chunk
+
+    async def create(**kwargs):
+        return stream_chunks()
+
+    deps["openai_client"].chat.completions.create.side_effect = create
+
+    stream = FakeResponseStream()
+    deps["model_response_processor"].start_stream = MagicMock(return_value=stream)
+    deps["model_response_processor"].process.return_value = True
+
+    processor = DefaultChatProcessor(
+        deps["openai_client"],
+        deps["llm_config"],
+        deps["openai_config"],
+        deps["tool_dispatcher"],
+        deps["message_service"],
+        deps["limits_config"],
+        deps["context_provider"],
+        deps["limits_serivce"],
+        deps["model_response_processor"],
+        deps["support_service"],
+        deps["token_estimator"],
+        deps["request_templates"],
+        deps["load_shedding_config"],
+        deps["history_compactor"],
+        deps["history_validator"],
+        deps["media_resolver"],
+    )
+
+    turn = ChatTurn()
+    await processor.process(chat_id=123, chat_type=ChatType.private, turn=turn)
+
+    call_args = deps["openai_client"].chat.completions.create.call_args
+    assert call_args[1]["stream"] is True
+    assert call_args[1]["stream_options"] == {"include_usage": True}
+
+    assert stream.parts == content_parts
+    assert stream.restarts == 1
+
+    deps["model_response_processor"].process.assert_called_once_with(
+        123, "".join(content_parts), stream
+    )
+    deps["limits_serivce"].subtract_private_tokens.assert_called_once()
+
+    saved_messages = deps["message_service"].add_messages.call_args[0][1]
+    assert saved_messages[0]["content"] == "".join(content_parts)
+    assert "parsed" not in saved_messages[0]
+
+    assert turn.first_byte_time is not None
+    assert turn.last_byte_time is not None
+    assert not turn.is_restartable
+
+
+@pytest.mark.asyncio
+async def test_parallel_safe_tools_run_concurrently(mock_dependencies):
+    deps = mock_dependencies
+
+    tool_names = ["fetch_user_info", "fetch_user_info", "kick_user", "fetch_info"]
+    tool_calls = []
+    for i, name in enumerate(tool_names):
+        tool_call = MagicMock(spec=ChatCompletionMessageToolCall)
+        tool_call.id = f"call_{i}"
+        tool_call.function = MagicMock(spec=Function)
+        tool_call.function.name = name
+        tool_call.function.arguments = str(i)
+        tool_calls.append(tool_call)
+
+    mock_message = MagicMock(spec=ChatCompletionMessage)
+    mock_message.content = None
+    mock_message.refusal = None
+    mock_message.tool_calls = tool_calls
+    mock_message.model_dump.return_value = {"role": "assistant", "content": None}
+
+    tools_completion = MagicMock(spec=ChatCompletion)
+    tools_completion.choices = [MagicMock()]
+    tools_completion.choices[0].message = mock_message
+    tools_completion.usage = MagicMock(prompt_tokens=100, total_tokens=200)
+
+    empty_completion = MagicMock(spec=ChatCompletion)
+    empty_completion.choices = []
+    empty_completion.usage = MagicMock(prompt_tokens=100, total_tokens=200)
+
+    deps["openai_client"].chat.completions.create.side_effect = [
+        tools_completion,
+        empty_completion,
+    ]
+
+    events = []
+
+    async def execute_tool(name: str, arguments: str, chat_id: int):
+        events.append(f"start {arguments}")
+        # the later read finishes first, but its result must stay in place
+        await asyncio.sleep(0.02 if arguments == "0" else 0.01)
+        events.append(f"end {arguments}")
+
+        return ToolExecutionResult(response=f"result {arguments}")
+
+    deps["tool_dispatcher"].execute_tool.side_effect = execute_tool
+    deps["tool_dispatcher"].is_parallel_safe.side_effect = lambda name: name != "kick_user"
+
+    processor = DefaultChatProcessor(
+        deps["openai_client"],
+        deps["llm_config"],
+        deps["openai_config"],
+        deps["tool_dispatcher"],
+        deps["message_service"],
+        deps["limits_config"],
+        deps["context_provider"],
+        deps["limits_serivce"],
+        deps["model_response_processor"],
+        deps["support_service"],
+        deps["token_estimator"],
+        deps["request_templates"],
+        deps["load_shedding_config"],
+        deps["history_compactor"],
+        deps["history_validator"],
+        deps["media_resolver"],
+    )
+
+    await processor.process(chat_id=123, chat_type=ChatType.group)
+
+    # both reads run together, the kick waits for them and the last read waits for the kick
+    assert events == [
+        "start 0",
+        "start 1",
+        "end 1",
+        "end 0",
+        "start 2",
+        "end 2",
+        "start 3",
+        "end 3",
+    ]
+
+    saved_messages = deps["message_service"].add_messages.call_args[0][1]
+    tool_messages = [message for message in saved_messages if message["role"] == "tool"]
+    assert [message["tool_call_id"] for message in tool_messages] == [
+        "call_0",
+        "call_1",
+        "call_2",
+        "call_3",
+    ]
+    assert [message["content"] for message in tool_messages] == [
+        "result 0",
+        "result 1",
+        "result 2",
+        "result 3",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_history_shortened_before_request(mock_dependencies, mock_chat_completion):
+    deps = mock_dependencies
+
+    long_history = [{"role": "user", "content": "очень длинное сообщение " * 200}] * 10
+    short_history = [{"role": "assistant", "content": "краткое содержание"}]
+
+    deps["message_service"].fetch_messages.side_effect = [list(long_history), short_history]
+    deps["openai_client"].chat.completions.create.return_value = mock_chat_completion
+
+    processor = DefaultChatProcessor(
+        deps["openai_client"],
+        deps["llm_config"],
+        deps["openai_config"],
+        deps["tool_dispatcher"],
+        deps["message_service"],
+        deps["limits_config"],
+        deps["context_provider"],
+        deps["limits_serivce"],
+        deps["model_response_processor"],
+        deps["support_service"],
+        deps["token_estimator"],
+        deps["request_templates"],
+        deps["load_shedding_config"],
+        deps["history_compactor"],
+        deps["history_validator"],
+        deps["media_resolver"],
+    )
+
+    await processor.process(chat_id=123, chat_type=ChatType.private)
+
+    # the turn waits for the shortening of a history which doesn't fit at all,
+    # and requests another one in background since the test limits are 1 token
+    deps["history_compactor"].compact.assert_called_once_with(123)
+    deps["history_compactor"].request.assert_called_once_with(123)
+
+    # the request has been sent with the shortened history
+    call_args = deps["openai_client"].chat.completions.create.call_args
+    assert short_history[0] in call_args[1]["messages"]
+    assert long_history[0] not in call_args[1]["messages"]
+
+
+@pytest.mark.asyncio
+async def test_cached_tokens_are_tracked(mock_dependencies, mock_chat_completion):
+    deps = mock_dependencies
+
+    mock_chat_completion.usage.prompt_tokens_details = MagicMock(cached_tokens=64)
+    deps["openai_client"].chat.completions.create.return_value = mock_chat_completion
+    deps["openai_config"].group_model = "gpt-4"
+
+    processor = DefaultChatProcessor(
+        deps["openai_client"],
+        deps["llm_config"],
+        deps["openai_config"],
+        deps["tool_dispatcher"],
+        deps["message_service"],
+        deps["limits_config"],
+        deps["context_provider"],
+        deps["limits_serivce"],
+        deps["model_response_processor"],
+        deps["support_service"],
+        deps["token_estimator"],
+        deps["request_templates"],
+        deps["load_shedding_config"],
+        deps["history_compactor"],
+        deps["history_validator"],
+        deps["media_resolver"],
+    )
+
+    turn = ChatTurn()
+    await processor.process(chat_id=123, chat_type=ChatType.group, turn=turn)
+
+    assert turn.model == "gpt-4"
+    assert turn.prompt_tokens == 100
+    assert turn.cached_tokens == 64
+
+    # the request starts with the template's prefix
+    call_args = deps["openai_client"].chat.completions.create.call_args
+    template = deps["request_templates"].get(ChatType.group, "gpt-4")
+    assert call_args[1]["messages"][:1] == template.messages()
+
+
+@pytest.mark.asyncio
+async def test_degraded_turn(mock_dependencies):
+    deps = mock_dependencies
+
+    mock_message = MagicMock(spec=ChatCompletionMessage)
+    mock_message.content = None
+    mock_message.refusal = None
+    mock_message.tool_calls = [
+        ChatCompletionMessageToolCall(
+            id=f"call_{i}", type="function", function={"name": "think", "arguments": "{}"}
+        )
+        for i in range(3)
+    ]
+    mock_message.model_dump.return_value = {"role": "assistant", "content": None}
+
+    mock_completion = MagicMock(spec=ChatCompletion)
+    mock_completion.choices = [MagicMock()]
+    mock_completion.choices[0].message = mock_message
+    mock_completion.usage = MagicMock(prompt_tokens=100, total_tokens=200)
+
+    deps["openai_client"].chat.completions.create.return_value = mock_completion
+    deps["tool_dispatcher"].execute_tool.return_value = ToolExecutionResult(response="ok")
+
+    image_message = {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": "look"},
+            {"type": "image_url", "image_url": {"url": "https://example.com/cat.png"}},
+        ],
+    }
+    deps["message_service"].fetch_messages.return_value = [image_message]
+
+    load_shedding_config = LoadSheddingConfig(
+        fallback_model="gpt-nano", dropped_tools=["test_tool"], max_tool_calls=2
+    )
+
+    processor = DefaultChatProcessor(
+        deps["openai_client"],
+        deps["llm_config"],
+        deps["openai_config"],
+        deps["tool_dispatcher"],
+        deps["message_service"],
+        deps["limits_config"],
+        deps["context_provider"],
+        deps["limits_serivce"],
+        deps["model_response_processor"],
+        deps["support_service"],
+        deps["token_estimator"],
+        deps["request_templates"],
+        load_shedding_config,
+        deps["history_compactor"],
+        deps["history_validator"],
+        deps["media_resolver"],
+    )
+
+    turn = ChatTurn()
+    turn.is_degraded = True
+    await processor.process(chat_id=123, chat_type=ChatType.private, turn=turn)
+
+    call_args = deps["openai_client"].chat.completions.create.call_args
+    assert call_args[1]["model"] == "gpt-nano"
+    assert call_args[1]["tools"] == []
+    assert not any(
+        part.get("type") == "image_url"
+        for message in call_args[1]["messages"]
+        if isinstance(message["content"], list)
+        for part in message["content"]
+    )
+
+    # the stored history keeps the image
+    assert image_message["content"][1]["type"] == "image_url"
+
+    assert deps["tool_dispatcher"].execute_tool.call_count == 2
+    assert turn.model == "gpt-nano"
+
+
+def make_bad_request_error(message: str) -> BadRequestError:
+    return BadRequestError(
+        message=message,
+        response=Response(status_code=400, request=Request(method="", url="")),
+        body=None,
+    )
+
+
+@pytest.mark.asyncio
+async def test_bad_request_repairs_history(mock_dependencies, mock_chat_completion):
+    deps = mock_dependencies
+    deps["message_service"].repair_history = AsyncMock(return_value=True)
+
+    url = "https://api.telegram.org/file/botTOKEN/photos/file_1.jpg"
+    deps["openai_client"].chat.completions.create.side_effect = [
+        make_bad_request_error(f"Error while downloading {url}."),
+        mock_chat_completion,
+    ]
+
+    processor = DefaultChatProcessor(
+        deps["openai_client"],
+        deps["llm_config"],
+        deps["openai_config"],
+        deps["tool_dispatcher"],
+        deps["message_service"],
+        deps["limits_config"],
+        deps["context_provider"],
+        deps["limits_serivce"],
+        deps["model_response_processor"],
+        deps["support_service"],
+        deps["token_estimator"],
+        deps["request_templates"],
+        deps["load_shedding_config"],
+        deps["history_compactor"],
+        deps["history_validator"],
+        deps["media_resolver"],
+    )
+
+    await processor.process(chat_id=123, chat_type=ChatType.group)
+
+    # only the broken image is removed, the history isn't summarized
+    deps["message_service"].repair_history.assert_called_once_with(123, {url})
+    deps["history_compactor"].compact.assert_not_called()
+    deps["model_response_processor"].process.assert_called_once()
+    assert deps["history_validator"].avoided_summarizations_count == 1
+
+
+@pytest.mark.asyncio
+async def test_bad_request_without_repair_summarizes_history(
+    mock_dependencies, mock_chat_completion
+):
+    deps = mock_dependencies
+    deps["message_service"].repair_history = AsyncMock(return_value=False)
+
+    deps["openai_client"].chat.completions.create.side_effect = [
+        make_bad_request_error("Invalid request."),
+        mock_chat_completion,
+    ]
+
+    processor = DefaultChatProcessor(
+        deps["openai_client"],
+        deps["llm_config"],
+        deps["openai_config"],
+        deps["tool_dispatcher"],
+        deps["message_service"],
+        deps["limits_config"],
+        deps["context_provider"],
+        deps["limits_serivce"],
+        deps["model_response_processor"],
+        deps["support_service"],
+        deps["token_estimator"],
+        deps["request_templates"],
+        deps["load_shedding_config"],
+        deps["history_compactor"],
+        deps["history_validator"],
+        deps["media_resolver"],
+    )
+
+    await processor.process(chat_id=123, chat_type=ChatType.group)
+
+    deps["history_compactor"].compact.assert_called_once_with(123, without_media=True)
+    deps["model_response_processor"].process.assert_called_once()
+    assert deps["history_validator"].avoided_summarizations_count == 0
@@ -0,0 +1,173 @@
+import asyncio
+
+import pytest
+
+from aerith_cbot.config import WorkersConfig
+from aerith_cbot.services.abstractions.models import ChatType
+from aerith_cbot.services.abstractions.processors import ChatTurn
+from aerith_cbot.services.implementations.chat_dispatcher import (
+    ChatWorker,
+    LocalWorkerTransport,
+    ProcessWorkerTransport,
+    TurnExecutor,
+    WorkerPoolTurnExecutor,
+    WorkerTurnError,
+)
+from aerith_cbot.services.implementations.chat_dispatcher.message_queue import LocalQueueEntry
+from aerith_cbot.services.implementations.chat_dispatcher.workers import TurnCommand, TurnReport
+
+
+class RecordingTurnExecutor(TurnExecutor):
+    def __init__(self, worker_id: int, handled_turns: list[tuple[int, int]]) -> None:
+        self.worker_id = worker_id
+        self.handled_turns = handled_turns
+        self.release_event = asyncio.Event()
+        self.release_event.set()
+
+    async def execute(self, chat_id: int, entry: LocalQueueEntry, turn: ChatTurn) -> None:
+        turn.is_input_saved = True
+        self.handled_turns.append((self.worker_id, chat_id))
+
+        await self.release_event.wait()
+
+        turn.llm_calls = 2
+
+
+def make_entry(chat_id: int) -> LocalQueueEntry:
+    return LocalQueueEntry(chat_id, ChatType.group, [{"role": "user", "content": "hi"}])
+
+
+async def stop_tasks(tasks: list[asyncio.Task | None]) -> None:
+    for task in tasks:
+        if task is not None:
+            task.cancel()
+
+    await asyncio.gather(*(task for task in tasks if task is not None), return_exceptions=True)
+
+
+def start_workers(
+    workers_count: int, worker_tasks: list[asyncio.Task]
+) -> tuple[WorkerPoolTurnExecutor, list[RecordingTurnExecutor], list[tuple[int, int]]]:
+    transport = LocalWorkerTransport(workers_count)
+    handled_turns: list[tuple[int, int]] = []
+
+    executors = [RecordingTurnExecutor(i, handled_turns) for i in range(workers_count)]
+    for worker_id, executor in enumerate(executors):
+        worker_tasks.append(asyncio.create_task(ChatWorker(worker_id, transport, executor).run()))
+
+    pool = WorkerPoolTurnExecutor(transport, WorkersConfig(count=workers_count))
+
+    return pool, executors, handled_turns
+
+
+@pytest.mark.asyncio
+async def test_chats_are_pinned_to_workers():
+    worker_tasks: list[asyncio.Task] = []
+    pool, _, handled_turns = start_workers(3, worker_tasks)
+
+    turns = [ChatTurn() for _ in range(6)]
+    chat_ids = [1, 2, 3, -1001, 1, -1001]
+
+    await asyncio.gather(
+        *(
+            pool.execute(chat_id, make_entry(chat_id), turn)
+            for chat_id, turn in zip(chat_ids, turns)
+        )
+    )
+
+    assert sorted(handled_turns) == sorted(
+        (pool.worker_for(chat_id), chat_id) for chat_id in chat_ids
+    )
+    assert len({worker_id for worker_id, _ in handled_turns}) == 3
+    assert all(turn.llm_calls == 2 and turn.is_input_saved for turn in turns)
+
+    await stop_tasks([*worker_tasks, pool._read_task])
+
+
+@pytest.mark.asyncio
+async def test_cancelled_turn_is_cancelled_in_worker():
+    worker_tasks: list[asyncio.Task] = []
+    pool, executors, _ = start_workers(1, worker_tasks)
+    executors[0].release_event.clear()
+
+    turn = ChatTurn()
+    task = asyncio.create_task(pool.execute(1, make_entry(1), turn))
+    await asyncio.sleep(0.01)
+
+    task.cancel()
+
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    # the worker has reported that the input had been saved before the cancellation
+    assert turn.is_input_saved
+    assert turn.llm_calls == 0
+
+    await stop_tasks([*worker_tasks, pool._read_task])
+
+
+@pytest.mark.asyncio
+async def test_chat_waits_until_worker_confirms_cancel(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(WorkerPoolTurnExecutor, "CANCEL_TIMEOUT", 0.01)
+
+    # no worker runs the turns, they are reported by hand
+    transport = LocalWorkerTransport(1)
+    pool = WorkerPoolTurnExecutor(transport, WorkersConfig(count=1))
+
+    task = asyncio.create_task(pool.execute(1, make_entry(1), ChatTurn()))
+    await asyncio.sleep(0.01)
+    task.cancel()
+
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    next_task = asyncio.create_task(pool.execute(1, make_entry(1), ChatTurn()))
+    await asyncio.sleep(0.05)
+
+    # the turn and its cancel, the next turn isn't sent while the first one may be running
+    assert transport._commands[0].qsize() == 2
+    assert not next_task.done()
+
+    await transport.send_report(TurnReport(0, is_input_saved=True, llm_calls=1))
+    await asyncio.sleep(0.01)
+    assert transport._commands[0].qsize() == 3
+
+    await transport.send_report(TurnReport(1, is_input_saved=True, llm_calls=1))
+    await next_task
+
+    assert not pool._reports
+
+    await stop_tasks([pool._read_task])
+
+
+@pytest.mark.asyncio
+async def test_process_transport_round_trip():
+    transport = ProcessWorkerTransport(2)
+
+    await transport.send_command(1, TurnCommand(7, make_entry(1)))
+    await transport.send_command(0, None)
+
+    command = await asyncio.wait_for(transport.receive_command(1), 5)
+
+    assert command is not None
+    assert command.turn_id == 7
+    assert command.entry is not None
+    assert command.entry.messages == [{"role": "user", "content": "hi"}]
+
+    assert await asyncio.wait_for(transport.receive_command(0), 5) is None
+
+
+@pytest.mark.asyncio
+async def test_failed_turn_is_reported_as_error():
+    worker_tasks: list[asyncio.Task] = []
+    pool, executors, _ = start_workers(1, worker_tasks)
+
+    async def execute(chat_id: int, entry: LocalQueueEntry, turn: ChatTurn) -> None:
+        raise RuntimeError("broken history")
+
+    executors[0].execute = execute  # type: ignore
+
+    with pytest.raises(WorkerTurnError, match="broken history"):
+        await pool.execute(1, make_entry(1), ChatTurn())
+
+    await stop_tasks([*worker_tasks, pool._read_task])
@@ -30,6 +30,7 @@ def default_llm_config() -> LLMConfig:
         group_instruction="",
         private_instruction="",
         summarize_instruction="",
+        describe_image_instruction="",
         additional_instructions=AdditionalInstructions(
             descr_edited="",
             name_changed="",
@@ -6,7 +6,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from aerith_cbot.config import LimitsConfig, LLMConfig
 from aerith_cbot.database.models import ChatState
-from aerith_cbot.services.abstractions import VoiceTranscriber
+from aerith_cbot.services.abstractions import SupportService, VoiceTranscriber
 from aerith_cbot.services.abstractions.models import InputChat, InputMessage, InputUser
 from aerith_cbot.services.implementations import DefaultLimitsService, DefaultSenderService
 from aerith_cbot.services.implementations.chat_dispatcher import MessageQueue
@@ -51,6 +51,7 @@ async def test_sleeping_chat_ignore(
         llm_config=default_llm_config,
         sender_service=mock_sender_service,
         voice_transcriber=mock_voice_transcriber,
+        support_service=AsyncMock(spec=SupportService),
     )
 
     await group_message_processor.process(default_message_to_process)
@@ -85,6 +86,7 @@ async def test_addding_chat_state_if_none(
         llm_config=default_llm_config,
         sender_service=mock_sender_service,
         voice_transcriber=mock_voice_transcriber,
+        support_service=AsyncMock(spec=SupportService),
     )
 
     await group_message_processor.process(default_message_to_process)
@@ -122,6 +124,7 @@ async def test_skipping_unfocused(
         llm_config=default_llm_config,
         sender_service=mock_sender_service,
         voice_transcriber=mock_voice_transcriber,
+        support_service=AsyncMock(spec=SupportService),
     )
 
     group_message_processor._is_chat_inactive = AsyncMock(return_value=False)
@@ -175,6 +178,7 @@ async def test_focusing_unfocused(
         llm_config=default_llm_config,
         sender_service=mock_sender_service,
         voice_transcriber=mock_voice_transcriber,
+        support_service=AsyncMock(spec=SupportService),
     )
 
     group_message_processor._is_chat_inactive = AsyncMock(return_value=False)
@@ -228,6 +232,7 @@ async def test_adding_message_to_queue(
         llm_config=default_llm_config,
         sender_service=mock_sender_service,
         voice_transcriber=mock_voice_transcriber,
+        support_service=AsyncMock(spec=SupportService),
     )
 
     await group_message_processor.process(
@@ -0,0 +1,218 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from aerith_cbot.config import IdleCompactionConfig, LimitsConfig
+from aerith_cbot.services.abstractions import MessageService
+from aerith_cbot.services.implementations import (
+    HistoryCompactor,
+    IdleCompactionScheduler,
+    TokenEstimator,
+)
+
+
+def make_compactor(
+    message_service: MessageService, limits_config: LimitsConfig
+) -> HistoryCompactor:
+    request_container = MagicMock()
+    request_container.get = AsyncMock(return_value=message_service)
+
+    container = MagicMock()
+    container.return_value.__aenter__ = AsyncMock(return_value=request_container)
+    container.return_value.__aexit__ = AsyncMock(return_value=False)
+
+    return HistoryCompactor(container, limits_config, TokenEstimator())
+
+
+def make_message_service(release_event: asyncio.Event) -> MagicMock:
+    message_service = MagicMock(spec=MessageService)
+    message_service.running = 0
+    message_service.max_running = 0
+
+    async def shorten(chat_id: int) -> None:
+        message_service.running += 1
+        message_service.max_running = max(message_service.max_running, message_service.running)
+
+        await release_event.wait()
+
+        message_service.running -= 1
+
+    message_service.shorten_history = AsyncMock(side_effect=shorten)
+    message_service.shorten_full_history_without_media = AsyncMock(side_effect=shorten)
+
+    return message_service
+
+
+@pytest.mark.asyncio
+async def test_one_compaction_per_chat(default_limits_config: LimitsConfig):
+    release_event = asyncio.Event()
+    message_service = make_message_service(release_event)
+    compactor = make_compactor(message_service, default_limits_config)
+
+    compactor.request(1)
+    compactor.request(1)
+    compact_task = asyncio.create_task(compactor.compact(1))
+
+    await asyncio.sleep(0.01)
+    assert compactor.is_compacting(1)
+    assert not compact_task.done()
+
+    release_event.set()
+    await compact_task
+
+    message_service.shorten_history.assert_called_once_with(1)
+    assert not compactor.is_compacting(1)
+    assert compactor.compactions_count == 1
+    assert compactor.blocked_turns_count == 1
+
+
+@pytest.mark.asyncio
+async def test_turns_wait_only_for_running_compactions(default_limits_config: LimitsConfig):
+    release_event = asyncio.Event()
+    compactor = make_compactor(make_message_service(release_event), default_limits_config)
+
+    # nothing is running, so nothing is waited for
+    await compactor.wait(1)
+    assert compactor.blocked_turns_count == 0
+
+    compactor.request(1)
+    wait_task = asyncio.create_task(compactor.wait(1))
+
+    await asyncio.sleep(0.01)
+    assert not wait_task.done()
+
+    release_event.set()
+    await wait_task
+
+    assert compactor.blocked_turns_count == 1
+    assert compactor.average_lag > 0
+
+
+@pytest.mark.asyncio
+async def test_compactions_of_different_kinds_do_not_overlap(default_limits_config: LimitsConfig):
+    release_event = asyncio.Event()
+    message_service = make_message_service(release_event)
+    compactor = make_compactor(message_service, default_limits_config)
+
+    compactor.request(1)
+    compact_task = asyncio.create_task(compactor.compact(1, without_media=True))
+
+    await asyncio.sleep(0.01)
+    message_service.shorten_full_history_without_media.assert_not_called()
+
+    release_event.set()
+    await compact_task
+
+    message_service.shorten_history.assert_called_once_with(1)
+    message_service.shorten_full_history_without_media.assert_called_once_with(1)
+    assert message_service.max_running == 1
+    assert compactor.compactions_count == 2
+
+
+@pytest.mark.asyncio
+async def test_failed_compaction_does_not_fail_the_turn(default_limits_config: LimitsConfig):
+    message_service = MagicMock(spec=MessageService)
+    message_service.shorten_history = AsyncMock(side_effect=RuntimeError("summarizer is down"))
+    compactor = make_compactor(message_service, default_limits_config)
+
+    await compactor.compact(1)
+
+    assert compactor.failures_count == 1
+    assert compactor.compactions_count == 0
+    assert compactor.average_lag == 0
+    assert not compactor.is_compacting(1)
+
+
+def make_growing_message_service() -> MagicMock:
+    """A long history of each chat until it's shortened"""
+
+    message_service = make_message_service(asyncio.Event())
+    shortened_chats = set()
+
+    async def fetch_messages(chat_id: int) -> list[dict]:
+        if chat_id in shortened_chats:
+            return [{"role": "assistant", "content": "summary"}]
+
+        return [{"role": "user", "content": "hello there " * 100}] * 10
+
+    async def shorten(chat_id: int) -> None:
+        message_service.running += 1
+        message_service.max_running = max(message_service.max_running, message_service.running)
+
+        await asyncio.sleep(0.01)
+        shortened_chats.add(chat_id)
+
+        message_service.running -= 1
+
+    message_service.fetch_messages = AsyncMock(side_effect=fetch_messages)
+    message_service.shorten_history = AsyncMock(side_effect=shorten)
+
+    return message_service
+
+
+@pytest.mark.asyncio
+async def test_idle_chats_are_compacted_within_budget(default_limits_config: LimitsConfig):
+    message_service = make_growing_message_service()
+    compactor = make_compactor(message_service, default_limits_config)
+
+    compactor.track_usage(1, 900, 1000)
+    compactor.track_usage(2, 600, 1000)
+    # too small to be compacted
+    compactor.track_usage(3, 100, 1000)
+    # doesn't fit into the rest of the budget
+    compactor.track_usage(4, 800, 1000)
+
+    scheduler = IdleCompactionScheduler(
+        compactor,
+        IdleCompactionConfig(
+            enabled=True, idle_time=0, min_usage_ratio=0.5, max_concurrent=1, tokens_per_run=1500
+        ),
+    )
+
+    assert await scheduler.run_once() == 2
+
+    assert sorted(call.args[0] for call in message_service.shorten_history.call_args_list) == [
+        1,
+        2,
+    ]
+    assert message_service.max_running == 1
+    assert compactor.idle_compactions_count == 2
+
+    # the compacted chats aren't picked again until their next turns
+    assert await scheduler.run_once() == 1
+    message_service.shorten_history.assert_called_with(4)
+
+
+@pytest.mark.asyncio
+async def test_active_chats_are_not_compacted(default_limits_config: LimitsConfig):
+    message_service = make_growing_message_service()
+    compactor = make_compactor(message_service, default_limits_config)
+
+    compactor.track_usage(1, 900, 1000)
+
+    scheduler = IdleCompactionScheduler(
+        compactor, IdleCompactionConfig(enabled=True, idle_time=600, min_usage_ratio=0.5)
+    )
+
+    assert await scheduler.run_once() == 0
+    message_service.shorten_history.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_avoided_compactions_are_counted(default_limits_config: LimitsConfig):
+    compactor = make_compactor(make_growing_message_service(), default_limits_config)
+
+    await compactor.compact_idle(1)
+    await compactor.compact_idle(2)
+
+    # the next turn of the first chat would have crossed the soft limit with the whole history
+    compactor.track_usage(1, 700, 1000)
+
+    # the second chat has needed a compaction anyway
+    compactor.request(2)
+    await compactor.wait(2)
+    compactor.track_usage(2, 700, 1000)
+
+    assert compactor.idle_compactions_count == 2
+    assert compactor.avoided_compactions_count == 1
@@ -0,0 +1,145 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from openai.types.chat import ChatCompletion
+
+from aerith_cbot.config import MediaConfig
+from aerith_cbot.services.abstractions import SummarizationError
+from aerith_cbot.services.implementations import (
+    MediaCache,
+    MediaResolver,
+    OpenAIHistorySummarizer,
+    TokenEstimator,
+)
+
+
+def make_completion(content: str) -> ChatCompletion:
+    return ChatCompletion.model_validate(
+        {
+            "id": "chatcmpl-1",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "gpt-4",
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ],
+        }
+    )
+
+
+def make_summarizer(create, chunk_tokens=100, concurrency=2) -> OpenAIHistorySummarizer:
+    openai_client = MagicMock()
+    openai_client.chat.completions.create = AsyncMock(side_effect=create)
+
+    openai_config = MagicMock()
+    openai_config.summarizer_model = "gpt-4"
+    openai_config.summarizer_chunk_tokens = chunk_tokens
+    openai_config.summarizer_concurrency = concurrency
+
+    llm_config = MagicMock()
+    llm_config.summarize_instruction = "summarize"
+
+    return OpenAIHistorySummarizer(
+        openai_client,
+        openai_config,
+        llm_config,
+        TokenEstimator(),
+        MediaResolver(MagicMock(), MediaCache(MediaConfig()), MediaConfig()),
+    )
+
+
+def make_history(count: int) -> list[dict]:
+    # about 50 tokens each
+    return [{"role": "user", "content": f"{i} " + "a" * 180} for i in range(count)]
+
+
+def test_split_by_tokens():
+    summarizer = make_summarizer(None)
+
+    history = make_history(5)
+    history.insert(2, {"role": "assistant", "content": None, "tool_calls": []})
+    history.insert(3, {"role": "tool", "content": "b" * 400})
+
+    chunks = summarizer.split(history)
+
+    assert [len(chunk) for chunk in chunks] == [2, 2, 2, 1]
+    # the tool response stays with its call, though the chunk is too big with it
+    assert [message["role"] for message in chunks[1]] == ["assistant", "tool"]
+
+
+@pytest.mark.asyncio
+async def test_short_history_is_summarized_in_one_request():
+    async def create(model: str, messages: list[dict]) -> ChatCompletion:
+        return make_completion("summary")
+
+    summarizer = make_summarizer(create, chunk_tokens=10_000)
+
+    assert await summarizer.summarize(make_history(10)) == "summary"
+    summarizer._openai_client.chat.completions.create.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_long_history_is_summarized_by_chunks():
+    running = 0
+    max_running = 0
+
+    async def create(model: str, messages: list[dict]) -> ChatCompletion:
+        nonlocal running, max_running
+
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+        contents = [message["content"] for message in messages[1:]]
+        if all(content.startswith("chunk") for content in contents):
+            return make_completion("merged " + " + ".join(contents))
+
+        return make_completion(f"chunk {contents[0].split()[0]}")
+
+    summarizer = make_summarizer(create)
+
+    summary = await summarizer.summarize(make_history(6))
+
+    assert summary == "merged chunk 0 + chunk 2 + chunk 4"
+    assert max_running == 2
+    # three chunks and the merge
+    assert summarizer._openai_client.chat.completions.create.call_count == 4
+
+
+@pytest.mark.asyncio
+async def test_failed_chunk_fails_the_summary():
+    async def create(model: str, messages: list[dict]) -> ChatCompletion:
+        contents = [message["content"] for message in messages[1:]]
+
+        if contents[0].startswith("2 "):
+            raise RuntimeError("server error")
+        if contents[0].startswith("chunk"):
+            return make_completion("merged " + " + ".join(contents))
+
+        return make_completion(f"chunk {contents[0].split()[0]}")
+
+    summarizer = make_summarizer(create)
+
+    # the history would lose the part of the failed chunk
+    with pytest.raises(SummarizationError):
+        await summarizer.summarize(make_history(6))
+
+    # the others aren't merged
+    assert summarizer._openai_client.chat.completions.create.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_empty_summary_is_a_failure():
+    async def create(model: str, messages: list[dict]) -> ChatCompletion:
+        return make_completion("")
+
+    summarizer = make_summarizer(create, chunk_tokens=10_000)
+
+    with pytest.raises(SummarizationError):
+        await summarizer.summarize(make_history(2))
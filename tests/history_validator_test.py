@@ -0,0 +1,260 @@
+import time
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+from uuid_utils.compat import uuid7
+
+from aerith_cbot.config import LimitsConfig
+from aerith_cbot.database.models import Message
+from aerith_cbot.services.abstractions import HistorySummarizer
+from aerith_cbot.services.implementations import (
+    DefaultMessageService,
+    HistoryValidator,
+    ImageDescriber,
+)
+from aerith_cbot.services.implementations.history_validator import (
+    IMAGE_UNAVAILABLE,
+    broken_media_urls,
+    message_age,
+)
+
+TELEGRAM_URL = "https://api.telegram.org/file/botTOKEN/photos/file_{}.jpg"
+
+
+def tool_call(call_id: str) -> dict:
+    return {"id": call_id, "type": "function", "function": {"name": "f", "arguments": "{}"}}
+
+
+def image_message(*urls: str) -> dict:
+    return {
+        "role": "user",
+        "content": [{"type": "text", "text": "смотри"}]
+        + [{"type": "image_url", "image_url": {"url": url, "detail": "low"}} for url in urls],
+    }
+
+
+def test_tool_calls_are_paired(default_limits_config: LimitsConfig):
+    validator = HistoryValidator(default_limits_config)
+
+    messages = [
+        {"role": "tool", "tool_call_id": "call_0", "content": "потерянный ответ"},
+        {"role": "user", "content": "привет"},
+        {"role": "assistant", "content": None, "tool_calls": [tool_call("1"), tool_call("2")]},
+        {"role": "tool", "tool_call_id": "1", "content": "ok"},
+        {"role": "assistant", "content": None, "tool_calls": [tool_call("3")]},
+        {"role": "user", "content": "ответь"},
+    ]
+
+    repair = validator.repair(messages)
+
+    assert repair.repaired() == [
+        {"role": "user", "content": "привет"},
+        {"role": "assistant", "content": None, "tool_calls": [tool_call("1")]},
+        {"role": "tool", "tool_call_id": "1", "content": "ok"},
+        {"role": "user", "content": "ответь"},
+    ]
+    assert repair.dropped_tool_messages == 1
+    assert repair.dropped_tool_calls == 2
+    # the untouched messages aren't copied
+    assert repair.messages[1] is messages[1]
+
+
+def test_valid_history_is_untouched(default_limits_config: LimitsConfig):
+    validator = HistoryValidator(default_limits_config)
+
+    messages = [
+        image_message(TELEGRAM_URL.format(1)),
+        {"role": "assistant", "content": None, "tool_calls": [tool_call("1")]},
+        {"role": "tool", "tool_call_id": "1", "content": "ok"},
+    ]
+
+    repair = validator.repair(messages, [10.0, 5.0, 5.0])
+
+    assert repair.is_empty
+    assert repair.repaired() == messages
+    assert validator.repaired_histories_count == 0
+
+
+def test_expired_and_broken_images_are_replaced(default_limits_config: LimitsConfig):
+    default_limits_config.media_ttl = 3600
+    validator = HistoryValidator(default_limits_config)
+
+    messages = [
+        image_message(TELEGRAM_URL.format(1)),
+        image_message(TELEGRAM_URL.format(2), TELEGRAM_URL.format(3)),
+        image_message("not a link"),
+    ]
+
+    repair = validator.repair(messages, [4000.0, 60.0, None], broken_urls={TELEGRAM_URL.format(3)})
+
+    assert repair.messages[0]["content"][1] == IMAGE_UNAVAILABLE  # type: ignore
+    assert repair.messages[1]["content"][1]["type"] == "image_url"  # type: ignore
+    assert repair.messages[1]["content"][2] == IMAGE_UNAVAILABLE  # type: ignore
+    assert repair.messages[2]["content"][1] == IMAGE_UNAVAILABLE  # type: ignore
+    assert repair.replaced_images == 3
+    assert validator.repaired_histories_count == 1
+
+
+def test_size_limits(default_limits_config: LimitsConfig):
+    default_limits_config.max_message_chars = 10
+    default_limits_config.max_images = 2
+    validator = HistoryValidator(default_limits_config)
+
+    messages = [
+        image_message(TELEGRAM_URL.format(1), TELEGRAM_URL.format(2)),
+        image_message(TELEGRAM_URL.format(3)),
+        {"role": "user", "content": "очень длинное сообщение"},
+    ]
+
+    repaired = validator.repair(messages).repaired()
+
+    # only the newest images are kept
+    assert repaired[0]["content"][1] == IMAGE_UNAVAILABLE
+    assert repaired[0]["content"][2]["type"] == "image_url"
+    assert repaired[1]["content"][1]["type"] == "image_url"
+    assert repaired[2]["content"].startswith("очень длин")
+    assert len(repaired[2]["content"]) < len(messages[2]["content"]) + 25
+
+    # the stored history keeps them, they are limited in each request
+    assert validator.repair(messages, apply_limits=False).is_empty
+
+
+def test_broken_media_urls():
+    url = TELEGRAM_URL.format(1)
+
+    assert broken_media_urls(f"Error while downloading {url}.") == {url}
+    assert broken_media_urls("Invalid 'messages[2].content'") == set()
+
+
+def test_message_age():
+    assert message_age(uuid7(), time.time()) == pytest.approx(0, abs=1)
+    assert message_age(1, time.time()) is None
+
+
+@pytest.mark.asyncio
+async def test_fetched_history_is_repaired_in_db(default_limits_config: LimitsConfig):
+    history = [
+        Message(id=1, chat_id=1, data={"role": "tool", "tool_call_id": "0", "content": "ok"}),
+        Message(id=2, chat_id=1, data={"role": "user", "content": "привет"}),
+        Message(
+            id=3,
+            chat_id=1,
+            data={"role": "assistant", "content": "ищу", "tool_calls": [tool_call("1")]},
+        ),
+    ]
+
+    mock_db_session = MagicMock(spec=AsyncSession)
+    mock_result = MagicMock()
+    mock_result.scalars.return_value = history
+    mock_db_session.execute = AsyncMock(return_value=mock_result)
+    mock_db_session.commit = AsyncMock()
+
+    mock_image_describer = MagicMock(spec=ImageDescriber)
+    mock_image_describer.aged_images.return_value = {}
+
+    message_service = DefaultMessageService(
+        mock_db_session,
+        MagicMock(spec=HistorySummarizer),
+        default_limits_config,
+        HistoryValidator(default_limits_config),
+        mock_image_describer,
+    )
+
+    # the repaired messages are stored as they were read
+    mock_result.all.return_value = [
+        (msg.id, msg.level, msg.data) for msg in (history[0], history[2])
+    ]
+
+    messages = await message_service.fetch_messages(1)
+
+    assert messages == [
+        {"role": "user", "content": "привет"},
+        {"role": "assistant", "content": "ищу"},
+    ]
+
+    # the select, the lock and the check of the repaired messages, an update of the call
+    # and a delete of the orphaned response
+    statements = [call.args[0] for call in mock_db_session.execute.call_args_list]
+    assert [statement.is_select for statement in statements] == [True, True, True, False, False]
+    assert "pg_advisory_xact_lock(1)" in str(
+        statements[1].compile(compile_kwargs={"literal_binds": True})
+    )
+    assert statements[3].is_update
+    assert statements[4].is_delete
+    mock_db_session.commit.assert_called_once()
+
+    # another instance has compacted the history meanwhile, so nothing is written
+    mock_db_session.execute.reset_mock()
+    mock_db_session.commit.reset_mock()
+    mock_result.all.return_value = []
+
+    assert await message_service.fetch_messages(1) == messages
+
+    statements = [call.args[0] for call in mock_db_session.execute.call_args_list]
+    assert all(statement.is_select for statement in statements)
+
+
+async def test_size_limits_are_not_stored(default_limits_config: LimitsConfig):
+    default_limits_config.max_message_chars = 10
+    default_limits_config.max_images = 1
+    history = [
+        Message(id=1, chat_id=1, data=image_message(TELEGRAM_URL.format(1))),
+        Message(id=2, chat_id=1, data=image_message(TELEGRAM_URL.format(2))),
+        Message(id=3, chat_id=1, data={"role": "user", "content": "очень длинное сообщение"}),
+    ]
+
+    mock_db_session = MagicMock(spec=AsyncSession)
+    mock_result = MagicMock()
+    mock_result.scalars.return_value = history
+    mock_db_session.execute = AsyncMock(return_value=mock_result)
+    mock_db_session.commit = AsyncMock()
+
+    mock_image_describer = MagicMock(spec=ImageDescriber)
+    mock_image_describer.aged_images.return_value = {}
+
+    message_service = DefaultMessageService(
+        mock_db_session,
+        MagicMock(spec=HistorySummarizer),
+        default_limits_config,
+        HistoryValidator(default_limits_config),
+        mock_image_describer,
+    )
+
+    messages = await message_service.fetch_messages(1)
+
+    # the old image is left for the describer and the text for the summarizer
+    assert messages == [message.data for message in history]
+    assert mock_db_session.execute.call_count == 1
+    mock_db_session.commit.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_broken_images_are_repaired_under_lock(default_limits_config: LimitsConfig):
+    url = TELEGRAM_URL.format(1)
+    history = [Message(id=1, chat_id=1, data=image_message(url))]
+
+    mock_db_session = MagicMock(spec=AsyncSession)
+    mock_result = MagicMock()
+    mock_result.scalars.return_value = history
+    mock_db_session.execute = AsyncMock(return_value=mock_result)
+    mock_db_session.commit = AsyncMock()
+
+    message_service = DefaultMessageService(
+        mock_db_session,
+        MagicMock(spec=HistorySummarizer),
+        default_limits_config,
+        HistoryValidator(default_limits_config),
+        MagicMock(spec=ImageDescriber),
+    )
+
+    assert await message_service.repair_history(1, {url})
+
+    # the history is read after the lock and rewritten in the same transaction
+    statements = [call.args[0] for call in mock_db_session.execute.call_args_list]
+    assert "pg_advisory_xact_lock(1)" in str(
+        statements[0].compile(compile_kwargs={"literal_binds": True})
+    )
+    assert statements[1].is_select
+    assert statements[2].is_update
+    mock_db_session.commit.assert_called_once()
@@ -0,0 +1,174 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from aerith_cbot.config import LimitsConfig, LLMConfig, MediaConfig
+from aerith_cbot.database.models import ImageDescription, Message
+from aerith_cbot.services.abstractions import HistorySummarizer
+from aerith_cbot.services.implementations import (
+    DefaultMessageService,
+    HistoryValidator,
+    ImageDescriber,
+    MediaResolver,
+    TokenEstimator,
+)
+from aerith_cbot.services.implementations.image_describer import description_part
+from aerith_cbot.utils.media import media_reference
+
+MEME = media_reference("file_1", "meme")
+# the same image forwarded from another chat
+FORWARDED_MEME = media_reference("file_2", "meme")
+
+
+def image_message(url: str) -> dict:
+    return {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": "смотри"},
+            {"type": "image_url", "image_url": {"url": url, "detail": "low"}},
+        ],
+    }
+
+
+def make_db_session(rows: list) -> MagicMock:
+    db_session = MagicMock(spec=AsyncSession)
+    result = MagicMock()
+    result.scalars.return_value = rows
+    db_session.execute = AsyncMock(return_value=result)
+    db_session.merge = AsyncMock()
+    db_session.commit = AsyncMock()
+    return db_session
+
+
+def make_describer(
+    llm_config: LLMConfig, db_session: MagicMock | None = None, description: str = "кот в коробке"
+) -> tuple[ImageDescriber, MagicMock]:
+    container = MagicMock()
+    container.return_value.__aenter__.return_value.get = AsyncMock(return_value=db_session)
+
+    openai_client = MagicMock()
+    completion = MagicMock()
+    completion.choices[0].message.content = description
+    openai_client.chat.completions.create = AsyncMock(return_value=completion)
+
+    media_resolver = MagicMock(spec=MediaResolver)
+    media_resolver.resolve = AsyncMock(
+        side_effect=lambda messages: [
+            {
+                "role": "user",
+                "content": [{"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,"}}],
+            }
+        ]
+    )
+
+    image_describer = ImageDescriber(
+        container,
+        openai_client,
+        MagicMock(summarizer_model="gpt-5-nano"),
+        llm_config,
+        MediaConfig(describe_after_turns=2, describe_after=3600),
+        media_resolver,
+        TokenEstimator(),
+    )
+
+    return image_describer, openai_client
+
+
+def test_images_age_by_turns_and_time(default_llm_config: LLMConfig):
+    image_describer, _ = make_describer(default_llm_config)
+
+    messages = [
+        image_message(media_reference("file_1", "old")),
+        {"role": "assistant", "content": "ого"},
+        image_message(media_reference("file_2", "recent")),
+        {"role": "assistant", "content": None, "tool_calls": [{"id": "1"}]},
+        {"role": "tool", "tool_call_id": "1", "content": "ok"},
+        {"role": "assistant", "content": "красиво"},
+        image_message(media_reference("file_3", "new_but_stale")),
+        image_message("https://example.com/not_ours.jpg"),
+    ]
+    ages: list[float | None] = [None] * len(messages)
+    ages[6] = 7200
+
+    assert image_describer.aged_images(messages, ages) == {
+        "old": media_reference("file_1", "old"),
+        "new_but_stale": media_reference("file_3", "new_but_stale"),
+    }
+
+
+@pytest.mark.asyncio
+async def test_description_is_made_once_per_file(default_llm_config: LLMConfig):
+    db_session = make_db_session([])
+    image_describer, openai_client = make_describer(default_llm_config, db_session)
+
+    # nothing is stored yet, the description is made in the background
+    assert await image_describer.descriptions(db_session, {"meme": MEME}) == {}
+    assert await image_describer.descriptions(db_session, {"meme": FORWARDED_MEME}) == {}
+    await asyncio.sleep(0.01)
+
+    assert await image_describer.descriptions(db_session, {"meme": FORWARDED_MEME}) == {
+        "meme": "кот в коробке"
+    }
+
+    openai_client.chat.completions.create.assert_called_once()
+    stored = db_session.merge.call_args[0][0]
+    assert (stored.file_unique_id, stored.description) == ("meme", "кот в коробке")
+    assert image_describer.descriptions_count == 1
+
+
+@pytest.mark.asyncio
+async def test_stored_descriptions_are_loaded(default_llm_config: LLMConfig):
+    db_session = make_db_session([ImageDescription(file_unique_id="meme", description="мем")])
+    image_describer, openai_client = make_describer(default_llm_config, db_session)
+
+    assert await image_describer.descriptions(db_session, {"meme": MEME}) == {"meme": "мем"}
+    assert await image_describer.descriptions(db_session, {"meme": MEME}) == {"meme": "мем"}
+
+    # the second time it's already in memory
+    db_session.execute.assert_called_once()
+    openai_client.chat.completions.create.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_old_images_are_replaced_in_history(
+    default_limits_config: LimitsConfig, default_llm_config: LLMConfig
+):
+    history = [
+        Message(id=1, chat_id=1, data=image_message(MEME)),
+        Message(id=2, chat_id=1, data={"role": "assistant", "content": "ха"}),
+        Message(id=3, chat_id=1, data={"role": "user", "content": "ещё"}),
+        Message(id=4, chat_id=1, data={"role": "assistant", "content": "да"}),
+        Message(id=5, chat_id=1, data=image_message(FORWARDED_MEME)),
+    ]
+    db_session = make_db_session(history)
+    image_describer, _ = make_describer(default_llm_config, db_session)
+    image_describer._remember("meme", "кот в коробке")
+
+    message_service = DefaultMessageService(
+        db_session,
+        MagicMock(spec=HistorySummarizer),
+        default_limits_config,
+        HistoryValidator(default_limits_config),
+        image_describer,
+    )
+
+    # the described message is stored as it was read
+    db_session.execute.return_value.all.return_value = [(1, history[0].level, history[0].data)]
+
+    messages = await message_service.fetch_messages(1)
+
+    # only the image two turns ago is replaced, the forwarded copy is still fresh
+    assert messages[0]["content"][1] == description_part("кот в коробке")
+    assert messages[4] is history[4].data
+
+    # the select, then the lock, the check and the update in one transaction
+    statements = [call.args[0] for call in db_session.execute.call_args_list]
+    assert [statement.is_update for statement in statements] == [False, False, False, True]
+    assert "pg_advisory_xact_lock" in str(statements[1])
+    db_session.commit.assert_called_once()
+
+    savings = image_describer.savings()[1]
+    assert savings.described_images == 1
+    assert savings.saved_tokens > 60
@@ -0,0 +1,67 @@
+from aerith_cbot.config import LoadSheddingConfig
+from aerith_cbot.services.implementations.chat_dispatcher.load_shedding import LoadShedder
+
+
+def make_shedder(**kwargs) -> LoadShedder:
+    config = {
+        "enabled": True,
+        "high_pending_turns": 10,
+        "low_pending_turns": 2,
+        "high_latency": 30,
+        "low_latency": 10,
+        **kwargs,
+    }
+
+    return LoadShedder(LoadSheddingConfig(**config))
+
+
+def test_disabled_shedder_never_degrades():
+    shedder = make_shedder(enabled=False)
+    shedder.observe_latency(100)
+
+    assert not shedder.update(1000)
+    assert shedder.switches_count == 0
+
+
+def test_hysteresis_on_pending_turns():
+    shedder = make_shedder()
+
+    assert not shedder.update(9)
+    assert shedder.update(10)
+
+    # between the marks the state is kept
+    assert shedder.update(5)
+    assert shedder.update(3)
+
+    assert not shedder.update(2)
+    assert not shedder.update(9)
+
+    assert shedder.switches_count == 2
+    assert shedder.degraded_turns_count == 3
+
+
+def test_latency_turns_shedding_on_and_keeps_it():
+    shedder = make_shedder()
+
+    for _ in range(20):
+        shedder.observe_latency(5)
+    assert not shedder.update(0)
+
+    for _ in range(20):
+        shedder.observe_latency(40)
+    assert shedder.p95_latency() == 40
+    assert shedder.update(0)
+
+    # the backlog is gone, but replies are still slow
+    assert shedder.update(0)
+    assert shedder.is_shedding
+
+
+def test_p95_latency():
+    shedder = make_shedder()
+    assert shedder.p95_latency() == 0
+
+    for latency in range(1, 101):
+        shedder.observe_latency(latency)
+
+    assert shedder.p95_latency() == 96
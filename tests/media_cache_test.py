@@ -0,0 +1,181 @@
+import asyncio
+import base64
+import io
+import os
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest
+
+from aerith_cbot.config import LimitsConfig, MediaConfig
+from aerith_cbot.services.implementations import (
+    HistoryValidator,
+    MediaCache,
+    MediaResolver,
+)
+from aerith_cbot.services.implementations.history_validator import IMAGE_UNAVAILABLE
+from aerith_cbot.utils.media import (
+    low_detail_photo,
+    media_reference,
+    parse_media_reference,
+)
+
+JPEG = b"\xff\xd8\xff\xe0" + b"0" * 96
+
+
+def make_bot(fails: bool = False) -> MagicMock:
+    bot = MagicMock()
+    bot.token = "TOKEN"
+    bot.session.api.file_url.side_effect = lambda token, path: (
+        f"https://api.telegram.org/file/bot{token}/{path}"
+    )
+
+    calls = 0
+
+    async def get_file(file_id: str) -> SimpleNamespace:
+        nonlocal calls
+        calls += 1
+
+        if fails:
+            raise TelegramBadRequest(MagicMock(), "Bad Request: wrong file_id")
+
+        return SimpleNamespace(file_path=f"photos/{file_id}_{calls}.jpg")
+
+    bot.get_file = AsyncMock(side_effect=get_file)
+    bot.download_file = AsyncMock(side_effect=lambda *args, **kwargs: io.BytesIO(JPEG))
+
+    return bot
+
+
+def image_message(url: str) -> dict:
+    return {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": "смотри"},
+            {"type": "image_url", "image_url": {"url": url, "detail": "low"}},
+        ],
+    }
+
+
+def test_media_references():
+    reference = media_reference("AgACAgIAAxk-BAAI", "AQADe_1")
+
+    assert parse_media_reference(reference) == ("AgACAgIAAxk-BAAI", "AQADe_1")
+    assert parse_media_reference("https://a.b/c.jpg") is None
+    assert parse_media_reference("tg-file:AQADe_1") is None
+
+    sizes = [SimpleNamespace(width=w, height=w // 2) for w in (90, 320, 800, 1280)]
+    assert low_detail_photo(sizes).width == 800  # type: ignore
+    assert low_detail_photo(sizes[:2]).width == 320  # type: ignore
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_files_are_evicted(tmp_path):
+    media_config = MediaConfig(cache_dir=str(tmp_path), cache_max_bytes=250)
+    media_cache = MediaCache(media_config)
+
+    await media_cache.put("a", b"a" * 100)
+    await media_cache.put("b", b"b" * 100)
+    assert await media_cache.get("a") == b"a" * 100
+
+    await media_cache.put("c", b"c" * 100)
+
+    assert "b" not in media_cache
+    assert not (tmp_path / "b").exists()
+    assert media_cache.size_bytes == 200
+    assert media_cache.evictions_count == 1
+
+    # too big and foreign keys aren't stored
+    await media_cache.put("d", b"d" * 300)
+    await media_cache.put("../e", b"e")
+    assert media_cache.files_count == 2
+
+    assert await media_cache.get("b") is None
+    assert (media_cache.hits_count, media_cache.misses_count) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_cache_is_restored_from_disk(tmp_path):
+    for i, key in enumerate(("old", "new", "newest")):
+        (tmp_path / key).write_bytes(b"0" * 100)
+        os.utime(tmp_path / key, (1000 + i, 1000 + i))
+    (tmp_path / "new.tmp").write_bytes(b"0")
+
+    media_cache = MediaCache(MediaConfig(cache_dir=str(tmp_path), cache_max_bytes=200))
+
+    # the order survives restarts, the lowered limit is applied
+    assert "old" not in media_cache
+    assert await media_cache.get("new") == b"0" * 100
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["new", "newest"]
+
+
+@pytest.mark.asyncio
+async def test_images_are_inlined_from_cache(tmp_path):
+    media_config = MediaConfig(cache_dir=str(tmp_path))
+    media_cache = MediaCache(media_config)
+    bot = make_bot()
+    media_resolver = MediaResolver(bot, media_cache, media_config)
+
+    reference = media_reference("file_1", "unique_1")
+    messages = [image_message(reference), {"role": "assistant", "content": "ого"}]
+
+    # the same image in several requests at once is downloaded once
+    results = await asyncio.gather(*(media_resolver.resolve(messages) for _ in range(3)))
+    resolved = await media_resolver.resolve(messages)
+
+    for result in results + [resolved]:
+        assert result[0]["content"][1]["image_url"] == {
+            "url": "data:image/jpeg;base64," + base64.b64encode(JPEG).decode(),
+            "detail": "low",
+        }
+        assert result[1] is messages[1]
+
+    bot.download_file.assert_called_once()
+    assert (tmp_path / "unique_1").read_bytes() == JPEG
+    assert media_cache.hits_count == 1
+    # the stored history keeps the reference
+    assert messages[0]["content"][1]["image_url"]["url"] == reference
+
+
+@pytest.mark.asyncio
+async def test_links_are_resolved_again_when_stale(tmp_path):
+    media_config = MediaConfig(cache_dir=str(tmp_path), delivery="url", url_ttl=1800)
+    bot = make_bot()
+    media_resolver = MediaResolver(bot, MediaCache(media_config), media_config)
+
+    messages = [image_message(media_reference("file_1", "unique_1"))]
+
+    first = await media_resolver.resolve(messages)
+    second = await media_resolver.resolve(messages)
+
+    url = "https://api.telegram.org/file/botTOKEN/photos/file_1_1.jpg"
+    assert first[0]["content"][1]["image_url"]["url"] == url
+    assert second == first
+    assert bot.get_file.call_count == 1
+
+    # a link OpenAI couldn't download isn't reused
+    assert media_resolver.references_of({url}) == {url, media_reference("file_1", "unique_1")}
+
+    media_config.url_ttl = 0
+    third = await media_resolver.resolve(messages)
+
+    assert third[0]["content"][1]["image_url"]["url"].endswith("file_1_2.jpg")
+    bot.download_file.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_unresolvable_images_are_replaced(tmp_path, default_limits_config: LimitsConfig):
+    media_config = MediaConfig(cache_dir=str(tmp_path))
+    media_resolver = MediaResolver(make_bot(fails=True), MediaCache(media_config), media_config)
+
+    reference = media_reference("file_1", "unique_1")
+
+    # references never expire for the validator, whatever the age of the message
+    repair = HistoryValidator(default_limits_config).repair([image_message(reference)], [10**6])
+    assert repair.is_empty
+
+    resolved = await media_resolver.resolve(repair.repaired())
+
+    assert resolved[0]["content"][1] == IMAGE_UNAVAILABLE
+    assert media_resolver.unavailable_count == 1
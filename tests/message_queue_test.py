@@ -1,20 +1,26 @@
+import asyncio
+import time
 from unittest.mock import patch
 
+import pytest
+
 from aerith_cbot.services.abstractions.models.chat import ChatType
 from aerith_cbot.services.implementations.chat_dispatcher import MessageQueue
 
 
+@pytest.mark.parametrize("chat_type", [ChatType.private, ChatType.group])
 @patch("time.time")
-def test_fetch_ready_entries_by_time(mock_time):
+def test_fetch_ready_entries_by_time(mock_time, chat_type: ChatType):
     start_time = 1000.0
     mock_time.return_value = start_time
 
     queue = MessageQueue()
-    queue.add(123, ChatType.private, [{"role": "user", "content": "Hello"}])
+    queue.add(123, chat_type, [{"role": "user", "content": "Hello"}])
 
     assert len(queue.fetch_ready_entries()) == 0
 
-    mock_time.return_value = start_time + MessageQueue.TIME_LIMIT_UPPER_BOUND + 0.1
+    policy = MessageQueue.BATCHING_POLICIES[chat_type]
+    mock_time.return_value = start_time + policy.max_window + 0.1
 
     ready_entries = queue.fetch_ready_entries()
 
@@ -22,24 +28,30 @@ def test_fetch_ready_entries_by_time(mock_time):
     assert ready_entries[0].chat_id == 123
 
 
+@pytest.mark.parametrize("chat_type", [ChatType.private, ChatType.group])
 @patch("time.time")
-def test_fetch_ready_entries_by_count(mock_time):
-    mock_time.return_value = 1000.0
+def test_fetch_ready_entries_by_count(mock_time, chat_type: ChatType):
+    current_time = 1000.0
+    mock_time.return_value = current_time
 
     queue = MessageQueue()
-    queue.add(123, ChatType.private, [{"role": "user", "content": "Message 1"}])
+    policy = MessageQueue.BATCHING_POLICIES[chat_type]
+
+    # messages come fast enough for the count limit to reach its maximum
+    for i in range(policy.max_count):
+        queue.add(123, chat_type, [{"role": "user", "content": f"Message {i}"}])
+
+        current_time += 0.1
+        mock_time.return_value = current_time
 
     assert len(queue.fetch_ready_entries()) == 0
 
-    messages = [
-        {"role": "user", "content": f"Message {i}"} for i in range(2, MessageQueue.COUNT_LIMIT + 2)
-    ]
-    queue.add(123, ChatType.private, messages)
+    queue.add(123, chat_type, [{"role": "user", "content": "One more"}])
 
     ready_entries = queue.fetch_ready_entries()
 
     assert len(ready_entries) == 1
-    assert len(ready_entries[0].messages) == MessageQueue.COUNT_LIMIT + 1
+    assert len(ready_entries[0].messages) == policy.max_count + 1
 
 
 @patch("time.time")
@@ -52,7 +64,8 @@ def test_clear(mock_time):
 
     queue.clear(123)
 
-    mock_time.return_value = 1000.0 + MessageQueue.TIME_LIMIT_UPPER_BOUND + 0.1
+    policy = MessageQueue.BATCHING_POLICIES[ChatType.group]
+    mock_time.return_value = 1000.0 + policy.max_window + 0.1
 
     ready_entries = queue.fetch_ready_entries()
 
@@ -68,26 +81,274 @@ def test_latest_update_not_ready(mock_time):
     queue = MessageQueue()
     queue.add(123, ChatType.private, [{"role": "user", "content": "Initial message"}])
 
-    with patch("random.randint", return_value=MessageQueue.TIME_LIMIT_UPPER_BOUND):
-        # still not ready cause 0 seconds passed since last adding
-        assert len(queue.fetch_ready_entries()) == 0
+    # still not ready cause 0 seconds passed since last adding
+    assert len(queue.fetch_ready_entries()) == 0
 
-        current_time += MessageQueue.TIME_LIMIT_UPPER_BOUND - 0.5
-        mock_time.return_value = current_time
+    current_time += 1
+    mock_time.return_value = current_time
 
-        queue.add(123, ChatType.private, [{"role": "user", "content": "New message"}])
+    queue.add(123, ChatType.private, [{"role": "user", "content": "New message"}])
 
-        # same: still not ready cause 0 seconds passed since last adding
-        assert len(queue.fetch_ready_entries()) == 0
+    # same: still not ready cause 0 seconds passed since last adding
+    assert len(queue.fetch_ready_entries()) == 0
 
-        current_time += MessageQueue.TIME_LIMIT_UPPER_BOUND - 0.5
-        mock_time.return_value = current_time
+    current_time += 1
+    mock_time.return_value = current_time
+
+    # not ready cause messages come every second, so the window is 1.5 seconds
+    assert len(queue.fetch_ready_entries()) == 0
+
+    current_time += 1
+    mock_time.return_value = current_time
+
+    # wait fot another second and now entries are available
+    assert len(queue.fetch_ready_entries()) == 1
+
+
+@patch("time.time")
+def test_new_chat_starts_with_min_window(mock_time):
+    mock_time.return_value = 1000.0
+
+    queue = MessageQueue()
+    queue.add(123, ChatType.private, [{"role": "user", "content": "Hello"}])
+
+    policy = MessageQueue.BATCHING_POLICIES[ChatType.private]
+
+    mock_time.return_value = 1000.0 + policy.min_window - 0.01
+    assert len(queue.fetch_ready_entries()) == 0
+
+    mock_time.return_value = 1000.0 + policy.min_window + 0.01
+    assert len(queue.fetch_ready_entries()) == 1
+
+
+@patch("time.time")
+def test_quiet_chat_gets_short_window(mock_time):
+    current_time = 1000.0
+    mock_time.return_value = current_time
+
+    queue = MessageQueue()
+    queue.add(123, ChatType.private, [{"role": "user", "content": "Hello"}])
+
+    current_time += 60
+    mock_time.return_value = current_time
+
+    queue.fetch_ready_entries()
+    queue.add(123, ChatType.private, [{"role": "user", "content": "Are you here?"}])
+
+    policy = MessageQueue.BATCHING_POLICIES[ChatType.private]
+
+    # the next message is not expected soon, so there is no point in waiting long
+    mock_time.return_value = current_time + policy.min_window + 0.01
+
+    assert len(queue.fetch_ready_entries()) == 1
+    assert queue.stats().average_windows[ChatType.private] < policy.max_window
 
-        # not ready cause only MessageQueue.TIME_LIMIT - 0.5 seconds passed, so 0.5 seconds left
-        assert len(queue.fetch_ready_entries()) == 0
 
-        current_time += 1
+@patch("time.time")
+def test_fast_group_batches_more_messages(mock_time):
+    current_time = 1000.0
+    mock_time.return_value = current_time
+
+    queue = MessageQueue()
+    policy = MessageQueue.BATCHING_POLICIES[ChatType.group]
+
+    for i in range(policy.max_count):
+        queue.add(456, ChatType.group, [{"role": "user", "content": f"Message {i}"}])
+
+        current_time += 0.2
         mock_time.return_value = current_time
 
-        # wait fot another second and now entries are available
-        assert len(queue.fetch_ready_entries()) == 1
+    # the count limit has grown with the rate, so the burst is still being collected
+    assert len(queue.fetch_ready_entries()) == 0
+
+    queue.add(456, ChatType.group, [{"role": "user", "content": "One more"}])
+
+    ready_entries = queue.fetch_ready_entries()
+
+    assert len(ready_entries) == 1
+    assert len(ready_entries[0].messages) == policy.max_count + 1
+
+
+@pytest.mark.asyncio
+async def test_wait_ready_entries_by_count():
+    queue = MessageQueue()
+    policy = MessageQueue.BATCHING_POLICIES[ChatType.private]
+
+    messages = [{"role": "user", "content": f"Message {i}"} for i in range(policy.max_count + 1)]
+    queue.add(123, ChatType.private, messages)
+
+    ready_entries = await asyncio.wait_for(queue.wait_ready_entries(), 1)
+
+    assert len(ready_entries) == 1
+    assert ready_entries[0].chat_id == 123
+
+
+@pytest.mark.asyncio
+async def test_wait_ready_entries_sleeps_until_deadline():
+    queue = MessageQueue()
+
+    with patch.object(MessageQueue, "_window", return_value=0.2):
+        queue.add(123, ChatType.private, [{"role": "user", "content": "Hello"}])
+
+    start_time = time.monotonic()
+    ready_entries = await asyncio.wait_for(queue.wait_ready_entries(), 1)
+
+    assert time.monotonic() - start_time >= 0.15
+    assert len(ready_entries) == 1
+
+
+@pytest.mark.asyncio
+async def test_wait_ready_entries_wakes_up_on_add():
+    queue = MessageQueue()
+
+    wait_task = asyncio.create_task(queue.wait_ready_entries())
+    await asyncio.sleep(0.05)
+
+    assert not wait_task.done()
+
+    with patch.object(MessageQueue, "_window", return_value=0):
+        queue.add(456, ChatType.group, [{"role": "user", "content": "Hello"}])
+
+    ready_entries = await asyncio.wait_for(wait_task, 1)
+
+    assert len(ready_entries) == 1
+    assert ready_entries[0].chat_id == 456
+
+
+@patch("time.time")
+def test_fetch_ready_entries_hands_off_messages(mock_time):
+    mock_time.return_value = 1000.0
+
+    queue = MessageQueue()
+    queue.add(123, ChatType.private, [{"role": "user", "content": "Hello"}])
+
+    policy = MessageQueue.BATCHING_POLICIES[ChatType.private]
+    mock_time.return_value = 1000.0 + policy.max_window + 0.1
+
+    ready_entries = queue.fetch_ready_entries()
+    handed_off_messages = ready_entries[0].messages
+
+    queue.add(123, ChatType.private, [{"role": "user", "content": "New message"}])
+
+    # the queue has started a fresh buffer, so the handed off list is not touched anymore
+    assert handed_off_messages == [{"role": "user", "content": "Hello"}]
+
+    mock_time.return_value = 1000.0 + 2 * policy.max_window + 0.2
+
+    ready_entries = queue.fetch_ready_entries()
+
+    assert ready_entries[0].messages == [{"role": "user", "content": "New message"}]
+
+
+@patch("time.time")
+def test_fetch_ready_entries_excluded(mock_time):
+    mock_time.return_value = 1000.0
+
+    queue = MessageQueue()
+    queue.add(123, ChatType.private, [{"role": "user", "content": "Hello"}])
+
+    policy = MessageQueue.BATCHING_POLICIES[ChatType.private]
+    mock_time.return_value = 1000.0 + policy.max_window + 0.1
+
+    assert len(queue.fetch_ready_entries(exclude={123})) == 0
+    assert queue.is_ready(123)
+
+    ready_entry = queue.take(123)
+
+    assert ready_entry is not None
+    assert ready_entry.messages == [{"role": "user", "content": "Hello"}]
+    assert not queue.is_ready(123)
+    assert queue.take(123) is None
+
+
+@patch("time.time")
+def test_flooding_chat_drops_oldest_messages(mock_time):
+    mock_time.return_value = 1000.0
+
+    queue = MessageQueue()
+    queue.add(123, ChatType.group, [{"role": "system", "content": "Aerith was mentioned"}])
+
+    messages = [
+        {"role": "user", "content": f"Message {i}"}
+        for i in range(MessageQueue.MAX_ENTRY_MESSAGES + 10)
+    ]
+    queue.add(123, ChatType.group, messages)
+
+    ready_entries = queue.fetch_ready_entries()
+
+    assert len(ready_entries[0].messages) == MessageQueue.MAX_ENTRY_MESSAGES
+    assert ready_entries[0].messages[0] == {"role": "system", "content": "Aerith was mentioned"}
+    assert ready_entries[0].messages[1] == {"role": "user", "content": "Message 11"}
+    assert queue.stats().dropped_messages == 11
+
+
+@patch("time.time")
+def test_idle_entries_eviction(mock_time):
+    mock_time.return_value = 1000.0
+
+    queue = MessageQueue()
+    queue.add(456, ChatType.group, [{"role": "user", "content": "Hello"}])
+    queue.add(123, ChatType.private, [{"role": "user", "content": "Hello"}])
+    queue.add(789, ChatType.private, [{"role": "user", "content": "Hello"}])
+
+    policy = MessageQueue.BATCHING_POLICIES[ChatType.private]
+    mock_time.return_value = 1000.0 + policy.max_window + 0.1
+
+    # 123 and 789 are handed off, 456 stays buffered (e.g. the chat is busy)
+    assert len(queue.fetch_ready_entries(exclude={456})) == 2
+    assert queue.stats().chats == 3
+
+    mock_time.return_value = 1000.0 + MessageQueue.IDLE_ENTRY_TTL + 1
+
+    queue.fetch_ready_entries(exclude={456})
+
+    stats = queue.stats()
+
+    # the busy entry doesn't keep the idle ones behind it
+    assert stats.chats == 1
+    assert stats.evicted_entries == 2
+    assert stats.buffered_chats == 1
+
+
+@patch("time.time")
+def test_stats(mock_time):
+    mock_time.return_value = 1000.0
+
+    queue = MessageQueue()
+    queue.add(123, ChatType.private, [{"role": "user", "content": "Hello"}])
+    queue.add(123, ChatType.private, [{"role": "user", "content": "World"}])
+    queue.add(456, ChatType.group, [{"role": "user", "content": "Hi"}])
+
+    stats = queue.stats()
+
+    assert stats.chats == 2
+    assert stats.buffered_chats == 2
+    assert stats.buffered_messages == 3
+    # estimated from the texts
+    assert stats.buffered_bytes == len("Hello") + len("World") + len("Hi")
+
+    queue.clear(123)
+
+    assert queue.stats().buffered_messages == 1
+
+
+@patch("time.time")
+def test_put_back(mock_time):
+    mock_time.return_value = 1000.0
+
+    queue = MessageQueue()
+    queue.add(123, ChatType.private, [{"role": "user", "content": "First"}], from_supporter=True)
+
+    entry = queue.take(123)
+    assert entry is not None
+
+    queue.add(123, ChatType.private, [{"role": "user", "content": "Second"}])
+    queue.put_back(entry, delay=1)
+
+    mock_time.return_value = 1000.0 + 1.1
+
+    ready_entries = queue.fetch_ready_entries()
+
+    assert len(ready_entries) == 1
+    assert [message["content"] for message in ready_entries[0].messages] == ["First", "Second"]
+    assert ready_entries[0].from_supporter
@@ -0,0 +1,234 @@
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from aerith_cbot.config import LimitsConfig
+from aerith_cbot.database.models import Message, MessageLevel
+from aerith_cbot.services.abstractions import HistorySummarizer, SummarizationError
+from aerith_cbot.services.implementations import (
+    DefaultMessageService,
+    HistoryValidator,
+    ImageDescriber,
+)
+from aerith_cbot.services.implementations.default_message_service import (
+    HierarchicalCompaction,
+)
+
+
+def make_history(count: int, start: int = 0, level=MessageLevel.raw) -> list[Message]:
+    return [
+        Message(id=i, chat_id=1, data={"role": "user", "content": f"сообщение {i}"}, level=level)
+        for i in range(start, start + count)
+    ]
+
+
+async def shorten_history(history: list[Message], limits_config: LimitsConfig) -> MagicMock:
+    mock_db_session = MagicMock(spec=AsyncSession)
+    mock_result = MagicMock()
+    mock_result.scalars.return_value = history
+    mock_db_session.execute = AsyncMock(return_value=mock_result)
+    mock_db_session.commit = AsyncMock()
+
+    mock_summarizer = MagicMock(spec=HistorySummarizer)
+    mock_summarizer.summarize = AsyncMock(return_value="краткое содержание")
+
+    message_service = DefaultMessageService(
+        mock_db_session,
+        mock_summarizer,
+        limits_config,
+        HistoryValidator(limits_config),
+        MagicMock(spec=ImageDescriber),
+    )
+    await message_service.shorten_history(1)
+
+    return mock_summarizer.summarize
+
+
+def content_ids(messages: list[dict]) -> list[int]:
+    return [int(message["content"].split()[-1]) for message in messages]
+
+
+async def summarized_ids(history: list[Message], limits_config: LimitsConfig) -> list[int]:
+    summarize = await shorten_history(history, limits_config)
+    return content_ids(summarize.call_args[0][0])
+
+
+@pytest.mark.asyncio
+async def test_shorten_history_takes_first_half(default_limits_config: LimitsConfig):
+    default_limits_config.compaction = "halve"
+
+    assert await summarized_ids(make_history(8), default_limits_config) == [0, 1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_cache_friendly_compaction_keeps_oldest_message(
+    default_limits_config: LimitsConfig,
+):
+    default_limits_config.compaction = "halve"
+    default_limits_config.cache_friendly_compaction = True
+
+    assert await summarized_ids(make_history(8), default_limits_config) == [1, 2, 3, 4, 5]
+    # nothing is left to keep when there are only two messages
+    assert await summarized_ids(make_history(2), default_limits_config) == [0]
+
+
+@pytest.mark.asyncio
+async def test_hierarchical_compaction_summarizes_only_raw_messages(
+    default_limits_config: LimitsConfig,
+):
+    history = (
+        make_history(1, level=MessageLevel.digest)
+        + make_history(2, start=1, level=MessageLevel.chunk_summary)
+        + make_history(8, start=3)
+    )
+
+    summarize = await shorten_history(history, default_limits_config)
+
+    # the summaries aren't read again
+    summarize.assert_called_once()
+    assert content_ids(summarize.call_args[0][0]) == [3, 4, 5, 6, 7, 8]
+
+
+@pytest.mark.asyncio
+async def test_hierarchical_compaction_folds_chunk_summaries_into_digest(
+    default_limits_config: LimitsConfig,
+):
+    chunks_count = HierarchicalCompaction.MAX_CHUNK_SUMMARIES
+    history = (
+        make_history(1, level=MessageLevel.digest)
+        + make_history(chunks_count, start=1, level=MessageLevel.chunk_summary)
+        + make_history(4, start=1 + chunks_count)
+    )
+
+    summarize = await shorten_history(history, default_limits_config)
+
+    assert summarize.call_count == 2
+    raw_ids = content_ids(summarize.call_args_list[0][0][0])
+    assert raw_ids == list(range(1 + chunks_count, 1 + chunks_count + 3))
+
+    # with the new one, only the last KEPT_CHUNK_SUMMARIES chunk summaries are kept
+    folded_ids = content_ids(summarize.call_args_list[1][0][0])
+    kept_count = HierarchicalCompaction.KEPT_CHUNK_SUMMARIES - 1
+    assert folded_ids == list(range(1 + chunks_count - kept_count))
+
+
+@pytest.mark.asyncio
+async def test_compactions_lock_the_history(default_limits_config: LimitsConfig):
+    mock_db_session = MagicMock(spec=AsyncSession)
+    mock_result = MagicMock()
+    mock_result.scalars.return_value = make_history(8)
+    mock_db_session.execute = AsyncMock(return_value=mock_result)
+    mock_db_session.commit = AsyncMock()
+
+    mock_summarizer = MagicMock(spec=HistorySummarizer)
+    mock_summarizer.summarize = AsyncMock(return_value="краткое содержание")
+
+    message_service = DefaultMessageService(
+        mock_db_session,
+        mock_summarizer,
+        default_limits_config,
+        HistoryValidator(default_limits_config),
+        MagicMock(spec=ImageDescriber),
+    )
+
+    for shorten in (
+        message_service.shorten_history,
+        message_service.shorten_full_history_without_media,
+    ):
+        mock_db_session.execute.reset_mock()
+        await shorten(-1001)
+
+        # the lock of other instances' compactions comes before the history is read
+        statements = [call.args[0] for call in mock_db_session.execute.call_args_list]
+        lock = str(statements[0].compile(compile_kwargs={"literal_binds": True}))
+        assert "pg_advisory_xact_lock(-1001)" in lock
+        assert statements[1].is_select
+
+
+@pytest.mark.asyncio
+async def test_failed_summary_keeps_the_history(default_limits_config: LimitsConfig):
+    mock_db_session = MagicMock(spec=AsyncSession)
+    mock_result = MagicMock()
+    mock_result.scalars.return_value = make_history(8)
+    mock_db_session.execute = AsyncMock(return_value=mock_result)
+    mock_db_session.commit = AsyncMock()
+
+    mock_summarizer = MagicMock(spec=HistorySummarizer)
+    mock_summarizer.summarize = AsyncMock(side_effect=SummarizationError("1 of 3 chunks"))
+
+    message_service = DefaultMessageService(
+        mock_db_session,
+        mock_summarizer,
+        default_limits_config,
+        HistoryValidator(default_limits_config),
+        MagicMock(spec=ImageDescriber),
+    )
+
+    with pytest.raises(SummarizationError):
+        await message_service.shorten_history(1)
+
+    # only the lock and the select, their transaction is over before the summarizer is called
+    assert mock_db_session.execute.call_count == 2
+    mock_db_session.commit.assert_called_once()
+
+
+def stored_rows(messages: list[Message]) -> list[tuple]:
+    return [(message.id, message.level, message.data) for message in messages]
+
+
+@pytest.mark.asyncio
+async def test_compaction_writes_only_unchanged_history(default_limits_config: LimitsConfig):
+    default_limits_config.compaction = "halve"
+    history = make_history(8)
+
+    mock_db_session = MagicMock(spec=AsyncSession)
+    mock_result = MagicMock()
+    mock_result.scalars.return_value = history
+    mock_db_session.execute = AsyncMock(return_value=mock_result)
+    mock_db_session.commit = AsyncMock()
+
+    mock_summarizer = MagicMock(spec=HistorySummarizer)
+    mock_summarizer.summarize = AsyncMock(return_value="краткое содержание")
+
+    message_service = DefaultMessageService(
+        mock_db_session,
+        mock_summarizer,
+        default_limits_config,
+        HistoryValidator(default_limits_config),
+        MagicMock(spec=ImageDescriber),
+    )
+
+    # the summarized messages are still there, the summary replaces them
+    mock_result.all.return_value = stored_rows(history[:4])
+    await message_service.shorten_history(1)
+
+    statements = [call.args[0] for call in mock_db_session.execute.call_args_list]
+    # the read, then the lock again with the check and the update and delete
+    assert [statement.is_select for statement in statements] == [True] * 4 + [False] * 2
+    assert "pg_advisory_xact_lock" in str(statements[2])
+    assert statements[4].is_update
+    assert statements[5].is_delete
+    assert mock_db_session.commit.call_count == 2
+
+    # another instance has compacted the history meanwhile
+    mock_db_session.execute.reset_mock()
+    mock_db_session.commit.reset_mock()
+    mock_result.all.return_value = stored_rows(history[:1])
+    await message_service.shorten_history(1)
+
+    statements = [call.args[0] for call in mock_db_session.execute.call_args_list]
+    assert all(statement.is_select for statement in statements)
+    assert mock_db_session.commit.call_count == 2
+
+
+def test_tool_messages_stay_with_their_calls():
+    history = make_history(4)
+    history[2].data = {"role": "assistant", "content": None, "tool_calls": []}
+    history[3].data = {"role": "tool", "content": "ok"}
+    history += make_history(2, start=4)
+
+    compaction = HierarchicalCompaction(history)
+
+    assert [m.id for m in compaction.raw_messages_to_summarize] == [0, 1, 2, 3]
+    assert compaction.chunk_summaries_to_fold == []
@@ -0,0 +1,76 @@
+import json
+
+from aerith_cbot.services.abstractions.models import ModelInputMessage, ModelInputUser
+from aerith_cbot.services.abstractions.utils.encoding import (
+    MAX_QUOTE_CHARS,
+    compact_batch,
+    compact_date,
+    encode_model_input,
+)
+
+PETYA = ModelInputUser(user_id=42, name="Петя", is_aerith=False)
+AERITH = ModelInputUser(user_id=7, name="Айрис", is_aerith=True)
+
+
+def make_message(message_id: int, sender: ModelInputUser = PETYA, **kwargs) -> ModelInputMessage:
+    kwargs.setdefault("meta", None)
+    return ModelInputMessage(
+        message_id=message_id, sender=sender, date="2025-04-26 15:08:27+00:00", **kwargs
+    )
+
+
+def user_message(text: str) -> dict:
+    return {"role": "user", "content": [{"type": "text", "text": text}]}
+
+
+def test_messages_are_encoded_compactly():
+    reply = make_message(1, AERITH, text="а" * 300)
+    message = make_message(2, reply_message=reply, text="ага", meta="переслано")
+
+    encoded = encode_model_input(message)
+
+    assert json.loads(encoded) == {
+        "v": 2,
+        "id": 2,
+        "u": [42, "Петя"],
+        "at": "04-26 15:08",
+        "re": {"id": 1, "u": "me", "t": "а" * MAX_QUOTE_CHARS + "…"},
+        "t": "ага",
+        "m": "переслано",
+    }
+    assert len(encoded) < len(encode_model_input(message, version=1)) - 250
+
+
+def test_dates_are_shortened():
+    assert compact_date("2025-04-26 15:08:27+00:00") == "04-26 15:08"
+    assert compact_date("вчера") == "вчера"
+
+
+def test_repeated_senders_and_times_are_dropped():
+    other = ModelInputUser(user_id=43, name="Вася", is_aerith=False)
+    messages = [
+        user_message(encode_model_input(make_message(1, text="раз"))),
+        user_message(encode_model_input(make_message(2, text="два"))),
+        user_message(encode_model_input(make_message(3, other, text="три"))),
+        {"role": "assistant", "content": "ну"},
+        user_message(encode_model_input(make_message(4, other, text="четыре"))),
+        user_message(make_message(5, other, text="пять").model_dump_json(exclude_none=True)),
+        user_message(encode_model_input(make_message(6, other, text="шесть"))),
+    ]
+
+    compacted = compact_batch(messages)
+    texts = [
+        json.loads(message["content"][0]["text"]) if message["role"] == "user" else None
+        for message in compacted
+    ]
+
+    assert texts[0] == {"v": 2, "id": 1, "u": [42, "Петя"], "at": "04-26 15:08", "t": "раз"}
+    assert texts[1] == {"v": 2, "id": 2, "t": "два"}
+    assert texts[2] == {"v": 2, "id": 3, "u": [43, "Вася"], "t": "три"}
+    # the answer of the assistant and the old format start over
+    assert compacted[4] is messages[4]
+    assert compacted[5] is messages[5]
+    assert compacted[6] is messages[6]
+
+    # the stored messages are left as they are
+    assert json.loads(messages[1]["content"][0]["text"])["u"] == [42, "Петя"]
@@ -0,0 +1,213 @@
+import asyncio
+import io
+import time
+
+import httpx
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from aerith_cbot.config import RateLimitsConfig
+from aerith_cbot.services.implementations import (
+    OpenAIRateLimiter,
+    RateLimitedTransport,
+    RequestPriority,
+    TokenEstimator,
+)
+from aerith_cbot.services.implementations.openai_rate_limiter import (
+    measure_requests,
+    parse_reset_time,
+)
+
+
+class FakeOpenAI:
+    """Chat completions endpoint with a requests-per-minute limit, like the real one"""
+
+    def __init__(self, requests_per_minute: int, burst: int) -> None:
+        self.requests_per_minute = requests_per_minute
+        self.burst = burst
+
+        self.remaining = float(burst)
+        self.updated_at = time.monotonic()
+
+        self.accepted = 0
+        self.rejected = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        await request.json()
+
+        current_time = time.monotonic()
+        self.remaining = min(
+            self.burst,
+            self.remaining + (current_time - self.updated_at) * self.requests_per_minute / 60,
+        )
+        self.updated_at = current_time
+
+        headers = {
+            "x-ratelimit-limit-requests": str(self.requests_per_minute),
+            "x-ratelimit-limit-tokens": "1000000",
+            "x-ratelimit-remaining-tokens": "1000000",
+        }
+
+        if self.remaining < 1:
+            self.rejected += 1
+            headers["x-ratelimit-remaining-requests"] = "0"
+            headers["retry-after-ms"] = str(int(60_000 / self.requests_per_minute))
+
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                status=429,
+                headers=headers,
+            )
+
+        self.remaining -= 1
+        self.accepted += 1
+        headers["x-ratelimit-remaining-requests"] = str(int(self.remaining))
+
+        return web.json_response(
+            {
+                "id": "chatcmpl-1",
+                "object": "chat.completion",
+                "created": 0,
+                "model": "gpt-4",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "ok"},
+                        "finish_reason": "stop",
+                    }
+                ],
+            },
+            headers=headers,
+        )
+
+
+async def run_storm(rate_limiter: OpenAIRateLimiter | None, callers: int) -> FakeOpenAI:
+    fake_openai = FakeOpenAI(requests_per_minute=1200, burst=5)
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", fake_openai.handle)
+
+    server = TestServer(app)
+    await server.start_server()
+
+    http_client = None
+    if rate_limiter is not None:
+        http_client = DefaultAsyncHttpxClient(transport=RateLimitedTransport(rate_limiter))
+
+    client = AsyncOpenAI(
+        api_key="test",
+        base_url=str(server.make_url("/v1")),
+        http_client=http_client,
+        max_retries=50,
+    )
+
+    try:
+        results = await asyncio.gather(
+            *(
+                client.chat.completions.create(
+                    model="gpt-4", messages=[{"role": "user", "content": "привет"}]
+                )
+                for _ in range(callers)
+            )
+        )
+        assert all(result.choices[0].message.content == "ok" for result in results)
+    finally:
+        await client.close()
+        await server.close()
+
+    return fake_openai
+
+
+@pytest.mark.asyncio
+async def test_survives_429_storm():
+    # the limiter starts with a budget far above the server's one and learns it from headers
+    rate_limiter = OpenAIRateLimiter(
+        RateLimitsConfig(requests_per_minute=60_000, base_backoff=0.05, max_backoff=1),
+        TokenEstimator(),
+    )
+
+    unlimited_storm = await run_storm(None, callers=30)
+    first_storm = await run_storm(rate_limiter, callers=30)
+
+    assert first_storm.accepted == 30
+    # only the first burst, sent before any headers came, is rejected; after that callers are
+    # paced instead of retrying together
+    assert first_storm.rejected < 30
+    assert first_storm.rejected * 3 < unlimited_storm.rejected
+    assert rate_limiter.rate_limited_count == first_storm.rejected
+
+    # with the budget known nothing is rejected at all
+    second_storm = await run_storm(rate_limiter, callers=30)
+    assert second_storm.accepted == 30
+    assert second_storm.rejected == 0
+
+
+@pytest.mark.asyncio
+async def test_higher_priority_goes_first():
+    rate_limiter = OpenAIRateLimiter(RateLimitsConfig(requests_per_minute=600), TokenEstimator())
+
+    budget = rate_limiter.budget("gpt-4")
+    budget.requests_remaining = 0
+
+    order = []
+
+    async def call(name: str, priority: RequestPriority):
+        await rate_limiter.acquire("gpt-4", 0, priority)
+        order.append(name)
+
+    tasks = [asyncio.create_task(call("background", RequestPriority.background))]
+    await asyncio.sleep(0)
+    tasks.append(asyncio.create_task(call("interactive", RequestPriority.interactive)))
+
+    await asyncio.gather(*tasks)
+
+    assert order == ["interactive", "background"]
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_lets_others_through():
+    rate_limiter = OpenAIRateLimiter(RateLimitsConfig(requests_per_minute=600), TokenEstimator())
+    rate_limiter.budget("gpt-4").requests_remaining = 0
+
+    first = asyncio.create_task(rate_limiter.acquire("gpt-4", 0))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(rate_limiter.acquire("gpt-4", 0))
+    await asyncio.sleep(0)
+
+    first.cancel()
+    await asyncio.wait_for(second, 1)
+
+    assert not rate_limiter.budget("gpt-4").waiters
+
+
+def test_parse_reset_time():
+    assert parse_reset_time("1s") == 1
+    assert parse_reset_time("6m0s") == 360
+    assert parse_reset_time("20ms") == pytest.approx(0.02)
+    assert parse_reset_time("1m30.5s") == pytest.approx(90.5)
+
+
+@pytest.mark.asyncio
+async def test_uploads_are_measured_without_reading_them():
+    rate_limiter = OpenAIRateLimiter(RateLimitsConfig(), TokenEstimator())
+    transport = RateLimitedTransport(
+        rate_limiter, httpx.MockTransport(lambda request: httpx.Response(200, json={}))
+    )
+
+    upload = httpx.Request(
+        "POST",
+        "https://api.openai.com/v1/audio/transcriptions",
+        files={"file": ("voice.ogg", io.BytesIO(b"0" * 1000))},
+    )
+    chat = httpx.Request(
+        "POST", "https://api.openai.com/v1/chat/completions", json={"model": "gpt-4"}
+    )
+
+    with measure_requests() as meter:
+        await transport.handle_async_request(upload)
+        await transport.handle_async_request(chat)
+
+    assert meter.requests == 2
+    assert meter.sent_bytes == int(upload.headers["content-length"]) + len(chat.content)
@@ -5,7 +5,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from aerith_cbot.config import LimitsConfig, LLMConfig
 from aerith_cbot.database.models import ChatState
-from aerith_cbot.services.abstractions import VoiceTranscriber
+from aerith_cbot.services.abstractions import SupportService, VoiceTranscriber
 from aerith_cbot.services.abstractions.models import InputMessage
 from aerith_cbot.services.implementations import DefaultLimitsService, DefaultSenderService
 from aerith_cbot.services.implementations.chat_dispatcher import MessageQueue
@@ -51,6 +51,7 @@ async def test_sleeping_chat_ignore(
         llm_config=default_llm_config,
         sender_service=mock_sender_service,
         voice_transcriber=mock_voice_transcriber,
+        support_service=AsyncMock(spec=SupportService),
     )
 
     await private_message_processor.process(default_message_to_process)
@@ -85,6 +86,7 @@ async def test_addding_chat_state_if_none(
         llm_config=default_llm_config,
         sender_service=mock_sender_service,
         voice_transcriber=mock_voice_transcriber,
+        support_service=AsyncMock(spec=SupportService),
     )
 
     await private_message_processor.process(default_message_to_process)
@@ -124,6 +126,7 @@ async def test_adding_message_to_queue(
         llm_config=default_llm_config,
         sender_service=mock_sender_service,
         voice_transcriber=mock_voice_transcriber,
+        support_service=AsyncMock(spec=SupportService),
     )
 
     await private_message_processor.process(default_message_to_process)
@@ -0,0 +1,66 @@
+import json
+
+from aerith_cbot.config import LLMConfig
+from aerith_cbot.services.abstractions.models import ChatType
+from aerith_cbot.services.implementations import PromptCacheStats, RequestTemplates, TokenEstimator
+
+
+def test_templates_are_built_once(default_llm_config: LLMConfig):
+    default_llm_config.tools = [{"type": "function", "function": {"name": "think"}}]
+    default_llm_config.group_tools = [{"type": "function", "function": {"name": "kick_user"}}]
+    default_llm_config.group_instruction = "групповая инструкция"
+
+    templates = RequestTemplates(default_llm_config, TokenEstimator())
+
+    group_template = templates.get(ChatType.group, "gpt-4")
+    assert templates.get(ChatType.group, "gpt-4") is group_template
+    assert templates.get(ChatType.private, "gpt-4") is not group_template
+
+    assert [tool["function"]["name"] for tool in group_template.tools] == ["think", "kick_user"]
+    assert group_template.prefix_tokens > 0
+
+
+def test_template_prefix_is_stable(default_llm_config: LLMConfig):
+    default_llm_config.group_instruction = "инструкция"
+    template = RequestTemplates(default_llm_config, TokenEstimator()).get(ChatType.group, "m")
+
+    history = [{"role": "user", "content": "привет"}]
+    first_request = template.messages(history, [])
+
+    # neither the config nor the lists given out can change the prefix of later requests
+    default_llm_config.group_instruction = "другая инструкция"
+    first_request.clear()
+    template.tools.append({"type": "function"})
+
+    second_request = template.messages(history, [{"role": "assistant", "content": "пока"}])
+    assert second_request[0] == {"role": "developer", "content": "инструкция"}
+    assert json.dumps(second_request[:2]) == json.dumps(template.messages(history))
+    assert template.tools == []
+
+
+def test_cache_stats():
+    stats = PromptCacheStats()
+
+    stats.observe(1, "gpt-4", prompt_tokens=1000, cached_tokens=900)
+    stats.observe(2, "gpt-4", prompt_tokens=1000, cached_tokens=100)
+    stats.observe(2, "gpt-4-mini", prompt_tokens=500, cached_tokens=0)
+
+    models = stats.models()
+    assert models["gpt-4"].ratio == 0.5
+    assert models["gpt-4-mini"].ratio == 0
+
+    chat_usage = stats.chat(2)
+    assert chat_usage is not None
+    assert chat_usage.prompt_tokens == 1500
+    assert [chat_id for chat_id, _ in stats.worst_chats(2)] == [2, 1]
+
+
+def test_cache_stats_keep_recent_chats():
+    stats = PromptCacheStats()
+
+    for chat_id in range(PromptCacheStats.MAX_CHATS + 10):
+        stats.observe(chat_id, "gpt-4", prompt_tokens=10, cached_tokens=5)
+
+    assert stats.chat(0) is None
+    assert stats.chat(PromptCacheStats.MAX_CHATS + 9) is not None
+    assert stats.models()["gpt-4"].prompt_tokens == (PromptCacheStats.MAX_CHATS + 10) * 10
@@ -0,0 +1,368 @@
+import json
+from unittest.mock import AsyncMock, MagicMock
+
+import httpx
+import pytest
+from openai import AsyncOpenAI
+
+from aerith_cbot.config import (
+    LimitsConfig,
+    LoadSheddingConfig,
+    MediaConfig,
+    OpenAIConfig,
+    RateLimitsConfig,
+)
+from aerith_cbot.services.abstractions import SupportService
+from aerith_cbot.services.abstractions.models import ChatType
+from aerith_cbot.services.abstractions.processors import ChatTurn
+from aerith_cbot.services.implementations import (
+    DefaultLimitsService,
+    DefaultUserContextProvider,
+    HistoryCompactor,
+    HistoryValidator,
+    MediaCache,
+    MediaResolver,
+    OpenAIRateLimiter,
+    RateLimitedTransport,
+    RequestTemplates,
+    TokenEstimator,
+)
+from aerith_cbot.services.implementations.processors import DefaultChatProcessor
+from aerith_cbot.services.implementations.processors.response_chain import (
+    to_response_input,
+)
+from aerith_cbot.services.implementations.processors.tools import ToolExecutionResult
+
+ANSWER = '{"text": ["готово"], "reply_to_message_id": null, "sticker": null}'
+
+
+class StubOpenAI:
+    """Both OpenAI APIs over a script of outputs: tool calls, then a text answer
+
+    Like the real Responses API, it keeps the conversations of the responses and rejects
+    continuations of unknown ones and function calls without outputs.
+    """
+
+    def __init__(self, tool_calls: int, keeps_responses: bool = True) -> None:
+        self._tool_calls = tool_calls
+        self._keeps_responses = keeps_responses
+        self._calls = 0
+
+        self.conversations: dict[str, list[dict]] = {}
+        self.requests: list[dict] = []
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        self.requests.append(body)
+
+        if request.url.path.endswith("/chat/completions"):
+            return self._chat_completion(body)
+
+        return self._response(body)
+
+    def _next_output(self) -> tuple[str, str | None]:
+        self._calls += 1
+
+        if self._calls <= self._tool_calls:
+            return "call", f"call_{self._calls}"
+
+        return "answer", None
+
+    def _chat_completion(self, body: dict) -> httpx.Response:
+        kind, call_id = self._next_output()
+
+        message: dict = {"role": "assistant", "content": ANSWER}
+        if kind == "call":
+            message = {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    {
+                        "id": call_id,
+                        "type": "function",
+                        "function": {"name": "test_tool", "arguments": "{}"},
+                    }
+                ],
+            }
+
+        return httpx.Response(
+            200,
+            json={
+                "id": f"chatcmpl-{self._calls}",
+                "object": "chat.completion",
+                "created": 0,
+                "model": body["model"],
+                "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110},
+            },
+        )
+
+    def _response(self, body: dict) -> httpx.Response:
+        previous_response_id = body.get("previous_response_id")
+
+        if previous_response_id is not None and previous_response_id not in self.conversations:
+            return self._error(
+                "previous_response_not_found",
+                f"Previous response with id '{previous_response_id}' not found.",
+            )
+
+        conversation = self.conversations.get(previous_response_id, []) + body["input"]
+
+        call_ids = {item["call_id"] for item in conversation if item.get("type") == "function_call"}
+        output_ids = {
+            item["call_id"] for item in conversation if item.get("type") == "function_call_output"
+        }
+        if call_ids != output_ids:
+            return self._error(None, "No tool output found for function call.")
+
+        kind, call_id = self._next_output()
+        response_id = f"resp_{self._calls}"
+
+        output: dict = {
+            "type": "message",
+            "id": f"msg_{self._calls}",
+            "role": "assistant",
+            "status": "completed",
+            "content": [{"type": "output_text", "text": ANSWER, "annotations": []}],
+        }
+        if kind == "call":
+            output = {
+                "type": "function_call",
+                "id": f"fc_{self._calls}",
+                "call_id": call_id,
+                "name": "test_tool",
+                "arguments": "{}",
+                "status": "completed",
+            }
+
+        if self._keeps_responses:
+            self.conversations[response_id] = conversation + [output]
+
+        return httpx.Response(
+            200,
+            json={
+                "id": response_id,
+                "object": "response",
+                "created_at": 0,
+                "model": body["model"],
+                "status": "completed",
+                "output": [output],
+                "parallel_tool_calls": True,
+                "tool_choice": "auto",
+                "tools": body["tools"],
+                "usage": {
+                    "input_tokens": 100,
+                    "input_tokens_details": {"cached_tokens": 0},
+                    "output_tokens": 10,
+                    "output_tokens_details": {"reasoning_tokens": 0},
+                    "total_tokens": 110,
+                },
+            },
+        )
+
+    def _error(self, code: str | None, message: str) -> httpx.Response:
+        return httpx.Response(
+            400,
+            json={
+                "error": {
+                    "message": message,
+                    "type": "invalid_request_error",
+                    "param": "previous_response_id" if code else "input",
+                    "code": code,
+                }
+            },
+        )
+
+
+def make_history(length: int) -> list[dict]:
+    return [
+        {
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": f"сообщение {i}: " + "как дела, что нового? " * 10,
+        }
+        for i in range(length)
+    ]
+
+
+def make_processor(
+    stub: StubOpenAI, limits_config: LimitsConfig, continue_responses: bool, history: list[dict]
+) -> tuple[DefaultChatProcessor, MagicMock]:
+    token_estimator = TokenEstimator()
+
+    openai_client = AsyncOpenAI(
+        api_key="TOKEN",
+        base_url="http://openai.test/v1",
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            transport=RateLimitedTransport(
+                OpenAIRateLimiter(RateLimitsConfig(), token_estimator),
+                httpx.MockTransport(stub.handle),
+            )
+        ),
+    )
+
+    openai_config = OpenAIConfig(
+        token="TOKEN",
+        group_model="gpt-5",
+        private_model="gpt-5",
+        private_support_model="gpt-5",
+        summarizer_model="gpt-5-nano",
+        memory_llm_model="gpt-5-nano",
+        memory_embedder_model="text-embedding-3-small",
+        continue_responses=continue_responses,
+    )
+
+    llm_config = MagicMock()
+    llm_config.tools = [
+        {
+            "type": "function",
+            "function": {"name": "test_tool", "parameters": {"type": "object"}},
+        }
+    ]
+    llm_config.group_tools = []
+    llm_config.response_schema = {
+        "type": "json_schema",
+        "json_schema": {"name": "response_format", "schema": {"type": "object"}},
+    }
+    llm_config.group_instruction = "Be helpful and concise."
+
+    tool_dispatcher = MagicMock()
+    tool_dispatcher.execute_tool = AsyncMock(return_value=ToolExecutionResult("Tool executed"))
+    tool_dispatcher.is_parallel_safe = MagicMock(return_value=False)
+
+    message_service = MagicMock()
+    message_service.fetch_messages = AsyncMock(return_value=history)
+    message_service.add_messages = AsyncMock()
+
+    limits_service = MagicMock(spec=DefaultLimitsService)
+    limits_service.subtract_group_tokens = AsyncMock()
+
+    model_response_processor = MagicMock()
+    model_response_processor.process = AsyncMock()
+
+    history_compactor = MagicMock(spec=HistoryCompactor)
+    history_compactor.wait = AsyncMock()
+    history_compactor.compact = AsyncMock()
+    history_compactor.is_compacting.return_value = False
+
+    processor = DefaultChatProcessor(
+        openai_client,
+        llm_config,
+        openai_config,
+        tool_dispatcher,
+        message_service,
+        limits_config,
+        MagicMock(spec=DefaultUserContextProvider),
+        limits_service,
+        model_response_processor,
+        MagicMock(spec=SupportService),
+        token_estimator,
+        RequestTemplates(llm_config, token_estimator),
+        LoadSheddingConfig(),
+        history_compactor,
+        HistoryValidator(limits_config),
+        MediaResolver(MagicMock(), MediaCache(MediaConfig()), MediaConfig()),
+    )
+
+    return processor, model_response_processor
+
+
+def test_messages_are_converted_to_response_input():
+    messages = [
+        {"role": "developer", "content": "инструкция"},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "смотри"},
+                {"type": "image_url", "image_url": {"url": "https://a.b/c.jpg", "detail": "low"}},
+            ],
+        },
+        {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [
+                {"id": "call_1", "type": "function", "function": {"name": "f", "arguments": "{}"}}
+            ],
+        },
+        {"role": "tool", "tool_call_id": "call_1", "content": "ok"},
+    ]
+
+    assert to_response_input(messages) == [
+        {"role": "developer", "content": "инструкция"},
+        {
+            "role": "user",
+            "content": [
+                {"type": "input_text", "text": "смотри"},
+                {"type": "input_image", "image_url": "https://a.b/c.jpg", "detail": "low"},
+            ],
+        },
+        {"type": "function_call", "call_id": "call_1", "name": "f", "arguments": "{}"},
+        {"type": "function_call_output", "call_id": "call_1", "output": "ok"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_tool_calls_continue_stored_response(default_limits_config: LimitsConfig):
+    default_limits_config.group_max_context_tokens = 100_000
+
+    stub = StubOpenAI(tool_calls=2)
+    history = make_history(20)
+    processor, model_response_processor = make_processor(stub, default_limits_config, True, history)
+
+    turn = ChatTurn()
+    await processor.process(chat_id=1, chat_type=ChatType.group, turn=turn)
+
+    assert len(stub.requests) == 3
+    assert "previous_response_id" not in stub.requests[0]
+    assert len(stub.requests[0]["input"]) == len(history) + 1
+
+    # only the outputs of the tools go after the first request
+    for i, request in enumerate(stub.requests[1:], start=1):
+        assert request["previous_response_id"] == f"resp_{i}"
+        assert request["input"] == [
+            {"type": "function_call_output", "call_id": f"call_{i}", "output": "Tool executed"}
+        ]
+
+    model_response_processor.process.assert_called_once()
+    assert model_response_processor.process.call_args[0][1] == ANSWER
+    assert turn.llm_calls == 3
+
+
+@pytest.mark.asyncio
+async def test_expired_response_is_replayed(default_limits_config: LimitsConfig):
+    default_limits_config.group_max_context_tokens = 100_000
+
+    stub = StubOpenAI(tool_calls=1, keeps_responses=False)
+    history = make_history(20)
+    processor, model_response_processor = make_processor(stub, default_limits_config, True, history)
+
+    await processor.process(chat_id=1, chat_type=ChatType.group, turn=ChatTurn())
+
+    assert len(stub.requests) == 3
+    # the continuation is rejected, so the whole history is sent again
+    assert stub.requests[1]["previous_response_id"] == "resp_1"
+    assert "previous_response_id" not in stub.requests[2]
+    assert len(stub.requests[2]["input"]) == len(history) + 3
+
+    model_response_processor.process.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_continuation_sends_fewer_bytes(default_limits_config: LimitsConfig):
+    default_limits_config.group_max_context_tokens = 100_000
+
+    sent_bytes = {}
+
+    for continue_responses in (False, True):
+        stub = StubOpenAI(tool_calls=4)
+        processor, _ = make_processor(
+            stub, default_limits_config, continue_responses, make_history(50)
+        )
+
+        turn = ChatTurn()
+        await processor.process(chat_id=1, chat_type=ChatType.group, turn=turn)
+
+        assert len(stub.requests) == 5
+        sent_bytes[continue_responses] = turn.sent_bytes
+
+    assert sent_bytes[True] < sent_bytes[False] / 3
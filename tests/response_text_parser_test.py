@@ -0,0 +1,72 @@
+import itertools
+import json
+import random
+
+from aerith_cbot.utils.streaming import ResponseTextParser
+
+
+def feed_by_chunks(raw: str, chunk_size: int) -> list[str]:
+    parser = ResponseTextParser()
+    texts = []
+
+    for i in range(0, len(raw), chunk_size):
+        parser.feed(raw[i : i + chunk_size])
+        texts.append(parser.text)
+
+    return texts
+
+
+def test_text_grows_while_streamed():
+    raw = json.dumps({"reply_to_message_id": 5, "text": "привет, как дела?", "sticker": None})
+
+    texts = feed_by_chunks(raw, 3)
+
+    assert texts[-1] == "привет, как дела?"
+    for previous, current in itertools.pairwise(texts):
+        assert current.startswith(previous)
+
+
+def test_other_fields_are_known_before_text():
+    parser = ResponseTextParser()
+    parser.feed('{"reply_to_message_id": 42, "text": "hel')
+
+    assert parser.values["reply_to_message_id"] == 42
+    assert parser.text == "hel"
+    assert "sticker" not in parser.values
+
+
+def test_escapes_split_between_chunks():
+    text = 'кавычки "так", слэш \\ перевод\nстроки и эмодзи 😀'
+    raw = json.dumps({"text": text, "sticker": None})
+
+    for chunk_size in range(1, 8):
+        assert feed_by_chunks(raw, chunk_size)[-1] == text
+
+
+def test_random_chunks():
+    rng = random.Random(0)
+
+    for _ in range(100):
+        text = "".join(rng.choice('ab "\\\n\t/юя😀') for _ in range(rng.randint(0, 30)))
+        raw = json.dumps(
+            {"reply_to_message_id": None, "text": text, "sticker": rng.choice([None, "🙂"])},
+            ensure_ascii=rng.random() < 0.5,
+        )
+
+        parser = ResponseTextParser()
+        position = 0
+        while position < len(raw):
+            size = rng.randint(1, 6)
+            parser.feed(raw[position : position + size])
+            position += size
+
+        assert parser.text == text
+        assert parser.values == json.loads(raw)
+
+
+def test_null_text():
+    parser = ResponseTextParser()
+    parser.feed('{"text": null, "sticker": "🙂"}')
+
+    assert parser.text == ""
+    assert parser.values["sticker"] == "🙂"
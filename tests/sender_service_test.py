@@ -198,3 +198,38 @@ async def test_send_text_instead_of_emoji():
 
     mock_db_session.execute.assert_called_once()
     mock_db_session.commit.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_send_streamed_message():
+    mock_db_session = MagicMock(spec=AsyncSession)
+    mock_db_session.execute = AsyncMock()
+    mock_db_session.commit = AsyncMock()
+
+    mock_stickers_service = MagicMock(spec=StickersService)
+
+    mock_bot = MagicMock()
+    mock_bot.send_chat_action = AsyncMock()
+    mock_bot.send_message = AsyncMock(return_value=MagicMock(message_id=7))
+    mock_bot.edit_message_text = AsyncMock()
+
+    send_service = DefaultSenderService(
+        db_session=mock_db_session, stickers_service=mock_stickers_service, bot=mock_bot
+    )
+
+    message_id = await send_service.send_model_response_part(1, "hello", reply_to_message_id=3)
+    assert message_id == 7
+    assert mock_bot.send_message.call_args.kwargs["reply_to_message_id"] == 3
+
+    await send_service.send_model_response_part(1, "hello world", message_id=message_id)
+    assert mock_bot.edit_message_text.call_args.kwargs["parse_mode"] is None
+
+    response = ModelResponse(text="hello **world**", sticker=None, reply_to_message_id=3)
+    await send_service.send_model_response(1, response, streamed_message_id=message_id)
+
+    # the final text replaces the streamed one in the same message
+    assert mock_bot.send_message.call_count == 1
+    assert mock_bot.edit_message_text.call_count == 2
+    assert mock_bot.edit_message_text.call_args.kwargs["message_id"] == 7
+    assert mock_bot.edit_message_text.call_args.kwargs["parse_mode"] == "HTML"
+    mock_bot.send_chat_action.assert_not_called()
@@ -0,0 +1,60 @@
+from aerith_cbot.services.implementations import TokenEstimator
+
+
+def test_estimate_grows_with_content():
+    estimator = TokenEstimator()
+
+    short = estimator.estimate([{"role": "user", "content": "привет"}], [])
+    long = estimator.estimate([{"role": "user", "content": "привет " * 100}], [])
+
+    assert 0 < short < long
+    # cyrillic takes more tokens than the same number of latin characters
+    assert estimator.estimate_text("а" * 120) > estimator.estimate_text("a" * 120)
+
+
+def test_images_and_tools_are_counted():
+    estimator = TokenEstimator()
+
+    text_message = {"role": "user", "content": [{"type": "text", "text": "look"}]}
+    image_message = {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": "look"},
+            {"type": "image_url", "image_url": {"url": "https://x/y.jpg", "detail": "low"}},
+        ],
+    }
+    assert (
+        estimator.estimate_message(image_message) - estimator.estimate_message(text_message)
+        == TokenEstimator.LOW_DETAIL_IMAGE_TOKENS
+    )
+
+    tool = {
+        "type": "function",
+        "function": {
+            "name": "kick_user",
+            "parameters": {"type": "object", "properties": {"user_id": {"type": "integer"}}},
+        },
+    }
+    assert estimator.estimate([text_message], [tool]) > estimator.estimate([text_message], [])
+
+
+def test_observe_corrects_estimates():
+    estimator = TokenEstimator()
+    messages = [{"role": "user", "content": "hello there " * 50}]
+
+    raw_estimate = estimator.estimate(messages, [])
+    actual_tokens = int(raw_estimate * 1.5)
+
+    for _ in range(30):
+        estimator.observe(estimator.estimate(messages, []), actual_tokens)
+
+    assert abs(estimator.estimate(messages, []) - actual_tokens) / actual_tokens < 0.05
+
+
+def test_observe_ignores_outliers():
+    estimator = TokenEstimator()
+
+    for _ in range(50):
+        estimator.observe(100, 100_000)
+
+    assert estimator.correction <= TokenEstimator.MAX_CORRECTION